@@ -0,0 +1,369 @@
+"""
+Interfaz de acceso a datos (Almacen) y lo que comparten sus implementaciones.
+"""
+
+from fastapi import HTTPException
+from typing import Optional, List
+from datetime import date, timedelta
+import json
+import base64
+import binascii
+from abc import ABC, abstractmethod
+
+from modelos import UserRegister, ClienteCreate, VisitaCreate, LineaPresupuesto, PresupuestoCreate
+
+# ============ ALMACÉN DE DATOS ============
+
+class Almacen(ABC):
+    """Interfaz de acceso a datos de los endpoints.
+
+    Los endpoints piden y guardan los datos a través de `almacen` (según
+    DB_BACKEND) y se quedan con lo HTTP: validación, errores, caché e
+    invalidaciones. Los métodos reciben primero el usuario y devuelven dicts
+    (o filas que se leen por nombre de columna) con las columnas de los
+    modelos de respuesta. Otro motor tiene que implementar todos estos métodos.
+    """
+
+    # Usuarios y sesiones
+
+    @abstractmethod
+    def email_registrado(self, email: str) -> bool:
+        ...
+
+    @abstractmethod
+    def insertar_usuario(self, user: UserRegister, password_hash: str) -> Optional[int]:
+        # None si el email ya está registrado
+        ...
+
+    @abstractmethod
+    def buscar_usuario(self, email: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def obtener_usuario(self, user_id: int) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def actualizar_hash(self, user_id: int, password_hash: str):
+        ...
+
+    @abstractmethod
+    def guardar_refresh_token(self, user_id: int, token_hash: str, familia: str, expira: float):
+        ...
+
+    @abstractmethod
+    def renovar_refresh_token(self, token_hash: str, nuevo_hash: str, expira: float, ahora: float) -> tuple:
+        # Gasta el refresh token y guarda el siguiente de la misma sesión, de
+        # forma atómica. Devuelve (estado, fila del token, usuario) con estado
+        # "ok", "caducada" o "reutilizada"; si se reutiliza, revoca la sesión
+        ...
+
+    @abstractmethod
+    def revocar_sesion(self, familia: str):
+        # Invalida los refresh tokens de la sesión y, hasta que caduquen, sus access tokens
+        ...
+
+    @abstractmethod
+    def revocaciones_desde(self, ultimo_id: int, ahora: float) -> list:
+        ...
+
+    @abstractmethod
+    def versiones(self, user_id: int, tablas: tuple) -> dict:
+        ...
+
+    # Clientes, visitas y agenda
+
+    @abstractmethod
+    def listar_clientes(self, user_id: int, q: Optional[str], tipo: Optional[str],
+                        limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+        # Los listados devuelven (filas, total, cursor siguiente o None)
+        ...
+
+    @abstractmethod
+    def obtener_cliente(self, user_id: int, cliente_id: int) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def crear_cliente(self, user_id: int, cliente: ClienteCreate) -> dict:
+        ...
+
+    @abstractmethod
+    def actualizar_cliente(self, user_id: int, cliente_id: int, cliente: ClienteCreate) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def eliminar_cliente(self, user_id: int, cliente_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def listar_visitas(self, user_id: int, fecha: Optional[str], estado: Optional[str], desde: Optional[str],
+                       hasta: Optional[str], limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+        ...
+
+    @abstractmethod
+    def obtener_visita(self, user_id: int, visita_id: int) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def crear_visita(self, user_id: int, visita: VisitaCreate) -> int:
+        ...
+
+    @abstractmethod
+    def actualizar_visita(self, user_id: int, visita_id: int, visita: VisitaCreate) -> bool:
+        ...
+
+    @abstractmethod
+    def cambiar_estado_visita(self, user_id: int, visita_id: int, estado: str, completed_at: Optional[str]) -> bool:
+        ...
+
+    @abstractmethod
+    def completar_visita(self, user_id: int, visita_id: int, firma: Optional[tuple], nombre_firmante: Optional[str],
+                         notas_internas: Optional[str], completed_at: str) -> bool:
+        # `firma` es (mime, contenido) o None
+        ...
+
+    @abstractmethod
+    def eliminar_visita(self, user_id: int, visita_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def datos_pdf_visita(self, user_id: int, visita_id: int) -> dict:
+        ...
+
+    @abstractmethod
+    def agenda(self, user_id: int, desde: str, hasta: str, incluir_visitas: bool) -> list:
+        # Filas en orden de fecha y hora con la columna `conflicto`
+        ...
+
+    # Firmas
+
+    @abstractmethod
+    def info_firma(self, user_id: int, firma_hash: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def trozos_firma(self, user_id: int, firma_id: int, inicio: int, fin: int):
+        # Generador de trozos de [inicio, fin] de los datos guardados (los de
+        # una firma zlib van comprimidos)
+        ...
+
+    # Presupuestos
+
+    @abstractmethod
+    def listar_presupuestos(self, user_id: int, estado: Optional[str], desde: Optional[str], hasta: Optional[str],
+                            incluir_lineas: bool, limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+        ...
+
+    @abstractmethod
+    def presupuestos_cliente(self, user_id: int, cliente_id: int, incluir_lineas: bool) -> List[dict]:
+        ...
+
+    @abstractmethod
+    def obtener_presupuesto(self, user_id: int, presupuesto_id: int) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def datos_pdf_presupuesto(self, user_id: int, presupuesto_id: int) -> dict:
+        ...
+
+    @abstractmethod
+    def crear_presupuesto(self, user_id: int, presupuesto: PresupuestoCreate) -> int:
+        ...
+
+    @abstractmethod
+    def editar_presupuesto(self, user_id: int, presupuesto_id: int, version: int, cambios: dict,
+                           lineas: Optional[List[LineaPresupuesto]]):
+        # Versión, diferencias de líneas y totales en una transacción; 404 o 409
+        ...
+
+    @abstractmethod
+    def cambiar_estado_presupuesto(self, user_id: int, presupuesto_id: int, estado: str,
+                                   fecha_rechazo: Optional[str]) -> bool:
+        ...
+
+    @abstractmethod
+    def eliminar_presupuesto(self, user_id: int, presupuesto_id: int) -> bool:
+        ...
+
+    # Importación y exportación
+
+    @abstractmethod
+    def importar_lote(self, user_id: int, entidad: str, lote: list, errores: list) -> int:
+        # Un lote = una transacción. Devuelve las filas insertadas y apunta en
+        # `errores` las que no: una fila que viola una restricción no tumba
+        # las demás del lote
+        ...
+
+    @abstractmethod
+    def exportar(self, user_id: int, entidad: str):
+        # Generador de bloques de dicts (COLUMNAS_EXPORTACION). Toma la conexión
+        # al empezar a iterar y la devuelve al terminar o al cerrarlo
+        ...
+
+    # Sincronización
+
+    @abstractmethod
+    def leer_cambios_sync(self, user_id: int, desde: int, limite: int) -> tuple:
+        # (reiniciar, mas, cambios, {tabla: registros}) de una misma instantánea
+        ...
+
+    @abstractmethod
+    def transaccion(self):
+        # Context manager: lo que se haga dentro en este hilo va por la misma
+        # conexión; guardar_peticion_sync confirma y deshacer() descarta
+        ...
+
+    @abstractmethod
+    def peticion_sync(self, user_id: int, id_peticion: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def registrar_peticion_sync(self, user_id: int, id_peticion: str):
+        ...
+
+    @abstractmethod
+    def guardar_peticion_sync(self, user_id: int, id_peticion: str, estado: int, resultado: str):
+        ...
+
+    @abstractmethod
+    def deshacer(self):
+        ...
+
+    # Búsqueda, dashboard y analítica
+
+    @abstractmethod
+    def buscar(self, user_id: int, q: str, entidades: set, limite: int) -> dict:
+        # {entidad: filas}, por relevancia
+        ...
+
+    @abstractmethod
+    def contadores(self, user_id: int, claves: List[str]) -> dict:
+        # Claves de resumen_contadores; las que no existen valen 0
+        ...
+
+    @abstractmethod
+    def presupuestos_por_estado(self, user_id: int) -> dict:
+        ...
+
+    @abstractmethod
+    def analitica(self, tabla: str, user_id: int, inicio: date, fin: date, agrupar: str, por: Optional[str]) -> List[dict]:
+        ...
+
+    # Tareas programadas
+
+    @abstractmethod
+    def tareas_programadas(self) -> dict:
+        ...
+
+    @abstractmethod
+    def tomar_tarea(self, nombre: str, propietario: str, forzar: bool) -> bool:
+        ...
+
+    @abstractmethod
+    def ejecutar_tarea(self, nombre: str, funcion, dry_run: bool) -> dict:
+        ...
+
+    @abstractmethod
+    def cerrar_tarea(self, nombre: str, propietario: str, proxima: float, ahora: float, duracion_ms: float,
+                     resultado: str, error: Optional[str]):
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict:
+        ...
+
+    @abstractmethod
+    def close(self):
+        ...
+
+# Columnas que se escriben desde ClienteCreate y VisitaCreate
+CAMPOS_CLIENTE = ("nombre", "apellidos", "email", "telefono", "telefono_secundario", "direccion", "ciudad",
+                  "codigo_postal", "provincia", "tipo", "nif_cif", "notas")
+CAMPOS_VISITA = ("cliente_id", "titulo", "descripcion", "fecha", "hora", "tipo", "estado", "prioridad", "notas_internas")
+
+# ============ FUNCIONES AUXILIARES ============
+
+def calcular_totales(presupuesto: PresupuestoCreate) -> tuple:
+    subtotal = sum(l.cantidad * l.precio_unitario for l in presupuesto.lineas)
+    iva_amount = subtotal * (presupuesto.iva_porcentaje / 100) if presupuesto.aplicar_iva else 0
+    return subtotal, iva_amount, subtotal + iva_amount
+
+def codificar_cursor(valores: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(valores).encode()).decode().rstrip("=")
+
+def decodificar_cursor(token: str, n_valores: int) -> list:
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if not isinstance(valores, list) or len(valores) != n_valores:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return valores
+
+def lista_estados(estado: str) -> List[str]:
+    # Admite varios estados separados por comas: ?estado=pendiente,confirmada
+    return [e for e in estado.split(",") if e]
+
+def diferencias_lineas(guardadas: dict, enviadas: List[LineaPresupuesto]) -> tuple:
+    # Compara las líneas enviadas con las guardadas ({id: fila}) y devuelve solo
+    # lo que cambia: (altas, modificaciones, bajas). Una línea sin id es nueva,
+    # una guardada que no llega se borra y el orden es la posición en la lista
+    altas, modificaciones, conservadas = [], [], set()
+    for orden, linea in enumerate(enviadas):
+        valores = (linea.concepto, linea.descripcion, linea.cantidad, linea.precio_unitario, orden)
+        if linea.id is None:
+            altas.append(valores)
+            continue
+        if linea.id not in guardadas or linea.id in conservadas:
+            raise HTTPException(status_code=400, detail=f"La línea {linea.id} no pertenece al presupuesto")
+        conservadas.add(linea.id)
+        if tuple(guardadas[linea.id]) != valores:
+            modificaciones.append((*valores, linea.id))
+    bajas = [(linea_id,) for linea_id in guardadas if linea_id not in conservadas]
+    return altas, modificaciones, bajas
+
+# Columnas de cada entidad en la exportación; las líneas van dentro de cada presupuesto
+COLUMNAS_EXPORTACION = {
+    "clientes": ["id", "nombre", "apellidos", "email", "telefono", "telefono_secundario", "direccion",
+                 "ciudad", "codigo_postal", "provincia", "tipo", "nif_cif", "notas", "created_at"],
+    "visitas": ["id", "cliente_id", "titulo", "descripcion", "fecha", "hora", "tipo", "estado", "prioridad",
+                "notas_internas", "firma_hash", "nombre_firmante", "created_at", "completed_at"],
+    "presupuestos": ["id", "cliente_id", "numero", "titulo", "descripcion", "subtotal", "iva_porcentaje",
+                     "aplicar_iva", "iva_amount", "total", "estado", "fecha_emision", "fecha_validez",
+                     "fecha_rechazo", "notas", "created_at"],
+}
+
+CAMPOS_LINEA = ["concepto", "descripcion", "cantidad", "precio_unitario"]
+
+# ============ ANALÍTICA (TRAMOS) ============
+
+def tramos_rollup(inicio: date, fin: date) -> tuple:
+    # Parte [inicio, fin] en meses completos (AAAA-MM desde/hasta, o None) y
+    # los tramos de días sueltos de los extremos
+    primer_mes = inicio if inicio.day == 1 else (inicio.replace(day=28) + timedelta(days=4)).replace(day=1)
+    fin_meses = fin if (fin + timedelta(days=1)).day == 1 else fin.replace(day=1) - timedelta(days=1)
+    if primer_mes > fin_meses:
+        return None, [(inicio, fin)]
+    dias = []
+    if inicio < primer_mes:
+        dias.append((inicio, primer_mes - timedelta(days=1)))
+    if fin_meses < fin:
+        dias.append((fin_meses + timedelta(days=1), fin))
+    return (primer_mes.isoformat()[:7], fin_meses.isoformat()[:7]), dias
+
+def tramos_analitica(inicio: date, fin: date, agrupar: str) -> list:
+    # (granularidad, desde, hasta) de las filas de rollup que cubren el rango.
+    # Agrupado por día solo sirven las filas diarias; por mes, las mensuales
+    # cubren los meses completos y las diarias el resto
+    if agrupar == "dia":
+        return [("d", inicio.isoformat(), fin.isoformat())]
+    meses, dias = tramos_rollup(inicio, fin)
+    tramos = [("m", *meses)] if meses else []
+    return tramos + [("d", desde_dia.isoformat(), hasta_dia.isoformat()) for desde_dia, hasta_dia in dias]
+
+# Desglose de cada rollup (`por`): columna, nombre y join para el nombre
+DESGLOSES_ROLLUP = {
+    "analitica_presupuestos": ("cliente_id", "c.nombre || ' ' || COALESCE(c.apellidos, '') AS cliente_nombre",
+                               "LEFT JOIN clientes c ON c.id = a.cliente_id"),
+    "analitica_visitas": ("tipo",),
+}
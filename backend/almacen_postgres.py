@@ -0,0 +1,1941 @@
+"""
+Almacén PostgreSQL (DB_BACKEND=postgres) con asyncpg. main solo lo importa
+con ese DB_BACKEND, así que una instalación solo SQLite no necesita asyncpg.
+"""
+
+from fastapi import HTTPException
+from typing import Optional, List
+from datetime import date, datetime, timedelta
+from concurrent.futures import Future
+import asyncio
+import asyncpg
+import contextvars
+import hashlib
+import sqlite3
+import os
+import re
+import threading
+import time
+import functools
+from contextlib import asynccontextmanager, contextmanager
+
+from config import (
+    logger, ACCESS_TOKEN_EXPIRE_MINUTES, DATABASE_URL, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_STATEMENT_CACHE,
+    DB_SHARDING, EXPORT_CHUNK_SIZE, FIRMA_CHUNK_SIZE, SYNC_TOMBSTONE_DAYS, SYNC_REQUEST_DAYS,
+    SCHEDULER_LOCK_SECONDS, REJECTED_RETENTION_DAYS, PURGE_BATCH_SIZE, METRICS_ENABLED
+)
+from metricas import registrar_consulta
+from modelos import (
+    UserRegister, ClienteCreate, ClienteResponse, VisitaCreate, VisitaResponse, LineaPresupuesto,
+    PresupuestoCreate, PresupuestoResponse, filas_respuesta
+)
+from cache import invalidar_cache
+from almacen import (
+    calcular_totales, codificar_cursor, decodificar_cursor, lista_estados, Almacen, CAMPOS_CLIENTE, CAMPOS_VISITA,
+    diferencias_lineas, COLUMNAS_EXPORTACION, CAMPOS_LINEA, tramos_analitica, DESGLOSES_ROLLUP
+)
+# Tablas, contadores, rollups y firmas se definen una vez, junto al almacén SQLite
+from almacen_sqlite import (
+    PoolAgotado, SQL_RESUMEN_CALCULADO, sql_reconstruir_resumen, comparar_contadores, GRANULARIDADES, ROLLUPS,
+    claves_rollup, sql_reconstruir_analitica, sql_diferencias_analitica, codificar_firma, leer_contenido_firma,
+    INDICES_BUSQUEDA, BUSQUEDA_MAX_TERMINOS, TABLAS_SYNC, SQL_INDICES_PRESUPUESTOS, valores_campos,
+    MODELOS_RESPUESTA, limpiar_cache_pdf
+)
+
+# ============ ALMACÉN POSTGRESQL ============
+
+# Con DB_BACKEND=postgres los datos viven en DATABASE_URL y pueden atenderlos
+# varias réplicas del backend a la vez. asyncpg es asíncrono y los endpoints
+# de datos son síncronos (threadpool o DBExecutor): su pool vive en un event
+# loop propio, en un hilo, y cada método del almacén encola allí su corrutina
+# y espera el resultado. Versiones, registro de cambios, resumen_contadores y
+# los rollups de analítica los mantienen triggers por sentencia. Las listas
+# sin límite se leen con un cursor de servidor y la importación va con COPY.
+
+# pg_advisory_lock de dos claves: no coincide con los bloqueos por usuario
+# (una clave) de marcar_cambios()
+POSTGRES_BLOQUEO_MIGRACIONES = (0x7465636E, 1)
+POSTGRES_BLOQUEO_REVOCACIONES = (0x7465636E, 2)
+
+# Sin extensiones (unaccent) para no depender de permisos de superusuario
+_CON_ACENTO = "áàäâãéèëêíìïîóòöôõúùüûñçÁÀÄÂÃÉÈËÊÍÌÏÎÓÒÖÔÕÚÙÜÛÑÇ"
+_SIN_ACENTO = "aaaaaeeeeiiiiooooouuuuncAAAAAEEEEIIIIOOOOOUUUUNC"
+
+# Peso de bm25 en INDICES_BUSQUEDA -> peso de tsvector (ts_rank: D, C, B, A)
+PESOS_TSVECTOR = {10: "A", 5: "B", 2: "C", 1: "D"}
+SQL_PESOS_RANKING = "'{0.1, 0.2, 0.5, 1.0}'"
+
+# Columnas de cada tabla (sin `busqueda`): las consultas no usan SELECT *
+COLUMNAS_POSTGRES = {
+    "usuarios": ("id", "nombre", "apellidos", "email", "telefono", "empresa", "password_hash", "created_at"),
+    "clientes": ("id", "usuario_id", *CAMPOS_CLIENTE, "created_at"),
+    "visitas": ("id", "usuario_id", *CAMPOS_VISITA, "firma_hash", "nombre_firmante", "created_at", "completed_at",
+                "version"),
+    "presupuestos": ("id", "usuario_id", "cliente_id", "numero", "titulo", "descripcion", "subtotal", "iva_porcentaje",
+                     "aplicar_iva", "iva_amount", "total", "estado", "fecha_emision", "fecha_validez", "fecha_rechazo",
+                     "notas", "created_at", "version"),
+    "lineas_presupuesto": ("id", "presupuesto_id", "concepto", "descripcion", "cantidad", "precio_unitario", "total",
+                           "orden"),
+}
+
+def columnas_postgres(tabla: str, alias: str = "") -> str:
+    return ", ".join(f"{alias}{columna}" for columna in COLUMNAS_POSTGRES[tabla])
+
+def _sql_vector_busqueda(entidad: str) -> str:
+    _, _, pesos = INDICES_BUSQUEDA[entidad]
+    return " || ".join(
+        f"setweight(to_tsvector('simple', sin_acentos(COALESCE({columna}, ''))), '{PESOS_TSVECTOR[peso]}')"
+        for columna, peso in pesos.items()
+    )
+
+def _sql_trigger_postgres(tabla: str, funcion: str, operacion: str) -> str:
+    # Trigger por sentencia: las filas afectadas llegan en `nuevas` / `viejas`
+    transicion = {
+        "insert": "NEW TABLE AS nuevas",
+        "update": "OLD TABLE AS viejas NEW TABLE AS nuevas",
+        "delete": "OLD TABLE AS viejas",
+    }[operacion]
+    return f"""CREATE TRIGGER trg_{funcion}_{operacion} AFTER {operacion.upper()} ON {tabla}
+        REFERENCING {transicion} FOR EACH STATEMENT EXECUTE FUNCTION {funcion}()"""
+
+# resumen_contadores y los rollups, como en SQLite: las filas de la sentencia
+# con su signo (las nuevas suman y las viejas restan) se agregan por clave y
+# se suman a lo guardado. Los triggers de resumen van detrás de los de
+# registrar_cambios (orden alfabético), que ya han bloqueado a los usuarios
+FILAS_CON_SIGNO_POSTGRES = {
+    "INSERT": "(SELECT *, 1 AS signo FROM nuevas)",
+    "UPDATE": "(SELECT *, -1 AS signo FROM viejas UNION ALL SELECT *, 1 AS signo FROM nuevas)",
+    "DELETE": "(SELECT *, -1 AS signo FROM viejas)",
+}
+
+# Claves de resumen_contadores de cada fila (las de SQL_RESUMEN_CALCULADO):
+# tabla -> [(clave, valor, condición)] sobre la fila `f`
+CONTADORES_POSTGRES = {
+    "clientes": [("'clientes'", "1", "true")],
+    "visitas": [
+        ("'visitas:estado:' || COALESCE(f.estado, '')", "1", "true"),
+        ("'visitas:fecha:' || f.fecha", "1", "true"),
+    ],
+    "presupuestos": [
+        ("'presupuestos:estado:' || COALESCE(f.estado, '')", "1", "true"),
+        ("'facturacion:' || substr(f.fecha_emision, 1, 7)", "COALESCE(f.total, 0)",
+         "f.estado = 'aceptado' AND f.fecha_emision IS NOT NULL"),
+    ],
+}
+
+def _sql_sumar_contadores_postgres(origen: str, filas: str) -> str:
+    # Las claves que se quedan igual (un UPDATE de otra columna) no se tocan
+    partes = " UNION ALL ".join(
+        f"SELECT f.usuario_id, {clave} AS clave, f.signo * {valor} AS valor FROM {filas} f WHERE {condicion}"
+        for clave, valor, condicion in CONTADORES_POSTGRES[origen]
+    )
+    return f"""INSERT INTO resumen_contadores (usuario_id, clave, valor)
+            SELECT usuario_id, clave, SUM(valor) FROM ({partes}) c
+            GROUP BY 1, 2 HAVING SUM(valor) <> 0 ORDER BY 1, 2
+            ON CONFLICT (usuario_id, clave) DO UPDATE SET valor = resumen_contadores.valor + excluded.valor"""
+
+def _sql_sumar_rollup_postgres(tabla: str, filas: str) -> str:
+    _, fecha, _, metricas = ROLLUPS[tabla]
+    partes = []
+    for granularidad in GRANULARIDADES:
+        columnas = [f"{e} AS {c}" for c, e in claves_rollup(tabla, "f", granularidad).items()]
+        columnas += [f"f.signo * {e.replace('{fila}', 'f')} AS {m}" for m, e in metricas.items()]
+        partes.append(f"SELECT {', '.join(columnas)} FROM {filas} f WHERE f.{fecha} IS NOT NULL")
+    claves = list(claves_rollup(tabla, "f", "d"))
+    posiciones = ", ".join(str(n) for n in range(1, len(claves) + 1))
+    return f"""INSERT INTO {tabla} ({', '.join([*claves, *metricas])})
+            SELECT {', '.join(claves)}, {', '.join(f'SUM({m})' for m in metricas)}
+            FROM ({' UNION ALL '.join(partes)}) r
+            GROUP BY {posiciones} HAVING {' OR '.join(f'SUM({m}) <> 0' for m in metricas)} ORDER BY {posiciones}
+            ON CONFLICT ({', '.join(claves)}) DO UPDATE SET {', '.join(f'{m} = {tabla}.{m} + excluded.{m}' for m in metricas)}"""
+
+def _sql_limpiar_rollup_postgres(tabla: str, filas: str) -> str:
+    # Las filas de las que se ha restado y se quedan sin elementos sobran
+    _, fecha, _, metricas = ROLLUPS[tabla]
+    claves = list(claves_rollup(tabla, "f", "d"))
+    partes = [
+        f"SELECT {', '.join(f'{e} AS {c}' for c, e in claves_rollup(tabla, 'f', granularidad).items())} "
+        f"FROM {filas} f WHERE f.signo = -1 AND f.{fecha} IS NOT NULL"
+        for granularidad in GRANULARIDADES
+    ]
+    return f"""DELETE FROM {tabla} t USING ({' UNION '.join(partes)}) k
+            WHERE {' AND '.join(f't.{c} = k.{c}' for c in claves)} AND t.{next(iter(metricas))} = 0"""
+
+def _sql_funcion_resumen_postgres(origen: str) -> str:
+    ramas = []
+    for operacion, filas in FILAS_CON_SIGNO_POSTGRES.items():
+        sentencias = [_sql_sumar_contadores_postgres(origen, filas)]
+        for tabla, (tabla_origen, *_) in ROLLUPS.items():
+            if tabla_origen == origen:
+                sentencias.append(_sql_sumar_rollup_postgres(tabla, filas))
+                if operacion != "INSERT":
+                    sentencias.append(_sql_limpiar_rollup_postgres(tabla, filas))
+        ramas.append(f"{'ELSIF' if ramas else 'IF'} TG_OP = '{operacion}' THEN\n"
+                     + "".join(f"            {sql};\n" for sql in sentencias))
+    return f"""CREATE OR REPLACE FUNCTION resumen_{origen}() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        {'        '.join(ramas)}        END IF;
+        RETURN NULL;
+    END $$"""
+
+SQL_FUNCIONES_POSTGRES = [
+    # Mismo formato que CURRENT_TIMESTAMP en SQLite (UTC, texto)
+    """CREATE OR REPLACE FUNCTION marca_tiempo() RETURNS text LANGUAGE sql STABLE AS $$
+        SELECT to_char(statement_timestamp() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')
+    $$""",
+    f"""CREATE OR REPLACE FUNCTION sin_acentos(texto text) RETURNS text LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT translate(texto, '{_CON_ACENTO}', '{_SIN_ACENTO}')
+    $$""",
+    # Versión de los datos (ETag) y registro de cambios (sync) de los registros
+    # indicados. Los usuarios se bloquean uno a uno y en orden hasta el commit:
+    # así el `seq` de cada usuario crece en el orden en que se confirman sus
+    # cambios y un cursor nunca se salta uno todavía sin confirmar
+    """CREATE OR REPLACE FUNCTION marcar_cambios(tabla_sync text, tabla_version text, usuarios bigint[],
+                                                registros bigint[], es_borrado boolean)
+    RETURNS void LANGUAGE plpgsql AS $$
+    DECLARE
+        u bigint;
+    BEGIN
+        FOR u IN SELECT DISTINCT x FROM unnest(usuarios) AS x WHERE x IS NOT NULL ORDER BY 1 LOOP
+            PERFORM pg_advisory_xact_lock(u);
+        END LOOP;
+        IF tabla_version IS NOT NULL THEN
+            INSERT INTO versiones_datos (usuario_id, tabla, version)
+            SELECT DISTINCT x, tabla_version, 1 FROM unnest(usuarios) AS x WHERE x IS NOT NULL
+            ON CONFLICT (usuario_id, tabla) DO UPDATE SET version = versiones_datos.version + 1;
+        END IF;
+        IF tabla_sync IS NOT NULL THEN
+            INSERT INTO cambios_sync (usuario_id, tabla, registro_id, borrado)
+            SELECT DISTINCT t.usuario_id, tabla_sync, t.registro_id, es_borrado
+            FROM unnest(usuarios, registros) AS t(usuario_id, registro_id)
+            WHERE t.usuario_id IS NOT NULL AND t.registro_id IS NOT NULL
+            ON CONFLICT (usuario_id, tabla, registro_id) DO UPDATE SET
+                seq = excluded.seq, borrado = excluded.borrado, fecha = excluded.fecha;
+        END IF;
+    END $$""",
+    """CREATE OR REPLACE FUNCTION registrar_cambios() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM marcar_cambios(TG_TABLE_NAME, TG_TABLE_NAME, array_agg(usuario_id), array_agg(id), true) FROM viejas;
+            RETURN NULL;
+        END IF;
+        PERFORM marcar_cambios(TG_TABLE_NAME, TG_TABLE_NAME, array_agg(usuario_id), array_agg(id), false) FROM nuevas;
+        IF TG_OP = 'UPDATE' THEN
+            -- El dueño anterior, si cambia, también ve cambiar la tabla
+            PERFORM marcar_cambios(NULL, TG_TABLE_NAME, array_agg(v.usuario_id), NULL, false)
+            FROM viejas v JOIN nuevas n ON n.id = v.id WHERE n.usuario_id IS DISTINCT FROM v.usuario_id;
+        END IF;
+        RETURN NULL;
+    END $$""",
+    # Las líneas viajan dentro de su presupuesto: tocarlas lo marca como cambiado
+    """CREATE OR REPLACE FUNCTION registrar_cambios_lineas() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM marcar_cambios('presupuestos', 'presupuestos', array_agg(p.usuario_id), array_agg(p.id), false)
+            FROM presupuestos p WHERE p.id IN (SELECT presupuesto_id FROM nuevas);
+        ELSIF TG_OP = 'UPDATE' THEN
+            PERFORM marcar_cambios('presupuestos', 'presupuestos', array_agg(p.usuario_id), array_agg(p.id), false)
+            FROM presupuestos p
+            WHERE p.id IN (SELECT presupuesto_id FROM nuevas UNION SELECT presupuesto_id FROM viejas);
+        ELSE
+            PERFORM marcar_cambios('presupuestos', 'presupuestos', array_agg(p.usuario_id), array_agg(p.id), false)
+            FROM presupuestos p WHERE p.id IN (SELECT presupuesto_id FROM viejas);
+        END IF;
+        RETURN NULL;
+    END $$""",
+    # Visitas y presupuestos llevan copiados nombre, teléfono y dirección del
+    # cliente: si cambian, también cuentan como cambiados
+    """CREATE OR REPLACE FUNCTION registrar_cambios_dependientes() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM marcar_cambios('visitas', NULL, array_agg(v.usuario_id), array_agg(v.id), false)
+        FROM nuevas n JOIN viejas o ON o.id = n.id
+        JOIN visitas v ON v.cliente_id = n.id AND v.usuario_id = n.usuario_id
+        WHERE (n.nombre, n.apellidos, n.telefono, n.direccion, n.ciudad)
+              IS DISTINCT FROM (o.nombre, o.apellidos, o.telefono, o.direccion, o.ciudad);
+        PERFORM marcar_cambios('presupuestos', NULL, array_agg(p.usuario_id), array_agg(p.id), false)
+        FROM nuevas n JOIN viejas o ON o.id = n.id
+        JOIN presupuestos p ON p.usuario_id = n.usuario_id AND p.cliente_id = n.id
+        WHERE (n.nombre, n.apellidos, n.telefono, n.direccion, n.ciudad)
+              IS DISTINCT FROM (o.nombre, o.apellidos, o.telefono, o.direccion, o.ciudad);
+        RETURN NULL;
+    END $$""",
+    # Borra las firmas que ninguna visita referencia ya
+    """CREATE OR REPLACE FUNCTION purgar_firmas() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM firmas f
+        WHERE f.hash IN (SELECT firma_hash FROM viejas WHERE firma_hash IS NOT NULL)
+          AND NOT EXISTS (SELECT 1 FROM visitas v WHERE v.firma_hash = f.hash);
+        RETURN NULL;
+    END $$""",
+]
+
+# Mismo esquema que SQLite con los tipos de PostgreSQL. Las columnas que se
+# ordenan o comparan por rangos de texto usan COLLATE "C", como el BINARY de
+# SQLite; `busqueda` es el tsvector de los campos de INDICES_BUSQUEDA
+MIGRACIONES_POSTGRES = [
+    (1, "Esquema inicial", [
+        *SQL_FUNCIONES_POSTGRES,
+        """CREATE TABLE usuarios (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            apellidos TEXT,
+            email TEXT UNIQUE NOT NULL,
+            telefono TEXT,
+            empresa TEXT,
+            password_hash TEXT NOT NULL,
+            created_at TEXT DEFAULT marca_tiempo()
+        )""",
+        f"""CREATE TABLE clientes (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            usuario_id BIGINT NOT NULL,
+            nombre TEXT COLLATE "C" NOT NULL,
+            apellidos TEXT,
+            email TEXT,
+            telefono TEXT NOT NULL,
+            telefono_secundario TEXT,
+            direccion TEXT,
+            ciudad TEXT,
+            codigo_postal TEXT,
+            provincia TEXT,
+            tipo TEXT DEFAULT 'particular',
+            nif_cif TEXT,
+            notas TEXT,
+            created_at TEXT COLLATE "C" DEFAULT marca_tiempo(),
+            busqueda tsvector GENERATED ALWAYS AS ({_sql_vector_busqueda("clientes")}) STORED
+        )""",
+        f"""CREATE TABLE visitas (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            usuario_id BIGINT NOT NULL,
+            cliente_id BIGINT NOT NULL,
+            titulo TEXT NOT NULL,
+            descripcion TEXT,
+            fecha TEXT COLLATE "C" NOT NULL,
+            hora TEXT COLLATE "C",
+            tipo TEXT DEFAULT 'reparacion',
+            estado TEXT DEFAULT 'pendiente',
+            prioridad TEXT DEFAULT 'normal',
+            notas_internas TEXT,
+            firma_hash TEXT,
+            nombre_firmante TEXT,
+            created_at TEXT COLLATE "C" DEFAULT marca_tiempo(),
+            completed_at TEXT,
+            version INTEGER NOT NULL DEFAULT 1,
+            busqueda tsvector GENERATED ALWAYS AS ({_sql_vector_busqueda("visitas")}) STORED
+        )""",
+        f"""CREATE TABLE presupuestos (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            usuario_id BIGINT NOT NULL,
+            cliente_id BIGINT NOT NULL,
+            numero TEXT NOT NULL,
+            titulo TEXT NOT NULL,
+            descripcion TEXT,
+            subtotal DOUBLE PRECISION DEFAULT 0,
+            iva_porcentaje DOUBLE PRECISION DEFAULT 21,
+            aplicar_iva BOOLEAN DEFAULT true,
+            iva_amount DOUBLE PRECISION DEFAULT 0,
+            total DOUBLE PRECISION DEFAULT 0,
+            estado TEXT DEFAULT 'borrador',
+            fecha_emision TEXT COLLATE "C",
+            fecha_validez TEXT,
+            fecha_rechazo TEXT COLLATE "C",
+            notas TEXT,
+            created_at TEXT COLLATE "C" DEFAULT marca_tiempo(),
+            version INTEGER NOT NULL DEFAULT 1,
+            busqueda tsvector GENERATED ALWAYS AS ({_sql_vector_busqueda("presupuestos")}) STORED,
+            UNIQUE (usuario_id, numero)
+        )""",
+        f"""CREATE TABLE lineas_presupuesto (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            presupuesto_id BIGINT NOT NULL REFERENCES presupuestos (id) ON DELETE CASCADE,
+            concepto TEXT NOT NULL,
+            descripcion TEXT,
+            cantidad DOUBLE PRECISION DEFAULT 1,
+            precio_unitario DOUBLE PRECISION DEFAULT 0,
+            total DOUBLE PRECISION DEFAULT 0,
+            orden INTEGER DEFAULT 0,
+            busqueda tsvector GENERATED ALWAYS AS ({_sql_vector_busqueda("lineas")}) STORED
+        )""",
+        # Las firmas ya van comprimidas cuando compensa: sin TOAST comprimido,
+        # substring() lee solo los trozos pedidos
+        """CREATE TABLE firmas (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            hash TEXT UNIQUE NOT NULL,
+            mime TEXT NOT NULL,
+            codificacion TEXT NOT NULL,
+            tamano INTEGER NOT NULL,
+            datos BYTEA NOT NULL,
+            created_at TEXT DEFAULT marca_tiempo()
+        )""",
+        "ALTER TABLE firmas ALTER COLUMN datos SET STORAGE EXTERNAL",
+        """CREATE TABLE secuencias_presupuesto (
+            usuario_id BIGINT NOT NULL,
+            anio INTEGER NOT NULL,
+            ultimo INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, anio)
+        )""",
+        """CREATE TABLE refresh_tokens (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            usuario_id BIGINT NOT NULL,
+            token_hash TEXT UNIQUE NOT NULL,
+            familia TEXT NOT NULL,
+            expira DOUBLE PRECISION NOT NULL,
+            usado_at DOUBLE PRECISION,
+            revocado_at DOUBLE PRECISION,
+            created_at TEXT DEFAULT marca_tiempo()
+        )""",
+        """CREATE TABLE tokens_revocados (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            clave TEXT UNIQUE NOT NULL,
+            expira DOUBLE PRECISION NOT NULL
+        )""",
+        """CREATE TABLE tareas_programadas (
+            nombre TEXT PRIMARY KEY,
+            proxima DOUBLE PRECISION NOT NULL DEFAULT 0,
+            propietario TEXT,
+            bloqueada_hasta DOUBLE PRECISION,
+            ultima_ejecucion DOUBLE PRECISION,
+            ultima_duracion_ms DOUBLE PRECISION,
+            ultimo_resultado TEXT,
+            ultimo_error TEXT,
+            ejecuciones INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE versiones_datos (
+            usuario_id BIGINT NOT NULL,
+            tabla TEXT NOT NULL,
+            version BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, tabla)
+        )""",
+        """CREATE TABLE cambios_sync (
+            seq BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            usuario_id BIGINT NOT NULL,
+            tabla TEXT NOT NULL,
+            registro_id BIGINT NOT NULL,
+            borrado BOOLEAN NOT NULL DEFAULT false,
+            fecha TEXT COLLATE "C" DEFAULT marca_tiempo(),
+            UNIQUE (usuario_id, tabla, registro_id)
+        )""",
+        """CREATE TABLE sync_horizonte (
+            usuario_id BIGINT PRIMARY KEY,
+            seq BIGINT NOT NULL
+        )""",
+        """CREATE TABLE peticiones_sync (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            usuario_id BIGINT NOT NULL,
+            id_peticion TEXT NOT NULL,
+            estado INTEGER,
+            resultado TEXT,
+            created_at TEXT COLLATE "C" DEFAULT marca_tiempo(),
+            UNIQUE (usuario_id, id_peticion)
+        )""",
+        "CREATE INDEX idx_clientes_usuario_nombre ON clientes (usuario_id, nombre, id)",
+        "CREATE INDEX idx_visitas_usuario_fecha_hora ON visitas (usuario_id, fecha, hora)",
+        "CREATE INDEX idx_visitas_usuario_estado ON visitas (usuario_id, estado)",
+        "CREATE INDEX idx_visitas_cliente ON visitas (cliente_id)",
+        "CREATE INDEX idx_visitas_firma ON visitas (firma_hash, usuario_id) WHERE firma_hash IS NOT NULL",
+        *SQL_INDICES_PRESUPUESTOS,
+        "CREATE INDEX idx_presupuestos_usuario_emision ON presupuestos (usuario_id, fecha_emision)",
+        "CREATE INDEX idx_presupuestos_rechazo ON presupuestos (fecha_rechazo) WHERE estado = 'rechazado'",
+        "CREATE INDEX idx_lineas_presupuesto_orden ON lineas_presupuesto (presupuesto_id, orden)",
+        "CREATE INDEX idx_refresh_tokens_familia ON refresh_tokens (familia)",
+        "CREATE INDEX idx_cambios_sync_usuario_seq ON cambios_sync (usuario_id, seq)",
+        "CREATE INDEX idx_cambios_sync_borrados ON cambios_sync (fecha) WHERE borrado",
+        "CREATE INDEX idx_peticiones_sync_created ON peticiones_sync (created_at)",
+        *[f"CREATE INDEX idx_{tabla}_busqueda ON {tabla} USING gin (busqueda)"
+          for tabla in ("clientes", "visitas", "presupuestos", "lineas_presupuesto")],
+        *[_sql_trigger_postgres(tabla, "registrar_cambios", operacion).replace(
+              "trg_registrar_cambios_", f"trg_registrar_cambios_{tabla}_")
+          for tabla in TABLAS_SYNC for operacion in ("insert", "update", "delete")],
+        *[_sql_trigger_postgres("lineas_presupuesto", "registrar_cambios_lineas", operacion)
+          for operacion in ("insert", "update", "delete")],
+        _sql_trigger_postgres("clientes", "registrar_cambios_dependientes", "update"),
+        _sql_trigger_postgres("visitas", "purgar_firmas", "update"),
+        _sql_trigger_postgres("visitas", "purgar_firmas", "delete"),
+    ]),
+    (2, "Contadores y agregados de analítica mantenidos por triggers", [
+        """CREATE TABLE resumen_contadores (
+            usuario_id BIGINT NOT NULL,
+            clave TEXT COLLATE "C" NOT NULL,
+            valor DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, clave)
+        )""",
+        """CREATE TABLE analitica_presupuestos (
+            usuario_id BIGINT NOT NULL,
+            granularidad TEXT NOT NULL,
+            periodo TEXT COLLATE "C" NOT NULL,
+            cliente_id BIGINT NOT NULL,
+            emitidos INTEGER NOT NULL DEFAULT 0,
+            aceptados INTEGER NOT NULL DEFAULT 0,
+            rechazados INTEGER NOT NULL DEFAULT 0,
+            importe DOUBLE PRECISION NOT NULL DEFAULT 0,
+            facturado DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, granularidad, periodo, cliente_id)
+        )""",
+        """CREATE TABLE analitica_visitas (
+            usuario_id BIGINT NOT NULL,
+            granularidad TEXT NOT NULL,
+            periodo TEXT COLLATE "C" NOT NULL,
+            tipo TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            completadas INTEGER NOT NULL DEFAULT 0,
+            canceladas INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, granularidad, periodo, tipo)
+        )""",
+        *[_sql_funcion_resumen_postgres(origen) for origen in CONTADORES_POSTGRES],
+        *[_sql_trigger_postgres(origen, f"resumen_{origen}", operacion)
+          for origen in CONTADORES_POSTGRES for operacion in ("insert", "update", "delete")],
+        *sql_reconstruir_resumen(),
+        *sql_reconstruir_analitica(),
+    ]),
+]
+
+SQL_EMISOR_PDF_POSTGRES = "SELECT nombre, apellidos, empresa, email, telefono FROM usuarios WHERE id = $1"
+
+SQL_COLUMNAS_VISITA_POSTGRES = f"""{columnas_postgres("visitas", "v.")},
+    c.nombre || ' ' || COALESCE(c.apellidos, '') AS cliente_nombre,
+    c.telefono AS cliente_telefono, c.direccion || ', ' || c.ciudad AS cliente_direccion,
+    v.firma_hash IS NOT NULL AS tiene_firma"""
+
+# dias_para_eliminar se calcula al leer (dias_para_eliminar())
+SQL_COLUMNAS_PRESUPUESTO_POSTGRES = f"""{columnas_postgres("presupuestos", "p.")},
+    c.nombre || ' ' || COALESCE(c.apellidos, '') AS cliente_nombre"""
+
+SQL_CONFLICTO_VISITA_POSTGRES = """COALESCE(v.hora, '') <> '' AND COALESCE(v.estado, '') <> 'cancelada'
+    AND COUNT(*) FILTER (WHERE COALESCE(v.estado, '') <> 'cancelada') OVER (PARTITION BY v.fecha, v.hora) > 1 AS conflicto"""
+
+SQL_REGISTROS_SYNC_POSTGRES = {
+    "clientes": f"SELECT {columnas_postgres('clientes')} FROM clientes WHERE usuario_id = $1 AND id = ANY($2::bigint[])",
+    "visitas": f"""SELECT {SQL_COLUMNAS_VISITA_POSTGRES}
+        FROM visitas v JOIN clientes c ON v.cliente_id = c.id
+        WHERE v.usuario_id = $1 AND v.id = ANY($2::bigint[])""",
+    "presupuestos": f"""SELECT {SQL_COLUMNAS_PRESUPUESTO_POSTGRES}
+        FROM presupuestos p JOIN clientes c ON p.cliente_id = c.id
+        WHERE p.usuario_id = $1 AND p.id = ANY($2::bigint[])""",
+}
+
+# Una sola sentencia para todas las líneas, con sus columnas como arrays
+SQL_INSERTAR_LINEAS_POSTGRES = """INSERT INTO lineas_presupuesto
+    (presupuesto_id, concepto, descripcion, cantidad, precio_unitario, total, orden)
+    SELECT $1, l.concepto, l.descripcion, l.cantidad, l.precio_unitario, l.cantidad * l.precio_unitario, l.orden
+    FROM unnest($2::text[], $3::text[], $4::float8[], $5::float8[], $6::int[])
+        AS l(concepto, descripcion, cantidad, precio_unitario, orden)"""
+
+SQL_MODIFICAR_LINEAS_POSTGRES = """UPDATE lineas_presupuesto l SET concepto = m.concepto, descripcion = m.descripcion,
+    cantidad = m.cantidad, precio_unitario = m.precio_unitario, total = m.cantidad * m.precio_unitario, orden = m.orden
+    FROM unnest($1::text[], $2::text[], $3::float8[], $4::float8[], $5::int[], $6::bigint[])
+        AS m(concepto, descripcion, cantidad, precio_unitario, orden, id)
+    WHERE l.id = m.id"""
+
+def dias_para_eliminar(fecha_rechazo: Optional[str]) -> Optional[int]:
+    # Lo mismo que SQL_DIAS_PARA_ELIMINAR, calculado al leer
+    if not fecha_rechazo:
+        return None
+    try:
+        limite = datetime.fromisoformat(fecha_rechazo) + timedelta(days=REJECTED_RETENTION_DAYS)
+    except ValueError:
+        return None
+    return max(0, int((limite - datetime.now()).total_seconds() / 86400))
+
+def consulta_tsquery(texto: str) -> Optional[str]:
+    # Como expresion_busqueda: cada palabra como prefijo y todas obligatorias.
+    # Solo pasan palabras (\w+), así que el texto no puede inyectar operadores
+    terminos = re.findall(r"\w+", texto)[:BUSQUEDA_MAX_TERMINOS]
+    return " & ".join(f"{termino}:*" for termino in terminos) or None
+
+def filas_afectadas(estado: str) -> int:
+    # Etiqueta de asyncpg ("UPDATE 3", "INSERT 0 1") -> filas
+    try:
+        return int(estado.rsplit(" ", 1)[-1])
+    except ValueError:
+        return 0
+
+class ParametrosSQL:
+    """Parámetros numerados de asyncpg ($1, $2...) para consultas que se
+    construyen por partes: p(valor) lo añade y devuelve su marcador."""
+
+    def __init__(self, *valores):
+        self.valores = list(valores)
+
+    def p(self, valor) -> str:
+        self.valores.append(valor)
+        return f"${len(self.valores)}"
+
+class ConexionPostgres:
+    """Conexión de asyncpg con las mismas métricas por sentencia que las de
+    SQLite (sin EXPLAIN en las lentas)."""
+
+    __slots__ = ("conn",)
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _registrar(self, sql: str, args, inicio: float, filas: int = 0, llamadas: int = 1):
+        if METRICS_ENABLED:
+            registrar_consulta(None, sql, args, time.perf_counter() - inicio, filas, llamadas, explicar=False)
+
+    async def fetch(self, sql: str, *args) -> list:
+        inicio, filas = time.perf_counter(), []
+        try:
+            filas = await self.conn.fetch(sql, *args)
+            return filas
+        finally:
+            self._registrar(sql, args, inicio, len(filas))
+
+    async def fetchrow(self, sql: str, *args):
+        inicio, fila = time.perf_counter(), None
+        try:
+            fila = await self.conn.fetchrow(sql, *args)
+            return fila
+        finally:
+            self._registrar(sql, args, inicio, fila is not None)
+
+    async def fetchval(self, sql: str, *args):
+        inicio = time.perf_counter()
+        try:
+            return await self.conn.fetchval(sql, *args)
+        finally:
+            self._registrar(sql, args, inicio, 1)
+
+    async def execute(self, sql: str, *args) -> int:
+        # Devuelve las filas modificadas, como rowcount
+        inicio, filas = time.perf_counter(), 0
+        try:
+            filas = filas_afectadas(await self.conn.execute(sql, *args))
+            return filas
+        finally:
+            self._registrar(sql, args, inicio, filas)
+
+    async def executemany(self, sql: str, filas: list):
+        inicio = time.perf_counter()
+        try:
+            await self.conn.executemany(sql, filas)
+        finally:
+            self._registrar(sql, (), inicio, len(filas), len(filas))
+
+    async def copiar(self, tabla: str, columnas: tuple, filas: list):
+        # COPY ... FROM STDIN en binario
+        if not filas:
+            return
+        inicio = time.perf_counter()
+        try:
+            await self.conn.copy_records_to_table(tabla, records=filas, columns=list(columnas))
+        finally:
+            self._registrar(f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN", (), inicio, len(filas))
+
+    async def cursor(self, sql: str, *args):
+        # Cursor de servidor; necesita una transacción abierta
+        inicio = time.perf_counter()
+        try:
+            return await self.conn.cursor(sql, *args)
+        finally:
+            self._registrar(sql, args, inicio)
+
+    async def leer(self, cursor, sql: str, n: int) -> list:
+        # Siguiente bloque del cursor; cuenta como parte de la misma sentencia
+        inicio, filas = time.perf_counter(), []
+        try:
+            filas = await cursor.fetch(n)
+            return filas
+        finally:
+            self._registrar(sql, (), inicio, len(filas), llamadas=0)
+
+    def transaction(self, **opciones):
+        return self.conn.transaction(**opciones)
+
+async def consulta_paginada_postgres(conn: ConexionPostgres, columnas: str, origen: str, condiciones: List[str],
+                                     params: ParametrosSQL, orden: str, filtro_cursor: str, clave_cursor,
+                                     limite: Optional[int], cursor_pagina: Optional[str], convertir) -> tuple:
+    # Como consulta_paginada, con marcadores {} en filtro_cursor. `convertir`
+    # (async) pasa las filas a dicts de respuesta. Sin límite el resultado se
+    # lee con un cursor de servidor por bloques de EXPORT_CHUNK_SIZE y se
+    # convierte bloque a bloque
+    where = " AND ".join(condiciones)
+    if limite is None:
+        sql = f"SELECT {columnas} FROM {origen} WHERE {where} ORDER BY {orden}"
+        filas = []
+        async with conn.transaction():
+            cursor = await conn.cursor(sql, *params.valores)
+            while True:
+                bloque = await conn.leer(cursor, sql, EXPORT_CHUNK_SIZE)
+                if not bloque:
+                    break
+                filas += await convertir(bloque)
+        return filas, len(filas), None
+
+    total = await conn.fetchval(f"SELECT COUNT(*) FROM {origen} WHERE {where}", *params.valores)
+    if cursor_pagina:
+        valores = decodificar_cursor(cursor_pagina, filtro_cursor.count("{}"))
+        where += " AND " + filtro_cursor.format(*(params.p(valor) for valor in valores))
+    try:
+        rows = await conn.fetch(
+            f"SELECT {columnas} FROM {origen} WHERE {where} ORDER BY {orden} LIMIT {params.p(limite + 1)}",
+            *params.valores
+        )
+    except (asyncpg.DataError, TypeError):
+        # Valores del cursor que no encajan con el tipo de su columna
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    siguiente = None
+    if len(rows) > limite:
+        rows = rows[:limite]
+        siguiente = codificar_cursor(clave_cursor(rows[-1]))
+    return await convertir(rows), total, siguiente
+
+async def reservar_numeros_postgres(conn: ConexionPostgres, usuario_id: int, cantidad: int) -> List[str]:
+    # Como reservar_numeros_presupuesto: el UPSERT bloquea la fila de la
+    # secuencia hasta el commit del presupuesto
+    year = datetime.now().year
+    ultimo = await conn.fetchval(
+        """INSERT INTO secuencias_presupuesto (usuario_id, anio, ultimo) VALUES ($1, $2, $3)
+           ON CONFLICT (usuario_id, anio) DO UPDATE SET ultimo = secuencias_presupuesto.ultimo + excluded.ultimo
+           RETURNING ultimo""",
+        usuario_id, year, cantidad
+    )
+    return [f"PRES-{year}-{n:04d}" for n in range(ultimo - cantidad + 1, ultimo + 1)]
+
+async def insertar_lineas_postgres(conn: ConexionPostgres, presupuesto_id: int, lineas: List[tuple]):
+    # `lineas`: (concepto, descripcion, cantidad, precio_unitario, orden)
+    if lineas:
+        await conn.execute(SQL_INSERTAR_LINEAS_POSTGRES, presupuesto_id, *(list(columna) for columna in zip(*lineas)))
+
+async def _copiar_clientes(conn: ConexionPostgres, user_id: int, clientes: List[ClienteCreate]):
+    await conn.copiar("clientes", ("usuario_id", *CAMPOS_CLIENTE),
+                      [(user_id, *valores_campos(c, CAMPOS_CLIENTE)) for c in clientes])
+
+async def _copiar_visitas(conn: ConexionPostgres, user_id: int, visitas: List[VisitaCreate]):
+    await conn.copiar("visitas", ("usuario_id", *CAMPOS_VISITA),
+                      [(user_id, *valores_campos(v, CAMPOS_VISITA)) for v in visitas])
+
+async def _copiar_presupuestos(conn: ConexionPostgres, user_id: int, presupuestos: List[PresupuestoCreate]):
+    # Los ids se reservan antes para poder copiar las líneas detrás
+    numeros = await reservar_numeros_postgres(conn, user_id, len(presupuestos))
+    ids = [fila[0] for fila in await conn.fetch(
+        "SELECT nextval(pg_get_serial_sequence('presupuestos', 'id')) FROM generate_series(1, $1)", len(presupuestos)
+    )]
+    fecha_emision = datetime.now().strftime("%Y-%m-%d")
+    filas = []
+    for presupuesto_id, numero, p in zip(ids, numeros, presupuestos):
+        subtotal, iva_amount, total = calcular_totales(p)
+        filas.append((presupuesto_id, user_id, p.cliente_id, numero, p.titulo, p.descripcion, subtotal,
+                      p.iva_porcentaje, p.aplicar_iva, iva_amount, total, "borrador", fecha_emision,
+                      p.fecha_validez, p.notas))
+    await conn.copiar("presupuestos", (
+        "id", "usuario_id", "cliente_id", "numero", "titulo", "descripcion", "subtotal", "iva_porcentaje",
+        "aplicar_iva", "iva_amount", "total", "estado", "fecha_emision", "fecha_validez", "notas"
+    ), filas)
+    await conn.copiar(
+        "lineas_presupuesto", ("presupuesto_id", "concepto", "descripcion", "cantidad", "precio_unitario", "total", "orden"),
+        [(presupuesto_id, l.concepto, l.descripcion, l.cantidad, l.precio_unitario, l.cantidad * l.precio_unitario, i)
+         for presupuesto_id, p in zip(ids, presupuestos) for i, l in enumerate(p.lineas)]
+    )
+
+IMPORTADORES_POSTGRES = {
+    "clientes": _copiar_clientes,
+    "visitas": _copiar_visitas,
+    "presupuestos": _copiar_presupuestos,
+}
+
+class SesionPostgres:
+    """Conexión fijada a un hilo por AlmacenPostgres.transaccion() y su
+    transacción exterior, que se abre con la primera escritura."""
+
+    __slots__ = ("conn", "transaccion")
+
+    def __init__(self, conn: ConexionPostgres):
+        self.conn = conn
+        self.transaccion = None
+
+_sesion_postgres = contextvars.ContextVar("sesion_postgres", default=None)
+
+def _copiar_resultado(tarea: asyncio.Task, futuro: Future):
+    if tarea.cancelled():
+        futuro.set_exception(asyncio.CancelledError())
+    elif tarea.exception() is not None:
+        futuro.set_exception(tarea.exception())
+    else:
+        futuro.set_result(tarea.result())
+
+def en_loop_postgres(metodo):
+    # Método async del almacén -> método síncrono que lo ejecuta en su event loop
+    @functools.wraps(metodo)
+    def envoltorio(self, *args, **kwargs):
+        return self._ejecutar(metodo(self, *args, **kwargs))
+    return envoltorio
+
+class AlmacenPostgres(Almacen):
+    """Almacén sobre PostgreSQL con un pool de asyncpg (DB_POOL_SIZE
+    conexiones, espera máxima DB_POOL_TIMEOUT). Las escrituras van cada una en
+    su transacción; dentro de transaccion() comparten la de la sesión."""
+
+    def __init__(self, dsn: str = DATABASE_URL):
+        if DB_SHARDING != "no":
+            raise ValueError("DB_SHARDING solo se aplica con DB_BACKEND=sqlite")
+        self.dsn = dsn
+        self._pool = None
+        self._checkouts = 0
+        self._espera = 0.0
+        self._timeouts = 0
+        self._loop = asyncio.new_event_loop()
+        self._hilo = threading.Thread(target=self._loop.run_forever, name="postgres", daemon=True)
+        self._hilo.start()
+        try:
+            self._ejecutar(self._iniciar())
+        except Exception:
+            self.close()
+            raise
+
+    def _ejecutar(self, corrutina):
+        # Ejecuta la corrutina en el loop del almacén con el contexto del
+        # llamante (métricas de la petición, sesión) y espera el resultado
+        if threading.get_ident() == self._hilo.ident:
+            corrutina.close()
+            raise RuntimeError("El almacén PostgreSQL no se puede usar desde su propio event loop")
+        futuro = Future()
+        contexto = contextvars.copy_context()
+
+        def lanzar():
+            tarea = self._loop.create_task(corrutina, context=contexto)
+            tarea.add_done_callback(lambda t: _copiar_resultado(t, futuro))
+
+        self._loop.call_soon_threadsafe(lanzar)
+        return futuro.result()
+
+    async def _iniciar(self):
+        self._pool = await asyncpg.create_pool(
+            self.dsn, min_size=1, max_size=max(1, DB_POOL_SIZE), statement_cache_size=DB_STATEMENT_CACHE
+        )
+        await self._migrar()
+
+    async def _migrar(self):
+        # Como aplicar_migraciones; el bloqueo evita que dos réplicas que
+        # arrancan a la vez apliquen la misma
+        async with self._pool.acquire() as conn:
+            await conn.execute("SELECT pg_advisory_lock($1, $2)", *POSTGRES_BLOQUEO_MIGRACIONES)
+            try:
+                await conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    descripcion TEXT,
+                    applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                )""")
+                actual = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                for version, descripcion, sentencias in MIGRACIONES_POSTGRES:
+                    if version <= actual:
+                        continue
+                    async with conn.transaction():
+                        for sql in sentencias:
+                            await conn.execute(sql)
+                        await conn.execute(
+                            "INSERT INTO schema_version (version, descripcion) VALUES ($1, $2)", version, descripcion
+                        )
+                    logger.info("PostgreSQL: migración %s aplicada (%s)", version, descripcion)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1, $2)", *POSTGRES_BLOQUEO_MIGRACIONES)
+
+    async def _adquirir(self) -> ConexionPostgres:
+        inicio = time.monotonic()
+        try:
+            conn = await self._pool.acquire(timeout=DB_POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            self._espera += time.monotonic() - inicio
+            raise PoolAgotado()
+        self._checkouts += 1
+        self._espera += time.monotonic() - inicio
+        return ConexionPostgres(conn)
+
+    async def _soltar(self, conn: ConexionPostgres, transaccion=None):
+        # Devuelve la conexión al pool deshaciendo lo que quede a medias
+        try:
+            if transaccion is not None and conn.conn.is_in_transaction():
+                await transaccion.rollback()
+        finally:
+            await self._pool.release(conn.conn)
+
+    @asynccontextmanager
+    async def _conexion(self):
+        # Conexión sin transacción: la de la sesión o una del pool
+        sesion = _sesion_postgres.get()
+        if sesion is not None:
+            yield sesion.conn
+            return
+        conn = await self._adquirir()
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn.conn)
+
+    @asynccontextmanager
+    async def _transaccion(self, **opciones):
+        # Dentro de una sesión, un savepoint de su transacción exterior
+        sesion = _sesion_postgres.get()
+        if sesion is not None:
+            if sesion.transaccion is None:
+                sesion.transaccion = sesion.conn.transaction()
+                await sesion.transaccion.start()
+            async with sesion.conn.transaction():
+                yield sesion.conn
+            return
+        async with self._conexion() as conn:
+            async with conn.transaction(**opciones):
+                yield conn
+
+    # Usuarios y sesiones
+
+    @en_loop_postgres
+    async def email_registrado(self, email: str) -> bool:
+        async with self._conexion() as conn:
+            return await conn.fetchval("SELECT EXISTS (SELECT 1 FROM usuarios WHERE email = $1)", email)
+
+    @en_loop_postgres
+    async def insertar_usuario(self, user: UserRegister, password_hash: str) -> Optional[int]:
+        async with self._conexion() as conn:
+            try:
+                return await conn.fetchval(
+                    """INSERT INTO usuarios (nombre, apellidos, email, telefono, empresa, password_hash)
+                       VALUES ($1, $2, $3, $4, $5, $6) RETURNING id""",
+                    user.nombre, user.apellidos, user.email, user.telefono, user.empresa, password_hash
+                )
+            except asyncpg.UniqueViolationError:
+                return None
+
+    @en_loop_postgres
+    async def buscar_usuario(self, email: str) -> Optional[dict]:
+        async with self._conexion() as conn:
+            fila = await conn.fetchrow(f"SELECT {columnas_postgres('usuarios')} FROM usuarios WHERE email = $1", email)
+        return dict(fila) if fila else None
+
+    @en_loop_postgres
+    async def obtener_usuario(self, user_id: int) -> Optional[dict]:
+        async with self._conexion() as conn:
+            fila = await conn.fetchrow(f"SELECT {columnas_postgres('usuarios')} FROM usuarios WHERE id = $1", user_id)
+        return dict(fila) if fila else None
+
+    @en_loop_postgres
+    async def actualizar_hash(self, user_id: int, password_hash: str):
+        async with self._conexion() as conn:
+            await conn.execute("UPDATE usuarios SET password_hash = $1 WHERE id = $2", password_hash, user_id)
+
+    @en_loop_postgres
+    async def guardar_refresh_token(self, user_id: int, token_hash: str, familia: str, expira: float):
+        async with self._conexion() as conn:
+            await conn.execute(
+                "INSERT INTO refresh_tokens (usuario_id, token_hash, familia, expira) VALUES ($1, $2, $3, $4)",
+                user_id, token_hash, familia, expira
+            )
+
+    @en_loop_postgres
+    async def renovar_refresh_token(self, token_hash: str, nuevo_hash: str, expira: float, ahora: float) -> tuple:
+        async with self._transaccion() as conn:
+            # FOR UPDATE: dos renovaciones simultáneas del mismo token se ordenan
+            fila = await conn.fetchrow(
+                """SELECT id, usuario_id, familia, expira, usado_at, revocado_at FROM refresh_tokens
+                   WHERE token_hash = $1 FOR UPDATE""",
+                token_hash
+            )
+            if not fila or fila["revocado_at"] or fila["expira"] < ahora:
+                return "caducada", None, None
+            if fila["usado_at"]:
+                await self._revocar(conn, fila["familia"], ahora)
+                return "reutilizada", dict(fila), None
+
+            await conn.execute("UPDATE refresh_tokens SET usado_at = $1 WHERE id = $2", ahora, fila["id"])
+            await conn.execute(
+                "INSERT INTO refresh_tokens (usuario_id, token_hash, familia, expira) VALUES ($1, $2, $3, $4)",
+                fila["usuario_id"], nuevo_hash, fila["familia"], expira
+            )
+            usuario = await conn.fetchrow(
+                f"SELECT {columnas_postgres('usuarios')} FROM usuarios WHERE id = $1", fila["usuario_id"]
+            )
+        return "ok", dict(fila), dict(usuario)
+
+    @en_loop_postgres
+    async def revocar_sesion(self, familia: str):
+        async with self._transaccion() as conn:
+            await self._revocar(conn, familia, time.time())
+
+    @staticmethod
+    async def _revocar(conn: ConexionPostgres, familia: str, ahora: float):
+        await conn.execute(
+            "UPDATE refresh_tokens SET revocado_at = $1 WHERE familia = $2 AND revocado_at IS NULL", ahora, familia
+        )
+        # Las revocaciones se numeran de una en una: los workers leen las
+        # nuevas por id y no deben ver la 6 confirmada antes que la 5
+        await conn.execute("SELECT pg_advisory_xact_lock($1, $2)", *POSTGRES_BLOQUEO_REVOCACIONES)
+        await conn.execute(
+            """INSERT INTO tokens_revocados (clave, expira) VALUES ($1, $2)
+               ON CONFLICT (clave) DO UPDATE SET expira = excluded.expira, id = excluded.id""",
+            f"sid:{familia}", ahora + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+        )
+
+    @en_loop_postgres
+    async def revocaciones_desde(self, ultimo_id: int, ahora: float) -> list:
+        async with self._conexion() as conn:
+            return await conn.fetch(
+                "SELECT id, clave, expira FROM tokens_revocados WHERE id > $1 AND expira > $2 ORDER BY id",
+                ultimo_id, ahora
+            )
+
+    @en_loop_postgres
+    async def versiones(self, user_id: int, tablas: tuple) -> dict:
+        async with self._conexion() as conn:
+            rows = await conn.fetch(
+                "SELECT tabla, version FROM versiones_datos WHERE usuario_id = $1 AND tabla = ANY($2::text[])",
+                user_id, list(tablas)
+            )
+        return {row["tabla"]: row["version"] for row in rows}
+
+    # Clientes, visitas y agenda
+
+    @en_loop_postgres
+    async def listar_clientes(self, user_id: int, q: Optional[str], tipo: Optional[str],
+                              limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+        params = ParametrosSQL(user_id)
+        condiciones = ["usuario_id = $1"]
+        if q:
+            patron = params.p(f"%{q}%")
+            condiciones.append(f"(nombre || ' ' || COALESCE(apellidos, '') ILIKE {patron} OR telefono ILIKE {patron})")
+        if tipo:
+            condiciones.append(f"tipo = {params.p(tipo)}")
+
+        async def convertir(rows):
+            return filas_respuesta(ClienteResponse, rows)
+
+        async with self._conexion() as conn:
+            return await consulta_paginada_postgres(
+                conn, columnas_postgres("clientes"), "clientes", condiciones, params,
+                orden="nombre, id",
+                filtro_cursor="(nombre, id) > ({}, {})",
+                clave_cursor=lambda r: [r["nombre"], r["id"]],
+                limite=limite, cursor_pagina=cursor_pagina, convertir=convertir
+            )
+
+    @en_loop_postgres
+    async def obtener_cliente(self, user_id: int, cliente_id: int) -> Optional[dict]:
+        async with self._conexion() as conn:
+            fila = await conn.fetchrow(
+                f"SELECT {columnas_postgres('clientes')} FROM clientes WHERE id = $1 AND usuario_id = $2",
+                cliente_id, user_id
+            )
+        return dict(fila) if fila else None
+
+    @en_loop_postgres
+    async def crear_cliente(self, user_id: int, cliente: ClienteCreate) -> dict:
+        async with self._transaccion() as conn:
+            fila = await conn.fetchrow(
+                f"""INSERT INTO clientes (usuario_id, {', '.join(CAMPOS_CLIENTE)})
+                   VALUES ({', '.join(f'${n}' for n in range(1, len(CAMPOS_CLIENTE) + 2))})
+                   RETURNING {columnas_postgres('clientes')}""",
+                user_id, *valores_campos(cliente, CAMPOS_CLIENTE)
+            )
+        return dict(fila)
+
+    @en_loop_postgres
+    async def actualizar_cliente(self, user_id: int, cliente_id: int, cliente: ClienteCreate) -> Optional[dict]:
+        n = len(CAMPOS_CLIENTE)
+        async with self._transaccion() as conn:
+            fila = await conn.fetchrow(
+                f"""UPDATE clientes SET {', '.join(f'{campo} = ${i}' for i, campo in enumerate(CAMPOS_CLIENTE, 1))}
+                   WHERE id = ${n + 1} AND usuario_id = ${n + 2}
+                   RETURNING {columnas_postgres('clientes')}""",
+                *valores_campos(cliente, CAMPOS_CLIENTE), cliente_id, user_id
+            )
+        return dict(fila) if fila else None
+
+    @en_loop_postgres
+    async def eliminar_cliente(self, user_id: int, cliente_id: int) -> bool:
+        async with self._transaccion() as conn:
+            return await conn.execute("DELETE FROM clientes WHERE id = $1 AND usuario_id = $2", cliente_id, user_id) > 0
+
+    @en_loop_postgres
+    async def listar_visitas(self, user_id: int, fecha: Optional[str], estado: Optional[str], desde: Optional[str],
+                             hasta: Optional[str], limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+        params = ParametrosSQL(user_id)
+        condiciones = ["v.usuario_id = $1"]
+        if fecha:
+            condiciones.append(f"v.fecha = {params.p(fecha)}")
+        if desde:
+            condiciones.append(f"v.fecha >= {params.p(desde)}")
+        if hasta:
+            condiciones.append(f"v.fecha <= {params.p(hasta)}")
+        if estado:
+            condiciones.append(f"v.estado = ANY({params.p(lista_estados(estado))}::text[])")
+
+        async def convertir(rows):
+            return filas_respuesta(VisitaResponse, rows)
+
+        async with self._conexion() as conn:
+            return await consulta_paginada_postgres(
+                conn, SQL_COLUMNAS_VISITA_POSTGRES,
+                "visitas v JOIN clientes c ON v.cliente_id = c.id",
+                condiciones, params,
+                orden="v.fecha DESC, COALESCE(v.hora, ''), v.id",
+                filtro_cursor="(v.fecha < {} OR (v.fecha = {} AND (COALESCE(v.hora, ''), v.id) > ({}, {})))",
+                clave_cursor=lambda r: [r["fecha"], r["fecha"], r["hora"] or "", r["id"]],
+                limite=limite, cursor_pagina=cursor_pagina, convertir=convertir
+            )
+
+    @en_loop_postgres
+    async def obtener_visita(self, user_id: int, visita_id: int) -> Optional[dict]:
+        async with self._conexion() as conn:
+            fila = await conn.fetchrow(
+                f"""SELECT {SQL_COLUMNAS_VISITA_POSTGRES}
+                   FROM visitas v JOIN clientes c ON v.cliente_id = c.id
+                   WHERE v.id = $1 AND v.usuario_id = $2""",
+                visita_id, user_id
+            )
+        return dict(fila) if fila else None
+
+    @en_loop_postgres
+    async def crear_visita(self, user_id: int, visita: VisitaCreate) -> int:
+        async with self._transaccion() as conn:
+            return await conn.fetchval(
+                f"""INSERT INTO visitas (usuario_id, {', '.join(CAMPOS_VISITA)})
+                   VALUES ({', '.join(f'${n}' for n in range(1, len(CAMPOS_VISITA) + 2))}) RETURNING id""",
+                user_id, *valores_campos(visita, CAMPOS_VISITA)
+            )
+
+    @en_loop_postgres
+    async def actualizar_visita(self, user_id: int, visita_id: int, visita: VisitaCreate) -> bool:
+        n = len(CAMPOS_VISITA)
+        async with self._transaccion() as conn:
+            return await conn.execute(
+                f"""UPDATE visitas SET {', '.join(f'{campo} = ${i}' for i, campo in enumerate(CAMPOS_VISITA, 1))},
+                   version = version + 1 WHERE id = ${n + 1} AND usuario_id = ${n + 2}""",
+                *valores_campos(visita, CAMPOS_VISITA), visita_id, user_id
+            ) > 0
+
+    @en_loop_postgres
+    async def cambiar_estado_visita(self, user_id: int, visita_id: int, estado: str, completed_at: Optional[str]) -> bool:
+        async with self._transaccion() as conn:
+            return await conn.execute(
+                """UPDATE visitas SET estado = $1, completed_at = $2, version = version + 1
+                   WHERE id = $3 AND usuario_id = $4""",
+                estado, completed_at, visita_id, user_id
+            ) > 0
+
+    @en_loop_postgres
+    async def completar_visita(self, user_id: int, visita_id: int, firma: Optional[tuple],
+                               nombre_firmante: Optional[str], notas_internas: Optional[str], completed_at: str) -> bool:
+        firma_hash = hashlib.sha256(firma[1]).hexdigest() if firma else None
+        async with self._transaccion() as conn:
+            # Primero la visita: si no existe no se guarda la firma
+            if not await conn.execute(
+                """UPDATE visitas SET estado = 'completada', completed_at = $1,
+                   firma_hash = $2, nombre_firmante = $3, notas_internas = $4, version = version + 1
+                   WHERE id = $5 AND usuario_id = $6""",
+                completed_at, firma_hash, nombre_firmante, notas_internas, visita_id, user_id
+            ):
+                return False
+            if firma and not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM firmas WHERE hash = $1)", firma_hash):
+                codificacion, datos = codificar_firma(*firma)
+                await conn.execute(
+                    """INSERT INTO firmas (hash, mime, codificacion, tamano, datos) VALUES ($1, $2, $3, $4, $5)
+                       ON CONFLICT (hash) DO NOTHING""",
+                    firma_hash, firma[0], codificacion, len(firma[1]), datos
+                )
+        return True
+
+    @en_loop_postgres
+    async def eliminar_visita(self, user_id: int, visita_id: int) -> bool:
+        async with self._transaccion() as conn:
+            return await conn.execute("DELETE FROM visitas WHERE id = $1 AND usuario_id = $2", visita_id, user_id) > 0
+
+    @en_loop_postgres
+    async def datos_pdf_visita(self, user_id: int, visita_id: int) -> dict:
+        async with self._conexion() as conn:
+            visita = await conn.fetchrow(
+                f"SELECT {columnas_postgres('visitas')} FROM visitas WHERE id = $1 AND usuario_id = $2", visita_id, user_id
+            )
+            if not visita:
+                raise HTTPException(status_code=404, detail="Visita no encontrada")
+            if visita["estado"] != "completada":
+                raise HTTPException(status_code=400, detail="Solo las visitas completadas tienen parte de trabajo")
+            firma = None
+            if visita["firma_hash"]:
+                fila = await conn.fetchrow("SELECT codificacion, datos FROM firmas WHERE hash = $1", visita["firma_hash"])
+                if fila:
+                    firma = leer_contenido_firma(fila["codificacion"], fila["datos"])
+            cliente = await conn.fetchrow(
+                f"SELECT {columnas_postgres('clientes')} FROM clientes WHERE id = $1", visita["cliente_id"]
+            )
+            return {
+                "emisor": dict(await conn.fetchrow(SQL_EMISOR_PDF_POSTGRES, user_id)),
+                "cliente": dict(cliente or {}),
+                "visita": dict(visita),
+                "firma": firma,
+            }
+
+    @en_loop_postgres
+    async def agenda(self, user_id: int, desde: str, hasta: str, incluir_visitas: bool) -> list:
+        if incluir_visitas:
+            columnas, origen = SQL_COLUMNAS_VISITA_POSTGRES, "visitas v JOIN clientes c ON v.cliente_id = c.id"
+        else:
+            columnas, origen = "v.fecha, v.hora, v.estado, v.prioridad", "visitas v"
+        async with self._conexion() as conn:
+            return await conn.fetch(
+                f"""SELECT {columnas}, {SQL_CONFLICTO_VISITA_POSTGRES}
+                   FROM {origen}
+                   WHERE v.usuario_id = $1 AND v.fecha BETWEEN $2 AND $3
+                   ORDER BY v.fecha, v.hora NULLS FIRST, v.id""",
+                user_id, desde, hasta
+            )
+
+    # Firmas
+
+    @en_loop_postgres
+    async def info_firma(self, user_id: int, firma_hash: str) -> Optional[dict]:
+        async with self._conexion() as conn:
+            fila = await conn.fetchrow(
+                """SELECT id, mime, codificacion, tamano, octet_length(datos) AS almacenado FROM firmas f
+                   WHERE hash = $1 AND EXISTS (SELECT 1 FROM visitas WHERE firma_hash = f.hash AND usuario_id = $2)""",
+                firma_hash, user_id
+            )
+        return dict(fila) if fila else None
+
+    @en_loop_postgres
+    async def _trozo_firma(self, firma_id: int, posicion: int, tamano: int) -> bytes:
+        async with self._conexion() as conn:
+            return await conn.fetchval(
+                "SELECT substring(datos FROM $2 FOR $3) FROM firmas WHERE id = $1", firma_id, posicion + 1, tamano
+            )
+
+    def trozos_firma(self, user_id: int, firma_id: int, inicio: int, fin: int):
+        # Cada trozo es una consulta: con STORAGE EXTERNAL solo se leen del
+        # TOAST las páginas del rango
+        posicion = inicio
+        while posicion <= fin:
+            trozo = self._trozo_firma(firma_id, posicion, min(FIRMA_CHUNK_SIZE, fin - posicion + 1))
+            if not trozo:
+                break
+            posicion += len(trozo)
+            yield trozo
+
+    # Presupuestos
+
+    async def _cargar_lineas(self, conn: ConexionPostgres, presupuesto_ids: List[int]) -> dict:
+        lineas = {pid: [] for pid in presupuesto_ids}
+        if presupuesto_ids:
+            for linea in await conn.fetch(
+                f"""SELECT {columnas_postgres('lineas_presupuesto')} FROM lineas_presupuesto
+                   WHERE presupuesto_id = ANY($1::bigint[]) ORDER BY presupuesto_id, orden, id""",
+                presupuesto_ids
+            ):
+                lineas[linea["presupuesto_id"]].append(dict(linea))
+        return lineas
+
+    async def _filas_presupuestos(self, conn: ConexionPostgres, rows, incluir_lineas: bool = True) -> List[dict]:
+        presupuestos = filas_respuesta(PresupuestoResponse, rows)
+        lineas = await self._cargar_lineas(conn, [p["id"] for p in presupuestos]) if incluir_lineas else {}
+        for pres_dict in presupuestos:
+            pres_dict["dias_para_eliminar"] = dias_para_eliminar(pres_dict["fecha_rechazo"])
+            pres_dict["lineas"] = lineas.get(pres_dict["id"], [])
+        return presupuestos
+
+    @en_loop_postgres
+    async def listar_presupuestos(self, user_id: int, estado: Optional[str], desde: Optional[str],
+                                  hasta: Optional[str], incluir_lineas: bool, limite: Optional[int],
+                                  cursor_pagina: Optional[str]) -> tuple:
+        params = ParametrosSQL(user_id)
+        condiciones = ["p.usuario_id = $1"]
+        if estado:
+            condiciones.append(f"p.estado = ANY({params.p(lista_estados(estado))}::text[])")
+        if desde:
+            condiciones.append(f"p.fecha_emision >= {params.p(desde)}")
+        if hasta:
+            condiciones.append(f"p.fecha_emision <= {params.p(hasta)}")
+
+        async with self._conexion() as conn:
+            async def convertir(rows):
+                return await self._filas_presupuestos(conn, rows, incluir_lineas)
+
+            return await consulta_paginada_postgres(
+                conn, SQL_COLUMNAS_PRESUPUESTO_POSTGRES,
+                "presupuestos p JOIN clientes c ON p.cliente_id = c.id",
+                condiciones, params,
+                orden="p.created_at DESC, p.id DESC",
+                filtro_cursor="(p.created_at, p.id) < ({}, {})",
+                clave_cursor=lambda r: [r["created_at"], r["id"]],
+                limite=limite, cursor_pagina=cursor_pagina, convertir=convertir
+            )
+
+    @en_loop_postgres
+    async def presupuestos_cliente(self, user_id: int, cliente_id: int, incluir_lineas: bool) -> List[dict]:
+        async with self._conexion() as conn:
+            rows = await conn.fetch(
+                f"""SELECT {SQL_COLUMNAS_PRESUPUESTO_POSTGRES}
+                   FROM presupuestos p JOIN clientes c ON p.cliente_id = c.id
+                   WHERE p.usuario_id = $1 AND p.cliente_id = $2
+                   ORDER BY p.created_at DESC""",
+                user_id, cliente_id
+            )
+            return await self._filas_presupuestos(conn, rows, incluir_lineas)
+
+    @en_loop_postgres
+    async def obtener_presupuesto(self, user_id: int, presupuesto_id: int) -> Optional[dict]:
+        async with self._conexion() as conn:
+            pres = await conn.fetchrow(
+                f"""SELECT {SQL_COLUMNAS_PRESUPUESTO_POSTGRES}
+                   FROM presupuestos p JOIN clientes c ON p.cliente_id = c.id
+                   WHERE p.id = $1 AND p.usuario_id = $2""",
+                presupuesto_id, user_id
+            )
+            if not pres:
+                return None
+            pres_dict = dict(pres)
+            pres_dict["dias_para_eliminar"] = dias_para_eliminar(pres_dict["fecha_rechazo"])
+            pres_dict["lineas"] = (await self._cargar_lineas(conn, [presupuesto_id]))[presupuesto_id]
+            return pres_dict
+
+    @en_loop_postgres
+    async def datos_pdf_presupuesto(self, user_id: int, presupuesto_id: int) -> dict:
+        async with self._conexion() as conn:
+            presupuesto = await conn.fetchrow(
+                f"SELECT {columnas_postgres('presupuestos')} FROM presupuestos WHERE id = $1 AND usuario_id = $2",
+                presupuesto_id, user_id
+            )
+            if not presupuesto:
+                raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
+            cliente = await conn.fetchrow(
+                f"SELECT {columnas_postgres('clientes')} FROM clientes WHERE id = $1", presupuesto["cliente_id"]
+            )
+            lineas = await conn.fetch(
+                """SELECT concepto, descripcion, cantidad, precio_unitario, total
+                   FROM lineas_presupuesto WHERE presupuesto_id = $1 ORDER BY orden, id""",
+                presupuesto_id
+            )
+            return {
+                "emisor": dict(await conn.fetchrow(SQL_EMISOR_PDF_POSTGRES, user_id)),
+                "cliente": dict(cliente or {}),
+                "presupuesto": dict(presupuesto),
+                "lineas": [dict(l) for l in lineas],
+            }
+
+    @en_loop_postgres
+    async def crear_presupuesto(self, user_id: int, presupuesto: PresupuestoCreate) -> int:
+        subtotal, iva_amount, total = calcular_totales(presupuesto)
+        async with self._transaccion() as conn:
+            numero = (await reservar_numeros_postgres(conn, user_id, 1))[0]
+            presupuesto_id = await conn.fetchval(
+                """INSERT INTO presupuestos (usuario_id, cliente_id, numero, titulo, descripcion,
+                   subtotal, iva_porcentaje, aplicar_iva, iva_amount, total, estado, fecha_emision, fecha_validez, notas)
+                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, 'borrador', $11, $12, $13) RETURNING id""",
+                user_id, presupuesto.cliente_id, numero, presupuesto.titulo, presupuesto.descripcion,
+                subtotal, presupuesto.iva_porcentaje, presupuesto.aplicar_iva, iva_amount, total,
+                datetime.now().strftime("%Y-%m-%d"), presupuesto.fecha_validez, presupuesto.notas
+            )
+            await insertar_lineas_postgres(conn, presupuesto_id, [
+                (l.concepto, l.descripcion, l.cantidad, l.precio_unitario, i) for i, l in enumerate(presupuesto.lineas)
+            ])
+        return presupuesto_id
+
+    @en_loop_postgres
+    async def editar_presupuesto(self, user_id: int, presupuesto_id: int, version: int, cambios: dict,
+                                 lineas: Optional[List[LineaPresupuesto]]):
+        async with self._transaccion() as conn:
+            # Bloqueo optimista, como en SQLite: el UPDATE comprueba la versión
+            # y bloquea la fila hasta el commit
+            if not await conn.execute(
+                "UPDATE presupuestos SET version = version + 1 WHERE id = $1 AND usuario_id = $2 AND version = $3",
+                presupuesto_id, user_id, version
+            ):
+                actual = await conn.fetchval(
+                    "SELECT version FROM presupuestos WHERE id = $1 AND usuario_id = $2", presupuesto_id, user_id
+                )
+                if actual is None:
+                    raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
+                raise HTTPException(
+                    status_code=409, detail=f"El presupuesto se ha modificado (versión {actual}); vuelve a cargarlo"
+                )
+
+            if lineas is not None:
+                guardadas = {row["id"]: tuple(row)[1:] for row in await conn.fetch(
+                    """SELECT id, concepto, descripcion, cantidad, precio_unitario, orden
+                       FROM lineas_presupuesto WHERE presupuesto_id = $1""",
+                    presupuesto_id
+                )}
+                altas, modificaciones, bajas = diferencias_lineas(guardadas, lineas)
+                if bajas:
+                    await conn.execute(
+                        "DELETE FROM lineas_presupuesto WHERE id = ANY($1::bigint[])", [linea_id for linea_id, in bajas]
+                    )
+                if modificaciones:
+                    await conn.execute(SQL_MODIFICAR_LINEAS_POSTGRES, *(list(columna) for columna in zip(*modificaciones)))
+                await insertar_lineas_postgres(conn, presupuesto_id, altas)
+
+            # Totales desde las líneas guardadas, con el IVA nuevo si cambia
+            params = ParametrosSQL(presupuesto_id)
+            marcas = {campo: params.p(valor) for campo, valor in cambios.items()}
+            aplicar_iva = f"{marcas['aplicar_iva']}::boolean" if "aplicar_iva" in marcas else "aplicar_iva"
+            iva_porcentaje = f"{marcas['iva_porcentaje']}::float8" if "iva_porcentaje" in marcas else "iva_porcentaje"
+            iva = f"CASE WHEN {aplicar_iva} THEN t.subtotal * {iva_porcentaje} / 100 ELSE 0 END"
+            asignaciones = [f"{campo} = {marca}" for campo, marca in marcas.items()] + [
+                "subtotal = t.subtotal", f"iva_amount = {iva}", f"total = t.subtotal + {iva}"
+            ]
+            await conn.execute(
+                f"""UPDATE presupuestos SET {', '.join(asignaciones)}
+                   FROM (SELECT COALESCE(SUM(total), 0) AS subtotal FROM lineas_presupuesto
+                         WHERE presupuesto_id = $1) AS t
+                   WHERE presupuestos.id = $1""",
+                *params.valores
+            )
+
+    @en_loop_postgres
+    async def cambiar_estado_presupuesto(self, user_id: int, presupuesto_id: int, estado: str,
+                                         fecha_rechazo: Optional[str]) -> bool:
+        async with self._transaccion() as conn:
+            return await conn.execute(
+                "UPDATE presupuestos SET estado = $1, fecha_rechazo = $2 WHERE id = $3 AND usuario_id = $4",
+                estado, fecha_rechazo, presupuesto_id, user_id
+            ) > 0
+
+    @en_loop_postgres
+    async def eliminar_presupuesto(self, user_id: int, presupuesto_id: int) -> bool:
+        async with self._transaccion() as conn:
+            return await conn.execute(
+                "DELETE FROM presupuestos WHERE id = $1 AND usuario_id = $2", presupuesto_id, user_id
+            ) > 0
+
+    # Importación y exportación
+
+    @en_loop_postgres
+    async def importar_lote(self, user_id: int, entidad: str, lote: list, errores: list) -> int:
+        # COPY de las filas válidas en una transacción; si alguna viola una
+        # restricción, se repite el lote fila a fila, cada una en su savepoint
+        async with self._transaccion() as conn:
+            if entidad != "clientes":
+                propios = {fila["id"] for fila in await conn.fetch(
+                    "SELECT id FROM clientes WHERE usuario_id = $1 AND id = ANY($2::bigint[])",
+                    user_id, sorted({obj.cliente_id for _, obj in lote})
+                )}
+                for n, obj in lote:
+                    if obj.cliente_id not in propios:
+                        errores.append({"fila": n, "error": f"cliente_id: el cliente {obj.cliente_id} no existe"})
+                lote = [(n, obj) for n, obj in lote if obj.cliente_id in propios]
+
+            if lote:
+                importador = IMPORTADORES_POSTGRES[entidad]
+                try:
+                    async with conn.transaction():
+                        await importador(conn, user_id, [obj for _, obj in lote])
+                except asyncpg.IntegrityConstraintViolationError:
+                    insertadas = []
+                    for n, obj in lote:
+                        try:
+                            async with conn.transaction():
+                                await importador(conn, user_id, [obj])
+                        except asyncpg.IntegrityConstraintViolationError as e:
+                            errores.append({"fila": n, "error": str(e)})
+                        else:
+                            insertadas.append((n, obj))
+                    lote = insertadas
+        return len(lote)
+
+    @en_loop_postgres
+    async def _abrir_exportacion(self, user_id: int, entidad: str) -> tuple:
+        conn = await self._adquirir()
+        transaccion = conn.transaction(isolation="repeatable_read", readonly=True)
+        try:
+            await transaccion.start()
+            columnas = ", ".join(
+                "aplicar_iva::int AS aplicar_iva" if columna == "aplicar_iva" else columna
+                for columna in COLUMNAS_EXPORTACION[entidad]
+            )
+            sql = f"SELECT {columnas} FROM {entidad} WHERE usuario_id = $1 ORDER BY id"
+            return conn, transaccion, sql, await conn.cursor(sql, user_id)
+        except BaseException:
+            await self._soltar(conn, transaccion)
+            raise
+
+    @en_loop_postgres
+    async def _bloque_exportacion(self, conn: ConexionPostgres, cursor, sql: str, entidad: str) -> List[dict]:
+        filas = [dict(row) for row in await conn.leer(cursor, sql, EXPORT_CHUNK_SIZE)]
+        if filas and entidad == "presupuestos":
+            lineas = await self._cargar_lineas(conn, [f["id"] for f in filas])
+            for f in filas:
+                f["lineas"] = [{c: l[c] for c in CAMPOS_LINEA} for l in lineas[f["id"]]]
+        return filas
+
+    def exportar(self, user_id: int, entidad: str):
+        # Cursor de servidor en una transacción de solo lectura (misma
+        # instantánea para filas y líneas). La conexión se presta al empezar a
+        # iterar: un generador sin arrancar no retiene ninguna
+        conn, transaccion, sql, cursor = self._abrir_exportacion(user_id, entidad)
+        try:
+            while True:
+                filas = self._bloque_exportacion(conn, cursor, sql, entidad)
+                if not filas:
+                    break
+                yield filas
+        finally:
+            self._ejecutar(self._soltar(conn, transaccion))
+
+    # Sincronización
+
+    @en_loop_postgres
+    async def leer_cambios_sync(self, user_id: int, desde: int, limite: int) -> tuple:
+        async with self._transaccion(isolation="repeatable_read", readonly=True) as conn:
+            reiniciar = False
+            if desde:
+                horizonte = await conn.fetchval("SELECT seq FROM sync_horizonte WHERE usuario_id = $1", user_id)
+                if horizonte is not None and desde < horizonte:
+                    desde, reiniciar = 0, True
+
+            cambios = [dict(c) for c in await conn.fetch(
+                """SELECT seq, tabla, registro_id, borrado FROM cambios_sync
+                   WHERE usuario_id = $1 AND seq > $2 AND ($2 > 0 OR NOT borrado)
+                   ORDER BY seq LIMIT $3""",
+                user_id, desde, limite + 1
+            )]
+            mas = len(cambios) > limite
+            cambios = cambios[:limite]
+
+            registros = {}
+            for tabla in TABLAS_SYNC:
+                ids = [c["registro_id"] for c in cambios if c["tabla"] == tabla and not c["borrado"]]
+                if ids:
+                    rows = await conn.fetch(SQL_REGISTROS_SYNC_POSTGRES[tabla], user_id, ids)
+                    registros[tabla] = (await self._filas_presupuestos(conn, rows) if tabla == "presupuestos"
+                                        else filas_respuesta(MODELOS_RESPUESTA[tabla], rows))
+        return reiniciar, mas, cambios, registros
+
+    @contextmanager
+    def transaccion(self):
+        if _sesion_postgres.get() is not None:
+            yield
+            return
+        sesion = SesionPostgres(self._ejecutar(self._adquirir()))
+        token = _sesion_postgres.set(sesion)
+        try:
+            yield
+        finally:
+            _sesion_postgres.reset(token)
+            self._ejecutar(self._soltar(sesion.conn, sesion.transaccion))
+
+    @en_loop_postgres
+    async def peticion_sync(self, user_id: int, id_peticion: str) -> Optional[dict]:
+        async with self._conexion() as conn:
+            fila = await conn.fetchrow(
+                "SELECT estado, resultado FROM peticiones_sync WHERE usuario_id = $1 AND id_peticion = $2",
+                user_id, id_peticion
+            )
+        return dict(fila) if fila else None
+
+    @en_loop_postgres
+    async def registrar_peticion_sync(self, user_id: int, id_peticion: str):
+        async with self._transaccion() as conn:
+            await conn.execute("INSERT INTO peticiones_sync (usuario_id, id_peticion) VALUES ($1, $2)", user_id, id_peticion)
+
+    @en_loop_postgres
+    async def guardar_peticion_sync(self, user_id: int, id_peticion: str, estado: int, resultado: str):
+        async with self._transaccion() as conn:
+            await conn.execute(
+                """INSERT INTO peticiones_sync (usuario_id, id_peticion, estado, resultado) VALUES ($1, $2, $3, $4)
+                   ON CONFLICT (usuario_id, id_peticion) DO UPDATE SET
+                   estado = excluded.estado, resultado = excluded.resultado""",
+                user_id, id_peticion, estado, resultado
+            )
+        sesion = _sesion_postgres.get()
+        if sesion is not None and sesion.transaccion is not None:
+            await sesion.transaccion.commit()
+            sesion.transaccion = None
+
+    @en_loop_postgres
+    async def deshacer(self):
+        sesion = _sesion_postgres.get()
+        if sesion is not None and sesion.transaccion is not None:
+            await sesion.transaccion.rollback()
+            sesion.transaccion = None
+
+    # Búsqueda, dashboard y analítica
+
+    @en_loop_postgres
+    async def buscar(self, user_id: int, q: str, entidades: set, limite: int) -> dict:
+        consulta = consulta_tsquery(q)
+        resultado = {}
+        if consulta is None:
+            return resultado
+        tsquery = "to_tsquery('simple', sin_acentos($2))"
+        async with self._conexion() as conn:
+            if "clientes" in entidades:
+                resultado["clientes"] = await conn.fetch(
+                    f"""SELECT id, nombre, apellidos, telefono FROM clientes
+                       WHERE usuario_id = $1 AND busqueda @@ {tsquery}
+                       ORDER BY ts_rank({SQL_PESOS_RANKING}, busqueda, {tsquery}) DESC, id LIMIT $3""",
+                    user_id, consulta, limite
+                )
+            if "visitas" in entidades:
+                resultado["visitas"] = await conn.fetch(
+                    f"""SELECT id, titulo, fecha, cliente_id FROM visitas
+                       WHERE usuario_id = $1 AND busqueda @@ {tsquery}
+                       ORDER BY ts_rank({SQL_PESOS_RANKING}, busqueda, {tsquery}) DESC, id LIMIT $3""",
+                    user_id, consulta, limite
+                )
+            if "presupuestos" in entidades:
+                # Por sus propios campos o por cualquiera de sus líneas; cuenta
+                # su mejor coincidencia
+                resultado["presupuestos"] = await conn.fetch(
+                    f"""WITH coincidencias AS (
+                           SELECT id, ts_rank({SQL_PESOS_RANKING}, busqueda, {tsquery}) AS rank FROM presupuestos
+                           WHERE usuario_id = $1 AND busqueda @@ {tsquery}
+                           UNION ALL
+                           SELECT l.presupuesto_id, ts_rank({SQL_PESOS_RANKING}, l.busqueda, {tsquery})
+                           FROM lineas_presupuesto l JOIN presupuestos p ON p.id = l.presupuesto_id
+                           WHERE p.usuario_id = $1 AND l.busqueda @@ {tsquery}
+                       )
+                       SELECT p.id, p.numero, p.titulo, p.cliente_id, MAX(m.rank) AS rank
+                       FROM coincidencias m JOIN presupuestos p ON p.id = m.id
+                       GROUP BY p.id ORDER BY rank DESC, p.id LIMIT $3""",
+                    user_id, consulta, limite
+                )
+        return resultado
+
+    @en_loop_postgres
+    async def contadores(self, user_id: int, claves: List[str]) -> dict:
+        async with self._conexion() as conn:
+            filas = await conn.fetch(
+                "SELECT clave, valor FROM resumen_contadores WHERE usuario_id = $1 AND clave = ANY($2::text[])",
+                user_id, claves
+            )
+        valores = {fila["clave"]: fila["valor"] for fila in filas}
+        return {clave: valores.get(clave, 0) for clave in claves}
+
+    @en_loop_postgres
+    async def presupuestos_por_estado(self, user_id: int) -> dict:
+        async with self._conexion() as conn:
+            filas = await conn.fetch(
+                "SELECT clave, valor FROM resumen_contadores WHERE usuario_id = $1 AND clave LIKE 'presupuestos:estado:%'",
+                user_id
+            )
+        return {fila["clave"][len("presupuestos:estado:"):]: int(fila["valor"]) for fila in filas}
+
+    @en_loop_postgres
+    async def analitica(self, tabla: str, user_id: int, inicio: date, fin: date, agrupar: str,
+                        por: Optional[str]) -> List[dict]:
+        # Como leer_rollup, pero con los tramos en un solo OR: PostgreSQL los
+        # busca por la clave primaria igual. Las filas diarias se recortan al
+        # mes cuando se agrupa por meses
+        metricas = ROLLUPS[tabla][3]
+        params = ParametrosSQL(user_id)
+        tramos = " OR ".join(
+            f"(a.granularidad = {params.p(granularidad)} AND a.periodo BETWEEN {params.p(desde)} AND {params.p(hasta)})"
+            for granularidad, desde, hasta in tramos_analitica(inicio, fin, agrupar)
+        )
+        columnas = [f"substr(a.periodo, 1, {GRANULARIDADES['d' if agrupar == 'dia' else 'm']}) AS periodo"]
+        join = ""
+        if por:
+            dimension, nombre, join = (*DESGLOSES_ROLLUP[tabla], "", "")[:3]
+            columnas += [f"a.{dimension}", *([nombre] if nombre else [])]
+        agrupacion = ", ".join(str(n) for n in range(1, len(columnas) + 1))
+        orden = f"1, {next(iter(metricas))} DESC, 2" if por else "1"
+        columnas += [f"SUM(a.{m}) AS {m}" for m in metricas]
+        async with self._conexion() as conn:
+            filas = await conn.fetch(
+                f"""SELECT {', '.join(columnas)} FROM {tabla} a {join}
+                   WHERE a.usuario_id = $1 AND ({tramos})
+                   GROUP BY {agrupacion} ORDER BY {orden}""",
+                *params.valores
+            )
+        return [dict(fila) for fila in filas]
+
+    @en_loop_postgres
+    async def verificar_resumen(self, usuario_id: Optional[int] = None) -> tuple:
+        # (desviaciones de resumen_contadores, {rollup: filas distintas}), como
+        # verificar_resumen y verificar_analitica en SQLite
+        filtro, params = ("WHERE usuario_id = $1", (usuario_id,)) if usuario_id is not None else ("", ())
+        async with self._conexion() as conn:
+            guardado = {(f[0], f[1]): f[2] for f in await conn.fetch(
+                f"SELECT usuario_id, clave, valor FROM resumen_contadores {filtro}", *params
+            )}
+            calculado = {(f[0], f[1]): f[2] for f in await conn.fetch(
+                f"SELECT usuario_id, clave, valor FROM ({SQL_RESUMEN_CALCULADO}) r {filtro}", *params
+            )}
+            diferencias = {}
+            for tabla in ROLLUPS:
+                diferencias[tabla] = 0
+                for sql in sql_diferencias_analitica(tabla, filtro):
+                    diferencias[tabla] += await conn.fetchval(sql, *params)
+        return comparar_contadores(guardado, calculado), diferencias
+
+    @en_loop_postgres
+    async def reconstruir_resumen(self, usuario_id: Optional[int] = None):
+        filtro, params = ("WHERE usuario_id = $1", (usuario_id,)) if usuario_id is not None else ("", ())
+        async with self._transaccion() as conn:
+            for sql in sql_reconstruir_resumen(filtro) + sql_reconstruir_analitica(filtro):
+                await conn.execute(sql, *params)
+
+    # Tareas programadas
+
+    def tareas_programadas(self) -> dict:
+        return TAREAS_POSTGRES
+
+    @en_loop_postgres
+    async def tomar_tarea(self, nombre: str, propietario: str, forzar: bool) -> bool:
+        ahora = time.time()
+        async with self._conexion() as conn:
+            await conn.execute("INSERT INTO tareas_programadas (nombre) VALUES ($1) ON CONFLICT DO NOTHING", nombre)
+            return await conn.execute(
+                """UPDATE tareas_programadas SET propietario = $2, bloqueada_hasta = $3
+                   WHERE nombre = $1 AND ($4 OR proxima <= $5) AND (bloqueada_hasta IS NULL OR bloqueada_hasta < $5)""",
+                nombre, propietario, ahora + SCHEDULER_LOCK_SECONDS, forzar, ahora
+            ) == 1
+
+    @en_loop_postgres
+    async def ejecutar_tarea(self, nombre: str, funcion, dry_run: bool) -> dict:
+        async with self._conexion() as conn:
+            return await funcion(conn, dry_run)
+
+    @en_loop_postgres
+    async def cerrar_tarea(self, nombre: str, propietario: str, proxima: float, ahora: float, duracion_ms: float,
+                           resultado: str, error: Optional[str]):
+        async with self._conexion() as conn:
+            await conn.execute(
+                """UPDATE tareas_programadas SET propietario = NULL, bloqueada_hasta = NULL, proxima = $1,
+                   ultima_ejecucion = $2, ultima_duracion_ms = $3, ultimo_resultado = $4, ultimo_error = $5,
+                   ejecuciones = ejecuciones + 1
+                   WHERE nombre = $6 AND propietario = $7""",
+                proxima, ahora, duracion_ms, resultado, error, nombre, propietario
+            )
+
+    # Copia desde SQLite
+
+    @en_loop_postgres
+    async def copiar_sqlite(self, origen: str, carpeta_shards: str) -> dict:
+        # Copia una instalación SQLite (la BD principal y sus shards) a esta
+        # base, que debe estar vacía, en una sola transacción y conservando
+        # los ids. Los triggers se desactivan: versiones y registro de cambios
+        # se copian tal cual
+        principal = sqlite3.connect(f"file:{origen}?mode=ro", uri=True)
+        principal.row_factory = sqlite3.Row
+        fuentes = [principal]
+        try:
+            if principal.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'directorio_shards'"
+            ).fetchone():
+                repartidos = principal.execute("SELECT shard, MIN(estado = 'activo') FROM directorio_shards GROUP BY shard").fetchall()
+                if not all(fila[1] for fila in repartidos):
+                    raise ValueError("Hay usuarios migrando entre shards: espera a que terminen")
+                for fila in repartidos:
+                    fuente = sqlite3.connect(f"file:{os.path.join(carpeta_shards, fila[0] + '.db')}?mode=ro", uri=True)
+                    fuente.row_factory = sqlite3.Row
+                    fuentes.append(fuente)
+
+            async with self._transaccion() as conn:
+                if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM usuarios)"):
+                    raise ValueError("La base PostgreSQL de destino no está vacía")
+                return await self._copiar_fuentes(conn, fuentes)
+        finally:
+            for fuente in fuentes:
+                fuente.close()
+
+    async def _copiar_fuentes(self, conn: ConexionPostgres, fuentes: list) -> dict:
+        tablas = ("usuarios", "refresh_tokens", "tokens_revocados", "clientes", "visitas", "presupuestos",
+                  "lineas_presupuesto", "firmas", "secuencias_presupuesto", "versiones_datos", "cambios_sync",
+                  "sync_horizonte", "peticiones_sync")
+        solo_principal = {"usuarios", "refresh_tokens", "tokens_revocados"}
+        sin_id = {"firmas", "peticiones_sync"}  # toman ids nuevos
+        # Tablas por usuario que podrían repetirse entre fuentes: gana el mayor valor
+        maximos = {"secuencias_presupuesto": (("usuario_id", "anio"), "ultimo"),
+                   "versiones_datos": (("usuario_id", "tabla"), "version"),
+                   "sync_horizonte": (("usuario_id",), "seq")}
+        conversores = {"bigint": int, "integer": int, "double precision": float, "boolean": bool, "bytea": bytes,
+                       "text": str}
+
+        # Cada shard numera su registro de cambios por separado: el de cada
+        # fuente va detrás del de la anterior. El orden por usuario se mantiene
+        # y los cursores de los clientes siguen siendo válidos (como mucho
+        # reciben de nuevo algún cambio)
+        desplazamientos, acumulado = [], 0
+        for fuente in fuentes:
+            desplazamientos.append(acumulado)
+            acumulado += fuente.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios_sync").fetchone()[0]
+
+        for tabla in tablas:
+            await conn.execute(f"ALTER TABLE {tabla} DISABLE TRIGGER USER")
+
+        copiadas = {}
+        vistos = {"presupuestos": set(), "firmas": set()}
+        for tabla in tablas:
+            tipos = {fila["column_name"]: fila["data_type"] for fila in await conn.fetch(
+                """SELECT column_name, data_type FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = $1 AND is_generated = 'NEVER'
+                   ORDER BY ordinal_position""",
+                tabla
+            )}
+            if tabla in sin_id:
+                del tipos["id"]
+            filas, por_clave = [], {}
+            for fuente, desplazamiento in zip(fuentes[:1] if tabla in solo_principal else fuentes, desplazamientos):
+                existentes = {fila[1] for fila in fuente.execute(f"PRAGMA table_info({tabla})")}
+                columnas = [c for c in tipos if c in existentes]
+                for fila in fuente.execute(f"SELECT {', '.join(columnas)} FROM {tabla}"):
+                    valores = {c: None if v is None else conversores.get(tipos[c], lambda x: x)(v)
+                               for c, v in zip(columnas, fila)}
+                    if tabla == "lineas_presupuesto" and valores["presupuesto_id"] not in vistos["presupuestos"]:
+                        continue  # líneas de presupuestos ya borrados
+                    if tabla in vistos:
+                        clave = valores["id" if tabla == "presupuestos" else "hash"]
+                        if clave in vistos[tabla]:
+                            continue
+                        vistos[tabla].add(clave)
+                    if tabla == "cambios_sync":
+                        valores["seq"] += desplazamiento
+                    if tabla in maximos:
+                        clave, campo = tuple(valores[c] for c in maximos[tabla][0]), maximos[tabla][1]
+                        if clave not in por_clave or por_clave[clave][campo] < valores[campo]:
+                            por_clave[clave] = valores
+                    else:
+                        filas.append(valores)
+            filas += por_clave.values()
+            await conn.copiar(tabla, tuple(tipos), [tuple(f.get(c) for c in tipos) for f in filas])
+            copiadas[tabla] = len(filas)
+
+        for tabla in tablas:
+            await conn.execute(f"ALTER TABLE {tabla} ENABLE TRIGGER USER")
+        # Contadores y agregados, con los triggers apagados, se calculan al final
+        for sql in sql_reconstruir_resumen() + sql_reconstruir_analitica():
+            await conn.execute(sql)
+        # Las identidades siguen desde el mayor id copiado
+        for tabla, columna in await conn.fetch(
+            """SELECT table_name, column_name FROM information_schema.columns
+               WHERE table_schema = current_schema() AND is_identity = 'YES'"""
+        ):
+            await conn.execute(
+                f"SELECT setval(pg_get_serial_sequence('{tabla}', '{columna}'), COALESCE(MAX({columna}), 0) + 1, false) "
+                f"FROM {tabla}"
+            )
+        return copiadas
+
+    def stats(self) -> dict:
+        pool = self._pool
+        return {
+            "size": pool.get_max_size(),
+            "open": pool.get_size(),
+            "idle": pool.get_idle_size(),
+            "in_use": pool.get_size() - pool.get_idle_size(),
+            "checkouts": self._checkouts,
+            "wait_time_ms": round(self._espera * 1000, 2),
+            "timeouts": self._timeouts,
+        }
+
+    async def _cerrar_pool(self):
+        try:
+            await asyncio.wait_for(self._pool.close(), DB_POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._pool.terminate()
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        if self._pool is not None:
+            self._ejecutar(self._cerrar_pool())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._hilo.join()
+        self._loop.close()
+
+# ============ TAREAS PROGRAMADAS ============
+
+# Las mismas tareas sobre PostgreSQL. Son corrutinas que se ejecutan en el
+# hilo del pool; el mantenimiento de SQLite (checkpoint, vacuum, analyze) lo
+# hace aquí el autovacuum del servidor
+
+async def purgar_presupuestos_postgres(conn: ConexionPostgres, dry_run: bool) -> dict:
+    # Por lotes; SKIP LOCKED evita esperar a los presupuestos que se estén editando
+    limite = (datetime.now() - timedelta(days=REJECTED_RETENTION_DAYS)).isoformat()
+    if dry_run:
+        fila = await conn.fetchrow(
+            """SELECT COUNT(*) AS presupuestos, COUNT(DISTINCT usuario_id) AS usuarios,
+                      (SELECT COUNT(*) FROM lineas_presupuesto l JOIN presupuestos p ON p.id = l.presupuesto_id
+                       WHERE p.estado = 'rechazado' AND p.fecha_rechazo < $1) AS lineas
+               FROM presupuestos WHERE estado = 'rechazado' AND fecha_rechazo < $1""",
+            limite
+        )
+        return dict(fila)
+
+    presupuestos = lineas = lotes = 0
+    usuarios = set()
+    while True:
+        async with conn.transaction():
+            filas = await conn.fetch(
+                """SELECT id, usuario_id FROM presupuestos
+                   WHERE estado = 'rechazado' AND fecha_rechazo < $1
+                   ORDER BY fecha_rechazo LIMIT $2 FOR UPDATE SKIP LOCKED""",
+                limite, PURGE_BATCH_SIZE
+            )
+            if not filas:
+                break
+            ids = [fila["id"] for fila in filas]
+            # Las líneas se borran en cascada; se cuentan antes para el resumen
+            lineas += await conn.fetchval(
+                "SELECT COUNT(*) FROM lineas_presupuesto WHERE presupuesto_id = ANY($1::bigint[])", ids
+            )
+            presupuestos += await conn.execute("DELETE FROM presupuestos WHERE id = ANY($1::bigint[])", ids)
+        lote_usuarios = {fila["usuario_id"] for fila in filas}
+        for usuario_id in lote_usuarios:
+            invalidar_cache(usuario_id)
+        usuarios |= lote_usuarios
+        lotes += 1
+    return {"presupuestos": presupuestos, "usuarios": len(usuarios), "lineas": lineas, "lotes": lotes}
+
+async def purgar_tokens_postgres(conn: ConexionPostgres, dry_run: bool) -> dict:
+    ahora = time.time()
+    resultado = {}
+    for tabla in ("refresh_tokens", "tokens_revocados"):
+        if dry_run:
+            resultado[tabla] = await conn.fetchval(f"SELECT COUNT(*) FROM {tabla} WHERE expira < $1", ahora)
+            continue
+        resultado[tabla] = 0
+        while True:
+            borrados = await conn.execute(
+                f"DELETE FROM {tabla} WHERE id IN (SELECT id FROM {tabla} WHERE expira < $1 LIMIT $2)",
+                ahora, PURGE_BATCH_SIZE
+            )
+            resultado[tabla] += borrados
+            if borrados < PURGE_BATCH_SIZE:
+                break
+    return resultado
+
+async def limpiar_pdf_postgres(conn: ConexionPostgres, dry_run: bool) -> dict:
+    # Ficheros locales: no toca la BD y no debe bloquear el loop del pool
+    return await asyncio.to_thread(limpiar_cache_pdf, None, dry_run)
+
+async def limpiar_sync_postgres(conn: ConexionPostgres, dry_run: bool) -> dict:
+    # Como limpiar_sync
+    ahora = datetime.utcnow()
+    limite_borrados = (ahora - timedelta(days=SYNC_TOMBSTONE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    limite_peticiones = (ahora - timedelta(days=SYNC_REQUEST_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    if dry_run:
+        return {
+            "borrados": await conn.fetchval(
+                "SELECT COUNT(*) FROM cambios_sync WHERE borrado AND fecha < $1", limite_borrados
+            ),
+            "peticiones": await conn.fetchval(
+                "SELECT COUNT(*) FROM peticiones_sync WHERE created_at < $1", limite_peticiones
+            ),
+        }
+
+    await conn.execute(
+        """INSERT INTO sync_horizonte (usuario_id, seq)
+           SELECT usuario_id, MAX(seq) FROM cambios_sync WHERE borrado AND fecha < $1 GROUP BY usuario_id
+           ON CONFLICT (usuario_id) DO UPDATE SET seq = GREATEST(sync_horizonte.seq, excluded.seq)""",
+        limite_borrados
+    )
+    resultado = {}
+    for clave, tabla, clave_fila, condicion, limite in (
+        ("borrados", "cambios_sync", "seq", "borrado AND fecha < $1", limite_borrados),
+        ("peticiones", "peticiones_sync", "id", "created_at < $1", limite_peticiones),
+    ):
+        resultado[clave] = 0
+        while True:
+            borrados = await conn.execute(
+                f"DELETE FROM {tabla} WHERE {clave_fila} IN (SELECT {clave_fila} FROM {tabla} WHERE {condicion} LIMIT $2)",
+                limite, PURGE_BATCH_SIZE
+            )
+            resultado[clave] += borrados
+            if borrados < PURGE_BATCH_SIZE:
+                break
+    return resultado
+
+TAREAS_POSTGRES = {
+    "purgar_presupuestos": (3600, purgar_presupuestos_postgres),
+    "purgar_tokens": (3600, purgar_tokens_postgres),
+    "limpiar_pdf": (24 * 3600, limpiar_pdf_postgres),
+    "limpiar_sync": (24 * 3600, limpiar_sync_postgres),
+}
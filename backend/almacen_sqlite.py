@@ -0,0 +1,2645 @@
+"""
+Almacén SQLite (DB_BACKEND=sqlite): pool de conexiones, esquema, migraciones,
+shards por usuario y tareas de mantenimiento.
+"""
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+from typing import Optional, List
+from datetime import date, datetime, timedelta
+import contextvars
+import json
+import base64
+import binascii
+import hashlib
+import sqlite3
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import (
+    logger, ACCESS_TOKEN_EXPIRE_MINUTES, DATABASE_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_BUSY_TIMEOUT_MS,
+    DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_STATEMENT_CACHE, DB_SHARDING, DB_SHARD_COUNT, DB_SHARD_DIR,
+    DB_SHARD_OPEN_MAX, DB_SHARD_POOL_SIZE, DB_SHARD_CACHE_SECONDS, EXPORT_CHUNK_SIZE, FIRMA_CHUNK_SIZE,
+    PDF_CACHE_DIR, PDF_CACHE_DAYS, SYNC_TOMBSTONE_DAYS, SYNC_REQUEST_DAYS, SCHEDULER_LOCK_SECONDS,
+    REJECTED_RETENTION_DAYS, PURGE_BATCH_SIZE, VACUUM_MAX_PAGES, METRICS_ENABLED
+)
+from metricas import ConexionInstrumentada
+from modelos import (
+    UserRegister, ClienteCreate, ClienteResponse, VisitaCreate, VisitaResponse, LineaPresupuesto,
+    PresupuestoCreate, PresupuestoResponse, filas_respuesta
+)
+from cache import invalidar_cache
+from almacen import (
+    calcular_totales, codificar_cursor, decodificar_cursor, lista_estados, Almacen, CAMPOS_CLIENTE, CAMPOS_VISITA,
+    diferencias_lineas, COLUMNAS_EXPORTACION, CAMPOS_LINEA, tramos_analitica, DESGLOSES_ROLLUP
+)
+
+# ============ BASE DE DATOS ============
+
+# PRAGMAs aplicados a cada conexión nueva del pool
+DB_PRAGMAS = [
+    # Solo tiene efecto en una BD nueva (antes de pasar a WAL); en una
+    # existente hace falta `python main.py mantenimiento --vacuum-completo`
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+]
+
+def abrir_conexion(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE,
+        factory=ConexionInstrumentada if METRICS_ENABLED else sqlite3.Connection,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class PoolAgotado(Exception):
+    """No quedó ninguna conexión libre del pool en DB_POOL_TIMEOUT segundos"""
+
+class ConnectionPool:
+    """Pool de conexiones SQLite compartido entre los hilos del servidor.
+
+    Las conexiones se crean bajo demanda hasta `size` y se reutilizan; cada una
+    mantiene su propia caché de sentencias preparadas (`cached_statements`).
+    """
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle: List[sqlite3.Connection] = []
+        self._cond = threading.Condition()
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._cerrado = False
+
+    def _connect(self) -> sqlite3.Connection:
+        return abrir_conexion(self.path)
+
+    def acquire(self) -> sqlite3.Connection:
+        conn = None
+        with self._cond:
+            started = None
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    break
+                # Pool agotado: esperar a que se libere una conexión
+                now = time.monotonic()
+                if started is None:
+                    started = now
+                    self._waits += 1
+                remaining = self.timeout - (now - started)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    self._wait_time += now - started
+                    raise PoolAgotado()
+                self._cond.wait(remaining)
+            if started is not None:
+                self._wait_time += time.monotonic() - started
+            self._checkouts += 1
+            self._in_use += 1
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._created -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        try:
+            # No devolver al pool una transacción a medias
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._cond:
+                self._created -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+            if not self._cerrado:
+                self._idle.append(conn)
+                return
+            self._created -= 1
+        # Pool ya cerrado (shard desalojado): la conexión no vuelve
+        conn.close()
+
+    def close(self):
+        with self._cond:
+            self._cerrado = True
+            while self._idle:
+                self._idle.pop().close()
+                self._created -= 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._created,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_ms": round(self._wait_time * 1000, 2),
+                "timeouts": self._timeouts,
+            }
+
+db_pool = ConnectionPool(DATABASE_PATH)
+
+_db_local = threading.local()
+
+# Usuario de la petición en curso; lo fija get_current_user y decide a qué
+# shard van las conexiones de get_db()
+usuario_peticion = contextvars.ContextVar("usuario_peticion", default=None)
+
+def pool_db(usuario_id: Optional[int] = None, principal: bool = False) -> ConnectionPool:
+    # Pool del shard del usuario (el indicado o el de la petición en curso);
+    # sin usuario, sin shards o con principal=True, el de DATABASE_PATH
+    if principal or DB_SHARDING == "no":
+        return db_pool
+    if usuario_id is None:
+        usuario_id = usuario_peticion.get()
+    return db_pool if usuario_id is None else shards.pool_usuario(usuario_id)
+
+@contextmanager
+def get_db(usuario_id: Optional[int] = None, principal: bool = False):
+    # Reentrante: las llamadas anidadas en el mismo hilo (p. ej. obtener_visita
+    # dentro de crear_visita) reutilizan la conexión ya prestada por ese pool
+    pool = pool_db(usuario_id, principal)
+    prestadas = getattr(_db_local, "conns", None)
+    if prestadas is None:
+        prestadas = _db_local.conns = {}
+    conn = prestadas.get(pool)
+    if conn is not None:
+        yield conn
+        return
+
+    conn = pool.acquire()
+    prestadas[pool] = conn
+    try:
+        yield conn
+    finally:
+        del prestadas[pool]
+        pool.release(conn)
+
+def crear_tablas(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    
+    # Tabla usuarios
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            apellidos TEXT,
+            email TEXT UNIQUE NOT NULL,
+            telefono TEXT,
+            empresa TEXT,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Tabla clientes
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS clientes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            nombre TEXT NOT NULL,
+            apellidos TEXT,
+            email TEXT,
+            telefono TEXT NOT NULL,
+            telefono_secundario TEXT,
+            direccion TEXT,
+            ciudad TEXT,
+            codigo_postal TEXT,
+            provincia TEXT,
+            tipo TEXT DEFAULT 'particular',
+            nif_cif TEXT,
+            notas TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
+        )
+    """)
+    
+    # Tabla visitas
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS visitas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            cliente_id INTEGER NOT NULL,
+            titulo TEXT NOT NULL,
+            descripcion TEXT,
+            fecha DATE NOT NULL,
+            hora TIME,
+            tipo TEXT DEFAULT 'reparacion',
+            estado TEXT DEFAULT 'pendiente',
+            prioridad TEXT DEFAULT 'normal',
+            notas_internas TEXT,
+            firma_cliente TEXT,
+            nombre_firmante TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
+            FOREIGN KEY (cliente_id) REFERENCES clientes(id)
+        )
+    """)
+    
+    # Tabla presupuestos
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS presupuestos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            cliente_id INTEGER NOT NULL,
+            numero TEXT UNIQUE NOT NULL,
+            titulo TEXT NOT NULL,
+            descripcion TEXT,
+            subtotal REAL DEFAULT 0,
+            iva_porcentaje REAL DEFAULT 21,
+            aplicar_iva BOOLEAN DEFAULT 1,
+            iva_amount REAL DEFAULT 0,
+            total REAL DEFAULT 0,
+            estado TEXT DEFAULT 'borrador',
+            fecha_emision DATE,
+            fecha_validez DATE,
+            fecha_rechazo TIMESTAMP,
+            notas TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
+            FOREIGN KEY (cliente_id) REFERENCES clientes(id)
+        )
+    """)
+    
+    # Tabla líneas de presupuesto
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lineas_presupuesto (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            presupuesto_id INTEGER NOT NULL,
+            concepto TEXT NOT NULL,
+            descripcion TEXT,
+            cantidad REAL DEFAULT 1,
+            precio_unitario REAL DEFAULT 0,
+            total REAL DEFAULT 0,
+            orden INTEGER DEFAULT 0,
+            FOREIGN KEY (presupuesto_id) REFERENCES presupuestos(id) ON DELETE CASCADE
+        )
+    """)
+    
+    conn.commit()
+
+# ============ RESUMEN POR USUARIO ============
+
+# Contadores por usuario que alimentan el dashboard y las estadísticas sin
+# recorrer las tablas. Los mantienen los triggers creados en la migración 2.
+# Claves:
+#   clientes                      número de clientes
+#   visitas:estado:<estado>       visitas por estado
+#   visitas:fecha:<AAAA-MM-DD>    visitas por día
+#   presupuestos:estado:<estado>  presupuestos por estado
+#   facturacion:<AAAA-MM>         importe aceptado por mes de emisión
+SQL_RESUMEN_CALCULADO = """
+    SELECT usuario_id, 'clientes' AS clave, COUNT(*) AS valor
+    FROM clientes GROUP BY usuario_id
+    UNION ALL
+    SELECT usuario_id, 'visitas:estado:' || COALESCE(estado, ''), COUNT(*)
+    FROM visitas GROUP BY usuario_id, COALESCE(estado, '')
+    UNION ALL
+    SELECT usuario_id, 'visitas:fecha:' || fecha, COUNT(*)
+    FROM visitas GROUP BY usuario_id, fecha
+    UNION ALL
+    SELECT usuario_id, 'presupuestos:estado:' || COALESCE(estado, ''), COUNT(*)
+    FROM presupuestos GROUP BY usuario_id, COALESCE(estado, '')
+    UNION ALL
+    SELECT usuario_id, 'facturacion:' || substr(fecha_emision, 1, 7), SUM(total)
+    FROM presupuestos WHERE estado = 'aceptado' AND fecha_emision IS NOT NULL
+    GROUP BY usuario_id, substr(fecha_emision, 1, 7)
+"""
+
+def _sql_sumar_contador(usuario: str, clave: str, valor: str, condicion: str = "1") -> str:
+    return f"""INSERT INTO resumen_contadores (usuario_id, clave, valor)
+        SELECT {usuario}, {clave}, {valor} WHERE {condicion}
+        ON CONFLICT (usuario_id, clave) DO UPDATE SET valor = valor + excluded.valor;"""
+
+def _sql_contadores_visita(fila: str, signo: str) -> str:
+    return (
+        _sql_sumar_contador(f"{fila}.usuario_id", f"'visitas:estado:' || COALESCE({fila}.estado, '')", signo)
+        + _sql_sumar_contador(f"{fila}.usuario_id", f"'visitas:fecha:' || {fila}.fecha", signo)
+    )
+
+def _sql_contadores_presupuesto(fila: str, signo: str) -> str:
+    return (
+        _sql_sumar_contador(f"{fila}.usuario_id", f"'presupuestos:estado:' || COALESCE({fila}.estado, '')", signo)
+        + _sql_sumar_contador(
+            f"{fila}.usuario_id", f"'facturacion:' || substr({fila}.fecha_emision, 1, 7)",
+            f"{signo} * COALESCE({fila}.total, 0)",
+            f"{fila}.estado = 'aceptado' AND {fila}.fecha_emision IS NOT NULL"
+        )
+    )
+
+def sql_reconstruir_resumen(filtro: str = "") -> List[str]:
+    # Sirve también para PostgreSQL, con su marcador en `filtro`
+    return [
+        f"DELETE FROM resumen_contadores {filtro}",
+        f"INSERT INTO resumen_contadores (usuario_id, clave, valor) "
+        f"SELECT usuario_id, clave, valor FROM ({SQL_RESUMEN_CALCULADO}) r {filtro}",
+    ]
+
+def reconstruir_resumen(conn: sqlite3.Connection, usuario_id: Optional[int] = None):
+    filtro, params = ("WHERE usuario_id = ?", (usuario_id,)) if usuario_id is not None else ("", ())
+    for sql in sql_reconstruir_resumen(filtro):
+        conn.execute(sql, params)
+
+def verificar_resumen(conn: sqlite3.Connection, usuario_id: Optional[int] = None) -> List[dict]:
+    # Compara los contadores guardados con los recalculados desde las tablas;
+    # una clave ausente equivale a 0
+    filtro, params = ("WHERE usuario_id = ?", (usuario_id,)) if usuario_id is not None else ("", ())
+    guardado = {
+        (r[0], r[1]): r[2]
+        for r in conn.execute(f"SELECT usuario_id, clave, valor FROM resumen_contadores {filtro}", params)
+    }
+    calculado = {
+        (r[0], r[1]): r[2]
+        for r in conn.execute(f"SELECT usuario_id, clave, valor FROM ({SQL_RESUMEN_CALCULADO}) {filtro}", params)
+    }
+    return comparar_contadores(guardado, calculado)
+
+def comparar_contadores(guardado: dict, calculado: dict) -> List[dict]:
+    # {(usuario, clave): valor} guardado frente a recalculado
+    desviaciones = []
+    for usuario, clave in sorted(set(guardado) | set(calculado)):
+        esperado = calculado.get((usuario, clave), 0)
+        actual = guardado.get((usuario, clave), 0)
+        if abs(esperado - actual) > 0.005:
+            desviaciones.append({"usuario_id": usuario, "clave": clave, "esperado": esperado, "actual": actual})
+    return desviaciones
+
+def _sql_incrementar_version(usuario: str, tabla: str, condicion: str = "1") -> str:
+    return f"""INSERT INTO versiones_datos (usuario_id, tabla, version)
+        SELECT {usuario}, '{tabla}', 1 WHERE {usuario} IS NOT NULL AND {condicion}
+        ON CONFLICT (usuario_id, tabla) DO UPDATE SET version = version + 1;"""
+
+def _sql_triggers_version(tabla: str, version: str, usuario: str) -> List[str]:
+    # `usuario` es la expresión que da el dueño de la fila, con {fila} en lugar
+    # de NEW/OLD
+    nuevo = usuario.replace("{fila}", "NEW")
+    viejo = usuario.replace("{fila}", "OLD")
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_version_{tabla}_insert AFTER INSERT ON {tabla} BEGIN
+            {_sql_incrementar_version(nuevo, version)}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_version_{tabla}_update AFTER UPDATE ON {tabla} BEGIN
+            {_sql_incrementar_version(viejo, version)}
+            {_sql_incrementar_version(nuevo, version, f"{nuevo} IS NOT {viejo}")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_version_{tabla}_delete AFTER DELETE ON {tabla} BEGIN
+            {_sql_incrementar_version(viejo, version)}
+        END""",
+    ]
+
+def leer_contadores(cursor, usuario_id: int, claves: List[str]) -> dict:
+    cursor.execute(
+        "SELECT clave, valor FROM resumen_contadores WHERE usuario_id = ? AND clave IN (SELECT value FROM json_each(?))",
+        (usuario_id, json.dumps(claves))
+    )
+    valores = {row["clave"]: row["valor"] for row in cursor.fetchall()}
+    return {clave: valores.get(clave, 0) for clave in claves}
+
+# ============ ANALÍTICA (ROLLUPS) ============
+
+# Agregados por día ('d') y por mes ('m') que sirven rangos arbitrarios sin
+# recorrer presupuestos ni visitas: los meses completos salen de las filas
+# mensuales y los extremos sueltos de las diarias. Los mantienen triggers
+# (migración 9) igual que resumen_contadores: al insertar se suma la fila, al
+# borrar se resta y al modificar se resta la vieja y se suma la nueva.
+#   analitica_presupuestos  por fecha de emisión y cliente
+#   analitica_visitas       por fecha de la visita y tipo
+GRANULARIDADES = {"d": 10, "m": 7}  # longitud de `periodo` (AAAA-MM-DD / AAAA-MM)
+
+# tabla -> (origen, columna de fecha, dimensión, métricas). Las métricas son
+# expresiones sobre una fila, con {fila} en lugar de NEW/OLD; nunca NULL (un
+# estado NULL no es ninguno de los contados). Valen también en PostgreSQL,
+# donde una comparación es boolean y hay que pasarla a entero con CAST
+ROLLUPS = {
+    "analitica_presupuestos": ("presupuestos", "fecha_emision", ("cliente_id", "{fila}.cliente_id"), {
+        "emitidos": "1",
+        "aceptados": "CAST(COALESCE({fila}.estado, '') = 'aceptado' AS INTEGER)",
+        "rechazados": "CAST(COALESCE({fila}.estado, '') = 'rechazado' AS INTEGER)",
+        "importe": "COALESCE({fila}.total, 0)",
+        "facturado": "CAST(COALESCE({fila}.estado, '') = 'aceptado' AS INTEGER) * COALESCE({fila}.total, 0)",
+    }),
+    "analitica_visitas": ("visitas", "fecha", ("tipo", "COALESCE({fila}.tipo, '')"), {
+        "total": "1",
+        "completadas": "CAST(COALESCE({fila}.estado, '') = 'completada' AS INTEGER)",
+        "canceladas": "CAST(COALESCE({fila}.estado, '') = 'cancelada' AS INTEGER)",
+    }),
+}
+
+def claves_rollup(tabla: str, fila: str, granularidad: str) -> dict:
+    _, fecha, (dimension, expresion), _ = ROLLUPS[tabla]
+    return {
+        "usuario_id": f"{fila}.usuario_id",
+        "granularidad": f"'{granularidad}'",
+        "periodo": f"substr({fila}.{fecha}, 1, {GRANULARIDADES[granularidad]})",
+        dimension: expresion.replace("{fila}", fila),
+    }
+
+def _sql_sumar_rollup(tabla: str, fila: str, signo: str) -> str:
+    origen, fecha, _, metricas = ROLLUPS[tabla]
+    sql = ""
+    for granularidad in GRANULARIDADES:
+        claves = claves_rollup(tabla, fila, granularidad)
+        valores = {m: f"{signo} * {e.replace('{fila}', fila)}" for m, e in metricas.items()}
+        sql += f"""INSERT INTO {tabla} ({', '.join([*claves, *valores])})
+        SELECT {', '.join([*claves.values(), *valores.values()])} WHERE {fila}.{fecha} IS NOT NULL
+        ON CONFLICT ({', '.join(claves)}) DO UPDATE SET {', '.join(f'{m} = {m} + excluded.{m}' for m in valores)};"""
+    return sql
+
+def _sql_limpiar_rollup(tabla: str) -> str:
+    # Tras restar, las filas que se quedan sin elementos sobran
+    primera = next(iter(ROLLUPS[tabla][3]))
+    condiciones = []
+    for granularidad in GRANULARIDADES:
+        claves = claves_rollup(tabla, "OLD", granularidad)
+        condiciones.append("(" + " AND ".join(f"{c} = {e}" for c, e in claves.items()) + ")")
+    return f"DELETE FROM {tabla} WHERE {primera} = 0 AND ({' OR '.join(condiciones)});"
+
+def _sql_triggers_rollup(tabla: str) -> List[str]:
+    origen, fecha, (dimension, _), metricas = ROLLUPS[tabla]
+    # Columnas de las que depende la fila agregada
+    vigiladas = {"presupuestos": "usuario_id, cliente_id, estado, total, fecha_emision",
+                 "visitas": "usuario_id, tipo, estado, fecha"}[origen]
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{tabla}_insert AFTER INSERT ON {origen} BEGIN
+            {_sql_sumar_rollup(tabla, "NEW", "1")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{tabla}_delete AFTER DELETE ON {origen} BEGIN
+            {_sql_sumar_rollup(tabla, "OLD", "-1")}
+            {_sql_limpiar_rollup(tabla)}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{tabla}_update AFTER UPDATE OF {vigiladas} ON {origen} BEGIN
+            {_sql_sumar_rollup(tabla, "OLD", "-1")}
+            {_sql_sumar_rollup(tabla, "NEW", "1")}
+            {_sql_limpiar_rollup(tabla)}
+        END""",
+    ]
+
+def _sql_rollup_calculado(tabla: str) -> str:
+    # El contenido que debería tener `tabla`, calculado desde el origen
+    origen, fecha, _, metricas = ROLLUPS[tabla]
+    partes = []
+    for granularidad in GRANULARIDADES:
+        claves = claves_rollup(tabla, origen, granularidad)
+        columnas = [f"{e} AS {c}" for c, e in claves.items()]
+        columnas += [f"SUM({e.replace('{fila}', origen)}) AS {m}" for m, e in metricas.items()]
+        partes.append(
+            f"SELECT {', '.join(columnas)} FROM {origen} WHERE {fecha} IS NOT NULL "
+            f"GROUP BY {', '.join(str(n) for n in range(1, len(claves) + 1))}"
+        )
+    return " UNION ALL ".join(partes)
+
+def sql_reconstruir_analitica(filtro: str = "") -> List[str]:
+    # Como sql_reconstruir_resumen, para los rollups
+    return [sql for tabla in ROLLUPS for sql in (
+        f"DELETE FROM {tabla} {filtro}",
+        f"INSERT INTO {tabla} SELECT * FROM ({_sql_rollup_calculado(tabla)}) r {filtro}",
+    )]
+
+def reconstruir_analitica(conn: sqlite3.Connection, usuario_id: Optional[int] = None):
+    filtro, params = ("WHERE usuario_id = ?", (usuario_id,)) if usuario_id is not None else ("", ())
+    for sql in sql_reconstruir_analitica(filtro):
+        conn.execute(sql, params)
+
+def sql_diferencias_analitica(tabla: str, filtro: str = "") -> List[str]:
+    # Cuentan las filas guardadas que no salen al recalcular y al revés. Los
+    # importes se comparan redondeados: sumar de uno en uno o de golpe no da
+    # exactamente el mismo float
+    _, _, (dimension, _), metricas = ROLLUPS[tabla]
+    columnas = ", ".join(["usuario_id", "granularidad", "periodo", dimension,
+                          *[f"ROUND(CAST({m} AS NUMERIC), 2)" for m in metricas]])
+    guardado = f"SELECT {columnas} FROM {tabla} {filtro}"
+    calculado = f"SELECT {columnas} FROM ({_sql_rollup_calculado(tabla)}) r {filtro}"
+    return [f"SELECT COUNT(*) FROM ({a} EXCEPT {b}) d" for a, b in ((guardado, calculado), (calculado, guardado))]
+
+def verificar_analitica(conn: sqlite3.Connection, usuario_id: Optional[int] = None) -> dict:
+    # Filas que difieren entre lo guardado y lo recalculado, por tabla
+    filtro, params = ("WHERE usuario_id = ?", (usuario_id,)) if usuario_id is not None else ("", ())
+    return {
+        tabla: sum(conn.execute(sql, params * 2).fetchone()[0] for sql in sql_diferencias_analitica(tabla, filtro))
+        for tabla in ROLLUPS
+    }
+
+def leer_rollup(cursor, tabla: str, user_id: int, inicio: date, fin: date, agrupar: str,
+                dimension: Optional[str] = None, nombre: str = "", origen: str = "") -> List[dict]:
+    # Suma las métricas de `tabla` en el rango por periodo (y por `dimension`)
+    tramos = tramos_analitica(inicio, fin, agrupar)
+    # Cada tramo es un rango de la clave primaria y se agrega por separado
+    # (con OR SQLite volvería a buscar cada fila por su clave). Las filas
+    # mensuales se agrupan en el orden del índice, sin ordenar nada
+    metricas = ROLLUPS[tabla][3]
+    agrupacion = f"1{f', {dimension}' if dimension else ''}"
+    partes = []
+    for granularidad, _, _ in tramos:
+        periodo = "periodo" if granularidad == "m" or agrupar == "dia" else "substr(periodo, 1, 7)"
+        partes.append(
+            f"""SELECT {periodo} AS periodo{f', {dimension}' if dimension else ''},
+                   {', '.join(f'SUM({m}) AS {m}' for m in metricas)}
+               FROM {tabla} WHERE usuario_id = ? AND granularidad = ? AND periodo BETWEEN ? AND ?
+               GROUP BY {agrupacion}"""
+        )
+    params = [valor for tramo in tramos for valor in (user_id, *tramo)]
+
+    columnas = ["a.periodo", *([f"a.{dimension}"] if dimension else []), *([nombre] if nombre else [])]
+    cursor.execute(
+        f"""SELECT {', '.join(columnas)}, {', '.join(f'SUM(a.{m}) AS {m}' for m in metricas)}
+            FROM ({' UNION ALL '.join(partes)}) a {origen}
+            GROUP BY {agrupacion}
+            ORDER BY 1{f', {next(iter(metricas))} DESC, 2' if dimension else ''}""",
+        params
+    )
+    return [dict(row) for row in cursor.fetchall()]
+
+# ============ ALMACÉN DE FIRMAS ============
+
+# Las firmas se guardan una sola vez en `firmas`, direccionadas por el SHA-256
+# de la imagen y comprimidas con zlib cuando compensa. `visitas.firma_hash`
+# apunta a ellas y las respuestas de visitas solo llevan esa referencia; la
+# imagen se sirve aparte en GET /api/firmas/{hash}.
+
+def decodificar_firma(data_url: str) -> tuple:
+    # "data:image/png;base64,iVBOR..." -> ("image/png", bytes). Sin cabecera se asume PNG
+    mime, datos = "image/png", data_url.strip()
+    if datos.startswith("data:"):
+        cabecera, separador, datos = datos.partition(",")
+        if not separador or not cabecera.endswith(";base64"):
+            raise ValueError("La firma debe ser una data URL en base64")
+        mime = cabecera[5:-7] or mime
+    try:
+        contenido = base64.b64decode(datos, validate=True)
+    except (ValueError, binascii.Error):
+        raise ValueError("La firma no está en base64 válido")
+    if not contenido:
+        raise ValueError("La firma está vacía")
+    return mime, contenido
+
+# Formatos que ya van comprimidos: se guardan tal cual y se sirven por trozos
+MIMES_COMPRIMIDOS = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+
+def codificar_firma(mime: str, contenido: bytes) -> tuple:
+    # zlib solo se queda si ahorra al menos un 10 %
+    if mime in MIMES_COMPRIMIDOS:
+        return "identity", contenido
+    comprimido = zlib.compress(contenido, 9)
+    return ("zlib", comprimido) if len(comprimido) < len(contenido) * 0.9 else ("identity", contenido)
+
+def leer_contenido_firma(codificacion: str, datos: bytes) -> bytes:
+    return zlib.decompress(datos) if codificacion == "zlib" else bytes(datos)
+
+def descomprimir_trozos(trozos, inicio: int, fin: int):
+    # Descomprime al vuelo los trozos de una firma zlib y entrega solo
+    # [inicio, fin], sin tener nunca más de FIRMA_CHUNK_SIZE descomprimidos
+    descompresor = zlib.decompressobj()
+    posicion = 0
+    try:
+        for trozo in trozos:
+            while trozo and posicion <= fin:
+                salida = descompresor.decompress(trozo, FIRMA_CHUNK_SIZE)
+                trozo = descompresor.unconsumed_tail
+                if salida and inicio < posicion + len(salida):
+                    yield salida[max(inicio - posicion, 0):fin + 1 - posicion]
+                posicion += len(salida)
+            if posicion > fin:
+                return
+        salida = descompresor.flush()
+        if salida and inicio < posicion + len(salida):
+            yield salida[max(inicio - posicion, 0):fin + 1 - posicion]
+    finally:
+        trozos.close()
+
+def guardar_firma(conn: sqlite3.Connection, mime: str, contenido: bytes) -> str:
+    firma_hash = hashlib.sha256(contenido).hexdigest()
+    if conn.execute("SELECT 1 FROM firmas WHERE hash = ?", (firma_hash,)).fetchone():
+        return firma_hash
+
+    codificacion, datos = codificar_firma(mime, contenido)
+    conn.execute(
+        "INSERT OR IGNORE INTO firmas (hash, mime, codificacion, tamano, datos) VALUES (?, ?, ?, ?, ?)",
+        (firma_hash, mime, codificacion, len(contenido), datos)
+    )
+    return firma_hash
+
+def migrar_firmas_en_linea(conn: sqlite3.Connection):
+    # Pasa al almacén las data URL guardadas en visitas.firma_cliente, por bloques
+    ultimo_id = 0
+    while True:
+        filas = conn.execute(
+            """SELECT id, firma_cliente FROM visitas
+               WHERE id > ? AND firma_cliente IS NOT NULL AND firma_cliente != ''
+               ORDER BY id LIMIT 500""",
+            (ultimo_id,)
+        ).fetchall()
+        if not filas:
+            return
+        for visita_id, data_url in filas:
+            try:
+                mime, contenido = decodificar_firma(data_url)
+            except ValueError:
+                # Valor que no es una imagen: se conserva tal cual
+                mime, contenido = "text/plain", data_url.encode()
+            conn.execute(
+                "UPDATE visitas SET firma_hash = ? WHERE id = ?",
+                (guardar_firma(conn, mime, contenido), visita_id)
+            )
+        ultimo_id = filas[-1][0]
+
+def quitar_firmas_en_linea(conn: sqlite3.Connection):
+    # Las data URL ya están en `firmas`. DROP COLUMN existe desde SQLite 3.35;
+    # con una versión anterior la columna se queda, vacía
+    if "firma_cliente" not in {fila[1] for fila in conn.execute("PRAGMA table_info(visitas)")}:
+        return  # base migrada cuando la 5 aún la borraba
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        conn.execute("ALTER TABLE visitas DROP COLUMN firma_cliente")
+    else:
+        conn.execute("UPDATE visitas SET firma_cliente = NULL WHERE firma_cliente IS NOT NULL")
+
+# Borra la firma cuando ninguna visita la referencia ya
+SQL_PURGAR_FIRMA = """DELETE FROM firmas WHERE hash = OLD.firma_hash
+    AND NOT EXISTS (SELECT 1 FROM visitas WHERE firma_hash = OLD.firma_hash);"""
+
+# ============ BÚSQUEDA DE TEXTO ============
+
+# Índices FTS5 por entidad: (tabla, índice, columnas con su peso en bm25).
+# Cada índice guarda además el dueño en `usuario_id` (columna indexada, para
+# que el filtro por usuario lo resuelva el propio índice) y su rowid es el id
+# de la fila. Las líneas cuentan como parte de su presupuesto.
+INDICES_BUSQUEDA = {
+    "clientes": ("clientes", "buscar_clientes", {
+        "nombre": 10, "apellidos": 10, "telefono": 5, "direccion": 2, "nif_cif": 5, "notas": 1,
+    }),
+    "visitas": ("visitas", "buscar_visitas", {"titulo": 10, "descripcion": 2}),
+    "presupuestos": ("presupuestos", "buscar_presupuestos", {"numero": 10, "titulo": 10, "descripcion": 2}),
+    "lineas": ("lineas_presupuesto", "buscar_lineas", {"concepto": 5, "descripcion": 1}),
+}
+BUSQUEDA_MAX_TERMINOS = 8
+
+def _sql_indice_busqueda(entidad: str, usuario: str = "{fila}.usuario_id", extras: tuple = ()) -> List[str]:
+    # Crea el índice, lo llena con lo existente y lo mantiene con triggers.
+    # `usuario` es la expresión que da el dueño (con {fila} en lugar de
+    # NEW/OLD) y `extras` columnas que se copian sin indexar
+    tabla, indice, pesos = INDICES_BUSQUEDA[entidad]
+    columnas = ["usuario_id", *extras, *pesos]
+    definicion = ", ".join(["usuario_id", *[f"{c} UNINDEXED" for c in extras], *pesos])
+    # El dueño no puntúa: todas las filas de un usuario lo comparten
+    ranking = ", ".join(["0.0"] * (1 + len(extras)) + [f"{peso:.1f}" for peso in pesos.values()])
+    vigiladas = ", ".join([*(["usuario_id"] if "usuario_id" in usuario else []), *extras, *pesos])
+
+    def valores(fila: str) -> str:
+        return ", ".join([usuario.replace("{fila}", fila), *[f"{fila}.{c}" for c in (*extras, *pesos)]])
+
+    insertar = f"INSERT INTO {indice} (rowid, {', '.join(columnas)}) VALUES (NEW.id, {valores('NEW')});"
+    borrar = f"DELETE FROM {indice} WHERE rowid = OLD.id;"
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {indice} USING fts5({definicion},
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+        f"INSERT INTO {indice} ({indice}, rank) VALUES ('rank', 'bm25({ranking})')",
+        f"INSERT INTO {indice} (rowid, {', '.join(columnas)}) SELECT id, {valores(tabla)} FROM {tabla}",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{indice}_insert AFTER INSERT ON {tabla} BEGIN
+            {insertar}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{indice}_update AFTER UPDATE OF {vigiladas} ON {tabla} BEGIN
+            {borrar}
+            {insertar}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{indice}_delete AFTER DELETE ON {tabla} BEGIN
+            {borrar}
+        END""",
+    ]
+
+def expresion_busqueda(texto: str, usuario_id: int, entidad: str) -> Optional[str]:
+    # Texto libre -> consulta FTS5: cada palabra como prefijo (para búsqueda
+    # mientras se escribe), todas obligatorias y solo en filas del usuario.
+    # Las palabras van entre comillas, así que el texto no puede inyectar
+    # operadores de FTS5
+    terminos = re.findall(r"\w+", texto)[:BUSQUEDA_MAX_TERMINOS]
+    if not terminos:
+        return None
+    columnas = " ".join(INDICES_BUSQUEDA[entidad][2])
+    prefijos = " AND ".join(f'"{termino}"*' for termino in terminos)
+    return f'usuario_id : "{usuario_id}" AND {{{columnas}}} : ({prefijos})'
+
+# ============ REGISTRO DE CAMBIOS (SYNC) ============
+
+# `cambios_sync` guarda una fila por registro de clientes, visitas y
+# presupuestos con el último cambio: `seq` crece con cada alta, modificación o
+# baja (AUTOINCREMENT no reutiliza valores), así que "lo cambiado desde X" es
+# un rango del índice (usuario_id, seq). Las bajas quedan como marca de
+# borrado (`borrado` = 1) hasta que las purga la tarea limpiar_sync; quien
+# sincronice con un cursor anterior a lo purgado (`sync_horizonte`) tiene que
+# empezar de cero. Lo mantienen triggers (migración 12).
+TABLAS_SYNC = ("clientes", "visitas", "presupuestos")
+
+def _sql_marcar_cambio(tabla: str, usuario: str, registros: str, borrado: str = "0") -> str:
+    # `registros` es una consulta que devuelve los ids afectados en `id`.
+    # DELETE + INSERT en vez de INSERT OR REPLACE: en un trigger manda la
+    # política de conflicto de la sentencia que lo dispara
+    return f"""DELETE FROM cambios_sync WHERE usuario_id = {usuario} AND tabla = '{tabla}'
+            AND registro_id IN ({registros});
+        INSERT INTO cambios_sync (usuario_id, tabla, registro_id, borrado)
+            SELECT {usuario}, '{tabla}', id, {borrado} FROM ({registros}) WHERE {usuario} IS NOT NULL;"""
+
+def _sql_triggers_sync(tabla: str) -> List[str]:
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_sync_{tabla}_insert AFTER INSERT ON {tabla} BEGIN
+            {_sql_marcar_cambio(tabla, "NEW.usuario_id", "SELECT NEW.id AS id")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_sync_{tabla}_update AFTER UPDATE ON {tabla} BEGIN
+            {_sql_marcar_cambio(tabla, "NEW.usuario_id", "SELECT NEW.id AS id")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_sync_{tabla}_delete AFTER DELETE ON {tabla} BEGIN
+            {_sql_marcar_cambio(tabla, "OLD.usuario_id", "SELECT OLD.id AS id", "1")}
+        END""",
+    ]
+
+# Las líneas viajan dentro de su presupuesto: tocarlas lo marca como cambiado.
+# Sin el presupuesto (ya borrado) el dueño es NULL y no se marca nada
+SQL_TRIGGERS_SYNC_LINEAS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_sync_lineas_presupuesto_{operacion} AFTER {operacion.upper()}
+    ON lineas_presupuesto BEGIN
+        {_sql_marcar_cambio(
+            "presupuestos", f"(SELECT usuario_id FROM presupuestos WHERE id = {fila}.presupuesto_id)",
+            f"SELECT {fila}.presupuesto_id AS id"
+        )}
+    END"""
+    for operacion, fila in (("insert", "NEW"), ("update", "NEW"), ("delete", "OLD"))
+]
+
+# Las visitas y presupuestos llevan copiados nombre, teléfono y dirección del
+# cliente: si cambian, también cuentan como cambiados
+SQL_TRIGGER_SYNC_CLIENTE_DEPENDIENTES = f"""CREATE TRIGGER IF NOT EXISTS trg_sync_clientes_dependientes
+    AFTER UPDATE OF nombre, apellidos, telefono, direccion, ciudad ON clientes BEGIN
+        {_sql_marcar_cambio(
+            "visitas", "NEW.usuario_id",
+            "SELECT id FROM visitas WHERE cliente_id = NEW.id AND usuario_id = NEW.usuario_id"
+        )}
+        {_sql_marcar_cambio(
+            "presupuestos", "NEW.usuario_id",
+            "SELECT id FROM presupuestos WHERE usuario_id = NEW.usuario_id AND cliente_id = NEW.id"
+        )}
+    END"""
+
+# ============ MIGRACIONES ============
+
+# Índices y triggers de `presupuestos`, compartidos por las migraciones que los
+# crean y por la que reconstruye la tabla
+SQL_INDICES_PRESUPUESTOS = [
+    "CREATE INDEX IF NOT EXISTS idx_presupuestos_usuario_created ON presupuestos (usuario_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_presupuestos_usuario_estado_created ON presupuestos (usuario_id, estado, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_presupuestos_usuario_cliente_created ON presupuestos (usuario_id, cliente_id, created_at)",
+]
+
+# Las líneas cuentan como cambio del presupuesto al que pertenecen
+SQL_TRIGGERS_VERSION_LINEAS = _sql_triggers_version(
+    "lineas_presupuesto", "presupuestos",
+    "(SELECT usuario_id FROM presupuestos WHERE id = {fila}.presupuesto_id)"
+)
+
+SQL_TRIGGERS_RESUMEN_PRESUPUESTOS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_presupuestos_insert AFTER INSERT ON presupuestos BEGIN
+        {_sql_contadores_presupuesto("NEW", "1")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_presupuestos_delete AFTER DELETE ON presupuestos BEGIN
+        {_sql_contadores_presupuesto("OLD", "-1")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_presupuestos_update
+    AFTER UPDATE OF usuario_id, estado, total, fecha_emision ON presupuestos BEGIN
+        {_sql_contadores_presupuesto("OLD", "-1")}
+        {_sql_contadores_presupuesto("NEW", "1")}
+    END""",
+]
+
+# Migraciones de esquema, en orden. Cada una se aplica una sola vez y en su
+# propia transacción; la versión aplicada queda en `schema_version`.
+# Para cambiar el esquema se añade una entrada nueva al final: las ya
+# publicadas no se modifican. Un paso puede ser SQL o una función que recibe
+# la conexión (para migrar datos que SQL no sabe transformar).
+MIGRACIONES = [
+    (1, "Índices compuestos según los patrones de acceso", [
+        "CREATE INDEX IF NOT EXISTS idx_clientes_usuario_nombre ON clientes (usuario_id, nombre, id)",
+        "CREATE INDEX IF NOT EXISTS idx_visitas_usuario_fecha_hora ON visitas (usuario_id, fecha, hora)",
+        "CREATE INDEX IF NOT EXISTS idx_visitas_usuario_estado ON visitas (usuario_id, estado)",
+        "CREATE INDEX IF NOT EXISTS idx_visitas_cliente ON visitas (cliente_id)",
+        *SQL_INDICES_PRESUPUESTOS,
+        "CREATE INDEX IF NOT EXISTS idx_lineas_presupuesto_orden ON lineas_presupuesto (presupuesto_id, orden)",
+        "ANALYZE",
+    ]),
+    (2, "Contadores por usuario mantenidos por triggers", [
+        """CREATE TABLE IF NOT EXISTS resumen_contadores (
+            usuario_id INTEGER NOT NULL,
+            clave TEXT NOT NULL,
+            valor NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, clave)
+        ) WITHOUT ROWID""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_clientes_insert AFTER INSERT ON clientes BEGIN
+            {_sql_sumar_contador("NEW.usuario_id", "'clientes'", "1")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_clientes_delete AFTER DELETE ON clientes BEGIN
+            {_sql_sumar_contador("OLD.usuario_id", "'clientes'", "-1")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_clientes_update AFTER UPDATE OF usuario_id ON clientes
+        WHEN OLD.usuario_id IS NOT NEW.usuario_id BEGIN
+            {_sql_sumar_contador("OLD.usuario_id", "'clientes'", "-1")}
+            {_sql_sumar_contador("NEW.usuario_id", "'clientes'", "1")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_visitas_insert AFTER INSERT ON visitas BEGIN
+            {_sql_contadores_visita("NEW", "1")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_visitas_delete AFTER DELETE ON visitas BEGIN
+            {_sql_contadores_visita("OLD", "-1")}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_resumen_visitas_update AFTER UPDATE OF usuario_id, estado, fecha ON visitas BEGIN
+            {_sql_contadores_visita("OLD", "-1")}
+            {_sql_contadores_visita("NEW", "1")}
+        END""",
+        *SQL_TRIGGERS_RESUMEN_PRESUPUESTOS,
+        "DELETE FROM resumen_contadores",
+        f"INSERT INTO resumen_contadores (usuario_id, clave, valor) SELECT usuario_id, clave, valor FROM ({SQL_RESUMEN_CALCULADO})",
+    ]),
+    (3, "Versiones de datos por usuario y tabla para ETags", [
+        """CREATE TABLE IF NOT EXISTS versiones_datos (
+            usuario_id INTEGER NOT NULL,
+            tabla TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, tabla)
+        ) WITHOUT ROWID""",
+        *_sql_triggers_version("clientes", "clientes", "{fila}.usuario_id"),
+        *_sql_triggers_version("visitas", "visitas", "{fila}.usuario_id"),
+        *_sql_triggers_version("presupuestos", "presupuestos", "{fila}.usuario_id"),
+        *SQL_TRIGGERS_VERSION_LINEAS,
+    ]),
+    (4, "Numeración de presupuestos por usuario y año", [
+        # `numero` pasa de único global a único por usuario. SQLite no permite
+        # quitar un UNIQUE de columna, así que se reconstruye la tabla (el pool
+        # no activa foreign_keys: el DROP no borra las líneas en cascada)
+        """CREATE TABLE presupuestos_nueva (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            cliente_id INTEGER NOT NULL,
+            numero TEXT NOT NULL,
+            titulo TEXT NOT NULL,
+            descripcion TEXT,
+            subtotal REAL DEFAULT 0,
+            iva_porcentaje REAL DEFAULT 21,
+            aplicar_iva BOOLEAN DEFAULT 1,
+            iva_amount REAL DEFAULT 0,
+            total REAL DEFAULT 0,
+            estado TEXT DEFAULT 'borrador',
+            fecha_emision DATE,
+            fecha_validez DATE,
+            fecha_rechazo TIMESTAMP,
+            notas TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (usuario_id, numero),
+            FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
+            FOREIGN KEY (cliente_id) REFERENCES clientes(id)
+        )""",
+        "INSERT INTO presupuestos_nueva SELECT * FROM presupuestos",
+        # Los triggers de las líneas consultan `presupuestos`: el RENAME falla
+        # si existen mientras la tabla no está
+        *[f"DROP TRIGGER IF EXISTS trg_version_lineas_presupuesto_{op}" for op in ("insert", "update", "delete")],
+        "DROP TABLE presupuestos",
+        "ALTER TABLE presupuestos_nueva RENAME TO presupuestos",
+        *SQL_INDICES_PRESUPUESTOS,
+        *SQL_TRIGGERS_RESUMEN_PRESUPUESTOS,
+        *_sql_triggers_version("presupuestos", "presupuestos", "{fila}.usuario_id"),
+        *SQL_TRIGGERS_VERSION_LINEAS,
+        # Último número emitido por usuario y año; continúa desde el mayor
+        # número existente para no repetir los ya emitidos
+        """CREATE TABLE IF NOT EXISTS secuencias_presupuesto (
+            usuario_id INTEGER NOT NULL,
+            anio INTEGER NOT NULL,
+            ultimo INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, anio)
+        ) WITHOUT ROWID""",
+        """INSERT INTO secuencias_presupuesto (usuario_id, anio, ultimo)
+           SELECT usuario_id, CAST(substr(numero, 6, 4) AS INTEGER), MAX(CAST(substr(numero, 11) AS INTEGER))
+           FROM presupuestos WHERE numero GLOB 'PRES-[0-9][0-9][0-9][0-9]-[0-9]*'
+           GROUP BY usuario_id, substr(numero, 6, 4)""",
+        "ANALYZE presupuestos",
+    ]),
+    (5, "Firmas comprimidas y deduplicadas fuera de visitas", [
+        """CREATE TABLE IF NOT EXISTS firmas (
+            id INTEGER PRIMARY KEY,
+            hash TEXT UNIQUE NOT NULL,
+            mime TEXT NOT NULL,
+            codificacion TEXT NOT NULL,
+            tamano INTEGER NOT NULL,
+            datos BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "ALTER TABLE visitas ADD COLUMN firma_hash TEXT",
+        # firma_cliente se conserva: la quita la migración 14
+        migrar_firmas_en_linea,
+        "CREATE INDEX IF NOT EXISTS idx_visitas_firma ON visitas (firma_hash, usuario_id) WHERE firma_hash IS NOT NULL",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_firmas_visitas_delete AFTER DELETE ON visitas
+        WHEN OLD.firma_hash IS NOT NULL BEGIN
+            {SQL_PURGAR_FIRMA}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_firmas_visitas_update AFTER UPDATE OF firma_hash ON visitas
+        WHEN OLD.firma_hash IS NOT NULL AND OLD.firma_hash IS NOT NEW.firma_hash BEGIN
+            {SQL_PURGAR_FIRMA}
+        END""",
+    ]),
+    (6, "Refresh tokens y lista de revocación", [
+        # Un refresh token es de un solo uso: al renovarlo se marca usado_at y
+        # se emite otro de la misma familia (= sesión)
+        """CREATE TABLE IF NOT EXISTS refresh_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            token_hash TEXT UNIQUE NOT NULL,
+            familia TEXT NOT NULL,
+            expira REAL NOT NULL,
+            usado_at REAL,
+            revocado_at REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_familia ON refresh_tokens (familia)",
+        # Claves "jti:<id>" o "sid:<sesión>" revocadas hasta que caduca el último
+        # access token afectado; el id creciente permite leer solo las nuevas
+        """CREATE TABLE IF NOT EXISTS tokens_revocados (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            clave TEXT UNIQUE NOT NULL,
+            expira REAL NOT NULL
+        )""",
+    ]),
+    (7, "Índices de búsqueda de texto (FTS5)", [
+        *_sql_indice_busqueda("clientes"),
+        *_sql_indice_busqueda("visitas"),
+        *_sql_indice_busqueda("presupuestos"),
+        *_sql_indice_busqueda(
+            "lineas", "(SELECT usuario_id FROM presupuestos WHERE id = {fila}.presupuesto_id)", ("presupuesto_id",)
+        ),
+        # Al borrar un presupuesto sus líneas se quedan en la tabla (el pool no
+        # activa foreign_keys), pero no deben seguir apareciendo en búsquedas
+        """CREATE TRIGGER IF NOT EXISTS trg_buscar_lineas_presupuesto_delete AFTER DELETE ON presupuestos BEGIN
+            DELETE FROM buscar_lineas WHERE rowid IN (SELECT id FROM lineas_presupuesto WHERE presupuesto_id = OLD.id);
+        END""",
+    ]),
+    (8, "Tareas programadas y purga de presupuestos rechazados", [
+        # Una fila por tarea: cuándo toca la siguiente ejecución y quién la
+        # tiene bloqueada, compartido por todos los workers
+        """CREATE TABLE IF NOT EXISTS tareas_programadas (
+            nombre TEXT PRIMARY KEY,
+            proxima REAL NOT NULL DEFAULT 0,
+            propietario TEXT,
+            bloqueada_hasta REAL,
+            ultima_ejecucion REAL,
+            ultima_duracion_ms REAL,
+            ultimo_resultado TEXT,
+            ultimo_error TEXT,
+            ejecuciones INTEGER NOT NULL DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_presupuestos_rechazo ON presupuestos (fecha_rechazo) WHERE estado = 'rechazado'",
+    ]),
+    (9, "Agregados diarios y mensuales para analítica", [
+        """CREATE TABLE IF NOT EXISTS analitica_presupuestos (
+            usuario_id INTEGER NOT NULL,
+            granularidad TEXT NOT NULL,
+            periodo TEXT NOT NULL,
+            cliente_id INTEGER NOT NULL,
+            emitidos INTEGER NOT NULL DEFAULT 0,
+            aceptados INTEGER NOT NULL DEFAULT 0,
+            rechazados INTEGER NOT NULL DEFAULT 0,
+            importe REAL NOT NULL DEFAULT 0,
+            facturado REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, granularidad, periodo, cliente_id)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS analitica_visitas (
+            usuario_id INTEGER NOT NULL,
+            granularidad TEXT NOT NULL,
+            periodo TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            completadas INTEGER NOT NULL DEFAULT 0,
+            canceladas INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, granularidad, periodo, tipo)
+        ) WITHOUT ROWID""",
+        *_sql_triggers_rollup("analitica_presupuestos"),
+        *_sql_triggers_rollup("analitica_visitas"),
+        reconstruir_analitica,
+    ]),
+    (10, "Versión de los presupuestos para la edición concurrente", [
+        "ALTER TABLE presupuestos ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+    ]),
+    (11, "Versión de las visitas", [
+        "ALTER TABLE visitas ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+    ]),
+    (12, "Registro de cambios e idempotencia para la sincronización offline", [
+        """CREATE TABLE IF NOT EXISTS cambios_sync (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            tabla TEXT NOT NULL,
+            registro_id INTEGER NOT NULL,
+            borrado INTEGER NOT NULL DEFAULT 0,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (usuario_id, tabla, registro_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_cambios_sync_usuario_seq ON cambios_sync (usuario_id, seq)",
+        "CREATE INDEX IF NOT EXISTS idx_cambios_sync_borrados ON cambios_sync (fecha) WHERE borrado = 1",
+        # Mayor `seq` purgado por usuario: un cursor anterior ya no es válido
+        """CREATE TABLE IF NOT EXISTS sync_horizonte (
+            usuario_id INTEGER PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )""",
+        # Operaciones offline ya aplicadas, por el id que genera el cliente.
+        # `estado` NULL: aplicada, pero se cortó antes de guardar la respuesta
+        """CREATE TABLE IF NOT EXISTS peticiones_sync (
+            id INTEGER PRIMARY KEY,
+            usuario_id INTEGER NOT NULL,
+            id_peticion TEXT NOT NULL,
+            estado INTEGER,
+            resultado TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (usuario_id, id_peticion)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_peticiones_sync_created ON peticiones_sync (created_at)",
+        *[sql for tabla in TABLAS_SYNC for sql in _sql_triggers_sync(tabla)],
+        *SQL_TRIGGERS_SYNC_LINEAS,
+        SQL_TRIGGER_SYNC_CLIENTE_DEPENDIENTES,
+        *[f"INSERT INTO cambios_sync (usuario_id, tabla, registro_id) SELECT usuario_id, '{tabla}', id FROM {tabla}"
+          for tabla in TABLAS_SYNC],
+    ]),
+    (13, "Directorio de shards por usuario", [
+        # Fichero que guarda los datos de cada usuario repartido; sin fila, los
+        # datos siguen en la BD principal. `estado` 'copiando' o 'migrando'
+        # mientras se trasladan (ver DirectorioShards.migrar)
+        """CREATE TABLE IF NOT EXISTS directorio_shards (
+            usuario_id INTEGER PRIMARY KEY,
+            shard TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'activo',
+            migrado_at TIMESTAMP
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_directorio_shards_shard ON directorio_shards (shard)",
+    ]),
+    (14, "Quitar visitas.firma_cliente (pasada a firmas en la 5)", [
+        quitar_firmas_en_linea,
+    ]),
+    (15, "Triggers de analítica que admiten estado NULL", [
+        *[f"DROP TRIGGER IF EXISTS trg_{tabla}_{operacion}"
+          for tabla in ROLLUPS for operacion in ("insert", "delete", "update")],
+        *_sql_triggers_rollup("analitica_presupuestos"),
+        *_sql_triggers_rollup("analitica_visitas"),
+    ]),
+]
+
+def version_esquema(conn: sqlite3.Connection) -> int:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def aplicar_migraciones(conn: sqlite3.Connection, hasta: Optional[int] = None) -> List[int]:
+    aplicadas = []
+    version_esquema(conn)
+    conn.commit()
+    for version, descripcion, sentencias in MIGRACIONES:
+        if hasta is not None and version > hasta:
+            break
+        # BEGIN IMMEDIATE toma el bloqueo de escritura: si varios workers
+        # arrancan a la vez, solo uno aplica cada migración
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= version_esquema(conn):
+                conn.rollback()
+                continue
+            for sql in sentencias:
+                if callable(sql):
+                    sql(conn)
+                else:
+                    conn.execute(sql)
+            conn.execute(
+                "INSERT INTO schema_version (version, descripcion) VALUES (?, ?)",
+                (version, descripcion)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas.append(version)
+    return aplicadas
+
+def init_db():
+    with get_db(principal=True) as conn:
+        crear_tablas(conn)
+        aplicar_migraciones(conn)
+
+# ============ SHARDS POR USUARIO ============
+
+# Con DB_SHARDING activo, los datos de cada usuario viven en un fichero SQLite
+# aparte (propio o compartido con otros), con el mismo esquema que la BD
+# principal. La principal hace de directorio (`directorio_shards`) y sigue
+# guardando usuarios, sesiones y tareas programadas; get_db() elige el fichero
+# por el usuario de la petición. Cada shard tiene su propio WAL y su propio
+# bloqueo de escritura: las escrituras de un usuario no esperan a las del resto.
+
+# Primer id AUTOINCREMENT de cada shard fijo (k + 1) * SHARD_ID_OFFSET: los
+# usuarios migrados traen los ids de la principal y los nuevos no chocan con ellos
+SHARD_ID_OFFSET = 10 ** 12
+TABLAS_ID_SHARD = ("clientes", "visitas", "presupuestos", "lineas_presupuesto")
+SHARD_CACHE_MAX = 50000  # asignaciones en memoria; al llenarse se vacía
+SHARD_MIGRACION_INTENTOS = 3
+
+# Qué se copia de un usuario al migrarlo, en orden: (tabla, INSERT, filas del
+# usuario, columnas que no se copian). Contadores, analítica, búsqueda y
+# registro de cambios los rellenan los triggers del shard al insertar; las
+# marcas de borrado se copian aparte para que los clientes offline no
+# tengan que empezar de cero
+COPIA_USUARIO = [
+    ("usuarios", "INSERT OR REPLACE", "id = ?1", ()),
+    ("firmas", "INSERT OR IGNORE", "hash IN (SELECT firma_hash FROM origen.visitas WHERE usuario_id = ?1)", ("id",)),
+    ("clientes", "INSERT", "usuario_id = ?1", ()),
+    ("visitas", "INSERT", "usuario_id = ?1", ()),
+    ("presupuestos", "INSERT", "usuario_id = ?1", ()),
+    ("lineas_presupuesto", "INSERT",
+     "presupuesto_id IN (SELECT id FROM origen.presupuestos WHERE usuario_id = ?1)", ()),
+    ("secuencias_presupuesto", "INSERT", "usuario_id = ?1", ()),
+    ("peticiones_sync", "INSERT", "usuario_id = ?1", ("id",)),
+    ("sync_horizonte", "INSERT OR REPLACE", "usuario_id = ?1", ()),
+    ("cambios_sync", "INSERT", "usuario_id = ?1 AND borrado = 1", ("seq",)),
+]
+
+# Tablas por usuario que no son datos: se vacían después de borrar los datos
+TABLAS_AUX_USUARIO = ("resumen_contadores", "analitica_presupuestos", "analitica_visitas", "versiones_datos",
+                      "cambios_sync", "sync_horizonte", "peticiones_sync", "secuencias_presupuesto")
+
+def subir_secuencia(conn: sqlite3.Connection, tabla: str, valor: int):
+    # Los siguientes ids AUTOINCREMENT de `tabla` serán mayores que `valor`
+    if not conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (valor, tabla)).rowcount:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (tabla, valor))
+
+def borrar_datos_usuario(conn: sqlite3.Connection, usuario_id: int) -> int:
+    # Todo lo del usuario menos su fila de usuarios, por lotes de
+    # PURGE_BATCH_SIZE para no retener el bloqueo de escritura. Los triggers
+    # limpian búsqueda y firmas sin visitas; devuelve las filas de datos borradas
+    borradas = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        ids = json.dumps([fila[0] for fila in conn.execute(
+            "SELECT id FROM presupuestos WHERE usuario_id = ? LIMIT ?", (usuario_id, PURGE_BATCH_SIZE)
+        )])
+        if ids == "[]":
+            conn.rollback()
+            break
+        for sql in ("DELETE FROM lineas_presupuesto WHERE presupuesto_id IN (SELECT value FROM json_each(?))",
+                    "DELETE FROM presupuestos WHERE id IN (SELECT value FROM json_each(?))"):
+            borradas += conn.execute(sql, (ids,)).rowcount
+        conn.commit()
+    for tabla in ("visitas", "clientes"):
+        while True:
+            lote = conn.execute(
+                f"DELETE FROM {tabla} WHERE id IN (SELECT id FROM {tabla} WHERE usuario_id = ? LIMIT ?)",
+                (usuario_id, PURGE_BATCH_SIZE)
+            ).rowcount
+            conn.commit()
+            borradas += lote
+            if lote < PURGE_BATCH_SIZE:
+                break
+    for tabla in TABLAS_AUX_USUARIO:
+        conn.execute(f"DELETE FROM {tabla} WHERE usuario_id = ?", (usuario_id,))
+    conn.commit()
+    return borradas
+
+def borrar_datos_usuario_en(conn: sqlite3.Connection, esquema: str, usuario_id: int) -> int:
+    # Como borrar_datos_usuario, pero de una vez, en la base adjunta `esquema`
+    # y dentro de la transacción de `conn` (que no se confirma)
+    borradas = 0
+    for sql in (
+        "DELETE FROM {0}.lineas_presupuesto WHERE presupuesto_id IN "
+        "(SELECT id FROM {0}.presupuestos WHERE usuario_id = ?)",
+        "DELETE FROM {0}.presupuestos WHERE usuario_id = ?",
+        "DELETE FROM {0}.visitas WHERE usuario_id = ?",
+        "DELETE FROM {0}.clientes WHERE usuario_id = ?",
+    ):
+        borradas += conn.execute(sql.format(esquema), (usuario_id,)).rowcount
+    for tabla in TABLAS_AUX_USUARIO:
+        conn.execute(f"DELETE FROM {esquema}.{tabla} WHERE usuario_id = ?", (usuario_id,))
+    return borradas
+
+class DirectorioShards:
+    """Pools de los shards y caché del directorio. Como mucho
+    DB_SHARD_OPEN_MAX shards tienen conexiones abiertas a la vez: al abrir
+    otro se cierra el que lleva más tiempo sin usarse (si no está en uso)."""
+
+    def __init__(self, modo: str = DB_SHARDING, carpeta: str = DB_SHARD_DIR, max_abiertos: int = DB_SHARD_OPEN_MAX):
+        if modo not in ("no", "usuario", "fijo"):
+            raise ValueError(f"DB_SHARDING no válido: {modo}")
+        self.modo = modo
+        self.carpeta = carpeta
+        self.max_abiertos = max(1, max_abiertos)
+        self._pools: "OrderedDict[str, ConnectionPool]" = OrderedDict()
+        self._asignaciones = {}
+        self._lock = threading.Lock()
+        self._aperturas = 0
+        self._desalojos = 0
+        self._consultas = 0
+        self._aciertos = 0
+
+    def ruta(self, shard: str) -> str:
+        return os.path.join(self.carpeta, f"{shard}.db")
+
+    def shard_para(self, usuario_id: int, propio: bool = False) -> str:
+        if propio or self.modo == "usuario":
+            return f"usuario-{usuario_id}"
+        return f"shard-{usuario_id % DB_SHARD_COUNT:02d}"
+
+    def asignacion(self, usuario_id: int) -> tuple:
+        # (shard, estado) del usuario, o (None, None) si sigue en la principal.
+        # Se recuerda DB_SHARD_CACHE_SECONDS para no leer el directorio en cada petición
+        ahora = time.monotonic()
+        with self._lock:
+            self._consultas += 1
+            guardada = self._asignaciones.get(usuario_id)
+            if guardada and guardada[2] > ahora:
+                self._aciertos += 1
+                return guardada[:2]
+        with get_db(principal=True) as conn:
+            fila = conn.execute(
+                "SELECT shard, estado FROM directorio_shards WHERE usuario_id = ?", (usuario_id,)
+            ).fetchone()
+        asignacion = (fila["shard"], fila["estado"]) if fila else (None, None)
+        with self._lock:
+            if len(self._asignaciones) >= SHARD_CACHE_MAX:
+                self._asignaciones.clear()
+            self._asignaciones[usuario_id] = (*asignacion, ahora + DB_SHARD_CACHE_SECONDS)
+        return asignacion
+
+    def invalidar(self, usuario_id: int):
+        with self._lock:
+            self._asignaciones.pop(usuario_id, None)
+
+    def pool_usuario(self, usuario_id: int) -> ConnectionPool:
+        shard, estado = self.asignacion(usuario_id)
+        if shard is None or estado == "copiando":
+            return db_pool
+        if estado != "activo":
+            raise HTTPException(
+                status_code=503,
+                detail="Tus datos se están trasladando, inténtalo de nuevo en unos segundos",
+                headers={"Retry-After": str(int(DB_SHARD_CACHE_SECONDS) + 1)}
+            )
+        return self.pool(shard)
+
+    def preparar(self, shard: str):
+        # Crea el fichero con el esquema al día, o lo pone al día
+        os.makedirs(self.carpeta, exist_ok=True)
+        conn = abrir_conexion(self.ruta(shard))
+        try:
+            version = version_esquema(conn)
+            conn.commit()
+            if version < MIGRACIONES[-1][0]:
+                crear_tablas(conn)
+                aplicar_migraciones(conn)
+            if version == 0 and shard.startswith("shard-"):
+                inicio = (int(shard.removeprefix("shard-")) + 1) * SHARD_ID_OFFSET
+                for tabla in TABLAS_ID_SHARD:
+                    subir_secuencia(conn, tabla, inicio)
+                conn.commit()
+        finally:
+            conn.close()
+
+    def pool(self, shard: str) -> ConnectionPool:
+        with self._lock:
+            pool = self._pools.get(shard)
+            if pool is not None:
+                self._pools.move_to_end(shard)
+                return pool
+        # Fuera del lock: preparar un fichero nuevo puede tardar
+        self.preparar(shard)
+        with self._lock:
+            pool = self._pools.get(shard)
+            if pool is None:
+                pool = self._pools[shard] = ConnectionPool(self.ruta(shard), DB_SHARD_POOL_SIZE)
+                self._aperturas += 1
+                # El recién abierto es el último: nunca se desaloja a sí mismo
+                for antiguo in list(self._pools)[:-1]:
+                    if len(self._pools) <= self.max_abiertos:
+                        break
+                    if self._pools[antiguo].stats()["in_use"] == 0:
+                        self._pools.pop(antiguo).close()
+                        self._desalojos += 1
+            self._pools.move_to_end(shard)
+            return pool
+
+    @contextmanager
+    def conexion_directa(self, shard: str):
+        # Conexión suelta, fuera de los pools: recorrer todos los shards (tareas
+        # programadas, CLI) no desaloja los que están usando las peticiones
+        conn = abrir_conexion(self.ruta(shard))
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def nombres(self) -> List[str]:
+        if self.modo == "no":
+            return []
+        with get_db(principal=True) as conn:
+            return [fila[0] for fila in conn.execute("SELECT DISTINCT shard FROM directorio_shards ORDER BY shard")]
+
+    def asignar(self, conn: sqlite3.Connection, usuario_id: int) -> str:
+        # Alta de un usuario nuevo en la transacción de `conn` (BD principal):
+        # copia su fila al shard, sin la contraseña, y lo apunta en el directorio
+        shard = self.shard_para(usuario_id)
+        datos = dict(conn.execute("SELECT * FROM usuarios WHERE id = ?", (usuario_id,)).fetchone())
+        datos["password_hash"] = ""
+        pool = self.pool(shard)
+        destino = pool.acquire()
+        try:
+            destino.execute(
+                f"INSERT OR REPLACE INTO usuarios ({', '.join(datos)}) VALUES ({', '.join('?' * len(datos))})",
+                tuple(datos.values())
+            )
+            destino.commit()
+        finally:
+            pool.release(destino)
+        conn.execute(
+            "INSERT INTO directorio_shards (usuario_id, shard, migrado_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+            (usuario_id, shard)
+        )
+        self.invalidar(usuario_id)
+        return shard
+
+    def migrar(self, usuario_id: int, propio: bool = False, espera: float = DB_SHARD_CACHE_SECONDS + 1) -> dict:
+        # Traslada a su shard los datos de un usuario que sigue en la principal.
+        # Primero se copian en 'copiando', con sus peticiones aún en la
+        # principal. Luego se marca 'migrando' (sus peticiones reciben 503) y se
+        # esperan `espera` segundos a que lo vean todos los workers (caché del
+        # directorio); si nada ha cambiado desde la copia se activa, y si no se
+        # copia otra vez, ya sin escrituras. Así el 503 dura `espera` más la
+        # activación, no lo que tarde la copia. Sus datos salen de la principal
+        # en la misma transacción que lo activa
+        shard = self.shard_para(usuario_id, propio)
+        self.preparar(shard)
+        with get_db(principal=True) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not conn.execute("SELECT 1 FROM usuarios WHERE id = ?", (usuario_id,)).fetchone():
+                raise ValueError(f"el usuario {usuario_id} no existe")
+            if conn.execute("SELECT 1 FROM directorio_shards WHERE usuario_id = ?", (usuario_id,)).fetchone():
+                raise ValueError(f"el usuario {usuario_id} ya está en un shard")
+            conn.execute(
+                "INSERT INTO directorio_shards (usuario_id, shard, estado) VALUES (?, ?, 'copiando')",
+                (usuario_id, shard)
+            )
+            conn.commit()
+        self.invalidar(usuario_id)
+
+        destino = abrir_conexion(self.ruta(shard))
+        try:
+            filas, versiones = self._copia(destino, usuario_id)
+            with get_db(principal=True) as conn:
+                conn.execute("UPDATE directorio_shards SET estado = 'migrando' WHERE usuario_id = ?", (usuario_id,))
+                conn.commit()
+            self.invalidar(usuario_id)
+            time.sleep(espera)
+
+            for intento in range(1, SHARD_MIGRACION_INTENTOS + 1):
+                if intento > 1:
+                    filas, versiones = self._copia(destino, usuario_id)
+                destino.execute("ATTACH DATABASE ? AS origen", (DATABASE_PATH,))
+                try:
+                    borradas = self._activar(destino, usuario_id, versiones)
+                finally:
+                    if destino.in_transaction:
+                        destino.rollback()
+                    destino.execute("DETACH DATABASE origen")
+                if borradas is not None:
+                    break
+            else:
+                raise RuntimeError(f"el usuario {usuario_id} ha seguido escribiendo durante la copia")
+        except BaseException:
+            # Sigue en la principal; lo copiado se descarta
+            with get_db(principal=True) as conn:
+                conn.execute("DELETE FROM directorio_shards WHERE usuario_id = ?", (usuario_id,))
+                conn.commit()
+            self.invalidar(usuario_id)
+            try:
+                borrar_datos_usuario(destino, usuario_id)
+            except sqlite3.Error:
+                logger.exception("Shard %s: no se pudo limpiar la copia del usuario %s", shard, usuario_id)
+            raise
+        finally:
+            destino.close()
+
+        self.invalidar(usuario_id)
+        invalidar_cache(usuario_id)
+        return {"usuario": usuario_id, "shard": shard, "filas": filas, "intentos": intento,
+                "borradas_principal": borradas}
+
+    @staticmethod
+    def _versiones(conn: sqlite3.Connection, usuario_id: int) -> dict:
+        return dict(conn.execute(
+            "SELECT tabla, version FROM origen.versiones_datos WHERE usuario_id = ?", (usuario_id,)
+        ).fetchall())
+
+    def _copia(self, destino: sqlite3.Connection, usuario_id: int) -> tuple:
+        borrar_datos_usuario(destino, usuario_id)  # restos de una copia anterior
+        destino.execute("ATTACH DATABASE ? AS origen", (DATABASE_PATH,))
+        try:
+            return self._copiar(destino, usuario_id)
+        finally:
+            if destino.in_transaction:
+                destino.rollback()
+            destino.execute("DETACH DATABASE origen")
+
+    def _copiar(self, destino: sqlite3.Connection, usuario_id: int) -> tuple:
+        # En una transacción: todo sale de la misma instantánea de la principal.
+        # Los cambios del shard van detrás de cualquier cursor de sync que ya
+        # tengan los clientes (seq mayores que el último de la principal)
+        destino.execute("BEGIN")
+        versiones = self._versiones(destino, usuario_id)
+        subir_secuencia(
+            destino, "cambios_sync",
+            destino.execute("SELECT COALESCE(MAX(seq), 0) FROM origen.cambios_sync").fetchone()[0]
+        )
+        filas = 0
+        for tabla, insertar, condicion, excluidas in COPIA_USUARIO:
+            columnas = ", ".join(
+                fila[1] for fila in destino.execute(f"PRAGMA main.table_info({tabla})") if fila[1] not in excluidas
+            )
+            filas += destino.execute(
+                f"{insertar} INTO main.{tabla} ({columnas}) SELECT {columnas} FROM origen.{tabla} WHERE {condicion}",
+                (usuario_id,)
+            ).rowcount
+        destino.execute("UPDATE main.usuarios SET password_hash = '' WHERE id = ?", (usuario_id,))
+        destino.commit()
+        return filas, versiones
+
+    def _activar(self, destino: sqlite3.Connection, usuario_id: int, versiones: dict) -> Optional[int]:
+        # Con el bloqueo de escritura de los dos ficheros: si nada ha cambiado
+        # desde la copia, el usuario pasa al shard y sus datos se borran de la
+        # principal, todo en una transacción; ninguna escritura puede colarse
+        # entre la comprobación y el borrado. Sus versiones quedan por encima
+        # de las de la principal para que ningún ETag antiguo coincida.
+        # Devuelve las filas borradas de la principal, o None si hay que repetir
+        destino.execute("BEGIN IMMEDIATE")
+        if self._versiones(destino, usuario_id) != versiones:
+            destino.rollback()
+            return None
+        destino.execute(
+            """INSERT INTO main.versiones_datos (usuario_id, tabla, version)
+               SELECT usuario_id, tabla, version FROM origen.versiones_datos WHERE usuario_id = ?
+               ON CONFLICT (usuario_id, tabla) DO UPDATE SET version = version + excluded.version""",
+            (usuario_id,)
+        )
+        destino.execute(
+            "UPDATE origen.directorio_shards SET estado = 'activo', migrado_at = CURRENT_TIMESTAMP WHERE usuario_id = ?",
+            (usuario_id,)
+        )
+        borradas = borrar_datos_usuario_en(destino, "origen", usuario_id)
+        destino.commit()
+        return borradas
+
+    def close(self):
+        with self._lock:
+            while self._pools:
+                self._pools.popitem()[1].close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pools = [pool.stats() for pool in self._pools.values()]
+            return {
+                "modo": self.modo,
+                "abiertos": len(pools),
+                "max_abiertos": self.max_abiertos,
+                "conexiones": sum(p["open"] for p in pools),
+                "en_uso": sum(p["in_use"] for p in pools),
+                "timeouts": sum(p["timeouts"] for p in pools),
+                "aperturas": self._aperturas,
+                "desalojos": self._desalojos,
+                "consultas_directorio": self._consultas,
+                "aciertos_directorio": self._aciertos,
+            }
+
+shards = DirectorioShards()
+
+# ============ FUNCIONES AUXILIARES ============
+
+def generar_numero_presupuesto(cursor, usuario_id: int) -> str:
+    return reservar_numeros_presupuesto(cursor, usuario_id, 1)[0]
+
+def reservar_numeros_presupuesto(cursor, usuario_id: int, cantidad: int) -> List[str]:
+    # Un único UPSERT sobre la secuencia del usuario y año: toma el bloqueo de
+    # escritura y queda en la transacción del INSERT del presupuesto, así que
+    # dos altas simultáneas no reciben el mismo número y un rollback no deja huecos
+    year = datetime.now().year
+    cursor.execute(
+        """INSERT INTO secuencias_presupuesto (usuario_id, anio, ultimo) VALUES (?, ?, ?)
+           ON CONFLICT (usuario_id, anio) DO UPDATE SET ultimo = ultimo + excluded.ultimo
+           RETURNING ultimo""",
+        (usuario_id, year, cantidad)
+    )
+    ultimo = cursor.fetchone()[0]
+    return [f"PRES-{year}-{n:04d}" for n in range(ultimo - cantidad + 1, ultimo + 1)]
+
+# El total de la línea se calcula en la propia sentencia
+SQL_INSERTAR_LINEA = """INSERT INTO lineas_presupuesto
+    (presupuesto_id, concepto, descripcion, cantidad, precio_unitario, total, orden)
+    VALUES (?1, ?2, ?3, ?4, ?5, ?4 * ?5, ?6)"""
+
+# Días que le quedan a un presupuesto rechazado antes de que lo purgue la
+# tarea programada; NULL si no está rechazado. Va en la propia consulta
+SQL_DIAS_PARA_ELIMINAR = f"""MAX(0, CAST(
+    julianday(p.fecha_rechazo, '+{REJECTED_RETENTION_DAYS} days') - julianday('now', 'localtime') AS INTEGER
+)) AS dias_para_eliminar"""
+
+def consulta_paginada(cursor, columnas: str, origen: str, condiciones: List[str], params: list, orden: str,
+                      filtro_cursor: str, clave_cursor, limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+    # Paginación por clave (keyset): la página siguiente empieza justo después
+    # de la última fila devuelta según el mismo ORDER BY, sin OFFSET.
+    # Devuelve (filas, total, cursor siguiente o None)
+    where = " AND ".join(condiciones)
+    if limite is None:
+        cursor.execute(f"SELECT {columnas} FROM {origen} WHERE {where} ORDER BY {orden}", params)
+        rows = cursor.fetchall()
+        return rows, len(rows), None
+
+    cursor.execute(f"SELECT COUNT(*) FROM {origen} WHERE {where}", params)
+    total = cursor.fetchone()[0]
+
+    if cursor_pagina:
+        where += f" AND {filtro_cursor}"
+        params = params + decodificar_cursor(cursor_pagina, filtro_cursor.count("?"))
+
+    cursor.execute(
+        f"SELECT {columnas} FROM {origen} WHERE {where} ORDER BY {orden} LIMIT ?",
+        params + [limite + 1]
+    )
+    rows = cursor.fetchall()
+    siguiente = None
+    if len(rows) > limite:
+        rows = rows[:limite]
+        siguiente = codificar_cursor(clave_cursor(rows[-1]))
+    return rows, total, siguiente
+
+def filtro_estados(columna: str, estado: str) -> tuple:
+    return f"{columna} IN (SELECT value FROM json_each(?))", json.dumps(lista_estados(estado))
+
+def cargar_lineas(cursor, presupuesto_ids: List[int]) -> dict:
+    # Una sola consulta para las líneas de todos los presupuestos; la lista de
+    # ids viaja como JSON para que la sentencia sea siempre la misma (cacheable)
+    lineas = {pid: [] for pid in presupuesto_ids}
+    if not presupuesto_ids:
+        return lineas
+    cursor.execute(
+        """SELECT * FROM lineas_presupuesto
+           WHERE presupuesto_id IN (SELECT value FROM json_each(?))
+           ORDER BY presupuesto_id, orden, id""",
+        (json.dumps(presupuesto_ids),)
+    )
+    for linea in cursor.fetchall():
+        lineas[linea["presupuesto_id"]].append(dict(linea))
+    return lineas
+
+def filas_presupuestos(cursor, rows, incluir_lineas: bool = True) -> List[dict]:
+    presupuestos = filas_respuesta(PresupuestoResponse, rows)
+    lineas = cargar_lineas(cursor, [p["id"] for p in presupuestos]) if incluir_lineas else {}
+    for pres_dict in presupuestos:
+        pres_dict['lineas'] = lineas.get(pres_dict['id'], [])
+    return presupuestos
+
+# ============ ALMACÉN SQLITE ============
+
+def valores_campos(modelo: BaseModel, campos: tuple) -> tuple:
+    return tuple(getattr(modelo, campo) for campo in campos)
+
+MODELOS_RESPUESTA = {"clientes": ClienteResponse, "visitas": VisitaResponse, "presupuestos": PresupuestoResponse}
+
+# Columnas de las respuestas de visitas: la firma va solo como referencia
+SQL_COLUMNAS_VISITA = """v.*, c.nombre || ' ' || COALESCE(c.apellidos, '') as cliente_nombre,
+    c.telefono as cliente_telefono, c.direccion || ', ' || c.ciudad as cliente_direccion,
+    v.firma_hash IS NOT NULL as tiene_firma"""
+
+SQL_COLUMNAS_PRESUPUESTO = f"""p.*, {SQL_DIAS_PARA_ELIMINAR},
+    c.nombre || ' ' || COALESCE(c.apellidos, '') as cliente_nombre"""
+
+# Una visita está en conflicto si otra no cancelada (o sin estado) del mismo
+# usuario tiene el mismo día y la misma hora. La ventana recorre las filas en
+# el orden del índice (usuario_id, fecha, hora, id), el mismo que pide la
+# consulta, así que SQLite no ordena nada: ni para la ventana ni para el resultado
+SQL_CONFLICTO_VISITA = """v.hora IS NOT NULL AND v.hora != '' AND COALESCE(v.estado, '') != 'cancelada'
+    AND SUM(COALESCE(v.estado, '') != 'cancelada') OVER (
+        PARTITION BY v.fecha, v.hora ORDER BY v.id ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+    ) > 1 AS conflicto"""
+
+SQL_EMISOR_PDF = "SELECT nombre, apellidos, empresa, email, telefono FROM usuarios WHERE id = ?"
+
+# Registros de cada tabla sincronizada a partir de sus ids (JSON en ?2), con
+# las mismas columnas que los listados
+SQL_REGISTROS_SYNC = {
+    "clientes": "SELECT * FROM clientes WHERE usuario_id = ?1 AND id IN (SELECT value FROM json_each(?2))",
+    "visitas": f"""SELECT {SQL_COLUMNAS_VISITA}
+        FROM visitas v JOIN clientes c ON v.cliente_id = c.id
+        WHERE v.usuario_id = ?1 AND v.id IN (SELECT value FROM json_each(?2))""",
+    "presupuestos": f"""SELECT {SQL_COLUMNAS_PRESUPUESTO}
+        FROM presupuestos p JOIN clientes c ON p.cliente_id = c.id
+        WHERE p.usuario_id = ?1 AND p.id IN (SELECT value FROM json_each(?2))""",
+}
+
+def leer_blob_firma(pool: ConnectionPool, firma_id: int, inicio: int, fin: int):
+    # Lectura incremental del BLOB, sin cargarlo entero en memoria. La conexión
+    # se presta al empezar a iterar: un generador sin arrancar no retiene ninguna
+    conn = pool.acquire()
+    try:
+        with conn.blobopen("firmas", "datos", firma_id, readonly=True) as blob:
+            blob.seek(inicio)
+            restante = fin - inicio + 1
+            while restante > 0:
+                trozo = blob.read(min(FIRMA_CHUNK_SIZE, restante))
+                if not trozo:
+                    break
+                restante -= len(trozo)
+                yield trozo
+    finally:
+        pool.release(conn)
+
+SQL_INSERTAR_CLIENTE = f"""INSERT INTO clientes (usuario_id, {', '.join(CAMPOS_CLIENTE)})
+    VALUES ({', '.join('?' * (len(CAMPOS_CLIENTE) + 1))})"""
+SQL_INSERTAR_VISITA = f"""INSERT INTO visitas (usuario_id, {', '.join(CAMPOS_VISITA)})
+    VALUES ({', '.join('?' * (len(CAMPOS_VISITA) + 1))})"""
+
+def _insertar_clientes(cursor, user_id: int, clientes: List[ClienteCreate]):
+    cursor.executemany(SQL_INSERTAR_CLIENTE, [(user_id, *valores_campos(c, CAMPOS_CLIENTE)) for c in clientes])
+
+def _insertar_visitas(cursor, user_id: int, visitas: List[VisitaCreate]):
+    cursor.executemany(SQL_INSERTAR_VISITA, [(user_id, *valores_campos(v, CAMPOS_VISITA)) for v in visitas])
+
+def _insertar_presupuestos(cursor, user_id: int, presupuestos: List[PresupuestoCreate]):
+    numeros = reservar_numeros_presupuesto(cursor, user_id, len(presupuestos))
+    fecha_emision = datetime.now().strftime("%Y-%m-%d")
+    filas = []
+    for numero, p in zip(numeros, presupuestos):
+        subtotal, iva_amount, total = calcular_totales(p)
+        filas.append((user_id, p.cliente_id, numero, p.titulo, p.descripcion, subtotal, p.iva_porcentaje,
+                      p.aplicar_iva, iva_amount, total, fecha_emision, p.fecha_validez, p.notas))
+    cursor.executemany(
+        """INSERT INTO presupuestos (usuario_id, cliente_id, numero, titulo, descripcion,
+           subtotal, iva_porcentaje, aplicar_iva, iva_amount, total, estado, fecha_emision, fecha_validez, notas)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'borrador', ?, ?, ?)""",
+        filas
+    )
+
+    # executemany no devuelve los ids: se recuperan por el número asignado
+    cursor.execute(
+        """SELECT id, numero FROM presupuestos
+           WHERE usuario_id = ? AND numero IN (SELECT value FROM json_each(?))""",
+        (user_id, json.dumps(numeros))
+    )
+    ids = {row["numero"]: row["id"] for row in cursor.fetchall()}
+    cursor.executemany(
+        """INSERT INTO lineas_presupuesto (presupuesto_id, concepto, descripcion, cantidad, precio_unitario, total, orden)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        [(ids[numero], l.concepto, l.descripcion, l.cantidad, l.precio_unitario, l.cantidad * l.precio_unitario, i)
+         for numero, p in zip(numeros, presupuestos) for i, l in enumerate(p.lineas)]
+    )
+
+IMPORTADORES = {
+    "clientes": _insertar_clientes,
+    "visitas": _insertar_visitas,
+    "presupuestos": _insertar_presupuestos,
+}
+
+def importar_fila_a_fila(cursor, importador, user_id: int, lote: list, errores: list) -> list:
+    # Cada fila en su savepoint: la que falla se deshace sola (con su número
+    # de presupuesto) y se apunta en `errores`. Devuelve las que entraron
+    insertadas = []
+    for n, obj in lote:
+        cursor.execute("SAVEPOINT fila")
+        try:
+            importador(cursor, user_id, [obj])
+        except sqlite3.IntegrityError as e:
+            cursor.execute("ROLLBACK TO fila")
+            errores.append({"fila": n, "error": str(e)})
+        else:
+            insertadas.append((n, obj))
+        cursor.execute("RELEASE fila")
+    return insertadas
+
+class AlmacenSQLite(Almacen):
+    """Almacén sobre SQLite: DATABASE_PATH y, con DB_SHARDING, los shards.
+    Cada método toma la conexión con get_db(), que es reentrante: dentro de
+    transaccion() todo lo del hilo va por la misma."""
+
+    def __init__(self):
+        init_db()
+        with get_db(principal=True) as conn:
+            if DB_SHARDING == "no" and conn.execute("SELECT 1 FROM directorio_shards LIMIT 1").fetchone():
+                logger.warning("DB_SHARDING=no pero hay usuarios en shards (%s): sus datos no serán accesibles", DB_SHARD_DIR)
+
+    def email_registrado(self, email: str) -> bool:
+        with get_db(principal=True) as conn:
+            return conn.execute("SELECT id FROM usuarios WHERE email = ?", (email,)).fetchone() is not None
+
+    def insertar_usuario(self, user: UserRegister, password_hash: str) -> Optional[int]:
+        with get_db(principal=True) as conn:
+            try:
+                cursor = conn.execute(
+                    """INSERT INTO usuarios (nombre, apellidos, email, telefono, empresa, password_hash)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (user.nombre, user.apellidos, user.email, user.telefono, user.empresa, password_hash)
+                )
+            except sqlite3.IntegrityError:
+                return None
+            user_id = cursor.lastrowid
+            if DB_SHARDING != "no":
+                # Los usuarios nuevos nacen ya en su shard
+                shards.asignar(conn, user_id)
+            conn.commit()
+            return user_id
+
+    def buscar_usuario(self, email: str) -> Optional[dict]:
+        with get_db(principal=True) as conn:
+            fila = conn.execute("SELECT * FROM usuarios WHERE email = ?", (email,)).fetchone()
+        return dict(fila) if fila else None
+
+    def obtener_usuario(self, user_id: int) -> Optional[dict]:
+        with get_db(principal=True) as conn:
+            fila = conn.execute("SELECT * FROM usuarios WHERE id = ?", (user_id,)).fetchone()
+        return dict(fila) if fila else None
+
+    def actualizar_hash(self, user_id: int, password_hash: str):
+        with get_db(principal=True) as conn:
+            conn.execute("UPDATE usuarios SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+            conn.commit()
+
+    def guardar_refresh_token(self, user_id: int, token_hash: str, familia: str, expira: float):
+        with get_db(principal=True) as conn:
+            conn.execute(
+                "INSERT INTO refresh_tokens (usuario_id, token_hash, familia, expira) VALUES (?, ?, ?, ?)",
+                (user_id, token_hash, familia, expira)
+            )
+            conn.commit()
+
+    def renovar_refresh_token(self, token_hash: str, nuevo_hash: str, expira: float, ahora: float) -> tuple:
+        with get_db(principal=True) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            fila = conn.execute("SELECT * FROM refresh_tokens WHERE token_hash = ?", (token_hash,)).fetchone()
+            if not fila or fila["revocado_at"] or fila["expira"] < ahora:
+                conn.rollback()
+                return "caducada", None, None
+            if fila["usado_at"]:
+                self._revocar(conn, fila["familia"], ahora)
+                conn.commit()
+                return "reutilizada", dict(fila), None
+
+            conn.execute("UPDATE refresh_tokens SET usado_at = ? WHERE id = ?", (ahora, fila["id"]))
+            conn.execute(
+                "INSERT INTO refresh_tokens (usuario_id, token_hash, familia, expira) VALUES (?, ?, ?, ?)",
+                (fila["usuario_id"], nuevo_hash, fila["familia"], expira)
+            )
+            usuario = conn.execute("SELECT * FROM usuarios WHERE id = ?", (fila["usuario_id"],)).fetchone()
+            conn.commit()
+        return "ok", dict(fila), dict(usuario)
+
+    def revocar_sesion(self, familia: str):
+        with get_db(principal=True) as conn:
+            self._revocar(conn, familia, time.time())
+            conn.commit()
+
+    @staticmethod
+    def _revocar(conn: sqlite3.Connection, familia: str, ahora: float):
+        conn.execute(
+            "UPDATE refresh_tokens SET revocado_at = ? WHERE familia = ? AND revocado_at IS NULL",
+            (ahora, familia)
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO tokens_revocados (clave, expira) VALUES (?, ?)",
+            (f"sid:{familia}", ahora + ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+        )
+
+    def revocaciones_desde(self, ultimo_id: int, ahora: float) -> list:
+        with get_db(principal=True) as conn:
+            return conn.execute(
+                "SELECT id, clave, expira FROM tokens_revocados WHERE id > ? AND expira > ? ORDER BY id",
+                (ultimo_id, ahora)
+            ).fetchall()
+
+    def versiones(self, user_id: int, tablas: tuple) -> dict:
+        with get_db() as conn:
+            rows = conn.execute(
+                "SELECT tabla, version FROM versiones_datos WHERE usuario_id = ? AND tabla IN (SELECT value FROM json_each(?))",
+                (user_id, json.dumps(tablas))
+            ).fetchall()
+        return {row["tabla"]: row["version"] for row in rows}
+
+    def listar_clientes(self, user_id: int, q: Optional[str], tipo: Optional[str],
+                        limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+        condiciones = ["usuario_id = ?"]
+        params = [user_id]
+        if q:
+            condiciones.append("(nombre || ' ' || COALESCE(apellidos, '') LIKE ? OR telefono LIKE ?)")
+            params += [f"%{q}%", f"%{q}%"]
+        if tipo:
+            condiciones.append("tipo = ?")
+            params.append(tipo)
+
+        with get_db() as conn:
+            rows, total, siguiente = consulta_paginada(
+                conn.cursor(), "*", "clientes", condiciones, params,
+                orden="nombre, id",
+                filtro_cursor="(nombre, id) > (?, ?)",
+                clave_cursor=lambda r: [r["nombre"], r["id"]],
+                limite=limite, cursor_pagina=cursor_pagina
+            )
+            return filas_respuesta(ClienteResponse, rows), total, siguiente
+
+    def obtener_cliente(self, user_id: int, cliente_id: int) -> Optional[dict]:
+        with get_db() as conn:
+            fila = conn.execute(
+                "SELECT * FROM clientes WHERE id = ? AND usuario_id = ?", (cliente_id, user_id)
+            ).fetchone()
+        return dict(fila) if fila else None
+
+    def crear_cliente(self, user_id: int, cliente: ClienteCreate) -> dict:
+        with get_db() as conn:
+            cursor = conn.execute(SQL_INSERTAR_CLIENTE, (user_id, *valores_campos(cliente, CAMPOS_CLIENTE)))
+            conn.commit()
+            return dict(conn.execute("SELECT * FROM clientes WHERE id = ?", (cursor.lastrowid,)).fetchone())
+
+    def actualizar_cliente(self, user_id: int, cliente_id: int, cliente: ClienteCreate) -> Optional[dict]:
+        with get_db() as conn:
+            cursor = conn.execute(
+                f"""UPDATE clientes SET {', '.join(f'{campo}=?' for campo in CAMPOS_CLIENTE)}
+                   WHERE id=? AND usuario_id=?""",
+                (*valores_campos(cliente, CAMPOS_CLIENTE), cliente_id, user_id)
+            )
+            conn.commit()
+            if cursor.rowcount == 0:
+                return None
+            return dict(conn.execute("SELECT * FROM clientes WHERE id = ?", (cliente_id,)).fetchone())
+
+    def eliminar_cliente(self, user_id: int, cliente_id: int) -> bool:
+        with get_db() as conn:
+            cursor = conn.execute("DELETE FROM clientes WHERE id = ? AND usuario_id = ?", (cliente_id, user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def listar_visitas(self, user_id: int, fecha: Optional[str], estado: Optional[str], desde: Optional[str],
+                       hasta: Optional[str], limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+        condiciones = ["v.usuario_id = ?"]
+        params = [user_id]
+        if fecha:
+            condiciones.append("v.fecha = ?")
+            params.append(fecha)
+        if desde:
+            condiciones.append("v.fecha >= ?")
+            params.append(desde)
+        if hasta:
+            condiciones.append("v.fecha <= ?")
+            params.append(hasta)
+        if estado:
+            condicion, valor = filtro_estados("v.estado", estado)
+            condiciones.append(condicion)
+            params.append(valor)
+
+        with get_db() as conn:
+            rows, total, siguiente = consulta_paginada(
+                conn.cursor(), SQL_COLUMNAS_VISITA,
+                "visitas v JOIN clientes c ON v.cliente_id = c.id",
+                condiciones, params,
+                orden="v.fecha DESC, COALESCE(v.hora, ''), v.id",
+                filtro_cursor="(v.fecha < ? OR (v.fecha = ? AND (COALESCE(v.hora, ''), v.id) > (?, ?)))",
+                clave_cursor=lambda r: [r["fecha"], r["fecha"], r["hora"] or "", r["id"]],
+                limite=limite, cursor_pagina=cursor_pagina
+            )
+            return filas_respuesta(VisitaResponse, rows), total, siguiente
+
+    def obtener_visita(self, user_id: int, visita_id: int) -> Optional[dict]:
+        with get_db() as conn:
+            fila = conn.execute(
+                f"""SELECT {SQL_COLUMNAS_VISITA}
+                   FROM visitas v
+                   JOIN clientes c ON v.cliente_id = c.id
+                   WHERE v.id = ? AND v.usuario_id = ?""",
+                (visita_id, user_id)
+            ).fetchone()
+        return dict(fila) if fila else None
+
+    def crear_visita(self, user_id: int, visita: VisitaCreate) -> int:
+        with get_db() as conn:
+            cursor = conn.execute(SQL_INSERTAR_VISITA, (user_id, *valores_campos(visita, CAMPOS_VISITA)))
+            conn.commit()
+            return cursor.lastrowid
+
+    def actualizar_visita(self, user_id: int, visita_id: int, visita: VisitaCreate) -> bool:
+        with get_db() as conn:
+            cursor = conn.execute(
+                f"""UPDATE visitas SET {', '.join(f'{campo}=?' for campo in CAMPOS_VISITA)}, version = version + 1
+                   WHERE id=? AND usuario_id=?""",
+                (*valores_campos(visita, CAMPOS_VISITA), visita_id, user_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def cambiar_estado_visita(self, user_id: int, visita_id: int, estado: str, completed_at: Optional[str]) -> bool:
+        with get_db() as conn:
+            cursor = conn.execute(
+                "UPDATE visitas SET estado = ?, completed_at = ?, version = version + 1 WHERE id = ? AND usuario_id = ?",
+                (estado, completed_at, visita_id, user_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def completar_visita(self, user_id: int, visita_id: int, firma: Optional[tuple], nombre_firmante: Optional[str],
+                         notas_internas: Optional[str], completed_at: str) -> bool:
+        with get_db() as conn:
+            firma_hash = guardar_firma(conn, *firma) if firma else None
+            cursor = conn.execute(
+                """UPDATE visitas SET estado = 'completada', completed_at = ?,
+                   firma_hash = ?, nombre_firmante = ?, notas_internas = ?, version = version + 1
+                   WHERE id = ? AND usuario_id = ?""",
+                (completed_at, firma_hash, nombre_firmante, notas_internas, visita_id, user_id)
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return False
+            conn.commit()
+            return True
+
+    def eliminar_visita(self, user_id: int, visita_id: int) -> bool:
+        with get_db() as conn:
+            cursor = conn.execute("DELETE FROM visitas WHERE id = ? AND usuario_id = ?", (visita_id, user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def datos_pdf_visita(self, user_id: int, visita_id: int) -> dict:
+        with get_db() as conn:
+            visita = conn.execute(
+                "SELECT * FROM visitas WHERE id = ? AND usuario_id = ?", (visita_id, user_id)
+            ).fetchone()
+            if not visita:
+                raise HTTPException(status_code=404, detail="Visita no encontrada")
+            if visita["estado"] != "completada":
+                raise HTTPException(status_code=400, detail="Solo las visitas completadas tienen parte de trabajo")
+            firma = None
+            if visita["firma_hash"]:
+                fila = conn.execute("SELECT codificacion, datos FROM firmas WHERE hash = ?", (visita["firma_hash"],)).fetchone()
+                if fila:
+                    firma = leer_contenido_firma(fila["codificacion"], fila["datos"])
+            return {
+                "emisor": dict(conn.execute(SQL_EMISOR_PDF, (user_id,)).fetchone()),
+                "cliente": dict(conn.execute("SELECT * FROM clientes WHERE id = ?", (visita["cliente_id"],)).fetchone() or {}),
+                "visita": dict(visita),
+                "firma": firma,
+            }
+
+    def agenda(self, user_id: int, desde: str, hasta: str, incluir_visitas: bool) -> list:
+        if incluir_visitas:
+            columnas, origen = SQL_COLUMNAS_VISITA, "visitas v JOIN clientes c ON v.cliente_id = c.id"
+        else:
+            columnas, origen = "v.fecha, v.hora, v.estado, v.prioridad", "visitas v"
+        with get_db() as conn:
+            return conn.execute(
+                f"""SELECT {columnas}, {SQL_CONFLICTO_VISITA}
+                   FROM {origen}
+                   WHERE v.usuario_id = ? AND v.fecha BETWEEN ? AND ?
+                   ORDER BY v.fecha, v.hora, v.id""",
+                (user_id, desde, hasta)
+            ).fetchall()
+
+    def info_firma(self, user_id: int, firma_hash: str) -> Optional[dict]:
+        with get_db() as conn:
+            fila = conn.execute(
+                """SELECT id, mime, codificacion, tamano, length(datos) AS almacenado FROM firmas f
+                   WHERE hash = ? AND EXISTS (SELECT 1 FROM visitas WHERE firma_hash = f.hash AND usuario_id = ?)""",
+                (firma_hash, user_id)
+            ).fetchone()
+        return dict(fila) if fila else None
+
+    def trozos_firma(self, user_id: int, firma_id: int, inicio: int, fin: int):
+        # La conexión se presta fuera de get_db: el generador avanza en hilos
+        # distintos y la libera él mismo
+        return leer_blob_firma(pool_db(user_id), firma_id, inicio, fin)
+
+    def listar_presupuestos(self, user_id: int, estado: Optional[str], desde: Optional[str], hasta: Optional[str],
+                            incluir_lineas: bool, limite: Optional[int], cursor_pagina: Optional[str]) -> tuple:
+        condiciones = ["p.usuario_id = ?"]
+        params = [user_id]
+        if estado:
+            condicion, valor = filtro_estados("p.estado", estado)
+            condiciones.append(condicion)
+            params.append(valor)
+        if desde:
+            condiciones.append("p.fecha_emision >= ?")
+            params.append(desde)
+        if hasta:
+            condiciones.append("p.fecha_emision <= ?")
+            params.append(hasta)
+
+        with get_db() as conn:
+            cursor = conn.cursor()
+            rows, total, siguiente = consulta_paginada(
+                cursor, SQL_COLUMNAS_PRESUPUESTO,
+                "presupuestos p JOIN clientes c ON p.cliente_id = c.id",
+                condiciones, params,
+                orden="p.created_at DESC, p.id DESC",
+                filtro_cursor="(p.created_at, p.id) < (?, ?)",
+                clave_cursor=lambda r: [r["created_at"], r["id"]],
+                limite=limite, cursor_pagina=cursor_pagina
+            )
+            return filas_presupuestos(cursor, rows, incluir_lineas), total, siguiente
+
+    def presupuestos_cliente(self, user_id: int, cliente_id: int, incluir_lineas: bool) -> List[dict]:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""SELECT {SQL_COLUMNAS_PRESUPUESTO}
+                   FROM presupuestos p
+                   JOIN clientes c ON p.cliente_id = c.id
+                   WHERE p.usuario_id = ? AND p.cliente_id = ?
+                   ORDER BY p.created_at DESC""",
+                (user_id, cliente_id)
+            )
+            return filas_presupuestos(cursor, cursor.fetchall(), incluir_lineas)
+
+    def obtener_presupuesto(self, user_id: int, presupuesto_id: int) -> Optional[dict]:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""SELECT {SQL_COLUMNAS_PRESUPUESTO}
+                   FROM presupuestos p
+                   JOIN clientes c ON p.cliente_id = c.id
+                   WHERE p.id = ? AND p.usuario_id = ?""",
+                (presupuesto_id, user_id)
+            )
+            pres = cursor.fetchone()
+            if not pres:
+                return None
+            pres_dict = dict(pres)
+            cursor.execute("SELECT * FROM lineas_presupuesto WHERE presupuesto_id = ? ORDER BY orden", (presupuesto_id,))
+            pres_dict["lineas"] = [dict(l) for l in cursor.fetchall()]
+            return pres_dict
+
+    def datos_pdf_presupuesto(self, user_id: int, presupuesto_id: int) -> dict:
+        with get_db() as conn:
+            presupuesto = conn.execute(
+                "SELECT * FROM presupuestos WHERE id = ? AND usuario_id = ?", (presupuesto_id, user_id)
+            ).fetchone()
+            if not presupuesto:
+                raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
+            return {
+                "emisor": dict(conn.execute(SQL_EMISOR_PDF, (user_id,)).fetchone()),
+                "cliente": dict(conn.execute("SELECT * FROM clientes WHERE id = ?", (presupuesto["cliente_id"],)).fetchone() or {}),
+                "presupuesto": dict(presupuesto),
+                "lineas": [dict(l) for l in conn.execute(
+                    """SELECT concepto, descripcion, cantidad, precio_unitario, total
+                       FROM lineas_presupuesto WHERE presupuesto_id = ? ORDER BY orden, id""",
+                    (presupuesto_id,)
+                ).fetchall()],
+            }
+
+    def crear_presupuesto(self, user_id: int, presupuesto: PresupuestoCreate) -> int:
+        subtotal, iva_amount, total = calcular_totales(presupuesto)
+        with get_db() as conn:
+            cursor = conn.cursor()
+            numero = generar_numero_presupuesto(cursor, user_id)
+            cursor.execute(
+                """INSERT INTO presupuestos (usuario_id, cliente_id, numero, titulo, descripcion,
+                   subtotal, iva_porcentaje, aplicar_iva, iva_amount, total, estado, fecha_emision, fecha_validez, notas)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'borrador', ?, ?, ?)""",
+                (user_id, presupuesto.cliente_id, numero, presupuesto.titulo, presupuesto.descripcion,
+                 subtotal, presupuesto.iva_porcentaje, presupuesto.aplicar_iva, iva_amount, total,
+                 datetime.now().strftime("%Y-%m-%d"), presupuesto.fecha_validez, presupuesto.notas)
+            )
+            presupuesto_id = cursor.lastrowid
+            cursor.executemany(
+                SQL_INSERTAR_LINEA,
+                [(presupuesto_id, l.concepto, l.descripcion, l.cantidad, l.precio_unitario, i)
+                 for i, l in enumerate(presupuesto.lineas)]
+            )
+            conn.commit()
+            return presupuesto_id
+
+    def editar_presupuesto(self, user_id: int, presupuesto_id: int, version: int, cambios: dict,
+                           lineas: Optional[List[LineaPresupuesto]]):
+        with get_db() as conn:
+            cursor = conn.cursor()
+
+            # Bloqueo optimista: la misma sentencia comprueba que nadie ha guardado
+            # desde que el cliente leyó el presupuesto y toma el bloqueo de escritura
+            cursor.execute(
+                "UPDATE presupuestos SET version = version + 1 WHERE id = ? AND usuario_id = ? AND version = ?",
+                (presupuesto_id, user_id, version)
+            )
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    "SELECT version FROM presupuestos WHERE id = ? AND usuario_id = ?", (presupuesto_id, user_id)
+                )
+                actual = cursor.fetchone()
+                if not actual:
+                    raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"El presupuesto se ha modificado (versión {actual['version']}); vuelve a cargarlo"
+                )
+
+            if lineas is not None:
+                cursor.execute(
+                    """SELECT id, concepto, descripcion, cantidad, precio_unitario, orden
+                       FROM lineas_presupuesto WHERE presupuesto_id = ?""",
+                    (presupuesto_id,)
+                )
+                guardadas = {row["id"]: row[1:] for row in cursor.fetchall()}
+                altas, modificaciones, bajas = diferencias_lineas(guardadas, lineas)
+                cursor.executemany("DELETE FROM lineas_presupuesto WHERE id = ?", bajas)
+                cursor.executemany(
+                    """UPDATE lineas_presupuesto SET concepto = ?1, descripcion = ?2, cantidad = ?3,
+                       precio_unitario = ?4, total = ?3 * ?4, orden = ?5 WHERE id = ?6""",
+                    modificaciones
+                )
+                cursor.executemany(SQL_INSERTAR_LINEA, [(presupuesto_id, *valores) for valores in altas])
+
+            # Los totales salen de las líneas ya guardadas. En un UPDATE las columnas
+            # valen lo que valían antes, así que el IVA nuevo se usa como parámetro
+            valor = {campo: f":{campo}" if campo in cambios else campo for campo in ("aplicar_iva", "iva_porcentaje")}
+            iva = f"CASE WHEN {valor['aplicar_iva']} THEN t.subtotal * {valor['iva_porcentaje']} / 100 ELSE 0 END"
+            asignaciones = [f"{campo} = :{campo}" for campo in cambios] + [
+                "subtotal = t.subtotal", f"iva_amount = {iva}", f"total = t.subtotal + {iva}"
+            ]
+            cursor.execute(
+                f"""UPDATE presupuestos SET {', '.join(asignaciones)}
+                   FROM (SELECT COALESCE(SUM(total), 0) AS subtotal FROM lineas_presupuesto
+                         WHERE presupuesto_id = :id) AS t
+                   WHERE presupuestos.id = :id""",
+                {**cambios, "id": presupuesto_id}
+            )
+            conn.commit()
+
+    def cambiar_estado_presupuesto(self, user_id: int, presupuesto_id: int, estado: str,
+                                   fecha_rechazo: Optional[str]) -> bool:
+        with get_db() as conn:
+            cursor = conn.execute(
+                "UPDATE presupuestos SET estado = ?, fecha_rechazo = ? WHERE id = ? AND usuario_id = ?",
+                (estado, fecha_rechazo, presupuesto_id, user_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def eliminar_presupuesto(self, user_id: int, presupuesto_id: int) -> bool:
+        with get_db() as conn:
+            cursor = conn.execute("DELETE FROM presupuestos WHERE id = ? AND usuario_id = ?", (presupuesto_id, user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def importar_lote(self, user_id: int, entidad: str, lote: list, errores: list) -> int:
+        # executemany de las filas válidas y commit; si alguna viola una
+        # restricción, se repite el lote fila a fila
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                if entidad != "clientes":
+                    cursor.execute(
+                        "SELECT id FROM clientes WHERE usuario_id = ? AND id IN (SELECT value FROM json_each(?))",
+                        (user_id, json.dumps(sorted({obj.cliente_id for _, obj in lote})))
+                    )
+                    propios = {row["id"] for row in cursor.fetchall()}
+                    for n, obj in lote:
+                        if obj.cliente_id not in propios:
+                            errores.append({"fila": n, "error": f"cliente_id: el cliente {obj.cliente_id} no existe"})
+                    lote = [(n, obj) for n, obj in lote if obj.cliente_id in propios]
+
+                if lote:
+                    cursor.execute("SAVEPOINT lote")
+                    try:
+                        IMPORTADORES[entidad](cursor, user_id, [obj for _, obj in lote])
+                    except sqlite3.IntegrityError:
+                        cursor.execute("ROLLBACK TO lote")
+                        lote = importar_fila_a_fila(cursor, IMPORTADORES[entidad], user_id, lote, errores)
+                    cursor.execute("RELEASE lote")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return len(lote)
+
+    def exportar(self, user_id: int, entidad: str):
+        # Recorre el cursor por bloques de EXPORT_CHUNK_SIZE filas. La conexión
+        # se presta fuera de get_db (el generador avanza en hilos distintos) y
+        # al empezar a iterar: un generador sin arrancar no retiene ninguna
+        pool = pool_db(user_id)
+        conn = pool.acquire()
+        try:
+            conn.execute("BEGIN")  # misma instantánea para filas y líneas
+            cursor = conn.execute(
+                f"SELECT {', '.join(COLUMNAS_EXPORTACION[entidad])} FROM {entidad} WHERE usuario_id = ? ORDER BY id",
+                (user_id,)
+            )
+            while True:
+                rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                filas = [dict(row) for row in rows]
+                if entidad == "presupuestos":
+                    lineas = cargar_lineas(conn.cursor(), [f["id"] for f in filas])
+                    for f in filas:
+                        f["lineas"] = [{c: l[c] for c in CAMPOS_LINEA} for l in lineas[f["id"]]]
+                yield filas
+        finally:
+            pool.release(conn)
+
+    def leer_cambios_sync(self, user_id: int, desde: int, limite: int) -> tuple:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")  # misma instantánea para el registro y los datos
+            reiniciar = False
+            if desde:
+                horizonte = cursor.execute("SELECT seq FROM sync_horizonte WHERE usuario_id = ?", (user_id,)).fetchone()
+                if horizonte and desde < horizonte["seq"]:
+                    desde, reiniciar = 0, True
+
+            cursor.execute(
+                """SELECT seq, tabla, registro_id, borrado FROM cambios_sync
+                   WHERE usuario_id = ?1 AND seq > ?2 AND (?2 > 0 OR borrado = 0)
+                   ORDER BY seq LIMIT ?3""",
+                (user_id, desde, limite + 1)
+            )
+            cambios = [dict(c) for c in cursor.fetchall()]
+            mas = len(cambios) > limite
+            cambios = cambios[:limite]
+
+            registros = {}
+            for tabla in TABLAS_SYNC:
+                ids = [c["registro_id"] for c in cambios if c["tabla"] == tabla and not c["borrado"]]
+                if ids:
+                    cursor.execute(SQL_REGISTROS_SYNC[tabla], (user_id, json.dumps(ids)))
+                    rows = cursor.fetchall()
+                    registros[tabla] = (filas_presupuestos(cursor, rows) if tabla == "presupuestos"
+                                        else filas_respuesta(MODELOS_RESPUESTA[tabla], rows))
+            conn.rollback()
+        return reiniciar, mas, cambios, registros
+
+    @contextmanager
+    def transaccion(self):
+        with get_db():
+            yield
+
+    def peticion_sync(self, user_id: int, id_peticion: str) -> Optional[dict]:
+        with get_db() as conn:
+            fila = conn.execute(
+                "SELECT estado, resultado FROM peticiones_sync WHERE usuario_id = ? AND id_peticion = ?",
+                (user_id, id_peticion)
+            ).fetchone()
+        return dict(fila) if fila else None
+
+    def registrar_peticion_sync(self, user_id: int, id_peticion: str):
+        # Se confirma con el commit de la propia operación
+        with get_db() as conn:
+            conn.execute("INSERT INTO peticiones_sync (usuario_id, id_peticion) VALUES (?, ?)", (user_id, id_peticion))
+
+    def guardar_peticion_sync(self, user_id: int, id_peticion: str, estado: int, resultado: str):
+        with get_db() as conn:
+            conn.execute(
+                """INSERT INTO peticiones_sync (usuario_id, id_peticion, estado, resultado) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (usuario_id, id_peticion) DO UPDATE SET
+                   estado = excluded.estado, resultado = excluded.resultado""",
+                (user_id, id_peticion, estado, resultado)
+            )
+            conn.commit()
+
+    def deshacer(self):
+        with get_db() as conn:
+            conn.rollback()
+
+    def buscar(self, user_id: int, q: str, entidades: set, limite: int) -> dict:
+        resultado = {}
+        with get_db() as conn:
+            if "clientes" in entidades:
+                resultado["clientes"] = conn.execute(
+                    """SELECT c.id, c.nombre, c.apellidos, c.telefono FROM buscar_clientes f
+                       JOIN clientes c ON c.id = f.rowid
+                       WHERE buscar_clientes MATCH ? AND c.usuario_id = ?
+                       ORDER BY f.rank LIMIT ?""",
+                    (expresion_busqueda(q, user_id, "clientes"), user_id, limite)
+                ).fetchall()
+            if "visitas" in entidades:
+                resultado["visitas"] = conn.execute(
+                    """SELECT v.id, v.titulo, v.fecha, v.cliente_id FROM buscar_visitas f
+                       JOIN visitas v ON v.id = f.rowid
+                       WHERE buscar_visitas MATCH ? AND v.usuario_id = ?
+                       ORDER BY f.rank LIMIT ?""",
+                    (expresion_busqueda(q, user_id, "visitas"), user_id, limite)
+                ).fetchall()
+            if "presupuestos" in entidades:
+                # Un presupuesto coincide por sus propios campos o por cualquiera
+                # de sus líneas; cuenta su mejor coincidencia
+                resultado["presupuestos"] = conn.execute(
+                    """WITH coincidencias AS (
+                           SELECT rowid AS id, rank FROM buscar_presupuestos WHERE buscar_presupuestos MATCH ?
+                           UNION ALL
+                           SELECT presupuesto_id, rank FROM buscar_lineas WHERE buscar_lineas MATCH ?
+                       )
+                       SELECT p.id, p.numero, p.titulo, p.cliente_id, MIN(m.rank) AS rank
+                       FROM coincidencias m JOIN presupuestos p ON p.id = m.id
+                       WHERE p.usuario_id = ?
+                       GROUP BY p.id ORDER BY rank LIMIT ?""",
+                    (expresion_busqueda(q, user_id, "presupuestos"), expresion_busqueda(q, user_id, "lineas"),
+                     user_id, limite)
+                ).fetchall()
+        return resultado
+
+    def contadores(self, user_id: int, claves: List[str]) -> dict:
+        # Todo sale de resumen_contadores en una sola consulta por clave primaria
+        with get_db() as conn:
+            return leer_contadores(conn.cursor(), user_id, claves)
+
+    def presupuestos_por_estado(self, user_id: int) -> dict:
+        with get_db() as conn:
+            filas = conn.execute(
+                "SELECT clave, valor FROM resumen_contadores WHERE usuario_id = ? AND clave GLOB 'presupuestos:estado:*'",
+                (user_id,)
+            ).fetchall()
+        return {fila["clave"][len("presupuestos:estado:"):]: int(fila["valor"]) for fila in filas}
+
+    def analitica(self, tabla: str, user_id: int, inicio: date, fin: date, agrupar: str, por: Optional[str]) -> List[dict]:
+        with get_db() as conn:
+            return leer_rollup(conn.cursor(), tabla, user_id, inicio, fin, agrupar,
+                               *(DESGLOSES_ROLLUP[tabla] if por else ()))
+
+    def tareas_programadas(self) -> dict:
+        return TAREAS_PROGRAMADAS
+
+    def tomar_tarea(self, nombre: str, propietario: str, forzar: bool) -> bool:
+        # UPDATE condicional atómico: solo un worker puede marcar la tarea
+        ahora = time.time()
+        with get_db(principal=True) as conn:
+            conn.execute("INSERT INTO tareas_programadas (nombre) VALUES (?) ON CONFLICT DO NOTHING", (nombre,))
+            cursor = conn.execute(
+                """UPDATE tareas_programadas SET propietario = ?, bloqueada_hasta = ?
+                   WHERE nombre = ? AND (? OR proxima <= ?) AND (bloqueada_hasta IS NULL OR bloqueada_hasta < ?)""",
+                (propietario, ahora + SCHEDULER_LOCK_SECONDS, nombre, forzar, ahora, ahora)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+
+    def ejecutar_tarea(self, nombre: str, funcion, dry_run: bool) -> dict:
+        # En la BD principal y, si es de TAREAS_POR_SHARD, en cada shard
+        with get_db(principal=True) as conn:
+            try:
+                resultado = funcion(conn, dry_run)
+                if nombre in TAREAS_POR_SHARD:
+                    for shard in shards.nombres():
+                        with shards.conexion_directa(shard) as conn_shard:
+                            resultado = sumar_resultados(resultado, funcion(conn_shard, dry_run))
+                        resultado["shards"] = resultado.get("shards", 0) + 1
+            except Exception:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+        return resultado
+
+    def cerrar_tarea(self, nombre: str, propietario: str, proxima: float, ahora: float, duracion_ms: float,
+                     resultado: str, error: Optional[str]):
+        with get_db(principal=True) as conn:
+            conn.execute(
+                """UPDATE tareas_programadas SET propietario = NULL, bloqueada_hasta = NULL, proxima = ?,
+                   ultima_ejecucion = ?, ultima_duracion_ms = ?, ultimo_resultado = ?, ultimo_error = ?,
+                   ejecuciones = ejecuciones + 1
+                   WHERE nombre = ? AND propietario = ?""",
+                (proxima, ahora, duracion_ms, resultado, error, nombre, propietario)
+            )
+            conn.commit()
+
+    def stats(self) -> dict:
+        return db_pool.stats()
+
+    def close(self):
+        shards.close()
+        db_pool.close()
+
+# ============ TAREAS PROGRAMADAS ============
+
+# Cada tarea recibe una conexión y `dry_run`, y devuelve un resumen de lo que
+# ha hecho (o haría). Se ejecutan en un hilo propio, fuera de las peticiones.
+
+def purgar_presupuestos_rechazados(conn: sqlite3.Connection, dry_run: bool) -> dict:
+    # Rechazados hace más de REJECTED_RETENTION_DAYS, con sus líneas. Por lotes
+    # de PURGE_BATCH_SIZE para no retener el bloqueo de escritura
+    limite = (datetime.now() - timedelta(days=REJECTED_RETENTION_DAYS)).isoformat()
+    if dry_run:
+        fila = conn.execute(
+            """SELECT COUNT(*), COUNT(DISTINCT usuario_id),
+                      (SELECT COUNT(*) FROM lineas_presupuesto l JOIN presupuestos p ON p.id = l.presupuesto_id
+                       WHERE p.estado = 'rechazado' AND p.fecha_rechazo < ?1)
+               FROM presupuestos WHERE estado = 'rechazado' AND fecha_rechazo < ?1""",
+            (limite,)
+        ).fetchone()
+        return {"presupuestos": fila[0], "usuarios": fila[1], "lineas": fila[2]}
+
+    presupuestos = lineas = lotes = 0
+    usuarios = set()
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        filas = conn.execute(
+            """SELECT id, usuario_id FROM presupuestos
+               WHERE estado = 'rechazado' AND fecha_rechazo < ? ORDER BY fecha_rechazo LIMIT ?""",
+            (limite, PURGE_BATCH_SIZE)
+        ).fetchall()
+        if not filas:
+            conn.rollback()
+            break
+        ids = json.dumps([fila["id"] for fila in filas])
+        lineas += conn.execute(
+            "DELETE FROM lineas_presupuesto WHERE presupuesto_id IN (SELECT value FROM json_each(?))", (ids,)
+        ).rowcount
+        presupuestos += conn.execute(
+            "DELETE FROM presupuestos WHERE id IN (SELECT value FROM json_each(?))", (ids,)
+        ).rowcount
+        conn.commit()
+        lote_usuarios = {fila["usuario_id"] for fila in filas}
+        for usuario_id in lote_usuarios:
+            invalidar_cache(usuario_id)
+        usuarios |= lote_usuarios
+        lotes += 1
+    return {"presupuestos": presupuestos, "usuarios": len(usuarios), "lineas": lineas, "lotes": lotes}
+
+def purgar_tokens_caducados(conn: sqlite3.Connection, dry_run: bool) -> dict:
+    # Refresh tokens caducados y revocaciones de access tokens que ya expiraron
+    ahora = time.time()
+    resultado = {}
+    for tabla in ("refresh_tokens", "tokens_revocados"):
+        if dry_run:
+            resultado[tabla] = conn.execute(f"SELECT COUNT(*) FROM {tabla} WHERE expira < ?", (ahora,)).fetchone()[0]
+            continue
+        resultado[tabla] = 0
+        while True:
+            borrados = conn.execute(
+                f"DELETE FROM {tabla} WHERE id IN (SELECT id FROM {tabla} WHERE expira < ? LIMIT ?)",
+                (ahora, PURGE_BATCH_SIZE)
+            ).rowcount
+            conn.commit()
+            resultado[tabla] += borrados
+            if borrados < PURGE_BATCH_SIZE:
+                break
+    return resultado
+
+def checkpoint_wal(conn: sqlite3.Connection, dry_run: bool) -> dict:
+    # PASSIVE: copia al fichero principal lo que pueda sin esperar a lectores
+    # ni bloquear escrituras
+    ruta_wal = conn.execute("PRAGMA database_list").fetchone()[2] + "-wal"
+    resultado = {"wal_bytes": os.path.getsize(ruta_wal) if os.path.exists(ruta_wal) else 0}
+    if not dry_run:
+        ocupada, paginas, copiadas = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        resultado.update({"ocupada": bool(ocupada), "paginas_wal": paginas, "paginas_copiadas": copiadas})
+    return resultado
+
+def vacuum_incremental(conn: sqlite3.Connection, dry_run: bool) -> dict:
+    # Devuelve al sistema hasta VACUUM_MAX_PAGES páginas libres por ejecución
+    libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return {"paginas_libres": libres, "omitida": "auto_vacuum no es incremental"}
+    if dry_run or not libres:
+        return {"paginas_libres": libres}
+    # El pragma libera una página por paso: hay que consumir todas las filas
+    conn.execute(f"PRAGMA incremental_vacuum({VACUUM_MAX_PAGES})").fetchall()
+    restantes = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {"paginas_liberadas": libres - restantes, "paginas_libres": restantes}
+
+def analizar_estadisticas(conn: sqlite3.Connection, dry_run: bool) -> dict:
+    # ANALYZE acotado (analysis_limit) para que no recorra tablas enteras
+    if dry_run:
+        return {}
+    conn.execute("PRAGMA analysis_limit = 1000")
+    try:
+        conn.execute("ANALYZE")
+    finally:
+        conn.execute("PRAGMA analysis_limit = 0")
+    return {"tablas": conn.execute("SELECT COUNT(DISTINCT tbl) FROM sqlite_stat1").fetchone()[0]}
+
+def limpiar_cache_pdf(conn: Optional[sqlite3.Connection], dry_run: bool) -> dict:
+    # PDF sin pedir en PDF_CACHE_DAYS días (cada acierto renueva la fecha):
+    # versiones viejas, registros borrados o datos de cliente que han cambiado
+    limite = time.time() - PDF_CACHE_DAYS * 86400
+    borrados = liberados = 0
+    for carpeta, _, archivos in os.walk(PDF_CACHE_DIR, topdown=False):
+        for archivo in archivos:
+            ruta = os.path.join(carpeta, archivo)
+            try:
+                info = os.stat(ruta)
+                if info.st_mtime < limite:
+                    if not dry_run:
+                        os.remove(ruta)
+                    borrados += 1
+                    liberados += info.st_size
+            except FileNotFoundError:
+                pass
+        if not dry_run and carpeta != PDF_CACHE_DIR:
+            try:
+                os.rmdir(carpeta)  # solo si ha quedado vacía
+            except OSError:
+                pass
+    return {"archivos": borrados, "bytes": liberados}
+
+def limpiar_sync(conn: sqlite3.Connection, dry_run: bool) -> dict:
+    # Marcas de borrado de más de SYNC_TOMBSTONE_DAYS (antes se sube el
+    # horizonte de cada usuario: quien no las haya recibido empieza de cero) y
+    # peticiones aplicadas de más de SYNC_REQUEST_DAYS
+    ahora = datetime.utcnow()  # CURRENT_TIMESTAMP es UTC
+    limite_borrados = (ahora - timedelta(days=SYNC_TOMBSTONE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    limite_peticiones = (ahora - timedelta(days=SYNC_REQUEST_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    if dry_run:
+        return {
+            "borrados": conn.execute(
+                "SELECT COUNT(*) FROM cambios_sync WHERE borrado = 1 AND fecha < ?", (limite_borrados,)
+            ).fetchone()[0],
+            "peticiones": conn.execute(
+                "SELECT COUNT(*) FROM peticiones_sync WHERE created_at < ?", (limite_peticiones,)
+            ).fetchone()[0],
+        }
+
+    conn.execute(
+        """INSERT INTO sync_horizonte (usuario_id, seq)
+           SELECT usuario_id, MAX(seq) FROM cambios_sync WHERE borrado = 1 AND fecha < ? GROUP BY usuario_id
+           ON CONFLICT (usuario_id) DO UPDATE SET seq = MAX(seq, excluded.seq)""",
+        (limite_borrados,)
+    )
+    conn.commit()
+    resultado = {}
+    for clave, tabla, clave_fila, condicion, limite in (
+        ("borrados", "cambios_sync", "seq", "borrado = 1 AND fecha < ?", limite_borrados),
+        ("peticiones", "peticiones_sync", "id", "created_at < ?", limite_peticiones),
+    ):
+        resultado[clave] = 0
+        while True:
+            borrados = conn.execute(
+                f"DELETE FROM {tabla} WHERE {clave_fila} IN (SELECT {clave_fila} FROM {tabla} WHERE {condicion} LIMIT ?)",
+                (limite, PURGE_BATCH_SIZE)
+            ).rowcount
+            conn.commit()
+            resultado[clave] += borrados
+            if borrados < PURGE_BATCH_SIZE:
+                break
+    return resultado
+
+def vacuum_completo(conn: sqlite3.Connection):
+    # Reescribe la BD entera; necesario una vez para activar auto_vacuum
+    # incremental en una BD creada antes. Bloquea las escrituras mientras dura
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+# Nombre -> (intervalo en segundos, función), en el orden en que se ejecutan
+TAREAS_PROGRAMADAS = {
+    "purgar_presupuestos": (3600, purgar_presupuestos_rechazados),
+    "purgar_tokens": (3600, purgar_tokens_caducados),
+    "checkpoint_wal": (300, checkpoint_wal),
+    "vacuum_incremental": (6 * 3600, vacuum_incremental),
+    "analyze": (24 * 3600, analizar_estadisticas),
+    "limpiar_pdf": (24 * 3600, limpiar_cache_pdf),
+    "limpiar_sync": (24 * 3600, limpiar_sync),
+}
+
+# Tareas sobre los datos de los usuarios: con DB_SHARDING se repiten en cada
+# shard y el resumen suma lo de todos
+TAREAS_POR_SHARD = {"purgar_presupuestos", "checkpoint_wal", "vacuum_incremental", "analyze", "limpiar_sync"}
+
+def sumar_resultados(total: dict, parcial: dict) -> dict:
+    # Suma los valores numéricos (los booleanos con or); del resto se queda el primero
+    for clave, valor in parcial.items():
+        if clave not in total:
+            total[clave] = valor
+        elif isinstance(valor, bool):
+            total[clave] = total[clave] or valor
+        elif isinstance(valor, (int, float)):
+            total[clave] += valor
+    return total
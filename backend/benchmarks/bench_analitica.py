@@ -0,0 +1,120 @@
+"""
+Analítica: compara /api/analitica/presupuestos (agregados diarios y mensuales)
+con el mismo cálculo sobre la tabla presupuestos, para rangos de distinta
+longitud. Mide también cuánto encarecen los triggers de los agregados el
+cambio de estado de un presupuesto.
+
+Uso (desde la carpeta backend):
+    python benchmarks/bench_analitica.py --usuarios 10 --presupuestos 200000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+# main.py inicializa su propia BD al importarse: apuntarla a un temporal y
+# desactivar la caché de respuestas para medir siempre la consulta
+_tmp = tempfile.mkdtemp(prefix="tecnigestion-bench-")
+os.environ["DATABASE_PATH"] = os.path.join(_tmp, "app.db")
+os.environ["RESPONSE_CACHE"] = "none"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+ESTADOS = ["borrador", "enviado", "aceptado", "rechazado"]
+
+# Lo mismo que devuelve el endpoint agrupado por mes, calculado sin agregados
+SQL_DIRECTO = """SELECT substr(fecha_emision, 1, 7), COUNT(*), SUM(estado = 'aceptado'), SUM(estado = 'rechazado'),
+       SUM(total), SUM((estado = 'aceptado') * total)
+    FROM presupuestos WHERE usuario_id = ? AND fecha_emision BETWEEN ? AND ?
+    GROUP BY 1 ORDER BY 1"""
+
+
+def poblar(conn, usuarios, clientes, presupuestos, dias):
+    rnd = random.Random(42)
+    hoy = date.today()
+    conn.executemany(
+        "INSERT INTO usuarios (id, nombre, email, password_hash) VALUES (?, ?, ?, 'x')",
+        [(u, f"Usuario {u}", f"u{u}@example.com") for u in range(1, usuarios + 1)],
+    )
+    conn.executemany(
+        "INSERT INTO clientes (id, usuario_id, nombre, telefono) VALUES (?, ?, ?, '600000000')",
+        [(i, i % usuarios + 1, f"Cliente {i}") for i in range(1, clientes + 1)],
+    )
+    filas = []
+    for i in range(1, presupuestos + 1):
+        cid = rnd.randint(1, clientes)
+        emision = (hoy - timedelta(days=rnd.randint(0, dias))).isoformat()
+        filas.append((i, cid % usuarios + 1, cid, f"B-{i}", rnd.choice(ESTADOS), round(rnd.uniform(50, 3000), 2), emision))
+    conn.executemany(
+        """INSERT INTO presupuestos (id, usuario_id, cliente_id, numero, titulo, estado, total, fecha_emision)
+           VALUES (?, ?, ?, ?, 'Presupuesto', ?, ?, ?)""",
+        filas,
+    )
+    conn.commit()
+
+
+def percentiles(tiempos):
+    tiempos.sort()
+    return statistics.median(tiempos), tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.99))]
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=10)
+    parser.add_argument("--clientes", type=int, default=2000)
+    parser.add_argument("--presupuestos", type=int, default=200000)
+    parser.add_argument("--dias", type=int, default=3 * 365, help="antigüedad máxima de las emisiones")
+    parser.add_argument("--repeticiones", type=int, default=50)
+    args = parser.parse_args()
+
+    print("Generando datos...")
+    with main.get_db() as conn:
+        poblar(conn, args.usuarios, args.clientes, args.presupuestos, args.dias)
+        conn.execute("ANALYZE")
+
+    rnd = random.Random(7)
+    hoy = date.today()
+    print(f"\n{'rango':<10}{'directo p50':>13}{'p99':>9}{'agregados p50':>15}{'p99':>9}  (ms)")
+    for etiqueta, longitud in (("1 mes", 30), ("3 meses", 90), ("12 meses", 365), ("3 años", 3 * 365)):
+        directo, agregados = [], []
+        for _ in range(args.repeticiones):
+            u = rnd.randint(1, args.usuarios)
+            desde = hoy - timedelta(days=longitud + rnd.randint(0, 60))
+            hasta = desde + timedelta(days=longitud)
+            with main.get_db() as conn:
+                inicio = time.perf_counter()
+                conn.execute(SQL_DIRECTO, (u, desde.isoformat(), hasta.isoformat())).fetchall()
+                directo.append((time.perf_counter() - inicio) * 1000)
+            inicio = time.perf_counter()
+            main.analitica_presupuestos(desde=desde.isoformat(), hasta=hasta.isoformat(), agrupar="mes", por=None, user_id=u)
+            agregados.append((time.perf_counter() - inicio) * 1000)
+        print(f"{etiqueta:<10}{percentiles(directo)[0]:>13.3f}{percentiles(directo)[1]:>9.3f}"
+              f"{percentiles(agregados)[0]:>15.3f}{percentiles(agregados)[1]:>9.3f}")
+
+    # Coste de mantener los agregados en una escritura
+    ids = [rnd.randint(1, args.presupuestos) for _ in range(args.repeticiones * 10)]
+    tiempos = {}
+    with main.get_db() as conn:
+        for con_triggers in (True, False):
+            if not con_triggers:
+                for tabla in main.ROLLUPS:
+                    for op in ("insert", "update", "delete"):
+                        conn.execute(f"DROP TRIGGER trg_{tabla}_{op}")
+            medidas = []
+            for pid in ids:
+                inicio = time.perf_counter()
+                conn.execute("UPDATE presupuestos SET estado = ? WHERE id = ?", (rnd.choice(ESTADOS), pid))
+                conn.commit()
+                medidas.append((time.perf_counter() - inicio) * 1000)
+            tiempos[con_triggers] = statistics.median(medidas)
+    print(f"\nCambio de estado: {tiempos[False]:.3f} ms sin agregados, {tiempos[True]:.3f} ms con agregados")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,208 @@
+"""
+Prueba de carga: compara DB_MODE=sync y DB_MODE=async con tráfico mixto
+concurrente (listados, detalle, dashboard y escrituras) contra un uvicorn real.
+Para cada modo arranca un servidor con una BD temporal, la puebla con la
+importación masiva y mide peticiones/s y latencias p50/p99.
+
+Requiere httpx (pip install httpx). Uso (desde la carpeta backend):
+    python benchmarks/bench_async.py --concurrencia 64 --duracion 20
+    python benchmarks/bench_async.py --modos async --cache
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# (peso, nombre); las escrituras son ~10 % del tráfico
+MEZCLA = [
+    (25, "listar_clientes"),
+    (20, "listar_visitas"),
+    (15, "obtener_visita"),
+    (15, "listar_presupuestos"),
+    (15, "dashboard"),
+    (5, "crear_cliente"),
+    (5, "cambiar_estado_visita"),
+]
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def ndjson(filas) -> bytes:
+    return "".join(json.dumps(f) + "\n" for f in filas).encode()
+
+
+async def esperar_servidor(client, proceso):
+    for _ in range(100):
+        if proceso.poll() is not None:
+            raise RuntimeError("El servidor no arrancó")
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("El servidor no responde")
+
+
+async def poblar(client, usuarios: int, clientes: int, visitas: int) -> list:
+    hoy = date.today()
+    sesiones = []
+    for u in range(usuarios):
+        r = await client.post("/api/auth/registro", json={
+            "nombre": f"Técnico {u}", "email": f"bench{u}@example.com", "password": "secreto-bench"
+        })
+        auth = {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+        await client.post("/api/importar/clientes?formato=ndjson", headers=auth, files={"archivo": ("c.ndjson", ndjson(
+            {"nombre": f"Cliente {i}", "telefono": f"6{i:08d}", "ciudad": "Madrid"} for i in range(clientes)
+        ))})
+        r = await client.get("/api/exportar/clientes?formato=ndjson", headers=auth)
+        cliente_ids = [json.loads(l)["id"] for l in r.text.splitlines()]
+
+        await client.post("/api/importar/visitas?formato=ndjson", headers=auth, files={"archivo": ("v.ndjson", ndjson(
+            {"cliente_id": random.choice(cliente_ids), "titulo": f"Visita {i}",
+             "fecha": (hoy + timedelta(days=random.randint(-60, 30))).isoformat(),
+             "estado": random.choice(["pendiente", "confirmada", "completada"])}
+            for i in range(visitas)
+        ))})
+        r = await client.get("/api/exportar/visitas?formato=ndjson", headers=auth)
+        visita_ids = [json.loads(l)["id"] for l in r.text.splitlines()]
+
+        await client.post("/api/importar/presupuestos?formato=ndjson", headers=auth, files={"archivo": ("p.ndjson", ndjson(
+            {"cliente_id": random.choice(cliente_ids), "titulo": f"Presupuesto {i}",
+             "lineas": [{"concepto": "Mano de obra", "cantidad": 2, "precio_unitario": 35}]}
+            for i in range(visitas // 10)
+        ))})
+        sesiones.append({"auth": auth, "visitas": visita_ids})
+    return sesiones
+
+
+async def peticion(client, nombre: str, sesion: dict):
+    auth = sesion["auth"]
+    if nombre == "listar_clientes":
+        return await client.get("/api/clientes?limite=50", headers=auth)
+    if nombre == "listar_visitas":
+        return await client.get("/api/visitas?limite=50&estado=pendiente,confirmada", headers=auth)
+    if nombre == "obtener_visita":
+        return await client.get(f"/api/visitas/{random.choice(sesion['visitas'])}", headers=auth)
+    if nombre == "listar_presupuestos":
+        return await client.get("/api/presupuestos?limite=20", headers=auth)
+    if nombre == "dashboard":
+        return await client.get("/api/dashboard", headers=auth)
+    if nombre == "crear_cliente":
+        return await client.post("/api/clientes", headers=auth, json={"nombre": "Nuevo", "telefono": "600000000"})
+    estado = random.choice(["pendiente", "confirmada"])
+    return await client.patch(f"/api/visitas/{random.choice(sesion['visitas'])}/estado?estado={estado}", headers=auth)
+
+
+async def carga(client, sesiones: list, concurrencia: int, duracion: float) -> dict:
+    pesos = [p for p, _ in MEZCLA]
+    nombres = [n for _, n in MEZCLA]
+    latencias = {n: [] for n in nombres}
+    errores = 0
+    fin = time.perf_counter() + duracion
+
+    async def cliente_virtual():
+        nonlocal errores
+        while time.perf_counter() < fin:
+            nombre = random.choices(nombres, pesos)[0]
+            inicio = time.perf_counter()
+            try:
+                r = await peticion(client, nombre, random.choice(sesiones))
+                ok = r.status_code < 400
+            except Exception:
+                ok = False
+            if ok:
+                latencias[nombre].append(time.perf_counter() - inicio)
+            else:
+                errores += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(cliente_virtual() for _ in range(concurrencia)))
+    transcurrido = time.perf_counter() - inicio
+    todas = [l for ls in latencias.values() for l in ls]
+    return {
+        "peticiones": len(todas),
+        "errores": errores,
+        "rps": round(len(todas) / transcurrido, 1),
+        "p50_ms": round(percentil(todas, 50) * 1000, 1),
+        "p99_ms": round(percentil(todas, 99) * 1000, 1),
+        "por_endpoint": {n: round(percentil(ls, 99) * 1000, 1) for n, ls in latencias.items()},
+    }
+
+
+async def medir_modo(modo: str, args) -> dict:
+    import httpx
+
+    puerto = puerto_libre()
+    entorno = dict(
+        os.environ,
+        DB_MODE=modo,
+        DATABASE_PATH=os.path.join(tempfile.mkdtemp(prefix="tecnigestion-bench-"), "app.db"),
+        RESPONSE_CACHE="memory" if args.cache else "none",
+        AUTH_EXECUTOR="thread",
+        BCRYPT_ROUNDS="4",
+    )
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(puerto), "--log-level", "warning"],
+        cwd=BACKEND, env=entorno,
+    )
+    try:
+        limites = httpx.Limits(max_connections=args.concurrencia, max_keepalive_connections=args.concurrencia)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{puerto}", limits=limites, timeout=60) as client:
+            await esperar_servidor(client, proceso)
+            sesiones = await poblar(client, args.usuarios, args.clientes, args.visitas)
+            await carga(client, sesiones, args.concurrencia, min(3, args.duracion))  # calentamiento
+            resultado = await carga(client, sesiones, args.concurrencia, args.duracion)
+            resultado["health"] = (await client.get("/health")).json()
+    finally:
+        proceso.terminate()
+        proceso.wait()
+    return resultado
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modos", default="sync,async")
+    parser.add_argument("--concurrencia", type=int, default=64)
+    parser.add_argument("--duracion", type=float, default=15, help="segundos de carga por modo")
+    parser.add_argument("--usuarios", type=int, default=4)
+    parser.add_argument("--clientes", type=int, default=500, help="por usuario")
+    parser.add_argument("--visitas", type=int, default=3000, help="por usuario")
+    parser.add_argument("--cache", action="store_true", help="mantener la caché de respuestas activa")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'modo':>6} {'peticiones':>10} {'errores':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for modo in args.modos.split(","):
+        random.seed(args.seed)
+        r = asyncio.run(medir_modo(modo, args))
+        print(f"{modo:>6} {r['peticiones']:>10} {r['errores']:>8} {r['rps']:>8} {r['p50_ms']:>8} {r['p99_ms']:>8}")
+        print("       p99 por endpoint (ms):", r["por_endpoint"])
+        if modo == "async":
+            print("       db_executor:", r["health"]["db_executor"])
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,98 @@
+"""
+Coste de autenticación por petición, con y sin la caché de tokens verificados
+(TOKEN_CACHE_MAX_ENTRIES=0 equivale a decodificar el JWT en cada petición,
+como antes). Mide la verificación aislada y una petición completa a
+GET /api/auth/perfil frente a GET / (sin autenticación).
+
+Requiere httpx (pip install httpx). Uso (desde la carpeta backend):
+    python benchmarks/bench_auth.py --iteraciones 20000 --clientes 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+async def medir(iteraciones: int, clientes: int) -> dict:
+    import httpx
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        tokens = []
+        for i in range(clientes):
+            r = await client.post("/api/auth/registro", json={
+                "nombre": "Bench", "email": f"bench{i}@example.com", "password": "secreto-bench"
+            })
+            tokens.append(r.json()["access_token"])
+
+        # Verificación aislada: lo que cuesta la dependencia get_current_user
+        for token in tokens:
+            await main.verificar_token(token)
+        inicio = time.perf_counter()
+        for i in range(iteraciones):
+            await main.verificar_token(tokens[i % clientes])
+        verificacion_us = (time.perf_counter() - inicio) / iteraciones * 1e6
+
+        async def por_peticion(ruta: str, con_token: bool) -> float:
+            n = max(1, iteraciones // 10)
+            inicio = time.perf_counter()
+            for i in range(n):
+                cabeceras = {"Authorization": f"Bearer {tokens[i % clientes]}"} if con_token else {}
+                await client.get(ruta, headers=cabeceras)
+            return (time.perf_counter() - inicio) / n * 1e6
+
+        await por_peticion("/api/auth/perfil", True)  # calentar la caché de respuestas
+        sin_auth_us = await por_peticion("/", False)
+        con_auth_us = await por_peticion("/api/auth/perfil", True)
+
+    return {
+        "cache_tokens": main.TOKEN_CACHE_MAX_ENTRIES,
+        "verificacion_us": round(verificacion_us, 2),
+        "peticion_sin_auth_us": round(sin_auth_us, 1),
+        "peticion_con_auth_us": round(con_auth_us, 1),
+        "sobrecoste_auth_us": round(con_auth_us - sin_auth_us, 1),
+    }
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iteraciones", type=int, default=20000)
+    parser.add_argument("--clientes", type=int, default=50, help="tokens distintos en circulación")
+    parser.add_argument("--hijo", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        print(json.dumps(asyncio.run(medir(args.iteraciones, args.clientes))))
+        return
+
+    resultados = []
+    for entradas in ("0", "10000"):
+        entorno = dict(
+            os.environ,
+            DATABASE_PATH=os.path.join(tempfile.mkdtemp(prefix="tecnigestion-bench-"), "app.db"),
+            TOKEN_CACHE_MAX_ENTRIES=entradas,
+            AUTH_EXECUTOR="inline",
+            BCRYPT_ROUNDS="4",
+        )
+        salida = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--hijo",
+             "--iteraciones", str(args.iteraciones), "--clientes", str(args.clientes)],
+            env=entorno, capture_output=True, text=True, check=True,
+        )
+        resultados.append(json.loads(salida.stdout.strip().splitlines()[-1]))
+
+    columnas = list(resultados[0].keys())
+    print("  ".join(f"{c:>22}" for c in columnas))
+    for r in resultados:
+        print("  ".join(f"{str(r[c]):>22}" for c in columnas))
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,123 @@
+"""
+Búsqueda de texto: compara /api/buscar (índices FTS5) con la alternativa sin
+índice, un LIKE '%texto%' sobre las mismas columnas, para prefijos como los
+que envía la búsqueda mientras se escribe.
+
+Uso (desde la carpeta backend):
+    python benchmarks/bench_busqueda.py --usuarios 20 --clientes 20000 --visitas 100000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# main.py inicializa su propia BD al importarse: apuntarla a un temporal y
+# desactivar la caché de respuestas para medir siempre la consulta
+_tmp = tempfile.mkdtemp(prefix="tecnigestion-bench-")
+os.environ["DATABASE_PATH"] = os.path.join(_tmp, "app.db")
+os.environ["RESPONSE_CACHE"] = "none"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+NOMBRES = ["José", "María", "Antonio", "Carmen", "Manuel", "Lucía", "Francisco", "Elena", "David", "Laura"]
+APELLIDOS = ["García", "López", "Martínez", "Sánchez", "Pérez", "Gómez", "Fernández", "Ruiz", "Díaz", "Moreno"]
+CALLES = ["Mayor", "Real", "Sol", "Luna", "Olmo", "Pinar", "Río", "Prado"]
+TRABAJOS = ["caldera", "radiador", "termostato", "fuga", "aire acondicionado", "calentador",
+            "grifo", "desagüe", "enchufe", "cuadro eléctrico", "persiana", "bomba de calor"]
+
+# Lo que haría cada entidad sin índice de texto
+CONSULTAS_LIKE = {
+    "clientes": """SELECT id FROM clientes WHERE usuario_id = ?1 AND (
+        nombre || ' ' || COALESCE(apellidos, '') LIKE ?2 OR telefono LIKE ?2 OR direccion LIKE ?2
+        OR nif_cif LIKE ?2 OR notas LIKE ?2) LIMIT 10""",
+    "visitas": "SELECT id FROM visitas WHERE usuario_id = ?1 AND (titulo LIKE ?2 OR descripcion LIKE ?2) LIMIT 10",
+    "presupuestos": """SELECT DISTINCT p.id FROM presupuestos p
+        LEFT JOIN lineas_presupuesto l ON l.presupuesto_id = p.id
+        WHERE p.usuario_id = ?1 AND (p.titulo LIKE ?2 OR p.descripcion LIKE ?2 OR l.concepto LIKE ?2) LIMIT 10""",
+}
+
+
+def poblar(conn, usuarios, clientes, visitas, presupuestos, lineas):
+    rnd = random.Random(42)
+    conn.executemany(
+        "INSERT INTO usuarios (id, nombre, email, password_hash) VALUES (?, ?, ?, 'x')",
+        [(u, f"Usuario {u}", f"u{u}@example.com") for u in range(1, usuarios + 1)],
+    )
+    conn.executemany(
+        """INSERT INTO clientes (id, usuario_id, nombre, apellidos, telefono, direccion, notas)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        [(i, rnd.randint(1, usuarios), rnd.choice(NOMBRES),
+          f"{rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}", f"6{i:08d}",
+          f"Calle {rnd.choice(CALLES)} {rnd.randint(1, 200)}", f"Tiene {rnd.choice(TRABAJOS)}")
+         for i in range(1, clientes + 1)],
+    )
+    cliente_usuario = dict(conn.execute("SELECT id, usuario_id FROM clientes"))
+    filas = []
+    for i in range(1, visitas + 1):
+        cid = rnd.randint(1, clientes)
+        filas.append((cliente_usuario[cid], cid, f"Revisión {rnd.choice(TRABAJOS)}",
+                      f"Avería en {rnd.choice(TRABAJOS)} y {rnd.choice(TRABAJOS)}", "2026-01-01"))
+    conn.executemany(
+        "INSERT INTO visitas (usuario_id, cliente_id, titulo, descripcion, fecha) VALUES (?, ?, ?, ?, ?)", filas
+    )
+    filas = []
+    for i in range(1, presupuestos + 1):
+        cid = rnd.randint(1, clientes)
+        filas.append((i, cliente_usuario[cid], cid, f"B-{i}", f"Cambio de {rnd.choice(TRABAJOS)}"))
+    conn.executemany(
+        "INSERT INTO presupuestos (id, usuario_id, cliente_id, numero, titulo) VALUES (?, ?, ?, ?, ?)", filas
+    )
+    conn.executemany(
+        "INSERT INTO lineas_presupuesto (presupuesto_id, concepto, orden) VALUES (?, ?, ?)",
+        [(p, f"Material {rnd.choice(TRABAJOS)}", n) for p in range(1, presupuestos + 1) for n in range(lineas)],
+    )
+    conn.commit()
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=20)
+    parser.add_argument("--clientes", type=int, default=20000)
+    parser.add_argument("--visitas", type=int, default=100000)
+    parser.add_argument("--presupuestos", type=int, default=20000)
+    parser.add_argument("--lineas", type=int, default=3, help="líneas por presupuesto")
+    parser.add_argument("--repeticiones", type=int, default=200)
+    args = parser.parse_args()
+
+    print("Generando datos...")
+    with main.get_db() as conn:
+        poblar(conn, args.usuarios, args.clientes, args.visitas, args.presupuestos, args.lineas)
+        conn.execute("ANALYZE")
+
+    rnd = random.Random(7)
+    palabras = [p.lower() for p in NOMBRES + APELLIDOS + TRABAJOS]
+    # Prefijos de 3 letras o más, como los de la búsqueda mientras se escribe
+    textos = [p[:rnd.randint(3, len(p))] for p in (rnd.choice(palabras) for _ in range(args.repeticiones))]
+    usuarios = [rnd.randint(1, args.usuarios) for _ in textos]
+
+    tiempos = {"like": [], "fts5": []}
+    with main.get_db() as conn:
+        for texto, u in zip(textos, usuarios):
+            inicio = time.perf_counter()
+            for sql in CONSULTAS_LIKE.values():
+                conn.execute(sql, (u, f"%{texto}%")).fetchall()
+            tiempos["like"].append((time.perf_counter() - inicio) * 1000)
+    for texto, u in zip(textos, usuarios):
+        inicio = time.perf_counter()
+        main.buscar(q=texto, tipos=None, limite=10, user_id=u)
+        tiempos["fts5"].append((time.perf_counter() - inicio) * 1000)
+
+    print(f"\n{'método':<8}{'p50 (ms)':>10}{'p99 (ms)':>10}")
+    for metodo, valores in tiempos.items():
+        valores.sort()
+        p99 = valores[min(len(valores) - 1, int(len(valores) * 0.99))]
+        print(f"{metodo:<8}{statistics.median(valores):>10.3f}{p99:>10.3f}")
+
+
+if __name__ == "__main__":
+    main_bench()
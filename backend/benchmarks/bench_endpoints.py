@@ -0,0 +1,873 @@
+"""
+Benchmark de todos los endpoints sobre una BD creada con generar_datos.py.
+Mide cada endpoint por separado (peticiones/s, latencia media y p50/p95/p99,
+bytes por respuesta) y la memoria pico, y guarda el resultado en JSON para
+comparar dos ejecuciones (antes y después de un cambio).
+
+Con --postgres DSN la app usa DB_BACKEND=postgres sobre esa base (vacía), en
+la que antes se copia la BD con `main.py postgres copiar-sqlite`; así las dos
+ejecuciones miden los mismos datos en cada backend.
+
+El subcomando paridad lanza las mismas peticiones, en el mismo orden, contra un
+servidor con SQLite y otro con PostgreSQL cargado con los mismos datos, y
+compara las respuestas: hace de batería de pruebas común a los dos backends.
+
+Dos modos:
+  inproceso  TestClient en este mismo proceso, una petición cada vez: aísla el
+             coste de la app (sin red ni servidor). Con --tracemalloc añade la
+             memoria pico de Python de cada endpoint
+  http       uvicorn real (lo arranca, o --url de uno ya en marcha) con
+             --concurrencia clientes simultáneos
+
+Las escrituras trabajan sobre una copia de la BD (salvo --sin-copia), así que
+dos ejecuciones sobre el mismo fichero parten de los mismos datos. Los pasos de
+preparación (crear el registro que luego se borra, leer la versión antes de
+editar, iniciar sesión antes de cerrarla) no se cronometran.
+
+Uso (desde la carpeta backend):
+    python benchmarks/generar_datos.py /tmp/bench.db --usuarios 20 --perfil realista
+    python benchmarks/bench_endpoints.py ejecutar /tmp/bench.db --salida antes.json
+    python benchmarks/bench_endpoints.py ejecutar /tmp/bench.db --modo http --concurrencia 32 --salida despues.json
+    python benchmarks/bench_endpoints.py comparar antes.json despues.json
+    python benchmarks/bench_endpoints.py ejecutar /tmp/bench.db --postgres postgresql://localhost/bench --salida pg.json
+    python benchmarks/bench_endpoints.py paridad /tmp/bench.db --postgres postgresql://localhost/bench
+"""
+
+import argparse
+import asyncio
+import base64
+import csv
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+from generar_datos import CONTRASENA, png_firma
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+TERMINOS_BUSQUEDA = ["garcia", "caldera", "madrid", "fuga", "radiador", "lopez mar", "split", "sevilla"]
+FIRMA = "data:image/png;base64," + base64.b64encode(png_firma(random.Random(0))).decode()
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def puerto_libre() -> int:
+    import socket
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ============ ESCENARIOS ============
+
+# Cada escenario es un generador que produce peticiones (metodo, url,
+# opciones, medir) y recibe la respuesta de cada una; solo se cronometra la
+# que lleva medir=True. `sesion` es el técnico (token e ids de sus datos) y
+# `local` el estado propio de cada cliente concurrente
+
+def peticion(metodo, url, medir=True, **opciones):
+    return metodo, url, opciones, medir
+
+
+def nueva_visita(sesion, **campos):
+    return {"cliente_id": random.choice(sesion["clientes"]), "titulo": "Visita de benchmark",
+            "fecha": date.today().isoformat(), "hora": "10:00", **campos}
+
+
+def nuevo_presupuesto(sesion):
+    return {"cliente_id": random.choice(sesion["clientes"]), "titulo": "Presupuesto de benchmark",
+            "lineas": [{"concepto": "Mano de obra", "cantidad": 2, "precio_unitario": 35},
+                       {"concepto": "Material", "cantidad": 1, "precio_unitario": 48.5}]}
+
+
+def iniciar_sesion(sesion):
+    return peticion("POST", "/api/auth/login", False, json={"email": sesion["email"], "password": CONTRASENA})
+
+
+def esc_registro(sesion, local):
+    yield peticion("POST", "/api/auth/registro", json={
+        "nombre": "Técnico", "email": f"alta-{uuid.uuid4().hex[:12]}@bench.example.com", "password": CONTRASENA
+    })
+
+
+def esc_login(sesion, local):
+    yield peticion("POST", "/api/auth/login", json={"email": sesion["email"], "password": CONTRASENA})
+
+
+def esc_refresh(sesion, local):
+    # Cada refresh token vale una vez: cada cliente concurrente sigue su cadena
+    if "refresh" not in local:
+        local["refresh"] = (yield iniciar_sesion(sesion)).json()["refresh_token"]
+    r = yield peticion("POST", "/api/auth/refresh", json={"refresh_token": local["refresh"]})
+    if r.status_code == 200:
+        local["refresh"] = r.json()["refresh_token"]
+    else:
+        local.pop("refresh")
+
+
+def esc_logout(sesion, local):
+    token = (yield iniciar_sesion(sesion)).json()["access_token"]
+    yield peticion("POST", "/api/auth/logout", headers={"Authorization": f"Bearer {token}"})
+
+
+def esc_perfil(sesion, local):
+    yield peticion("GET", "/api/auth/perfil", headers=sesion["auth"])
+
+
+def esc_listar(ruta, consulta=""):
+    def escenario(sesion, local):
+        yield peticion("GET", f"{ruta}{consulta}", headers=sesion["auth"])
+    return escenario
+
+
+def esc_obtener(ruta, ids):
+    def escenario(sesion, local):
+        yield peticion("GET", ruta.format(random.choice(sesion[ids])), headers=sesion["auth"])
+    return escenario
+
+
+def esc_crear_cliente(sesion, local):
+    yield peticion("POST", "/api/clientes", headers=sesion["auth"],
+                   json={"nombre": "Cliente", "apellidos": "De Benchmark", "telefono": "600000000", "ciudad": "Madrid"})
+
+
+def esc_actualizar_cliente(sesion, local):
+    cliente_id = random.choice(sesion["clientes"])
+    datos = (yield peticion("GET", f"/api/clientes/{cliente_id}", False, headers=sesion["auth"])).json()
+    datos["notas"] = f"Revisado {datetime.now():%H:%M:%S}"
+    yield peticion("PUT", f"/api/clientes/{cliente_id}", headers=sesion["auth"], json=datos)
+
+
+def esc_eliminar_cliente(sesion, local):
+    r = yield peticion("POST", "/api/clientes", False, headers=sesion["auth"],
+                       json={"nombre": "Cliente temporal", "telefono": "600000000"})
+    yield peticion("DELETE", f"/api/clientes/{r.json()['id']}", headers=sesion["auth"])
+
+
+def esc_crear_visita(sesion, local):
+    yield peticion("POST", "/api/visitas", headers=sesion["auth"], json=nueva_visita(sesion))
+
+
+def esc_actualizar_visita(sesion, local):
+    visita_id = random.choice(sesion["visitas"])
+    datos = (yield peticion("GET", f"/api/visitas/{visita_id}", False, headers=sesion["auth"])).json()
+    datos["notas_internas"] = f"Revisado {datetime.now():%H:%M:%S}"
+    yield peticion("PUT", f"/api/visitas/{visita_id}", headers=sesion["auth"], json=datos)
+
+
+def esc_estado_visita(sesion, local):
+    estado = random.choice(["pendiente", "confirmada"])
+    yield peticion("PATCH", f"/api/visitas/{random.choice(sesion['visitas'])}/estado?estado={estado}",
+                   headers=sesion["auth"])
+
+
+def esc_completar_visita(sesion, local):
+    r = yield peticion("POST", "/api/visitas", False, headers=sesion["auth"], json=nueva_visita(sesion))
+    yield peticion("PATCH", f"/api/visitas/{r.json()['id']}/completar", headers=sesion["auth"],
+                   json={"firma_cliente": FIRMA, "nombre_firmante": "Cliente de benchmark"})
+
+
+def esc_eliminar_visita(sesion, local):
+    r = yield peticion("POST", "/api/visitas", False, headers=sesion["auth"], json=nueva_visita(sesion))
+    yield peticion("DELETE", f"/api/visitas/{r.json()['id']}", headers=sesion["auth"])
+
+
+def esc_agenda(sesion, local):
+    hoy = date.today()
+    yield peticion("GET", f"/api/agenda?desde={hoy - timedelta(days=hoy.weekday())}"
+                          f"&hasta={hoy + timedelta(days=6 - hoy.weekday())}", headers=sesion["auth"])
+
+
+def esc_crear_presupuesto(sesion, local):
+    yield peticion("POST", "/api/presupuestos", headers=sesion["auth"], json=nuevo_presupuesto(sesion))
+
+
+def esc_actualizar_presupuesto(sesion, local):
+    presupuesto_id = random.choice(sesion["presupuestos"])
+    datos = (yield peticion("GET", f"/api/presupuestos/{presupuesto_id}", False, headers=sesion["auth"])).json()
+    datos["notas"] = f"Revisado {datetime.now():%H:%M:%S}"
+    yield peticion("PUT", f"/api/presupuestos/{presupuesto_id}", headers=sesion["auth"], json=datos)
+
+
+def esc_modificar_presupuesto(sesion, local):
+    presupuesto_id = random.choice(sesion["presupuestos"])
+    datos = (yield peticion("GET", f"/api/presupuestos/{presupuesto_id}", False, headers=sesion["auth"])).json()
+    yield peticion("PATCH", f"/api/presupuestos/{presupuesto_id}", headers=sesion["auth"],
+                   json={"version": datos["version"], "notas": f"Revisado {datetime.now():%H:%M:%S}"})
+
+
+def esc_estado_presupuesto(sesion, local):
+    estado = random.choice(["enviado", "aceptado"])
+    yield peticion("PATCH", f"/api/presupuestos/{random.choice(sesion['presupuestos'])}/estado?estado={estado}",
+                   headers=sesion["auth"])
+
+
+def esc_eliminar_presupuesto(sesion, local):
+    r = yield peticion("POST", "/api/presupuestos", False, headers=sesion["auth"], json=nuevo_presupuesto(sesion))
+    yield peticion("DELETE", f"/api/presupuestos/{r.json()['id']}", headers=sesion["auth"])
+
+
+def esc_importar(sesion, local):
+    filas = "".join(json.dumps({"nombre": f"Importado {i}", "telefono": f"6{i:08d}", "ciudad": "Sevilla"}) + "\n"
+                    for i in range(100))
+    yield peticion("POST", "/api/importar/clientes?formato=ndjson", headers=sesion["auth"],
+                   files={"archivo": ("clientes.ndjson", filas.encode())})
+
+
+def esc_subir_cambios(sesion, local):
+    yield peticion("POST", "/api/sync", headers=sesion["auth"], json={"operaciones": [
+        {"id_peticion": uuid.uuid4().hex, "entidad": "visitas", "accion": "estado",
+         "id": random.choice(sesion["visitas"]), "datos": {"estado": random.choice(["pendiente", "confirmada"])}}
+    ]})
+
+
+def esc_buscar(sesion, local):
+    yield peticion("GET", f"/api/buscar?q={random.choice(TERMINOS_BUSQUEDA)}", headers=sesion["auth"])
+
+
+def esc_metrics(sesion, local):
+    token = os.environ.get("METRICS_TOKEN")
+    yield peticion("GET", "/metrics", headers={"Authorization": f"Bearer {token}"} if token else {})
+
+
+# (nombre, ruta de main.py que cubre, escenario)
+ESCENARIOS = [
+    ("registro", "POST /api/auth/registro", esc_registro),
+    ("login", "POST /api/auth/login", esc_login),
+    ("refresh", "POST /api/auth/refresh", esc_refresh),
+    ("logout", "POST /api/auth/logout", esc_logout),
+    ("perfil", "GET /api/auth/perfil", esc_perfil),
+    ("clientes", "GET /api/clientes", esc_listar("/api/clientes")),
+    ("clientes_pagina", "GET /api/clientes", esc_listar("/api/clientes", "?limite=50")),
+    ("clientes_filtro", "GET /api/clientes", esc_listar("/api/clientes", "?q=gar&limite=50")),
+    ("obtener_cliente", "GET /api/clientes/{cliente_id}", esc_obtener("/api/clientes/{}", "clientes")),
+    ("crear_cliente", "POST /api/clientes", esc_crear_cliente),
+    ("actualizar_cliente", "PUT /api/clientes/{cliente_id}", esc_actualizar_cliente),
+    ("eliminar_cliente", "DELETE /api/clientes/{cliente_id}", esc_eliminar_cliente),
+    ("visitas", "GET /api/visitas", esc_listar("/api/visitas")),
+    ("visitas_pagina", "GET /api/visitas", esc_listar("/api/visitas", "?limite=50")),
+    ("visitas_pendientes", "GET /api/visitas", esc_listar("/api/visitas", "?estado=pendiente,confirmada&limite=50")),
+    ("visitas_hoy", "GET /api/visitas/hoy", esc_listar("/api/visitas/hoy")),
+    ("obtener_visita", "GET /api/visitas/{visita_id}", esc_obtener("/api/visitas/{}", "visitas")),
+    ("crear_visita", "POST /api/visitas", esc_crear_visita),
+    ("actualizar_visita", "PUT /api/visitas/{visita_id}", esc_actualizar_visita),
+    ("estado_visita", "PATCH /api/visitas/{visita_id}/estado", esc_estado_visita),
+    ("completar_visita", "PATCH /api/visitas/{visita_id}/completar", esc_completar_visita),
+    ("eliminar_visita", "DELETE /api/visitas/{visita_id}", esc_eliminar_visita),
+    ("pdf_visita", "GET /api/visitas/{visita_id}/pdf", esc_obtener("/api/visitas/{}/pdf", "completadas")),
+    ("agenda", "GET /api/agenda", esc_agenda),
+    ("firma", "GET /api/firmas/{firma_hash}", esc_obtener("/api/firmas/{}", "firmas")),
+    ("presupuestos", "GET /api/presupuestos", esc_listar("/api/presupuestos")),
+    ("presupuestos_pagina", "GET /api/presupuestos", esc_listar("/api/presupuestos", "?limite=50")),
+    ("presupuestos_sin_lineas", "GET /api/presupuestos",
+     esc_listar("/api/presupuestos", "?incluir_lineas=false&limite=50")),
+    ("presupuestos_cliente", "GET /api/presupuestos/cliente/{cliente_id}",
+     esc_obtener("/api/presupuestos/cliente/{}", "clientes")),
+    ("obtener_presupuesto", "GET /api/presupuestos/{presupuesto_id}",
+     esc_obtener("/api/presupuestos/{}", "presupuestos")),
+    ("pdf_presupuesto", "GET /api/presupuestos/{presupuesto_id}/pdf",
+     esc_obtener("/api/presupuestos/{}/pdf", "presupuestos")),
+    ("crear_presupuesto", "POST /api/presupuestos", esc_crear_presupuesto),
+    ("actualizar_presupuesto", "PUT /api/presupuestos/{presupuesto_id}", esc_actualizar_presupuesto),
+    ("modificar_presupuesto", "PATCH /api/presupuestos/{presupuesto_id}", esc_modificar_presupuesto),
+    ("estado_presupuesto", "PATCH /api/presupuestos/{presupuesto_id}/estado", esc_estado_presupuesto),
+    ("eliminar_presupuesto", "DELETE /api/presupuestos/{presupuesto_id}", esc_eliminar_presupuesto),
+    ("importar", "POST /api/importar/{entidad}", esc_importar),
+    ("exportar_clientes", "GET /api/exportar/{entidad}", esc_listar("/api/exportar/clientes", "?formato=csv")),
+    ("exportar_visitas", "GET /api/exportar/{entidad}", esc_listar("/api/exportar/visitas", "?formato=ndjson")),
+    ("sync_inicial", "GET /api/sync", esc_listar("/api/sync")),
+    ("subir_cambios", "POST /api/sync", esc_subir_cambios),
+    ("buscar", "GET /api/buscar", esc_buscar),
+    ("dashboard", "GET /api/dashboard", esc_listar("/api/dashboard")),
+    ("estadisticas", "GET /api/estadisticas/presupuestos", esc_listar("/api/estadisticas/presupuestos")),
+    ("analitica_presupuestos", "GET /api/analitica/presupuestos", esc_listar("/api/analitica/presupuestos")),
+    ("analitica_clientes", "GET /api/analitica/presupuestos",
+     esc_listar("/api/analitica/presupuestos", "?por=cliente")),
+    ("analitica_visitas", "GET /api/analitica/visitas", esc_listar("/api/analitica/visitas", "?agrupar=dia")),
+    ("root", "GET /", esc_listar("/")),
+    ("health", "GET /health", esc_listar("/health")),
+    ("metrics", "GET /metrics", esc_metrics),
+]
+
+
+# ============ DATOS Y SESIONES ============
+
+def carpeta_shards(db_path: str) -> str:
+    # La misma que usa main.py con DB_SHARDING
+    return os.getenv("DB_SHARD_DIR", os.path.join(os.path.dirname(db_path), "shards"))
+
+
+def ficheros_datos(db_path: str) -> dict:
+    # Usuario -> fichero con sus datos, para los que están en un shard
+    conn = sqlite3.connect(db_path)
+    try:
+        filas = conn.execute("SELECT usuario_id, shard FROM directorio_shards").fetchall()
+    except sqlite3.OperationalError:
+        filas = []
+    conn.close()
+    return {usuario_id: os.path.join(carpeta_shards(db_path), f"{shard}.db") for usuario_id, shard in filas}
+
+
+def muestrear(db_path: str, usuarios: int, muestra: int) -> list:
+    # Los técnicos con más visitas y una muestra de los ids de cada uno
+    ficheros = ficheros_datos(db_path)
+    conexiones = {db_path: sqlite3.connect(db_path)}
+    for ruta in set(ficheros.values()):
+        conexiones[ruta] = sqlite3.connect(ruta)
+    sesiones = []
+    filas = [
+        fila for conn in conexiones.values() for fila in conn.execute(
+            """SELECT r.valor, u.id, u.email FROM usuarios u JOIN resumen_contadores r ON r.usuario_id = u.id
+               WHERE r.clave = 'clientes'"""
+        )
+    ]
+    filas = [(usuario_id, email) for _, usuario_id, email in sorted(filas, key=lambda f: (-f[0], f[1]))[:usuarios]]
+    for usuario_id, email in filas:
+        conn = conexiones[ficheros.get(usuario_id, db_path)]
+
+        def ids(sql):
+            return [f[0] for f in conn.execute(sql + " ORDER BY random() LIMIT ?", (usuario_id, muestra))]
+
+        sesiones.append({
+            "usuario_id": usuario_id,
+            "email": email,
+            "clientes": ids("SELECT id FROM clientes WHERE usuario_id = ?"),
+            "visitas": ids("SELECT id FROM visitas WHERE usuario_id = ?"),
+            "completadas": ids("SELECT id FROM visitas WHERE usuario_id = ? AND estado = 'completada'"),
+            "presupuestos": ids("SELECT id FROM presupuestos WHERE usuario_id = ?"),
+            "firmas": ids("SELECT DISTINCT firma_hash FROM visitas WHERE usuario_id = ? AND firma_hash IS NOT NULL"),
+        })
+    for conn in conexiones.values():
+        conn.close()
+    if not sesiones or not all(s["clientes"] and s["visitas"] and s["presupuestos"] and s["firmas"]
+                               for s in sesiones):
+        sys.exit(f"{db_path} no tiene datos suficientes: genérala con benchmarks/generar_datos.py")
+    return sesiones
+
+
+def recuentos(db_path: str) -> dict:
+    # Sumando los shards; los usuarios, solo de la BD principal
+    rutas = [db_path, *sorted(set(ficheros_datos(db_path).values()))]
+    resultado = {"usuarios": 0, "clientes": 0, "visitas": 0, "presupuestos": 0, "lineas_presupuesto": 0, "firmas": 0}
+    for ruta in rutas:
+        conn = sqlite3.connect(ruta)
+        for tabla in resultado:
+            if tabla != "usuarios" or ruta == db_path:
+                resultado[tabla] += conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+        conn.close()
+    resultado["tamano_mb"] = round(sum(os.path.getsize(ruta) for ruta in rutas) / 2**20, 1)
+    return resultado
+
+
+def commit_git() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except OSError:
+        return ""
+
+
+def sin_cubrir(openapi: dict) -> list:
+    # Rutas del esquema que ningún escenario mide (/metrics no está en él)
+    cubiertas = {ruta for _, ruta, _ in ESCENARIOS}
+    return sorted(f"{metodo.upper()} {ruta}" for ruta, metodos in openapi["paths"].items()
+                  for metodo in metodos if f"{metodo.upper()} {ruta}" not in cubiertas)
+
+
+def entorno_servidor(args) -> dict:
+    # Sin tareas programadas ni registro de consultas lentas, que ensuciarían
+    # la medida; las variables ya definidas en el entorno mandan
+    return {"SCHEDULER_ENABLED": "0", "SLOW_QUERY_MS": "0", "RESPONSE_CACHE": "memory" if args.cache else "none"}
+
+
+def entorno_postgres(dsn: str) -> dict:
+    return {"DB_BACKEND": "postgres", "DATABASE_URL": dsn}
+
+
+def cargar_postgres(dsn: str, db_path: str):
+    # Copia la BD (y sus shards) a la base PostgreSQL, que tiene que estar vacía
+    print(f"Copiando {db_path} a PostgreSQL...", flush=True)
+    entorno = dict(os.environ, DATABASE_PATH=db_path, SCHEDULER_ENABLED="0", **entorno_postgres(dsn))
+    subprocess.run([sys.executable, "main.py", "postgres", "copiar-sqlite", "--origen", db_path,
+                    "--shards", carpeta_shards(db_path)], cwd=BACKEND, env=entorno, check=True)
+
+
+def lanzar_servidor(args, db_path: str, **entorno_extra) -> tuple:
+    # uvicorn en un puerto libre; devuelve (proceso, url)
+    puerto = puerto_libre()
+    entorno = dict(os.environ, DATABASE_PATH=db_path, **entorno_extra)
+    entorno.update({clave: os.environ.get(clave, valor) for clave, valor in entorno_servidor(args).items()})
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(puerto), "--log-level", "warning"],
+        cwd=BACKEND, env=entorno,
+    )
+    return proceso, f"http://127.0.0.1:{puerto}"
+
+
+def resumir(latencias: list, errores: int, bytes_totales: int, transcurrido: float) -> dict:
+    return {
+        "peticiones": len(latencias),
+        "errores": errores,
+        "rps": round(len(latencias) / transcurrido, 1) if transcurrido else 0.0,
+        "media_ms": round(sum(latencias) / len(latencias) * 1000, 3) if latencias else 0.0,
+        "p50_ms": round(percentil(latencias, 50) * 1000, 3),
+        "p95_ms": round(percentil(latencias, 95) * 1000, 3),
+        "p99_ms": round(percentil(latencias, 99) * 1000, 3),
+        "max_ms": round(max(latencias, default=0) * 1000, 3),
+        "bytes_medios": round(bytes_totales / len(latencias)) if latencias else 0,
+    }
+
+
+# ============ MODO EN PROCESO ============
+
+def ejecutar_escenario(client, escenario, sesion, local):
+    # Devuelve (segundos, ok, bytes) de la petición cronometrada
+    generador = escenario(sesion, local)
+    respuesta, medida = None, None
+    try:
+        while True:
+            metodo, url, opciones, medir = generador.send(respuesta)
+            inicio = time.perf_counter()
+            respuesta = client.request(metodo, url, **opciones)
+            if medir:
+                medida = (time.perf_counter() - inicio, respuesta.status_code < 400, len(respuesta.content))
+    except StopIteration:
+        pass
+    return medida
+
+
+def ejecutar_inproceso(args, db_path: str, sesiones: list, escenarios: list) -> dict:
+    os.environ["DATABASE_PATH"] = db_path
+    for clave, valor in entorno_servidor(args).items():
+        os.environ.setdefault(clave, valor)
+    sys.path.insert(0, BACKEND)
+    import tracemalloc
+
+    import main
+    from fastapi.testclient import TestClient
+
+    resultado = {}
+    with TestClient(main.app) as client:
+        for sesion in sesiones:
+            r = client.post("/api/auth/login", json={"email": sesion["email"], "password": CONTRASENA})
+            sesion["auth"] = {"Authorization": f"Bearer {r.json()['access_token']}"}
+        no_cubiertas = sin_cubrir(client.get("/openapi.json").json())
+
+        for nombre, ruta, escenario in escenarios:
+            local = {}
+            for _ in range(args.calentamiento):
+                ejecutar_escenario(client, escenario, random.choice(sesiones), local)
+            if args.tracemalloc:
+                tracemalloc.start()
+            latencias, errores, bytes_totales = [], 0, 0
+            inicio = time.perf_counter()
+            while len(latencias) + errores < args.peticiones and time.perf_counter() - inicio < args.segundos:
+                segundos, ok, tamano = ejecutar_escenario(client, escenario, random.choice(sesiones), local)
+                if ok:
+                    latencias.append(segundos)
+                    bytes_totales += tamano
+                else:
+                    errores += 1
+            resultado[nombre] = {"ruta": ruta, **resumir(latencias, errores, bytes_totales,
+                                                         time.perf_counter() - inicio)}
+            if args.tracemalloc:
+                resultado[nombre]["memoria_pico_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024)
+                tracemalloc.stop()
+            mostrar(nombre, resultado[nombre])
+
+    # ru_maxrss va en KB en Linux
+    return {"endpoints": resultado, "sin_cubrir": no_cubiertas,
+            "memoria": {"pico_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}}
+
+
+# ============ MODO HTTP ============
+
+def memoria_proceso(pid: int) -> dict:
+    # VmRSS actual y VmHWM (pico) del servidor, de /proc (solo Linux)
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            campos = dict(linea.split(":", 1) for linea in f if linea.startswith(("VmRSS", "VmHWM")))
+    except OSError:
+        return {}
+    return {clave: round(int(valor.split()[0]) / 1024, 1) for clave, valor in campos.items()}
+
+
+async def ejecutar_escenario_async(client, escenario, sesion, local):
+    generador = escenario(sesion, local)
+    respuesta, medida = None, None
+    try:
+        while True:
+            metodo, url, opciones, medir = generador.send(respuesta)
+            inicio = time.perf_counter()
+            respuesta = await client.request(metodo, url, **opciones)
+            if medir:
+                medida = (time.perf_counter() - inicio, respuesta.status_code < 400, len(respuesta.content))
+    except StopIteration:
+        pass
+    return medida
+
+
+async def medir_http(client, args, sesiones: list, escenarios: list, pid) -> dict:
+    for sesion in sesiones:
+        r = await client.post("/api/auth/login", json={"email": sesion["email"], "password": CONTRASENA})
+        sesion["auth"] = {"Authorization": f"Bearer {r.json()['access_token']}"}
+    no_cubiertas = sin_cubrir((await client.get("/openapi.json")).json())
+
+    resultado = {}
+    for nombre, ruta, escenario in escenarios:
+        latencias, errores, bytes_totales = [], 0, 0
+        locales = [{} for _ in range(args.concurrencia)]
+        for _ in range(args.calentamiento):
+            await ejecutar_escenario_async(client, escenario, random.choice(sesiones), locales[0])
+        inicio = time.perf_counter()
+        restantes = args.peticiones
+
+        async def cliente_virtual(local):
+            nonlocal errores, bytes_totales, restantes
+            while restantes > 0 and time.perf_counter() - inicio < args.segundos:
+                restantes -= 1
+                try:
+                    segundos, ok, tamano = await ejecutar_escenario_async(
+                        client, escenario, random.choice(sesiones), local
+                    )
+                except Exception:
+                    ok = False
+                if ok:
+                    latencias.append(segundos)
+                    bytes_totales += tamano
+                else:
+                    errores += 1
+
+        await asyncio.gather(*(cliente_virtual(local) for local in locales))
+        resultado[nombre] = {"ruta": ruta, **resumir(latencias, errores, bytes_totales, time.perf_counter() - inicio)}
+        if pid:
+            resultado[nombre]["memoria_rss_mb"] = memoria_proceso(pid).get("VmRSS")
+        mostrar(nombre, resultado[nombre])
+
+    memoria = memoria_proceso(pid) if pid else {}
+    return {"endpoints": resultado, "sin_cubrir": no_cubiertas,
+            "memoria": {"pico_mb": memoria.get("VmHWM"), "rss_final_mb": memoria.get("VmRSS")}}
+
+
+async def ejecutar_http(args, db_path: str, sesiones: list, escenarios: list) -> dict:
+    import httpx
+
+    proceso, url = None, args.url
+    if not url:
+        proceso, url = lanzar_servidor(args, db_path)
+    try:
+        limites = httpx.Limits(max_connections=args.concurrencia, max_keepalive_connections=args.concurrencia)
+        async with httpx.AsyncClient(base_url=url, limits=limites, timeout=120) as client:
+            for _ in range(300):
+                if proceso and proceso.poll() is not None:
+                    raise RuntimeError("El servidor no arrancó")
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.1)
+            return await medir_http(client, args, sesiones, escenarios, proceso.pid if proceso else None)
+    finally:
+        if proceso:
+            proceso.terminate()
+            proceso.wait()
+
+
+# ============ PARIDAD ============
+
+# Respuestas que dependen del servidor o del momento (tokens, PDF, métricas):
+# de estas solo se compara el código de estado
+PARIDAD_SOLO_ESTADO = {"registro", "login", "refresh", "logout", "pdf_visita", "pdf_presupuesto", "health", "metrics"}
+# Cuántos resultados hay de cada entidad: cuáles entran en el límite depende
+# de la relevancia (bm25 en SQLite, ts_rank en PostgreSQL)
+PARIDAD_SOLO_RECUENTO = {"buscar"}
+# Encadenan tokens que solo conoce el servidor que los emitió: cada servidor sigue su cadena
+PARIDAD_POR_SEPARADO = {"refresh", "logout"}
+# Claves que cambian entre dos servidores aunque los datos sean los mismos
+PARIDAD_VOLATILES = {"created_at", "completed_at", "cursor", "access_token", "refresh_token"}
+# Las sumas de importes en coma flotante pueden diferir en el último céntimo
+PARIDAD_TOLERANCIA = 0.011
+
+
+def normalizar(valor):
+    if isinstance(valor, dict):
+        return {k: normalizar(v) for k, v in valor.items() if k not in PARIDAD_VOLATILES}
+    if isinstance(valor, list):
+        return [normalizar(v) for v in valor]
+    return valor
+
+
+def contenido(respuesta, solo_recuento: bool):
+    tipo = respuesta.headers.get("content-type", "")
+    if tipo.startswith("application/json"):
+        datos = respuesta.json()
+        return {k: len(v) for k, v in datos.items()} if solo_recuento else normalizar(datos)
+    if "ndjson" in tipo:
+        return normalizar([json.loads(linea) for linea in respuesta.text.splitlines() if linea])
+    if tipo.startswith("text/csv"):
+        return normalizar(list(csv.DictReader(io.StringIO(respuesta.text.lstrip("\ufeff")))))
+    return respuesta.content
+
+
+def diferencia(a, b, ruta: str = "") -> str:
+    # Ruta (clave/índice) y valores de la primera diferencia, o "" si no hay
+    if isinstance(a, dict) and isinstance(b, dict):
+        for clave in sorted(a.keys() | b.keys()):
+            encontrada = diferencia(a.get(clave), b.get(clave), f"{ruta}.{clave}")
+            if encontrada:
+                return encontrada
+        return ""
+    if isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        for i, (x, y) in enumerate(zip(a, b)):
+            encontrada = diferencia(x, y, f"{ruta}[{i}]")
+            if encontrada:
+                return encontrada
+        return ""
+    if isinstance(a, float) or isinstance(b, float):
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and abs(a - b) <= PARIDAD_TOLERANCIA:
+            return ""
+    elif a == b:
+        return ""
+    return (f"{ruta or '.'}: {json.dumps(a, ensure_ascii=False, default=str)[:80]} != "
+            f"{json.dumps(b, ensure_ascii=False, default=str)[:80]}")
+
+
+def recorrer(clientes: list, escenario, sesion, local) -> list:
+    # Lanza cada petición del escenario a todos los servidores; el generador
+    # sigue con la respuesta del primero. Devuelve las respuestas de cada paso
+    generador = escenario(sesion, local)
+    pasos, respuestas = [], None
+    try:
+        while True:
+            metodo, url, opciones, _ = generador.send(respuestas[0] if respuestas else None)
+            respuestas = [client.request(metodo, url, **opciones) for client in clientes]
+            pasos.append(respuestas)
+    except StopIteration:
+        pass
+    return pasos
+
+
+def main_paridad(args):
+    import httpx
+
+    if not os.path.exists(args.bd):
+        sys.exit(f"No existe {args.bd}")
+    db_path = copiar_bd(os.path.abspath(args.bd))
+    cargar_postgres(args.postgres, db_path)
+    random.seed(args.semilla)
+    escenarios = [e for e in ESCENARIOS if not args.solo or any(s in e[0] for s in args.solo.split(","))]
+    sesiones = muestrear(db_path, args.usuarios, args.muestra)
+
+    servidores = [lanzar_servidor(args, db_path, DB_BACKEND="sqlite"),
+                  lanzar_servidor(args, db_path, **entorno_postgres(args.postgres))]
+    clientes = [httpx.Client(base_url=url, timeout=120) for _, url in servidores]
+    total = 0
+    try:
+        for (proceso, _), client in zip(servidores, clientes):
+            for _ in range(300):
+                if proceso.poll() is not None:
+                    raise RuntimeError("El servidor no arrancó")
+                try:
+                    if client.get("/health").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.1)
+        # Los tokens valen en los dos servidores (misma SECRET_KEY)
+        for sesion in sesiones:
+            r = clientes[0].post("/api/auth/login", json={"email": sesion["email"], "password": CONTRASENA})
+            sesion["auth"] = {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+        print(f"{'endpoint':<26}{'pasos':>7}{'difs':>6}")
+        for nombre, _, escenario in escenarios:
+            locales = [{} for _ in clientes]
+            pasos, diferencias = 0, []
+            for _ in range(args.rondas):
+                sesion = random.choice(sesiones)
+                if nombre in PARIDAD_POR_SEPARADO:
+                    recorridos = [recorrer([client], escenario, sesion, local)
+                                  for client, local in zip(clientes, locales)]
+                    respuestas = [[paso[0] for paso in grupo] for grupo in zip(*recorridos)]
+                else:
+                    respuestas = recorrer(clientes, escenario, sesion, locales[0])
+                for sqlite_r, postgres_r in respuestas:
+                    pasos += 1
+                    if sqlite_r.status_code != postgres_r.status_code:
+                        diferencias.append(f"{sqlite_r.request.method} {sqlite_r.request.url.path}: "
+                                           f"{sqlite_r.status_code} != {postgres_r.status_code}")
+                    elif nombre not in PARIDAD_SOLO_ESTADO:
+                        solo_recuento = nombre in PARIDAD_SOLO_RECUENTO
+                        encontrada = diferencia(contenido(sqlite_r, solo_recuento),
+                                                contenido(postgres_r, solo_recuento))
+                        if encontrada:
+                            diferencias.append(f"{sqlite_r.request.method} {sqlite_r.request.url.path} {encontrada}")
+            total += len(diferencias)
+            print(f"{nombre:<26}{pasos:>7}{len(diferencias):>6}", flush=True)
+            for texto in diferencias[:3]:
+                print(f"    {texto}")
+    finally:
+        for client in clientes:
+            client.close()
+        for proceso, _ in servidores:
+            proceso.terminate()
+            proceso.wait()
+        shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+    print(f"{total} diferencias")
+    if total:
+        sys.exit(1)
+
+
+# ============ SALIDA ============
+
+def mostrar(nombre: str, r: dict):
+    print(f"{nombre:<26}{r['peticiones']:>7}{r['errores']:>6}{r['rps']:>10,.1f}{r['p50_ms']:>9.2f}"
+          f"{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['bytes_medios']:>10}", flush=True)
+
+
+def copiar_bd(db_path: str) -> str:
+    copia = os.path.join(tempfile.mkdtemp(prefix="tecnigestion-bench-"), "app.db")
+    # Con DB_SHARDING, también los shards (en la carpeta por defecto de la copia)
+    ficheros = [(db_path, copia)] + [
+        (ruta, os.path.join(os.path.dirname(copia), "shards", os.path.basename(ruta)))
+        for ruta in set(ficheros_datos(db_path).values())
+    ]
+    for ruta, destino_ruta in ficheros:
+        os.makedirs(os.path.dirname(destino_ruta), exist_ok=True)
+        with sqlite3.connect(ruta) as origen, sqlite3.connect(destino_ruta) as destino:
+            origen.backup(destino)
+    os.environ.pop("DB_SHARD_DIR", None)
+    return copia
+
+
+def main_ejecutar(args):
+    if not os.path.exists(args.bd):
+        sys.exit(f"No existe {args.bd}")
+    db_path = os.path.abspath(args.bd)
+    if not args.sin_copia and not args.url:
+        db_path = copiar_bd(db_path)
+    if args.postgres:
+        if not args.url:
+            cargar_postgres(args.postgres, db_path)
+        os.environ.update(entorno_postgres(args.postgres))
+
+    random.seed(args.semilla)
+    escenarios = [e for e in ESCENARIOS if not args.solo or any(s in e[0] for s in args.solo.split(","))]
+    sesiones = muestrear(db_path, args.usuarios, args.muestra)
+    datos = recuentos(db_path)
+    print(f"{'endpoint':<26}{'n':>7}{'err':>6}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'bytes':>10}")
+    if args.modo == "inproceso":
+        resultado = ejecutar_inproceso(args, db_path, sesiones, escenarios)
+    else:
+        resultado = asyncio.run(ejecutar_http(args, db_path, sesiones, escenarios))
+
+    if resultado["sin_cubrir"]:
+        print("Rutas sin escenario:", ", ".join(resultado["sin_cubrir"]))
+    print(f"Memoria pico: {resultado['memoria']['pico_mb']} MB")
+    resultado["meta"] = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit_git(),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "modo": args.modo,
+        "argumentos": {k: v for k, v in vars(args).items() if k != "funcion"},
+        "entorno": {k: v for k, v in os.environ.items()
+                    if k in ("DB_BACKEND", "DB_MODE", "RESPONSE_CACHE", "DB_POOL_SIZE", "AUTH_EXECUTOR", "BCRYPT_ROUNDS",
+                             "METRICS_ENABLED", "DB_SHARDING", "DB_SHARD_COUNT")},
+        "datos": datos,
+    }
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"Resultado en {args.salida}")
+    if db_path != os.path.abspath(args.bd):
+        shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+
+
+def main_comparar(args):
+    with open(args.antes) as f:
+        antes = json.load(f)
+    with open(args.despues) as f:
+        despues = json.load(f)
+    for clave in ("modo", "commit"):
+        print(f"{clave}: {antes['meta'][clave]} -> {despues['meta'][clave]}")
+    # El tamaño no cuenta: cambia con solo repartir los mismos datos en shards
+    if ({k: v for k, v in antes["meta"]["datos"].items() if k != "tamano_mb"}
+            != {k: v for k, v in despues["meta"]["datos"].items() if k != "tamano_mb"}):
+        print("Aviso: los datos de las dos ejecuciones no son los mismos")
+
+    def delta(a, b):
+        return f"{(b - a) / a * 100:+.0f}%" if a else "-"
+
+    print(f"\n{'endpoint':<26}{'req/s':>18}{'':>8}{'p50 ms':>18}{'':>8}{'p99 ms':>18}{'':>8}")
+    for nombre, a in antes["endpoints"].items():
+        b = despues["endpoints"].get(nombre)
+        if not b:
+            continue
+        print(f"{nombre:<26}{a['rps']:>9.1f}{b['rps']:>9.1f}{delta(a['rps'], b['rps']):>8}"
+              f"{a['p50_ms']:>9.2f}{b['p50_ms']:>9.2f}{delta(a['p50_ms'], b['p50_ms']):>8}"
+              f"{a['p99_ms']:>9.2f}{b['p99_ms']:>9.2f}{delta(a['p99_ms'], b['p99_ms']):>8}")
+    print(f"\nMemoria pico: {antes['memoria']['pico_mb']} -> {despues['memoria']['pico_mb']} MB")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+
+    ejecutar = subparsers.add_parser("ejecutar", help="medir todos los endpoints")
+    ejecutar.add_argument("bd", help="BD generada con generar_datos.py")
+    ejecutar.add_argument("--modo", choices=["inproceso", "http"], default="inproceso")
+    ejecutar.add_argument("--url", help="modo http: servidor ya arrancado (usa la BD solo para elegir ids)")
+    ejecutar.add_argument("--concurrencia", type=int, default=16, help="modo http")
+    ejecutar.add_argument("--peticiones", type=int, default=200, help="máximo por endpoint")
+    ejecutar.add_argument("--segundos", type=float, default=10, help="máximo por endpoint")
+    ejecutar.add_argument("--calentamiento", type=int, default=3, help="peticiones sin medir por endpoint")
+    ejecutar.add_argument("--usuarios", type=int, default=4, help="técnicos (los de más clientes)")
+    ejecutar.add_argument("--muestra", type=int, default=1000, help="ids de cada tipo por técnico")
+    ejecutar.add_argument("--solo", help="solo los endpoints cuyo nombre contiene alguno (separados por comas)")
+    ejecutar.add_argument("--cache", action="store_true", help="mantener la caché de respuestas activa")
+    ejecutar.add_argument("--tracemalloc", action="store_true", help="inproceso: memoria pico por endpoint")
+    ejecutar.add_argument("--sin-copia", action="store_true", help="escribir en la BD original")
+    ejecutar.add_argument("--semilla", type=int, default=42)
+    ejecutar.add_argument("--salida", help="fichero JSON con el resultado")
+    ejecutar.add_argument("--postgres", metavar="DSN", help="usar DB_BACKEND=postgres sobre esta base vacía")
+    ejecutar.set_defaults(funcion=main_ejecutar)
+
+    paridad = subparsers.add_parser("paridad", help="comparar las respuestas de SQLite y PostgreSQL")
+    paridad.add_argument("bd", help="BD generada con generar_datos.py")
+    paridad.add_argument("--postgres", metavar="DSN", required=True, help="base PostgreSQL vacía")
+    paridad.add_argument("--rondas", type=int, default=5, help="veces que se repite cada escenario")
+    paridad.add_argument("--usuarios", type=int, default=2, help="técnicos (los de más clientes)")
+    paridad.add_argument("--muestra", type=int, default=200, help="ids de cada tipo por técnico")
+    paridad.add_argument("--solo", help="solo los endpoints cuyo nombre contiene alguno (separados por comas)")
+    paridad.add_argument("--semilla", type=int, default=42)
+    paridad.set_defaults(funcion=main_paridad, cache=False)
+
+    comparar = subparsers.add_parser("comparar", help="comparar dos resultados JSON")
+    comparar.add_argument("antes")
+    comparar.add_argument("despues")
+    comparar.set_defaults(funcion=main_comparar)
+
+    args = parser.parse_args()
+    args.funcion(args)
+
+
+if __name__ == "__main__":
+    main_bench()
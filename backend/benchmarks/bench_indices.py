@@ -0,0 +1,163 @@
+"""
+Benchmark de índices: compara planes de consulta y latencias de las consultas
+de los endpoints antes y después de aplicar las migraciones de índices.
+
+Uso (desde la carpeta backend):
+    python benchmarks/bench_indices.py --usuarios 20 --clientes 2000 --visitas 20000
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+# La BD del backend (DATABASE_PATH) se lee al importar: apuntarla a un temporal
+_tmp = tempfile.mkdtemp(prefix="tecnigestion-bench-")
+os.environ["DATABASE_PATH"] = os.path.join(_tmp, "app.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import almacen_sqlite  # noqa: E402
+
+ESTADOS_VISITA = ["pendiente", "confirmada", "en_curso", "completada", "cancelada"]
+ESTADOS_PRESUPUESTO = ["borrador", "enviado", "aceptado", "rechazado"]
+
+# Consultas tal como las ejecutan los endpoints
+CONSULTAS = {
+    "listar_clientes": (
+        "SELECT * FROM clientes WHERE usuario_id = ? ORDER BY nombre, id LIMIT 50",
+        lambda u, hoy, ids: (u,),
+    ),
+    "visitas_por_fecha": (
+        """SELECT v.*, c.nombre FROM visitas v JOIN clientes c ON v.cliente_id = c.id
+           WHERE v.usuario_id = ? AND v.fecha = ? ORDER BY v.fecha DESC, COALESCE(v.hora, ''), v.id""",
+        lambda u, hoy, ids: (u, hoy),
+    ),
+    "visitas_por_estado": (
+        """SELECT v.*, c.nombre FROM visitas v JOIN clientes c ON v.cliente_id = c.id
+           WHERE v.usuario_id = ? AND v.estado IN ('pendiente', 'confirmada')
+           ORDER BY v.fecha DESC, COALESCE(v.hora, ''), v.id LIMIT 50""",
+        lambda u, hoy, ids: (u,),
+    ),
+    "presupuestos_recientes": (
+        """SELECT p.*, c.nombre FROM presupuestos p JOIN clientes c ON p.cliente_id = c.id
+           WHERE p.usuario_id = ? ORDER BY p.created_at DESC, p.id DESC LIMIT 50""",
+        lambda u, hoy, ids: (u,),
+    ),
+    "presupuestos_por_estado": (
+        """SELECT COUNT(*) FROM presupuestos WHERE usuario_id = ? AND estado IN ('borrador', 'enviado')""",
+        lambda u, hoy, ids: (u,),
+    ),
+    "lineas_de_pagina": (
+        """SELECT * FROM lineas_presupuesto
+           WHERE presupuesto_id IN (SELECT value FROM json_each(?))
+           ORDER BY presupuesto_id, orden, id""",
+        lambda u, hoy, ids: (ids,),
+    ),
+    "dashboard_visitas_hoy": (
+        "SELECT COUNT(*) FROM visitas WHERE usuario_id = ? AND fecha = ?",
+        lambda u, hoy, ids: (u, hoy),
+    ),
+}
+
+
+def poblar(conn, usuarios, clientes, visitas, presupuestos, lineas):
+    rnd = random.Random(42)
+    hoy = date.today()
+    conn.executemany(
+        "INSERT INTO usuarios (id, nombre, email, password_hash) VALUES (?, ?, ?, 'x')",
+        [(u, f"Usuario {u}", f"u{u}@bench.local") for u in range(1, usuarios + 1)],
+    )
+    conn.executemany(
+        "INSERT INTO clientes (id, usuario_id, nombre, apellidos, telefono) VALUES (?, ?, ?, ?, ?)",
+        [(i, rnd.randint(1, usuarios), f"Cliente {rnd.randint(1, 10**6)}", "Pérez", f"6{i:08d}")
+         for i in range(1, clientes + 1)],
+    )
+    cliente_usuario = dict(conn.execute("SELECT id, usuario_id FROM clientes"))
+    filas = []
+    for i in range(1, visitas + 1):
+        cid = rnd.randint(1, clientes)
+        fecha = (hoy + timedelta(days=rnd.randint(-365, 60))).isoformat()
+        filas.append((i, cliente_usuario[cid], cid, f"Visita {i}", fecha,
+                      f"{rnd.randint(8, 19):02d}:00", rnd.choice(ESTADOS_VISITA)))
+    conn.executemany(
+        "INSERT INTO visitas (id, usuario_id, cliente_id, titulo, fecha, hora, estado) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        filas,
+    )
+    filas = []
+    for i in range(1, presupuestos + 1):
+        cid = rnd.randint(1, clientes)
+        creado = (hoy - timedelta(days=rnd.randint(0, 730))).isoformat() + " 10:00:00"
+        filas.append((i, cliente_usuario[cid], cid, f"B-{i}", f"Presupuesto {i}",
+                      rnd.choice(ESTADOS_PRESUPUESTO), creado[:10], creado))
+    conn.executemany(
+        """INSERT INTO presupuestos (id, usuario_id, cliente_id, numero, titulo, estado, fecha_emision, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        filas,
+    )
+    conn.executemany(
+        "INSERT INTO lineas_presupuesto (presupuesto_id, concepto, cantidad, precio_unitario, orden) VALUES (?, ?, 1, 10, ?)",
+        [(p, f"Concepto {n}", n) for p in range(1, presupuestos + 1) for n in range(lineas)],
+    )
+    conn.commit()
+
+
+def medir(conn, repeticiones, usuarios):
+    rnd = random.Random(7)
+    hoy = date.today().isoformat()
+    resultados = {}
+    for nombre, (sql, parametros) in CONSULTAS.items():
+        tiempos = []
+        for _ in range(repeticiones):
+            u = rnd.randint(1, usuarios)
+            ids = [r[0] for r in conn.execute(
+                "SELECT id FROM presupuestos WHERE usuario_id = ? LIMIT 50", (u,))]
+            params = parametros(u, hoy, json.dumps(ids))
+            inicio = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+        plan = [r[3] for r in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parametros(1, hoy, "[]"))]
+        resultados[nombre] = (statistics.median(tiempos), max(tiempos), plan)
+    return resultados
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=20)
+    parser.add_argument("--clientes", type=int, default=5000)
+    parser.add_argument("--visitas", type=int, default=50000)
+    parser.add_argument("--presupuestos", type=int, default=20000)
+    parser.add_argument("--lineas", type=int, default=3, help="líneas por presupuesto")
+    parser.add_argument("--repeticiones", type=int, default=50)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(os.path.join(_tmp, "bench.db"))
+    almacen_sqlite.crear_tablas(conn)
+    print("Generando datos...")
+    poblar(conn, args.usuarios, args.clientes, args.visitas, args.presupuestos, args.lineas)
+    conn.execute("ANALYZE")
+
+    antes = medir(conn, args.repeticiones, args.usuarios)
+    aplicadas = almacen_sqlite.aplicar_migraciones(conn)
+    print(f"Migraciones aplicadas: {aplicadas}")
+    despues = medir(conn, args.repeticiones, args.usuarios)
+
+    print(f"\n{'consulta':<26}{'antes (ms)':>12}{'después (ms)':>14}{'mejora':>9}")
+    for nombre in CONSULTAS:
+        a, d = antes[nombre][0], despues[nombre][0]
+        print(f"{nombre:<26}{a:>12.3f}{d:>14.3f}{a / d if d else float('inf'):>8.1f}x")
+
+    print("\nPlanes de consulta")
+    for nombre in CONSULTAS:
+        print(f"\n{nombre}")
+        print("  antes:   " + " | ".join(antes[nombre][2]))
+        print("  después: " + " | ".join(despues[nombre][2]))
+
+
+if __name__ == "__main__":
+    main_bench()
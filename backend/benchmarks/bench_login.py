@@ -0,0 +1,134 @@
+"""
+Benchmark de login bajo carga: mide logins/s y la latencia de otro endpoint
+(GET /api/clientes) mientras dura la ráfaga, para cada modo de AUTH_EXECUTOR.
+
+Requiere httpx (pip install httpx). Uso (desde la carpeta backend):
+    python benchmarks/bench_login.py --logins 200 --concurrencia 32
+    python benchmarks/bench_login.py --executors process --rounds 12
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+async def ejecutar_carga(logins, concurrencia):
+    import httpx
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        r = await client.post("/api/auth/registro", json={
+            "nombre": "Bench", "email": "bench@example.com", "password": "secreto-bench"
+        })
+        token = r.json()["access_token"]
+        auth = {"Authorization": f"Bearer {token}"}
+        await client.post("/api/clientes", json={"nombre": "Cliente", "telefono": "600000000"}, headers=auth)
+
+        latencias_login, latencias_otros = [], []
+        rechazados = 0
+        pendientes = asyncio.Semaphore(concurrencia)
+        terminado = asyncio.Event()
+
+        async def un_login():
+            nonlocal rechazados
+            async with pendientes:
+                inicio = time.perf_counter()
+                r = await client.post("/api/auth/login", json={
+                    "email": "bench@example.com", "password": "secreto-bench"
+                })
+                if r.status_code == 503:
+                    rechazados += 1
+                else:
+                    latencias_login.append(time.perf_counter() - inicio)
+
+        async def otros_endpoints():
+            # Sin caché de respuestas para medir el camino completo
+            while not terminado.is_set():
+                inicio = time.perf_counter()
+                await client.get("/api/clientes?limite=20", headers=auth)
+                latencias_otros.append(time.perf_counter() - inicio)
+                await asyncio.sleep(0.005)
+
+        sondeo = asyncio.create_task(otros_endpoints())
+        inicio = time.perf_counter()
+        await asyncio.gather(*(un_login() for _ in range(logins)))
+        duracion = time.perf_counter() - inicio
+        terminado.set()
+        await sondeo
+
+    return {
+        "executor": main.AUTH_EXECUTOR,
+        "workers": main.auth_pool.workers,
+        "rounds": main.BCRYPT_ROUNDS,
+        "logins_ok": len(latencias_login),
+        "rechazados_503": rechazados,
+        "logins_por_segundo": round(len(latencias_login) / duracion, 1),
+        "login_p50_ms": round(percentil(latencias_login, 50) * 1000, 1),
+        "login_p99_ms": round(percentil(latencias_login, 99) * 1000, 1),
+        "otros_p50_ms": round(percentil(latencias_otros, 50) * 1000, 1),
+        "otros_p99_ms": round(percentil(latencias_otros, 99) * 1000, 1),
+        "otros_peticiones": len(latencias_otros),
+    }
+
+
+def modo_hijo(args):
+    # Se ejecuta en un proceso aparte para que la configuración por entorno
+    # (AUTH_EXECUTOR, BCRYPT_ROUNDS...) se lea al importar main
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    resultado = asyncio.run(ejecutar_carga(args.logins, args.concurrencia))
+    import main
+    main.auth_pool.close()
+    print(json.dumps(resultado))
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=10, help="BCRYPT_ROUNDS")
+    parser.add_argument("--executors", default="inline,thread,process")
+    parser.add_argument("--max-pendientes", type=int, default=1000)
+    parser.add_argument("--hijo", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        return modo_hijo(args)
+
+    resultados = []
+    for executor in args.executors.split(","):
+        entorno = dict(
+            os.environ,
+            DATABASE_PATH=os.path.join(tempfile.mkdtemp(prefix="tecnigestion-bench-"), "app.db"),
+            AUTH_EXECUTOR=executor,
+            BCRYPT_ROUNDS=str(args.rounds),
+            AUTH_MAX_PENDING=str(args.max_pendientes),
+            RESPONSE_CACHE="none",
+        )
+        salida = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--hijo",
+             "--logins", str(args.logins), "--concurrencia", str(args.concurrencia)],
+            env=entorno, capture_output=True, text=True, check=True,
+        )
+        resultados.append(json.loads(salida.stdout.strip().splitlines()[-1]))
+
+    columnas = list(resultados[0].keys())
+    print("  ".join(f"{c:>18}" for c in columnas))
+    for r in resultados:
+        print("  ".join(f"{str(r[c]):>18}" for c in columnas))
+
+
+if __name__ == "__main__":
+    main_bench()
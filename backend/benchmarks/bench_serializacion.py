@@ -0,0 +1,181 @@
+"""
+Serialización de listados: compara, para clientes, visitas y presupuestos, el
+camino anterior (un modelo Pydantic por fila + jsonable_encoder + json) con
+filas_respuesta + orjson. Comprueba que los bytes son idénticos y mide filas/s
+de la serialización sola y del endpoint completo (consulta incluida).
+
+Uso (desde la carpeta backend):
+    python benchmarks/bench_serializacion.py --clientes 5000 --visitas 20000 --presupuestos 5000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+# main.py inicializa su propia BD al importarse: apuntarla a un temporal y
+# desactivar la caché de respuestas para medir siempre la consulta
+_tmp = tempfile.mkdtemp(prefix="tecnigestion-bench-")
+os.environ["DATABASE_PATH"] = os.path.join(_tmp, "app.db")
+os.environ["RESPONSE_CACHE"] = "none"
+os.environ["SLOW_QUERY_MS"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+import almacen_sqlite  # noqa: E402
+import modelos  # noqa: E402
+from fastapi import Response  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+NOMBRES = ["José", "María", "Antonio", "Carmen", "Manuel", "Lucía", "Francisco", "Elena", "David", "Laura"]
+APELLIDOS = ["García", "López", "Martínez", "Sánchez", "Pérez", "Gómez", "Fernández", "Ruiz", "Díaz", "Moreno"]
+TRABAJOS = ["Revisión caldera", "Cambio radiador", "Fuga en baño", "Instalación split", "Avería \"urgente\""]
+ESTADOS_VISITA = ["pendiente", "confirmada", "en_curso", "completada"]
+ESTADOS_PRESUPUESTO = ["borrador", "enviado", "aceptado", "rechazado"]
+
+SQL_CLIENTES = "SELECT * FROM clientes WHERE usuario_id = 1 ORDER BY nombre, id"
+SQL_VISITAS = f"""SELECT {almacen_sqlite.SQL_COLUMNAS_VISITA} FROM visitas v JOIN clientes c ON v.cliente_id = c.id
+    WHERE v.usuario_id = 1 ORDER BY v.fecha DESC, COALESCE(v.hora, ''), v.id"""
+SQL_PRESUPUESTOS = f"""SELECT p.*, {almacen_sqlite.SQL_DIAS_PARA_ELIMINAR}, c.nombre || ' ' || COALESCE(c.apellidos, '') as cliente_nombre
+    FROM presupuestos p JOIN clientes c ON p.cliente_id = c.id
+    WHERE p.usuario_id = 1 ORDER BY p.created_at DESC, p.id DESC"""
+
+
+def poblar(conn, clientes, visitas, presupuestos, lineas):
+    rnd = random.Random(42)
+    hoy = date.today()
+    conn.execute("INSERT INTO usuarios (id, nombre, email, password_hash) VALUES (1, 'Bench', 'b@example.com', 'x')")
+    conn.executemany(
+        """INSERT INTO clientes (id, usuario_id, nombre, apellidos, email, telefono, direccion, ciudad, notas)
+           VALUES (?, 1, ?, ?, ?, ?, ?, 'Sevilla', ?)""",
+        [(i, rnd.choice(NOMBRES), f"{rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}", f"c{i}@example.com",
+          f"6{i:08d}", f"Calle Mayor {rnd.randint(1, 200)}", None if i % 3 else "Llamar antes\nde ir")
+         for i in range(1, clientes + 1)],
+    )
+    conn.executemany(
+        """INSERT INTO visitas (usuario_id, cliente_id, titulo, descripcion, fecha, hora, estado, firma_hash)
+           VALUES (1, ?, ?, ?, ?, ?, ?, ?)""",
+        [(rnd.randint(1, clientes), rnd.choice(TRABAJOS), "Descripción del trabajo " * rnd.randint(0, 4),
+          (hoy - timedelta(days=rnd.randint(-30, 365))).isoformat(), f"{rnd.randint(8, 19):02d}:00",
+          rnd.choice(ESTADOS_VISITA), None if i % 4 else f"{i:064x}")
+         for i in range(visitas)],
+    )
+    for i in range(1, presupuestos + 1):
+        filas = [(i, f"Concepto {j}", rnd.choice([1, 2, 0.5, 3.25]), rnd.choice([12.5, 40, 99.99, 0.1 + 0.2]), j)
+                 for j in range(rnd.randint(0, lineas * 2))]
+        subtotal = round(sum(c * p for _, _, c, p, _ in filas), 2)
+        estado = rnd.choice(ESTADOS_PRESUPUESTO)
+        conn.execute(
+            """INSERT INTO presupuestos (id, usuario_id, cliente_id, numero, titulo, subtotal, aplicar_iva,
+                   iva_amount, total, estado, fecha_emision, fecha_rechazo)
+               VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (i, rnd.randint(1, clientes), f"B-{i}", rnd.choice(TRABAJOS), subtotal, i % 5 != 0,
+             round(subtotal * 0.21, 2), round(subtotal * 1.21, 2), estado, hoy.isoformat(),
+             hoy.isoformat() if estado == "rechazado" else None),
+        )
+        conn.executemany(
+            """INSERT INTO lineas_presupuesto (presupuesto_id, concepto, cantidad, precio_unitario, total, orden)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            [(pid, concepto, c, p, c * p, orden) for pid, concepto, c, p, orden in filas],
+        )
+    conn.commit()
+
+
+# Camino anterior: modelo por fila, jsonable_encoder y json de la librería estándar
+
+def antes_clientes(cursor, rows):
+    return JSONResponse(jsonable_encoder([main.ClienteResponse(**dict(row)) for row in rows])).body
+
+
+def antes_visitas(cursor, rows):
+    return JSONResponse(jsonable_encoder([main.VisitaResponse(**dict(row)) for row in rows])).body
+
+
+def antes_presupuestos(cursor, rows):
+    filas = [dict(row) for row in rows]
+    lineas = almacen_sqlite.cargar_lineas(cursor, [f["id"] for f in filas])
+    presupuestos = []
+    for pres_dict in filas:
+        pres_dict["lineas"] = lineas.get(pres_dict["id"], [])
+        presupuestos.append(main.PresupuestoResponse(**pres_dict))
+    return JSONResponse(jsonable_encoder(presupuestos)).body
+
+
+def despues_clientes(cursor, rows):
+    return main.RespuestaJSON(modelos.filas_respuesta(main.ClienteResponse, rows)).body
+
+
+def despues_visitas(cursor, rows):
+    return main.RespuestaJSON(modelos.filas_respuesta(main.VisitaResponse, rows)).body
+
+
+def despues_presupuestos(cursor, rows):
+    return main.RespuestaJSON(almacen_sqlite.filas_presupuestos(cursor, rows)).body
+
+
+CASOS = [
+    ("clientes", SQL_CLIENTES, antes_clientes, despues_clientes,
+     lambda limite: main.listar_clientes(Response(), limite=limite, user_id=1)),
+    ("visitas", SQL_VISITAS, antes_visitas, despues_visitas,
+     lambda limite: main.listar_visitas(Response(), limite=limite, user_id=1)),
+    ("presupuestos", SQL_PRESUPUESTOS, antes_presupuestos, despues_presupuestos,
+     lambda limite: main.listar_presupuestos(Response(), limite=limite, user_id=1)),
+]
+
+
+def medir(fn, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        fn()
+        tiempos.append(time.perf_counter() - inicio)
+    return statistics.median(tiempos)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clientes", type=int, default=5000)
+    parser.add_argument("--visitas", type=int, default=20000)
+    parser.add_argument("--presupuestos", type=int, default=5000)
+    parser.add_argument("--lineas", type=int, default=4, help="líneas medias por presupuesto")
+    parser.add_argument("--repeticiones", type=int, default=10)
+    args = parser.parse_args()
+
+    print("Generando datos...")
+    with main.get_db() as conn:
+        poblar(conn, args.clientes, args.visitas, args.presupuestos, args.lineas)
+        conn.execute("ANALYZE")
+
+    # Números que orjson escribe distinto que json: se resuelven con json
+    for valor in ({"precio": 0.00001}, [1e16, -2.5e-7], {"texto": "1e5,3e4"}):
+        if main.serializar_json(valor) != JSONResponse(valor).body:
+            sys.exit(f"{valor}: la respuesta no es idéntica byte a byte")
+
+    print(f"\n{'listado':<14}{'filas':>7}{'antes':>12}{'después':>12}{'mejora':>8}  (filas/s, solo serialización)")
+    for nombre, sql, antes, despues, _ in CASOS:
+        with main.get_db() as conn:
+            cursor = conn.cursor()
+            rows = cursor.execute(sql).fetchall()
+            if antes(cursor, rows) != despues(cursor, rows):
+                sys.exit(f"{nombre}: la respuesta no es idéntica byte a byte")
+            t_antes = medir(lambda: antes(cursor, rows), args.repeticiones)
+            t_despues = medir(lambda: despues(cursor, rows), args.repeticiones)
+        print(f"{nombre:<14}{len(rows):>7}{len(rows) / t_antes:>12,.0f}{len(rows) / t_despues:>12,.0f}"
+              f"{t_antes / t_despues:>7.1f}x")
+
+    # Endpoint completo (consulta, conversión y JSON) por página y sin paginar
+    print(f"\n{'listado':<14}{'límite':>7}{'filas/s':>12}{'ms/página':>12}  (endpoint completo, después)")
+    for nombre, _, _, _, endpoint in CASOS:
+        for limite in (50, main.PAGE_SIZE_MAX, None):
+            filas = len(main.json.loads(endpoint(limite).body))
+            t = medir(lambda: endpoint(limite), args.repeticiones)
+            print(f"{nombre:<14}{limite or 'todo':>7}{filas / t:>12,.0f}{t * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main_bench()
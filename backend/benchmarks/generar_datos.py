@@ -0,0 +1,278 @@
+"""
+Generador de datos sintéticos: crea (o amplía) una BD SQLite con técnicos
+realistas para los benchmarks. Cada técnico tiene clientes (particulares y
+empresas), visitas repartidas en dos años con su estado según la fecha, partes
+firmados y presupuestos numerados con sus líneas. Los datos entran por las
+mismas tablas, triggers y migraciones que la app, así que contadores, índices
+de búsqueda, agregados y registro de sincronización quedan coherentes.
+
+Con la misma semilla y la misma fecha de referencia el resultado es idéntico.
+Todos los técnicos usan la contraseña CONTRASENA (abajo) y el email
+tecnico<id>@bench.example.com.
+
+Uso (desde la carpeta backend):
+    python benchmarks/generar_datos.py /tmp/bench.db --usuarios 100 --clientes 5000 --visitas 50000 --presupuestos 20000
+    python benchmarks/generar_datos.py /tmp/bench.db --usuarios 20 --perfil realista
+"""
+
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+from datetime import date, datetime, timedelta
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CONTRASENA = "bench-password"
+DOMINIO = "bench.example.com"
+
+NOMBRES = ["José", "María", "Antonio", "Carmen", "Manuel", "Lucía", "Francisco", "Elena", "David", "Laura",
+           "Javier", "Ana", "Daniel", "Marta", "Pablo", "Cristina", "Alejandro", "Isabel", "Sergio", "Pilar"]
+APELLIDOS = ["García", "López", "Martínez", "Sánchez", "Pérez", "Gómez", "Fernández", "Ruiz", "Díaz", "Moreno",
+             "Muñoz", "Álvarez", "Romero", "Navarro", "Torres", "Domínguez", "Gil", "Vázquez", "Serrano", "Ramos"]
+EMPRESAS = ["Comunidad de Propietarios {}", "Talleres {} S.L.", "Hostal {}", "Bar {}", "Clínica {}",
+            "Construcciones {} S.A.", "Panadería {}", "Oficinas {} S.L."]
+CALLES = ["Calle Mayor", "Avenida de la Constitución", "Calle Real", "Plaza de España", "Calle del Sol",
+          "Avenida de Andalucía", "Calle Nueva", "Paseo del Prado", "Calle Ancha", "Ronda Norte"]
+# (ciudad, provincia, prefijo postal)
+CIUDADES = [("Madrid", "Madrid", "280"), ("Alcalá de Henares", "Madrid", "288"), ("Sevilla", "Sevilla", "410"),
+            ("Dos Hermanas", "Sevilla", "417"), ("Valencia", "Valencia", "460"), ("Zaragoza", "Zaragoza", "500"),
+            ("Málaga", "Málaga", "290"), ("Murcia", "Murcia", "300"), ("Valladolid", "Valladolid", "470"),
+            ("Bilbao", "Bizkaia", "480")]
+TRABAJOS = {
+    "reparacion": ["Fuga en el baño", "Caldera no enciende", "Radiador frío", "Avería del termo",
+                   "Cuadro eléctrico salta", "Persiana atascada", "Grifo gotea"],
+    "mantenimiento": ["Revisión anual de caldera", "Limpieza de filtros del aire", "Revisión de la bomba de calor",
+                      "Mantenimiento de la instalación de gas"],
+    "instalacion": ["Instalación de split", "Cambio de calentador", "Instalación de termostato",
+                    "Nueva toma de corriente", "Sustitución de radiadores"],
+    "valoracion": ["Valorar reforma del baño", "Valorar cambio de caldera", "Presupuesto de climatización"],
+    "urgencia": ["Sin agua caliente", "Inundación en la cocina", "Sin luz en la vivienda", "Olor a gas"],
+}
+DESCRIPCIONES = ["El cliente indica que el problema empezó hace unos días.", "Llamar media hora antes de ir.",
+                 "Portero automático averiado, llamar al móvil.", "Hay que llevar escalera.",
+                 "Acceso por el garaje, plaza 14.", "Pide factura a nombre de la empresa."]
+# (concepto, precio unitario)
+CONCEPTOS = [("Mano de obra (hora)", 35.0), ("Desplazamiento", 20.0), ("Caldera de condensación 24 kW", 1450.0),
+             ("Termostato programable", 89.9), ("Radiador de aluminio 8 elementos", 129.5),
+             ("Split 3000 frigorías", 799.0), ("Tubería multicapa (metro)", 6.75), ("Grifo monomando", 64.0),
+             ("Válvula de corte", 12.3), ("Material de fontanería", 18.4), ("Diferencial 40 A", 54.2)]
+LETRAS_NIF = "TRWAGMYFPDXBNJZSQVHLCKE"
+
+
+def png_firma(rnd: random.Random, ancho: int = 240, alto: int = 80) -> bytes:
+    # PNG en escala de grises con un trazo aleatorio, como el de la pantalla de firma
+    pixeles = [bytearray(b"\xff" * ancho) for _ in range(alto)]
+    x, y = 10.0, alto / 2
+    for _ in range(400):
+        x = min(ancho - 2, max(1, x + rnd.uniform(-1, 2)))
+        y = min(alto - 2, max(1, y + rnd.uniform(-3, 3)))
+        for dx in (0, 1):
+            for dy in (0, 1):
+                pixeles[int(y) + dy][int(x) + dx] = 0
+    crudo = b"".join(b"\x00" + bytes(fila) for fila in pixeles)
+
+    def bloque(tipo: bytes, datos: bytes) -> bytes:
+        return struct.pack(">I", len(datos)) + tipo + datos + struct.pack(">I", zlib.crc32(tipo + datos))
+
+    return (b"\x89PNG\r\n\x1a\n" + bloque(b"IHDR", struct.pack(">IIBBBBB", ancho, alto, 8, 0, 0, 0, 0))
+            + bloque(b"IDAT", zlib.compress(crudo, 9)) + bloque(b"IEND", b""))
+
+
+def tamanos(args) -> list:
+    # (clientes, visitas, presupuestos) de cada técnico. "realista": los valores
+    # indicados son los del técnico más grande y el k-ésimo tiene 1/k de ellos
+    resultado = []
+    for k in range(1, args.usuarios + 1):
+        factor = 1 if args.perfil == "uniforme" else 1 / k
+        resultado.append((max(1, round(args.clientes * factor)), round(args.visitas * factor),
+                          round(args.presupuestos * factor)))
+    return resultado
+
+
+def siguiente_id(conn, tabla: str) -> int:
+    return (conn.execute(f"SELECT MAX(id) FROM {tabla}").fetchone()[0] or 0) + 1
+
+
+def crear_clientes(rnd, usuario_id: int, primer_id: int, cantidad: int, hoy: date) -> list:
+    filas = []
+    for i in range(cantidad):
+        ciudad, provincia, prefijo = rnd.choice(CIUDADES)
+        if rnd.random() < 0.2:
+            nombre, apellidos, tipo = rnd.choice(EMPRESAS).format(rnd.choice(APELLIDOS)), "", "empresa"
+            nif = f"B{rnd.randint(10000000, 99999999)}"
+        else:
+            nombre, apellidos, tipo = rnd.choice(NOMBRES), f"{rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}", "particular"
+            numero = rnd.randint(10000000, 99999999)
+            nif = f"{numero}{LETRAS_NIF[numero % 23]}" if rnd.random() < 0.6 else ""
+        alta = datetime.combine(hoy - timedelta(days=rnd.randint(0, 1500)), datetime.min.time()) \
+            + timedelta(seconds=rnd.randint(8 * 3600, 20 * 3600))
+        filas.append((
+            primer_id + i, usuario_id, nombre, apellidos,
+            f"cliente{primer_id + i}@correo.example" if rnd.random() < 0.7 else "",
+            f"6{rnd.randint(10000000, 99999999)}", f"9{rnd.randint(10000000, 99999999)}" if rnd.random() < 0.2 else "",
+            f"{rnd.choice(CALLES)} {rnd.randint(1, 150)}, {rnd.randint(1, 8)}º", ciudad,
+            f"{prefijo}{rnd.randint(0, 99):02d}", provincia, tipo, nif,
+            rnd.choice(DESCRIPCIONES) if rnd.random() < 0.3 else "", alta.strftime("%Y-%m-%d %H:%M:%S"),
+        ))
+    return filas
+
+
+def crear_visitas(rnd, usuario_id: int, primer_id: int, cantidad: int, clientes: list, firmas: list,
+                  hoy: date) -> list:
+    filas = []
+    for i in range(cantidad):
+        # Unos pocos clientes concentran muchas visitas
+        cliente = clientes[int(len(clientes) * rnd.random() ** 2)]
+        fecha = hoy + timedelta(days=rnd.randint(-730, 60))
+        tipo = rnd.choices(list(TRABAJOS), [45, 25, 15, 8, 7])[0]
+        if fecha < hoy:
+            estado = rnd.choices(["completada", "cancelada", "pendiente"], [85, 10, 5])[0]
+        elif fecha == hoy:
+            estado = rnd.choice(["pendiente", "confirmada", "en_curso", "completada"])
+        else:
+            estado = rnd.choices(["pendiente", "confirmada"], [60, 40])[0]
+        hora = "" if rnd.random() < 0.05 else f"{rnd.randint(8, 19):02d}:{rnd.choice(['00', '30'])}"
+        creada = datetime.combine(fecha - timedelta(days=rnd.randint(0, 20)), datetime.min.time()) \
+            + timedelta(seconds=rnd.randint(8 * 3600, 20 * 3600))
+        firmada = estado == "completada" and firmas and rnd.random() < 0.7
+        filas.append((
+            primer_id + i, usuario_id, cliente, rnd.choice(TRABAJOS[tipo]),
+            rnd.choice(DESCRIPCIONES) if rnd.random() < 0.6 else "", fecha.isoformat(), hora, tipo, estado,
+            "alta" if tipo == "urgencia" else rnd.choices(["baja", "normal", "alta"], [15, 75, 10])[0],
+            "Revisar en la próxima visita" if rnd.random() < 0.1 else "",
+            rnd.choice(firmas) if firmada else None,
+            f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)}" if firmada else None,
+            creada.strftime("%Y-%m-%d %H:%M:%S"),
+            f"{fecha.isoformat()} {hora or '12:00'}:00" if estado == "completada" else None,
+        ))
+    return filas
+
+
+def crear_presupuestos(rnd, usuario_id: int, primer_id: int, cantidad: int, clientes: list, lineas: int,
+                       hoy: date, retencion: int) -> tuple:
+    emisiones = sorted(hoy - timedelta(days=rnd.randint(0, 730)) for _ in range(cantidad))
+    presupuestos, filas_lineas, secuencias = [], [], {}
+    for i, emision in enumerate(emisiones):
+        pid = primer_id + i
+        secuencias[emision.year] = secuencias.get(emision.year, 0) + 1
+        conceptos = [rnd.choice(CONCEPTOS) for _ in range(rnd.randint(1, max(1, 2 * lineas - 1)))]
+        subtotal = 0.0
+        for orden, (concepto, precio) in enumerate(conceptos):
+            cantidad_linea = rnd.choice([1, 1, 1, 2, 3, 0.5, 1.5, 4])
+            subtotal += cantidad_linea * precio
+            filas_lineas.append((pid, concepto, "", cantidad_linea, precio, orden))
+        aplicar_iva = rnd.random() < 0.9
+        iva = rnd.choice([21, 21, 21, 10])
+        iva_amount = subtotal * iva / 100 if aplicar_iva else 0
+        # Los rechazados más antiguos ya los habría purgado la tarea programada
+        dias = (hoy - emision).days
+        estados, pesos = ["borrador", "enviado", "aceptado", "rechazado"], [10, 25, 50, 15 if dias < retencion else 0]
+        estado = rnd.choices(estados, pesos)[0] if dias > 30 else rnd.choices(estados, [30, 40, 20, pesos[3]])[0]
+        rechazo = (emision + timedelta(days=rnd.randint(0, dias))).isoformat() + " 10:00:00" if estado == "rechazado" else None
+        creado = datetime.combine(emision, datetime.min.time()) + timedelta(seconds=rnd.randint(8 * 3600, 20 * 3600))
+        presupuestos.append((
+            pid, usuario_id, clientes[int(len(clientes) * rnd.random() ** 2)],
+            f"PRES-{emision.year}-{secuencias[emision.year]:04d}", rnd.choice(sum(TRABAJOS.values(), [])),
+            rnd.choice(DESCRIPCIONES) if rnd.random() < 0.4 else "",
+            subtotal, iva, aplicar_iva, iva_amount, subtotal + iva_amount, estado, emision.isoformat(),
+            (emision + timedelta(days=30)).isoformat(), rechazo, "", creado.strftime("%Y-%m-%d %H:%M:%S"),
+        ))
+    return presupuestos, filas_lineas, secuencias
+
+
+def generar_usuario(almacen_sqlite, conn, rnd, tamano: tuple, args, password_hash: str, hoy: date) -> int:
+    n_clientes, n_visitas, n_presupuestos = tamano
+    usuario_id = siguiente_id(conn, "usuarios")
+    conn.execute(
+        """INSERT INTO usuarios (id, nombre, apellidos, email, telefono, empresa, password_hash)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (usuario_id, rnd.choice(NOMBRES), rnd.choice(APELLIDOS), f"tecnico{usuario_id}@{DOMINIO}",
+         f"6{rnd.randint(10000000, 99999999)}", f"Servicios Técnicos {rnd.choice(APELLIDOS)}", password_hash)
+    )
+
+    primer_cliente = siguiente_id(conn, "clientes")
+    conn.executemany(
+        """INSERT INTO clientes (id, usuario_id, nombre, apellidos, email, telefono, telefono_secundario,
+               direccion, ciudad, codigo_postal, provincia, tipo, nif_cif, notas, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        crear_clientes(rnd, usuario_id, primer_cliente, n_clientes, hoy)
+    )
+    clientes = list(range(primer_cliente, primer_cliente + n_clientes))
+    rnd.shuffle(clientes)
+
+    firmas = [almacen_sqlite.guardar_firma(conn, "image/png", png_firma(rnd)) for _ in range(args.firmas)]
+    conn.executemany(
+        """INSERT INTO visitas (id, usuario_id, cliente_id, titulo, descripcion, fecha, hora, tipo, estado, prioridad,
+               notas_internas, firma_hash, nombre_firmante, created_at, completed_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        crear_visitas(rnd, usuario_id, siguiente_id(conn, "visitas"), n_visitas, clientes, firmas, hoy)
+    )
+
+    presupuestos, lineas, secuencias = crear_presupuestos(
+        rnd, usuario_id, siguiente_id(conn, "presupuestos"), n_presupuestos, clientes, args.lineas, hoy,
+        almacen_sqlite.REJECTED_RETENTION_DAYS
+    )
+    conn.executemany(
+        """INSERT INTO presupuestos (id, usuario_id, cliente_id, numero, titulo, descripcion, subtotal,
+               iva_porcentaje, aplicar_iva, iva_amount, total, estado, fecha_emision, fecha_validez,
+               fecha_rechazo, notas, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        presupuestos
+    )
+    conn.executemany(almacen_sqlite.SQL_INSERTAR_LINEA, lineas)
+    # La numeración sigue donde la dejan los datos generados
+    conn.executemany(
+        "INSERT INTO secuencias_presupuesto (usuario_id, anio, ultimo) VALUES (?, ?, ?)",
+        [(usuario_id, anio, ultimo) for anio, ultimo in secuencias.items()]
+    )
+    conn.commit()
+    return usuario_id
+
+
+def main_generar():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("destino", help="fichero SQLite a crear")
+    parser.add_argument("--usuarios", type=int, default=10)
+    parser.add_argument("--clientes", type=int, default=5000, help="por usuario")
+    parser.add_argument("--visitas", type=int, default=50000, help="por usuario")
+    parser.add_argument("--presupuestos", type=int, default=20000, help="por usuario")
+    parser.add_argument("--lineas", type=int, default=4, help="líneas medias por presupuesto")
+    parser.add_argument("--firmas", type=int, default=20, help="firmas distintas por usuario")
+    parser.add_argument("--perfil", choices=["uniforme", "realista"], default="uniforme",
+                        help="realista: el k-ésimo usuario tiene 1/k de los tamaños indicados")
+    parser.add_argument("--fecha", type=date.fromisoformat, default=date.today(),
+                        help="fecha de referencia (AAAA-MM-DD) para reproducir una BD exacta")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--anadir", action="store_true", help="añadir usuarios a una BD existente")
+    args = parser.parse_args()
+
+    if os.path.exists(args.destino) and not args.anadir:
+        parser.error(f"{args.destino} ya existe (bórralo o usa --anadir)")
+    # main.py crea el esquema al importarse; sin tareas ni instrumentación
+    os.environ["DATABASE_PATH"] = os.path.abspath(args.destino)
+    os.environ["SCHEDULER_ENABLED"] = "0"
+    os.environ["METRICS_ENABLED"] = "0"
+    sys.path.insert(0, BACKEND)
+    import main
+    import almacen_sqlite
+
+    password_hash = main.hash_password(CONTRASENA)
+    inicio = time.perf_counter()
+    with main.get_db() as conn:
+        for numero, tamano in enumerate(tamanos(args)):
+            rnd = random.Random(f"{args.semilla}-{numero}")
+            t = time.perf_counter()
+            usuario_id = generar_usuario(almacen_sqlite, conn, rnd, tamano, args, password_hash, args.fecha)
+            print(f"usuario {usuario_id}: {tamano[0]} clientes, {tamano[1]} visitas, {tamano[2]} presupuestos "
+                  f"({time.perf_counter() - t:.1f} s)")
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"{args.destino}: {os.path.getsize(args.destino) / 2**20:.0f} MB en {time.perf_counter() - inicio:.0f} s")
+
+
+if __name__ == "__main__":
+    main_generar()
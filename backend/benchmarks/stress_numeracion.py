@@ -0,0 +1,141 @@
+"""
+Prueba de estrés de la numeración de presupuestos: varios procesos (como los
+workers de uvicorn) con varios hilos cada uno crean presupuestos a la vez para
+los mismos usuarios, borrando algunos por el camino. Comprueba que, por
+usuario, los números emitidos son exactamente PRES-AAAA-0001..N: sin huecos,
+sin repetidos y sin altas fallidas.
+
+Uso (desde la carpeta backend):
+    python benchmarks/stress_numeracion.py --procesos 4 --hilos 8 --altas 50 --usuarios 3
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def importar_main():
+    sys.path.insert(0, BACKEND)
+    import main
+    return main
+
+
+def preparar(usuarios: int) -> list:
+    main = importar_main()
+    with main.get_db() as conn:
+        pares = []
+        for u in range(usuarios):
+            cur = conn.execute(
+                "INSERT INTO usuarios (nombre, email, password_hash) VALUES (?, ?, 'x')",
+                (f"Usuario {u}", f"stress{u}@example.com")
+            )
+            usuario_id = cur.lastrowid
+            cur = conn.execute(
+                "INSERT INTO clientes (usuario_id, nombre, telefono) VALUES (?, 'Cliente', '600000000')",
+                (usuario_id,)
+            )
+            pares.append((usuario_id, cur.lastrowid))
+        conn.commit()
+    return pares
+
+
+def trabajador(pares: list, hilos: int, altas: int, borrar_cada: int, cola):
+    main = importar_main()
+    creados, errores = [], []
+    lock = threading.Lock()
+
+    def hilo(n: int):
+        for i in range(altas):
+            usuario_id, cliente_id = pares[(n + i) % len(pares)]
+            datos = main.PresupuestoCreate(
+                cliente_id=cliente_id, titulo=f"Stress {os.getpid()}-{n}-{i}",
+                lineas=[main.LineaPresupuesto(concepto="Mano de obra", cantidad=1, precio_unitario=40)]
+            )
+            try:
+                respuesta = main.crear_presupuesto(datos, user_id=usuario_id)
+                if borrar_cada and i % borrar_cada == 0:
+                    main.eliminar_presupuesto(respuesta.id, user_id=usuario_id)
+                with lock:
+                    creados.append((usuario_id, respuesta.numero))
+            except Exception as e:
+                with lock:
+                    errores.append(f"{type(e).__name__}: {getattr(e, 'detail', e)}")
+
+    threads = [threading.Thread(target=hilo, args=(n,)) for n in range(hilos)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    main.almacen.close()
+    cola.put((creados, errores))
+
+
+def verificar(creados: list, errores: list) -> bool:
+    ok = not errores
+    year = datetime.now().year
+    por_usuario = defaultdict(list)
+    for usuario_id, numero in creados:
+        por_usuario[usuario_id].append(numero)
+
+    for usuario_id, numeros in sorted(por_usuario.items()):
+        repetidos = [n for n, veces in Counter(numeros).items() if veces > 1]
+        esperados = {f"PRES-{year}-{i:04d}" for i in range(1, len(numeros) + 1)}
+        huecos = sorted(esperados - set(numeros))
+        print(f"usuario {usuario_id}: {len(numeros)} números, {len(repetidos)} repetidos, {len(huecos)} huecos")
+        ok = ok and not repetidos and not huecos
+
+    for error in errores[:10]:
+        print("error:", error)
+    return ok
+
+
+def main_stress():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--procesos", type=int, default=4)
+    parser.add_argument("--hilos", type=int, default=8)
+    parser.add_argument("--altas", type=int, default=50, help="presupuestos por hilo")
+    parser.add_argument("--usuarios", type=int, default=3)
+    parser.add_argument("--borrar-cada", type=int, default=5, help="borra 1 de cada N presupuestos creados (0 = ninguno)")
+    args = parser.parse_args()
+
+    # main.py inicializa su propia BD al importarse: apuntarla a un temporal
+    # (los procesos hijos heredan el entorno)
+    os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="tecnigestion-stress-"), "app.db")
+    os.environ["RESPONSE_CACHE"] = "none"
+    pares = preparar(args.usuarios)
+
+    ctx = multiprocessing.get_context("spawn")
+    cola = ctx.Queue()
+    inicio = time.perf_counter()
+    procesos = [
+        ctx.Process(target=trabajador, args=(pares, args.hilos, args.altas, args.borrar_cada, cola))
+        for _ in range(args.procesos)
+    ]
+    for p in procesos:
+        p.start()
+    creados, errores = [], []
+    for _ in procesos:
+        c, e = cola.get()
+        creados += c
+        errores += e
+    for p in procesos:
+        p.join()
+    duracion = time.perf_counter() - inicio
+
+    total = args.procesos * args.hilos * args.altas
+    print(f"{len(creados)}/{total} altas en {duracion:.2f}s ({len(creados) / duracion:.0f}/s), {len(errores)} errores")
+    ok = verificar(creados, errores)
+    print("OK" if ok else "FALLO")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main_stress()
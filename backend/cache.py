@@ -0,0 +1,145 @@
+"""
+Caché de respuestas por usuario.
+"""
+
+from typing import Optional
+import threading
+import time
+import importlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from config import RESPONSE_CACHE, RESPONSE_CACHE_MAX_ENTRIES
+
+# ============ CACHÉ DE RESPUESTAS ============
+
+class CacheBackend(ABC):
+    """Interfaz de almacenamiento para la caché de respuestas.
+
+    Las claves empiezan por "<usuario_id>:" y los valores son tuplas
+    (body, headers). Un backend compartido (p. ej. Redis) para despliegues
+    con varios workers solo necesita implementar estos métodos.
+    """
+
+    @abstractmethod
+    def get(self, key: str):
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value, ttl: float, generacion: Optional[int] = None):
+        # Con `generacion`, no guarda nada si el usuario se ha invalidado
+        # después de leerla: el valor puede ser de antes de la escritura
+        ...
+
+    @abstractmethod
+    def generacion(self, user_id: int) -> int:
+        # Contador de invalidaciones del usuario
+        ...
+
+    @abstractmethod
+    def invalidate_user(self, user_id: int):
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+class NullCacheBackend(CacheBackend):
+    def get(self, key: str):
+        return None
+
+    def set(self, key: str, value, ttl: float, generacion: Optional[int] = None):
+        pass
+
+    def generacion(self, user_id: int) -> int:
+        return 0
+
+    def invalidate_user(self, user_id: int):
+        pass
+
+class MemoryCacheBackend(CacheBackend):
+    """LRU con caducidad en memoria del proceso."""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._por_usuario = {}
+        self._generaciones = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def _usuario(self, key: str) -> str:
+        return key.split(":", 1)[0]
+
+    def _quitar(self, key: str):
+        self._data.pop(key, None)
+        claves = self._por_usuario.get(self._usuario(key))
+        if claves is not None:
+            claves.discard(key)
+            if not claves:
+                del self._por_usuario[self._usuario(key)]
+
+    def get(self, key: str):
+        with self._lock:
+            entrada = self._data.get(key)
+            if entrada is None:
+                self._misses += 1
+                return None
+            expira, value = entrada
+            if expira < time.monotonic():
+                self._quitar(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key: str, value, ttl: float, generacion: Optional[int] = None):
+        with self._lock:
+            if generacion is not None and self._generaciones.get(self._usuario(key), 0) != generacion:
+                return
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            self._por_usuario.setdefault(self._usuario(key), set()).add(key)
+            while len(self._data) > self.max_entries:
+                self._quitar(next(iter(self._data)))
+                self._evictions += 1
+
+    def generacion(self, user_id: int) -> int:
+        with self._lock:
+            return self._generaciones.get(str(user_id), 0)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for key in list(self._por_usuario.get(str(user_id), ())):
+                self._quitar(key)
+            self._generaciones[str(user_id)] = self._generaciones.get(str(user_id), 0) + 1
+            self._invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "invalidations": self._invalidations,
+            }
+
+CACHE_BACKENDS = {"memory": MemoryCacheBackend, "none": NullCacheBackend}
+
+def crear_cache_backend(nombre: str) -> CacheBackend:
+    if nombre in CACHE_BACKENDS:
+        return CACHE_BACKENDS[nombre]()
+    modulo, _, clase = nombre.partition(":")
+    return getattr(importlib.import_module(modulo), clase)()
+
+response_cache = crear_cache_backend(RESPONSE_CACHE)
+
+def invalidar_cache(user_id: int):
+    response_cache.invalidate_user(user_id)
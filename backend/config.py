@@ -0,0 +1,114 @@
+"""
+Configuración de TecniGestión: variables de entorno y logger.
+"""
+
+import os
+import logging
+
+# ============ CONFIGURACIÓN ============
+logger = logging.getLogger("tecnigestion")
+
+# Seguridad
+SECRET_KEY = os.getenv("SECRET_KEY", "tecnigestion-secret-key-cambiar-en-produccion")
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+# Tokens ya verificados en memoria (0 = desactivada) y cada cuánto se leen
+# las revocaciones hechas por otros workers
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "5"))
+
+# Hashing de contraseñas: coste de bcrypt y pool de workers dedicado
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+AUTH_EXECUTOR = os.getenv("AUTH_EXECUTOR", "process")  # process | thread | inline
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", str(min(4, os.cpu_count() or 1))))
+AUTH_MAX_PENDING = int(os.getenv("AUTH_MAX_PENDING", "32"))
+
+# Base de datos: "sqlite" (fichero en DATABASE_PATH, una sola réplica),
+# "postgres" (DATABASE_URL, varias réplicas) o "modulo:Clase" para un almacén propio
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://tecnigestion@localhost/tecnigestion")
+DATABASE_PATH = os.getenv("DATABASE_PATH", "tecnigestion.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "128"))
+
+# Modo de acceso a datos: "sync" (handlers en el threadpool de Starlette) o
+# "async" (handlers en el event loop, SQLite en hilos dedicados)
+DB_MODE = os.getenv("DB_MODE", "sync")
+DB_ASYNC_MAX_PENDING = int(os.getenv("DB_ASYNC_MAX_PENDING", "256"))
+
+# Reparto de los datos de cada usuario en su propio fichero: "no" (todo en
+# DATABASE_PATH), "usuario" (un fichero por usuario) o "fijo" (DB_SHARD_COUNT
+# ficheros). DATABASE_PATH sigue guardando usuarios, sesiones y el directorio
+# que asigna cada usuario a su shard; los no asignados siguen en ella
+DB_SHARDING = os.getenv("DB_SHARDING", "no")
+DB_SHARD_COUNT = int(os.getenv("DB_SHARD_COUNT", "8"))
+DB_SHARD_DIR = os.getenv("DB_SHARD_DIR", os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), "shards"))
+DB_SHARD_OPEN_MAX = int(os.getenv("DB_SHARD_OPEN_MAX", "64"))  # shards con conexiones abiertas a la vez
+DB_SHARD_POOL_SIZE = int(os.getenv("DB_SHARD_POOL_SIZE", "4"))
+DB_SHARD_CACHE_SECONDS = float(os.getenv("DB_SHARD_CACHE_SECONDS", "5"))  # vigencia del directorio leído
+
+# Paginación de listados
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "200"))
+# Días máximos que abarca una consulta de la agenda (un mes con semanas completas)
+AGENDA_MAX_DAYS = int(os.getenv("AGENDA_MAX_DAYS", "62"))
+
+# Caché de respuestas: "memory", "none" o "modulo:Clase" para un backend propio.
+# La de memoria es por proceso: con varias réplicas sobre PostgreSQL, una
+# réplica no se enteraría de lo que invalida otra, así que ahí va apagada
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "memory" if DB_BACKEND == "sqlite" else "none")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+# Depuración y pruebas: los listados convertidos sin Pydantic (filas_respuesta)
+# se comparan fila a fila con lo que daría el modelo. Cuesta lo que se ahorra
+RESPONSE_VALIDATION = os.getenv("RESPONSE_VALIDATION", "0") == "1"
+
+# Importación y exportación masiva
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "1000"))
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "500"))
+
+# Firmas de visitas: tamaño máximo de la imagen decodificada
+FIRMA_MAX_BYTES = int(os.getenv("FIRMA_MAX_BYTES", str(512 * 1024)))
+FIRMA_CHUNK_SIZE = 64 * 1024
+
+# PDF de presupuestos y partes de visita: pool de generación (como el de
+# contraseñas) y caché en disco
+PDF_EXECUTOR = os.getenv("PDF_EXECUTOR", "process")  # process | thread | inline
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(2, os.cpu_count() or 1))))
+PDF_MAX_PENDING = int(os.getenv("PDF_MAX_PENDING", "16"))
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), "pdf_cache"))
+PDF_CACHE_DAYS = int(os.getenv("PDF_CACHE_DAYS", "30"))
+
+# Sincronización offline: cambios por página, operaciones por subida y días que
+# se guardan las marcas de borrado y las peticiones ya aplicadas
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "500"))
+SYNC_PAGE_SIZE_MAX = int(os.getenv("SYNC_PAGE_SIZE_MAX", "2000"))
+SYNC_MAX_OPERATIONS = int(os.getenv("SYNC_MAX_OPERATIONS", "200"))
+SYNC_TOMBSTONE_DAYS = int(os.getenv("SYNC_TOMBSTONE_DAYS", "90"))
+SYNC_REQUEST_DAYS = int(os.getenv("SYNC_REQUEST_DAYS", "30"))
+
+# Tareas programadas (purga de presupuestos rechazados y mantenimiento de
+# SQLite). Con SCHEDULER_DRY_RUN=1 informan de lo que harían sin hacerlo
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+SCHEDULER_DRY_RUN = os.getenv("SCHEDULER_DRY_RUN", "0") == "1"
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "30"))
+SCHEDULER_LOCK_SECONDS = float(os.getenv("SCHEDULER_LOCK_SECONDS", "900"))
+REJECTED_RETENTION_DAYS = int(os.getenv("REJECTED_RETENTION_DAYS", "30"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "200"))
+VACUUM_MAX_PAGES = int(os.getenv("VACUUM_MAX_PAGES", "2000"))
+
+# Métricas Prometheus en /metrics (por proceso) e instrumentación de las
+# consultas SQL. Con METRICS_TOKEN, /metrics exige "Authorization: Bearer <token>"
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_MAX_STATEMENTS = int(os.getenv("METRICS_MAX_STATEMENTS", "500"))
+# Avisos en el log: consultas lentas (con su EXPLAIN QUERY PLAN) y peticiones
+# con demasiadas consultas, típico de un N+1. 0 desactiva cada aviso
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+QUERIES_PER_REQUEST_WARN = int(os.getenv("QUERIES_PER_REQUEST_WARN", "50"))
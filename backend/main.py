@@ -3,19 +3,71 @@ TecniGestión - Backend API
 API REST completa para gestión de técnicos profesionales
 """
 
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, UploadFile, File, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
-from datetime import datetime, timedelta
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
+from pydantic import ValidationError
+from typing import Optional, List, Annotated
+from datetime import date, datetime, timedelta
 from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import contextvars
 import jwt
-import sqlite3
+import json
+import csv
+import io
+import hashlib
 import os
-from contextlib import contextmanager
+import re
+import secrets
+import shutil
+import socket
+import threading
+import time
+import unicodedata
+import zlib
+import functools
+import importlib
+import inspect
+from contextlib import asynccontextmanager
+
+from config import (
+    logger, SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, TOKEN_CACHE_MAX_ENTRIES,
+    REVOCATION_SYNC_SECONDS, BCRYPT_ROUNDS, AUTH_EXECUTOR, AUTH_WORKERS, AUTH_MAX_PENDING, DB_BACKEND,
+    DATABASE_PATH, DB_POOL_SIZE, DB_MODE, DB_ASYNC_MAX_PENDING, DB_SHARDING, DB_SHARD_DIR, DB_SHARD_CACHE_SECONDS,
+    PAGE_SIZE_MAX, AGENDA_MAX_DAYS, RESPONSE_CACHE_TTL, IMPORT_CHUNK_SIZE, IMPORT_MAX_ERRORS, FIRMA_MAX_BYTES,
+    PDF_EXECUTOR, PDF_WORKERS, PDF_MAX_PENDING, PDF_CACHE_DIR, SYNC_PAGE_SIZE, SYNC_PAGE_SIZE_MAX,
+    SYNC_MAX_OPERATIONS, SCHEDULER_ENABLED, SCHEDULER_DRY_RUN, SCHEDULER_TICK_SECONDS, METRICS_ENABLED,
+    METRICS_TOKEN
+)
+import metricas
+from metricas import (
+    etiquetas_prometheus, numero_prometheus, http_peticiones, http_latencia, http_entrada, http_salida,
+    http_consultas, sql_latencia, sql_lentas, estadisticas_sql, MiddlewareMetricas, exportar_stats
+)
+from modelos import (
+    UserRegister, UserLogin, UserResponse, TokenResponse, RefreshRequest, ClienteCreate, ClienteResponse,
+    VisitaCreate, VisitaResponse, VisitaAgenda, DiaAgenda, AgendaResponse, MetricasPresupuestos,
+    AnaliticaPresupuestosResponse, MetricasVisitas, AnaliticaVisitasResponse, CompletarVisita, LineaPresupuesto,
+    PresupuestoCreate, PresupuestoUpdate, PresupuestoPatch, PresupuestoResponse, ResultadoBusqueda,
+    BusquedaResponse, SyncResponse, OperacionSync, SubidaSync, ResultadoOperacionSync, SubidaSyncResponse,
+    EstadoSync, serializar_json, RespuestaJSON
+)
+from cache import NullCacheBackend, MemoryCacheBackend, response_cache, invalidar_cache
+from almacen import codificar_cursor, decodificar_cursor, Almacen, COLUMNAS_EXPORTACION
+from almacen_sqlite import (
+    PoolAgotado, usuario_peticion, get_db, reconstruir_resumen, verificar_resumen, ROLLUPS, reconstruir_analitica,
+    verificar_analitica, decodificar_firma, descomprimir_trozos, TABLAS_SYNC, shards, MODELOS_RESPUESTA,
+    vacuum_completo
+)
+
+# ============ APLICACIÓN ============
 
-# ============ CONFIGURACIÓN ============
 app = FastAPI(
     title="TecniGestión API",
     description="API para gestión de clientes, visitas y presupuestos",
@@ -29,269 +81,121 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count", "X-Next-Cursor", "ETag"],
 )
 
-# Seguridad
-SECRET_KEY = os.getenv("SECRET_KEY", "tecnigestion-secret-key-cambiar-en-produccion")
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_DAYS = 30
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# min_rounds = rounds: los hashes con menor coste se marcan para rehash en el login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
 security = HTTPBearer()
 
-# Base de datos
-DATABASE_PATH = os.getenv("DATABASE_PATH", "tecnigestion.db")
+if METRICS_ENABLED:
+    app.add_middleware(MiddlewareMetricas)
 
-# ============ BASE DE DATOS ============
-@contextmanager
-def get_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
-
-def init_db():
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        # Tabla usuarios
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS usuarios (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT NOT NULL,
-                apellidos TEXT,
-                email TEXT UNIQUE NOT NULL,
-                telefono TEXT,
-                empresa TEXT,
-                password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Tabla clientes
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS clientes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_id INTEGER NOT NULL,
-                nombre TEXT NOT NULL,
-                apellidos TEXT,
-                email TEXT,
-                telefono TEXT NOT NULL,
-                telefono_secundario TEXT,
-                direccion TEXT,
-                ciudad TEXT,
-                codigo_postal TEXT,
-                provincia TEXT,
-                tipo TEXT DEFAULT 'particular',
-                nif_cif TEXT,
-                notas TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
-            )
-        """)
-        
-        # Tabla visitas
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS visitas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_id INTEGER NOT NULL,
-                cliente_id INTEGER NOT NULL,
-                titulo TEXT NOT NULL,
-                descripcion TEXT,
-                fecha DATE NOT NULL,
-                hora TIME,
-                tipo TEXT DEFAULT 'reparacion',
-                estado TEXT DEFAULT 'pendiente',
-                prioridad TEXT DEFAULT 'normal',
-                notas_internas TEXT,
-                firma_cliente TEXT,
-                nombre_firmante TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                completed_at TIMESTAMP,
-                FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
-                FOREIGN KEY (cliente_id) REFERENCES clientes(id)
-            )
-        """)
-        
-        # Tabla presupuestos
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS presupuestos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_id INTEGER NOT NULL,
-                cliente_id INTEGER NOT NULL,
-                numero TEXT UNIQUE NOT NULL,
-                titulo TEXT NOT NULL,
-                descripcion TEXT,
-                subtotal REAL DEFAULT 0,
-                iva_porcentaje REAL DEFAULT 21,
-                aplicar_iva BOOLEAN DEFAULT 1,
-                iva_amount REAL DEFAULT 0,
-                total REAL DEFAULT 0,
-                estado TEXT DEFAULT 'borrador',
-                fecha_emision DATE,
-                fecha_validez DATE,
-                fecha_rechazo TIMESTAMP,
-                notas TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
-                FOREIGN KEY (cliente_id) REFERENCES clientes(id)
-            )
-        """)
-        
-        # Tabla líneas de presupuesto
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS lineas_presupuesto (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                presupuesto_id INTEGER NOT NULL,
-                concepto TEXT NOT NULL,
-                descripcion TEXT,
-                cantidad REAL DEFAULT 1,
-                precio_unitario REAL DEFAULT 0,
-                total REAL DEFAULT 0,
-                orden INTEGER DEFAULT 0,
-                FOREIGN KEY (presupuesto_id) REFERENCES presupuestos(id) ON DELETE CASCADE
-            )
-        """)
-        
-        conn.commit()
-
-# Inicializar BD al arrancar
-init_db()
-
-# ============ MODELOS PYDANTIC ============
-
-# Auth
-class UserRegister(BaseModel):
-    nombre: str
-    apellidos: Optional[str] = ""
-    email: EmailStr
-    telefono: Optional[str] = ""
-    empresa: Optional[str] = ""
-    password: str
-
-class UserLogin(BaseModel):
-    email: EmailStr
-    password: str
-
-class UserResponse(BaseModel):
-    id: int
-    nombre: str
-    apellidos: Optional[str]
-    email: str
-    telefono: Optional[str]
-    empresa: Optional[str]
-
-class TokenResponse(BaseModel):
-    access_token: str
-    token_type: str
-    user: UserResponse
-
-# Clientes
-class ClienteCreate(BaseModel):
-    nombre: str
-    apellidos: Optional[str] = ""
-    email: Optional[str] = ""
-    telefono: str
-    telefono_secundario: Optional[str] = ""
-    direccion: Optional[str] = ""
-    ciudad: Optional[str] = ""
-    codigo_postal: Optional[str] = ""
-    provincia: Optional[str] = ""
-    tipo: Optional[str] = "particular"
-    nif_cif: Optional[str] = ""
-    notas: Optional[str] = ""
-
-class ClienteResponse(BaseModel):
-    id: int
-    nombre: str
-    apellidos: Optional[str]
-    email: Optional[str]
-    telefono: str
-    telefono_secundario: Optional[str]
-    direccion: Optional[str]
-    ciudad: Optional[str]
-    codigo_postal: Optional[str]
-    provincia: Optional[str]
-    tipo: str
-    nif_cif: Optional[str]
-    notas: Optional[str]
-    created_at: Optional[str]
-
-# Visitas
-class VisitaCreate(BaseModel):
-    cliente_id: int
-    titulo: str
-    descripcion: Optional[str] = ""
-    fecha: str
-    hora: Optional[str] = ""
-    tipo: Optional[str] = "reparacion"
-    estado: Optional[str] = "pendiente"
-    prioridad: Optional[str] = "normal"
-    notas_internas: Optional[str] = ""
-
-class VisitaResponse(BaseModel):
-    id: int
-    cliente_id: int
-    cliente_nombre: Optional[str]
-    cliente_telefono: Optional[str]
-    cliente_direccion: Optional[str]
-    titulo: str
-    descripcion: Optional[str]
-    fecha: str
-    hora: Optional[str]
-    tipo: str
-    estado: str
-    prioridad: str
-    notas_internas: Optional[str]
-    firma_cliente: Optional[str]
-    nombre_firmante: Optional[str]
-    created_at: Optional[str]
-    completed_at: Optional[str]
-
-class CompletarVisita(BaseModel):
-    firma_cliente: Optional[str] = ""
-    nombre_firmante: Optional[str] = ""
-    notas_internas: Optional[str] = ""
-
-# Presupuestos
-class LineaPresupuesto(BaseModel):
-    concepto: str
-    descripcion: Optional[str] = ""
-    cantidad: float = 1
-    precio_unitario: float = 0
-
-class PresupuestoCreate(BaseModel):
-    cliente_id: int
-    titulo: str
-    descripcion: Optional[str] = ""
-    aplicar_iva: bool = True
-    iva_porcentaje: float = 21
-    fecha_validez: Optional[str] = ""
-    notas: Optional[str] = ""
-    lineas: List[LineaPresupuesto] = []
-
-class PresupuestoResponse(BaseModel):
-    id: int
-    cliente_id: int
-    cliente_nombre: Optional[str]
-    numero: str
-    titulo: str
-    descripcion: Optional[str]
-    subtotal: float
-    iva_porcentaje: float
-    aplicar_iva: bool
-    iva_amount: float
-    total: float
-    estado: str
-    fecha_emision: Optional[str]
-    fecha_validez: Optional[str]
-    fecha_rechazo: Optional[str]
-    dias_para_eliminar: Optional[int]
-    notas: Optional[str]
-    lineas: List[dict] = []
-    created_at: Optional[str]
+# ============ EJECUCIÓN DE CONSULTAS ============
+
+@app.exception_handler(PoolAgotado)
+async def pool_agotado(request: Request, exc: PoolAgotado):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Base de datos ocupada, inténtalo de nuevo"},
+        headers={"Retry-After": "1"}
+    )
+
+class DBExecutor:
+    """Hilos dedicados a SQLite para DB_MODE=async. Los endpoints se resuelven
+    en el event loop y encolan aquí su trabajo de base de datos, fuera del
+    threadpool de Starlette, con un límite de tareas en cola."""
+
+    def __init__(self, workers: int = DB_POOL_SIZE, max_pendientes: int = DB_ASYNC_MAX_PENDING):
+        # Tantos hilos como conexiones: ninguno espera al pool
+        self.workers = max(1, workers)
+        self.max_pendientes = max_pendientes
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pendientes = 0
+        self._completadas = 0
+        self._rechazadas = 0
+        self._espera = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db")
+        return self._executor
+
+    async def ejecutar(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._pendientes >= self.max_pendientes:
+                self._rechazadas += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Servidor ocupado, inténtalo de nuevo en unos segundos",
+                    headers={"Retry-After": "1"}
+                )
+            self._pendientes += 1
+        encolada = time.monotonic()
+
+        def tarea():
+            with self._lock:
+                self._espera += time.monotonic() - encolada
+            return fn(*args, **kwargs)
+
+        try:
+            contexto = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), contexto.run, tarea)
+        finally:
+            with self._lock:
+                self._pendientes -= 1
+                self._completadas += 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pendientes": self._pendientes,
+                "max_pendientes": self.max_pendientes,
+                "completadas": self._completadas,
+                "rechazadas": self._rechazadas,
+                "espera_media_ms": round(self._espera * 1000 / max(1, self._completadas), 3),
+            }
+
+db_executor = DBExecutor()
+
+async def ejecutar_db(fn, *args, **kwargs):
+    # Trabajo de BD desde código async, en los hilos que correspondan al modo
+    if DB_MODE == "async":
+        return await db_executor.ejecutar(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, *args, **kwargs)
+
+def en_db_executor(endpoint):
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        return await db_executor.ejecutar(endpoint, *args, **kwargs)
+    return wrapper
+
+class RutaDB(APIRoute):
+    """Con DB_MODE=async registra cada endpoint síncrono como un `async def`
+    que delega su cuerpo en db_executor. Los nombres del módulo siguen siendo
+    las funciones síncronas, así que las llamadas internas (obtener_visita
+    desde crear_visita...) no cambian."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if DB_MODE == "async" and not asyncio.iscoroutinefunction(endpoint):
+            endpoint = en_db_executor(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+app.router.route_class = RutaDB
+
+app.router.default_response_class = RespuestaJSON
 
 # ============ FUNCIONES AUXILIARES ============
 
@@ -301,534 +205,1786 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-def create_token(user_id: int) -> str:
-    expire = datetime.utcnow() + timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
-    payload = {"user_id": user_id, "exp": expire}
-    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple:
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+class WorkerPool:
+    """Ejecuta trabajo de CPU (hash de contraseñas, PDF) fuera del event loop y
+    del threadpool de la API, con un límite de peticiones en cola."""
+
+    def __init__(self, nombre: str, modo: str, workers: int, max_pendientes: int):
+        self.nombre = nombre
+        self.modo = modo
+        self.workers = max(1, workers)
+        self.max_pendientes = max_pendientes
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pendientes = 0
+        self._completadas = 0
+        self._rechazadas = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.modo == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.nombre)
+        return self._executor
+
+    async def ejecutar(self, fn, *args):
+        with self._lock:
+            if self._pendientes >= self.max_pendientes:
+                self._rechazadas += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Servidor ocupado, inténtalo de nuevo en unos segundos",
+                    headers={"Retry-After": "1"}
+                )
+            self._pendientes += 1
+        try:
+            if self.modo == "inline":
+                return await run_in_threadpool(fn, *args)
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            with self._lock:
+                self._pendientes -= 1
+                self._completadas += 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "modo": self.modo,
+                "workers": self.workers,
+                "pendientes": self._pendientes,
+                "max_pendientes": self.max_pendientes,
+                "completadas": self._completadas,
+                "rechazadas": self._rechazadas,
+            }
+
+auth_pool = WorkerPool("auth", AUTH_EXECUTOR, AUTH_WORKERS, AUTH_MAX_PENDING)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> int:
+async def hash_password_async(password: str) -> str:
+    return await auth_pool.ejecutar(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> tuple:
+    # Devuelve (válida, nuevo_hash); nuevo_hash no es None si hay que rehashear
+    return await auth_pool.ejecutar(verify_and_update_password, plain_password, hashed_password)
+
+def respuesta_pagina(response: Response, filas: List[dict], total: int, siguiente: Optional[str]) -> Response:
+    # El total va en X-Total-Count y el cursor siguiente en X-Next-Cursor
+    response.headers["X-Total-Count"] = str(total)
+    if siguiente:
+        response.headers["X-Next-Cursor"] = siguiente
+    return RespuestaJSON(filas)
+
+# ============ ALMACÉN DE DATOS ============
+
+# Como un almacén propio ("modulo:Clase"): el de PostgreSQL (y asyncpg) solo
+# se importa con DB_BACKEND=postgres
+ALMACENES = {"sqlite": "almacen_sqlite:AlmacenSQLite", "postgres": "almacen_postgres:AlmacenPostgres"}
+
+def crear_almacen(nombre: str) -> Almacen:
+    modulo, _, clase = ALMACENES.get(nombre, nombre).partition(":")
+    return getattr(importlib.import_module(modulo), clase)()
+
+almacen = crear_almacen(DB_BACKEND)
+
+# ============ CACHÉ DE RESPUESTAS ============
+
+def cacheado(endpoint):
+    # Caché de lectura para endpoints GET por (usuario, endpoint, parámetros).
+    # Guarda el JSON ya serializado y las cabeceras propias (X-Total-Count...),
+    # de modo que un acierto no toca la base de datos ni Pydantic. Solo en
+    # rutas: el código que necesita el registro llama a la función sin caché
+    # (leer_visita...), no al endpoint. Las escrituras llaman a
+    # invalidar_cache(user_id) tras el commit. La generación del usuario se
+    # lee antes de ejecutar el endpoint: si una escritura lo invalida mientras
+    # tanto, el resultado (quizá de antes de la escritura) no se guarda.
+    firma = inspect.signature(endpoint)
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        argumentos = firma.bind(*args, **kwargs)
+        argumentos.apply_defaults()
+        valores = dict(argumentos.arguments)
+        user_id = valores.pop("user_id")
+        response = valores.pop("response", None)
+        key = f"{user_id}:{endpoint.__name__}:{json.dumps(valores, sort_keys=True, default=str)}"
+
+        cached = response_cache.get(key)
+        if cached is None:
+            generacion = response_cache.generacion(user_id)
+            resultado = endpoint(*args, **kwargs)
+            if isinstance(resultado, Response):
+                body = resultado.body
+                headers = {k: v for k, v in resultado.headers.items() if k.lower().startswith("x-")}
+            else:
+                body = serializar_json(resultado)
+                headers = {}
+            if response is not None:
+                headers.update({k: v for k, v in response.headers.items() if k.lower().startswith("x-")})
+            cached = (body, headers)
+            response_cache.set(key, cached, RESPONSE_CACHE_TTL, generacion)
+
+        body, headers = cached
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    return wrapper
+
+# ============ PETICIONES CONDICIONALES (ETag) ============
+
+def calcular_etag(user_id: int, tablas: tuple) -> str:
+    # La versión de cada tabla la incrementan triggers en la misma transacción
+    # que la escritura. El día entra en la firma porque hay campos calculados
+    # con la fecha actual (dias_para_eliminar, visitas de hoy).
+    versiones = almacen.versiones(user_id, tablas)
+    firma = "|".join(
+        [str(user_id), app.version, datetime.now().strftime("%Y-%m-%d")]
+        + [f"{tabla}={versiones.get(tabla, 0)}" for tabla in tablas]
+    )
+    return 'W/"' + hashlib.blake2b(firma.encode(), digest_size=12).hexdigest() + '"'
+
+def etag_coincide(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # Comparación débil: se ignora el prefijo W/
+    candidatos = {c.strip().removeprefix("W/") for c in if_none_match.split(",")}
+    return "*" in candidatos or etag.removeprefix("W/") in candidatos
+
+def condicional(*tablas):
+    # Añade ETag a un GET que depende de `tablas` y responde 304 si el cliente
+    # ya tiene esa versión, sin ejecutar el endpoint. Las llamadas internas
+    # (sin request) pasan directamente al endpoint.
+    def decorador(endpoint):
+        firma = inspect.signature(endpoint)
+
+        @functools.wraps(endpoint)
+        def wrapper(*args, request: Optional[Request] = None, **kwargs):
+            if request is None:
+                return endpoint(*args, **kwargs)
+
+            user_id = firma.bind_partial(*args, **kwargs).arguments["user_id"]
+            # Las versiones se leen antes que los datos: el cuerpo es de esa
+            # versión o posterior, nunca anterior a su ETag
+            etag = calcular_etag(user_id, tablas)
+            cabeceras = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+            if etag_coincide(request.headers.get("if-none-match"), etag):
+                return Response(status_code=304, headers=cabeceras)
+
+            resultado = endpoint(*args, **kwargs)
+            if not isinstance(resultado, Response):
+                resultado = RespuestaJSON(resultado)
+            resultado.headers.update(cabeceras)
+            return resultado
+
+        wrapper.__signature__ = firma.replace(parameters=[
+            *firma.parameters.values(),
+            inspect.Parameter("request", inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+        ])
+        return wrapper
+
+    return decorador
+
+# ============ DOCUMENTOS PDF ============
+
+# Presupuestos y partes de visita en PDF, generados aquí mismo sin
+# dependencias: PDF 1.4 con las fuentes estándar Helvetica (sin incrustar, en
+# WinAnsi) y la firma como imagen. Se generan en pdf_pool y se guardan en
+# PDF_CACHE_DIR/<tabla>/<id>/v<versión>-<huella>.pdf: la versión del registro
+# y una huella de los datos impresos (cliente incluido) en el nombre hacen que
+# un cambio nunca sirva un PDF viejo, y al editar se borra la carpeta entera.
+
+PDF_PLANTILLA = 1  # subir al cambiar el diseño: invalida todo lo cacheado
+
+# Anchos de Helvetica y Helvetica-Bold (AFM, milésimas de em), caracteres 32-126
+_ANCHOS_HELVETICA = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+_ANCHOS_HELVETICA_BOLD = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]
+
+def ancho_texto(texto: str, tamano: float, negrita: bool = False) -> float:
+    # Las letras acentuadas miden como su letra base; el resto, como una cifra
+    anchos = _ANCHOS_HELVETICA_BOLD if negrita else _ANCHOS_HELVETICA
+    total = 0
+    for caracter in texto:
+        codigo = ord(unicodedata.normalize("NFD", caracter)[0])
+        total += anchos[codigo - 32] if 32 <= codigo < 127 else 556
+    return total * tamano / 1000
+
+def partir_texto(texto: Optional[str], ancho: float, tamano: float, negrita: bool = False) -> List[str]:
+    lineas = []
+    for parrafo in (texto or "").splitlines():
+        actual = ""
+        for palabra in parrafo.split():
+            candidata = f"{actual} {palabra}" if actual else palabra
+            if actual and ancho_texto(candidata, tamano, negrita) > ancho:
+                lineas.append(actual)
+                actual = palabra
+            else:
+                actual = candidata
+        lineas.append(actual)
+    return lineas
+
+def _desfiltrar_png(datos: bytes, ancho: int, alto: int, bpp: int) -> bytearray:
+    # Deshace el filtro de cada fila (PNG de 8 bits por canal). Las firmas son
+    # casi todo fondo: las filas a cero se resuelven sin recorrerlas
+    ancho_fila = ancho * bpp
+    salida = bytearray(ancho_fila * alto)
+    anterior = bytearray(ancho_fila)
+    pos = 0
+    for y in range(alto):
+        filtro = datos[pos]
+        fila = bytearray(datos[pos + 1:pos + 1 + ancho_fila])
+        pos += 1 + ancho_fila
+        vacia = not fila.strip(b"\0")
+        if filtro == 2:
+            if vacia:
+                fila = bytearray(anterior)
+            else:
+                fila = bytearray((a + b) & 0xFF for a, b in zip(fila, anterior))
+        elif filtro == 1 and not vacia:
+            for i in range(bpp, ancho_fila):
+                fila[i] = (fila[i] + fila[i - bpp]) & 0xFF
+        elif filtro == 3:
+            for i in range(ancho_fila):
+                izquierda = fila[i - bpp] if i >= bpp else 0
+                fila[i] = (fila[i] + ((izquierda + anterior[i]) >> 1)) & 0xFF
+        elif filtro == 4:
+            for i in range(ancho_fila):
+                a = fila[i - bpp] if i >= bpp else 0
+                b = anterior[i]
+                c = anterior[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                fila[i] = (fila[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xFF
+        salida[y * ancho_fila:(y + 1) * ancho_fila] = fila
+        anterior = fila
+    return salida
+
+def _imagen_png(contenido: bytes) -> Optional[dict]:
+    pos, idat, paleta, cabecera = 8, bytearray(), b"", None
+    while pos + 8 <= len(contenido):
+        longitud = int.from_bytes(contenido[pos:pos + 4], "big")
+        tipo, datos = contenido[pos + 4:pos + 8], contenido[pos + 8:pos + 8 + longitud]
+        if tipo == b"IHDR":
+            cabecera = datos
+        elif tipo == b"PLTE":
+            paleta = datos
+        elif tipo == b"IDAT":
+            idat += datos
+        elif tipo == b"IEND":
+            break
+        pos += 12 + longitud
+    if cabecera is None or len(cabecera) < 13:
+        return None
+    ancho, alto = int.from_bytes(cabecera[0:4], "big"), int.from_bytes(cabecera[4:8], "big")
+    bits, color, entrelazado = cabecera[8], cabecera[9], cabecera[12]
+    canales = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color)
+    if canales is None or entrelazado or (bits != 8 and color != 3):
+        return None
+    imagen = {"ancho": ancho, "alto": alto, "mascara": None}
+
+    if color in (0, 2, 3):
+        # Sin alfa: los datos comprimidos del PNG valen tal cual con el predictor PNG
+        espacio = {0: "/DeviceGray", 2: "/DeviceRGB"}.get(color) or \
+            f"[/Indexed /DeviceRGB {len(paleta) // 3 - 1} <{paleta.hex()}>]"
+        imagen["diccionario"] = (
+            f"/ColorSpace {espacio} /BitsPerComponent {bits} /Filter /FlateDecode "
+            f"/DecodeParms << /Predictor 15 /Colors {canales} /BitsPerComponent {bits} /Columns {ancho} >>"
+        )
+        imagen["datos"] = bytes(idat)
+        return imagen
+
+    # Con alfa (lo normal en una firma dibujada en un canvas): el PDF quiere
+    # el color y la transparencia (SMask) por separado
+    pixeles = _desfiltrar_png(zlib.decompress(bytes(idat)), ancho, alto, canales)
+    if color == 4:
+        colores, alfa, espacio = pixeles[0::2], pixeles[1::2], "/DeviceGray"
+    else:
+        colores = bytearray(ancho * alto * 3)
+        for canal in range(3):
+            colores[canal::3] = pixeles[canal::4]
+        alfa, espacio = pixeles[3::4], "/DeviceRGB"
+    imagen["diccionario"] = f"/ColorSpace {espacio} /BitsPerComponent 8 /Filter /FlateDecode"
+    imagen["datos"] = zlib.compress(bytes(colores))
+    imagen["mascara"] = zlib.compress(bytes(alfa))
+    return imagen
+
+def _imagen_jpeg(contenido: bytes) -> Optional[dict]:
+    # El JPEG se incrusta sin tocar; solo hace falta leer el tamaño del SOF
+    pos = 2
+    while pos + 10 <= len(contenido) and contenido[pos] == 0xFF:
+        marcador = contenido[pos + 1]
+        if 0xC0 <= marcador <= 0xCF and marcador not in (0xC4, 0xC8, 0xCC):
+            espacio = {1: "/DeviceGray", 3: "/DeviceRGB", 4: "/DeviceCMYK"}.get(contenido[pos + 9])
+            if espacio is None:
+                return None
+            return {
+                "ancho": int.from_bytes(contenido[pos + 7:pos + 9], "big"),
+                "alto": int.from_bytes(contenido[pos + 5:pos + 7], "big"),
+                "diccionario": f"/ColorSpace {espacio} /BitsPerComponent 8 /Filter /DCTDecode",
+                "datos": contenido,
+                "mascara": None,
+            }
+        pos += 2 + int.from_bytes(contenido[pos + 2:pos + 4], "big")
+    return None
+
+def imagen_pdf(contenido: bytes) -> Optional[dict]:
+    # Por la cabecera del fichero, no por el mime declarado; None si no se soporta
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Token inválido")
-        return user_id
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expirado")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Token inválido")
-
-def generar_numero_presupuesto(usuario_id: int) -> str:
-    with get_db() as conn:
-        cursor = conn.cursor()
-        year = datetime.now().year
-        cursor.execute(
-            "SELECT COUNT(*) FROM presupuestos WHERE usuario_id = ? AND numero LIKE ?",
-            (usuario_id, f"PRES-{year}-%")
+        if contenido.startswith(b"\x89PNG\r\n\x1a\n"):
+            return _imagen_png(contenido)
+        if contenido.startswith(b"\xff\xd8"):
+            return _imagen_jpeg(contenido)
+    except (zlib.error, IndexError, ValueError):
+        pass
+    return None
+
+PDF_GRIS = (0.45, 0.45, 0.45)
+PDF_AZUL = (0.12, 0.36, 0.75)
+
+class DocumentoPDF:
+    """PDF mínimo de páginas A4: texto en Helvetica, líneas, rectángulos e
+    imágenes. Las coordenadas son puntos desde la esquina superior izquierda
+    y `y` es la posición de escritura, que pasa de página al llenarse."""
+
+    ANCHO, ALTO, MARGEN = 595.28, 841.89, 50
+
+    def __init__(self):
+        self.paginas: List[bytearray] = []
+        self.imagenes: List[dict] = []
+        self.nueva_pagina()
+
+    def nueva_pagina(self):
+        self.paginas.append(bytearray())
+        self.y = self.MARGEN
+
+    def reservar(self, alto: float) -> float:
+        # Devuelve dónde empieza un bloque de `alto` puntos; si no cabe (se
+        # deja sitio para el pie), en una página nueva
+        if self.y + alto > self.ALTO - self.MARGEN - 20 and self.y > self.MARGEN:
+            self.nueva_pagina()
+        y = self.y
+        self.y += alto
+        return y
+
+    def _operadores(self, operadores: bytes):
+        self.paginas[-1] += operadores + b"\n"
+
+    def _texto(self, x: float, y: float, texto: str, tamano: float, negrita: bool, color: tuple, alinear: str) -> bytes:
+        if alinear != "izquierda":
+            ancho = ancho_texto(texto, tamano, negrita)
+            x -= ancho if alinear == "derecha" else ancho / 2
+        literal = texto.encode("cp1252", "replace").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+        return (
+            f"BT {color[0]:g} {color[1]:g} {color[2]:g} rg /{'F2' if negrita else 'F1'} {tamano:g} Tf "
+            f"{x:.2f} {self.ALTO - y:.2f} Td (".encode() + literal + b") Tj ET"
         )
-        count = cursor.fetchone()[0] + 1
-        return f"PRES-{year}-{count:04d}"
 
-def calcular_dias_para_eliminar(fecha_rechazo: str) -> Optional[int]:
-    if not fecha_rechazo:
-        return None
+    def texto(self, x: float, y: float, texto: str, tamano: float = 10, negrita: bool = False,
+              color: tuple = (0, 0, 0), alinear: str = "izquierda"):
+        # `y` es la línea base
+        self._operadores(self._texto(x, y, texto, tamano, negrita, color, alinear))
+
+    def parrafo(self, texto: Optional[str], x: float, ancho: float, tamano: float = 10,
+                negrita: bool = False, color: tuple = (0, 0, 0)):
+        for linea in partir_texto(texto, ancho, tamano, negrita):
+            self.texto(x, self.reservar(tamano * 1.4) + tamano, linea, tamano, negrita, color)
+
+    def linea(self, x1: float, y1: float, x2: float, y2: float, grosor: float = 0.5, color: tuple = (0.75, 0.75, 0.75)):
+        self._operadores(
+            f"{color[0]:g} {color[1]:g} {color[2]:g} RG {grosor:g} w "
+            f"{x1:.2f} {self.ALTO - y1:.2f} m {x2:.2f} {self.ALTO - y2:.2f} l S".encode()
+        )
+
+    def rectangulo(self, x: float, y: float, ancho: float, alto: float, relleno: tuple = (0.95, 0.95, 0.95)):
+        self._operadores(
+            f"{relleno[0]:g} {relleno[1]:g} {relleno[2]:g} rg "
+            f"{x:.2f} {self.ALTO - y - alto:.2f} {ancho:.2f} {alto:.2f} re f".encode()
+        )
+
+    def imagen(self, imagen: dict, x: float, y: float, ancho: float, alto: float):
+        # Ajusta la imagen dentro de la caja sin deformarla, centrada
+        escala = min(ancho / imagen["ancho"], alto / imagen["alto"])
+        w, h = imagen["ancho"] * escala, imagen["alto"] * escala
+        x, y = x + (ancho - w) / 2, y + (alto - h) / 2
+        self.imagenes.append(imagen)
+        self._operadores(
+            f"q {w:.2f} 0 0 {h:.2f} {x:.2f} {self.ALTO - y - h:.2f} cm /Im{len(self.imagenes) - 1} Do Q".encode()
+        )
+
+    def pie(self, texto: str):
+        # Al final, cuando ya se sabe cuántas páginas hay
+        for numero, pagina in enumerate(self.paginas, 1):
+            pagina += self._texto(self.ANCHO / 2, self.ALTO - 30, f"{texto} · Página {numero} de {len(self.paginas)}",
+                                  8, False, PDF_GRIS, "centro") + b"\n"
+
+    def generar(self) -> bytes:
+        objetos: List[bytes] = []
+
+        def agregar(cuerpo: bytes) -> int:
+            objetos.append(cuerpo)
+            return len(objetos)
+
+        def flujo(diccionario: str, datos: bytes) -> bytes:
+            return f"<< {diccionario} /Length {len(datos)} >>\nstream\n".encode() + datos + b"\nendstream"
+
+        agregar(b"<< /Type /Catalog /Pages 2 0 R >>")
+        agregar(b"")  # el árbol de páginas se rellena al final
+        fuentes = []
+        for nombre, base in (("F1", "Helvetica"), ("F2", "Helvetica-Bold")):
+            fuente_id = agregar(f"<< /Type /Font /Subtype /Type1 /BaseFont /{base} /Encoding /WinAnsiEncoding >>".encode())
+            fuentes.append(f"/{nombre} {fuente_id} 0 R")
+        xobjects = []
+        for numero, imagen in enumerate(self.imagenes):
+            cabecera = f"/Type /XObject /Subtype /Image /Width {imagen['ancho']} /Height {imagen['alto']}"
+            diccionario = f"{cabecera} {imagen['diccionario']}"
+            if imagen["mascara"] is not None:
+                mascara_id = agregar(flujo(
+                    f"{cabecera} /ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode", imagen["mascara"]
+                ))
+                diccionario += f" /SMask {mascara_id} 0 R"
+            xobjects.append(f"/Im{numero} {agregar(flujo(diccionario, imagen['datos']))} 0 R")
+        recursos = f"<< /Font << {' '.join(fuentes)} >> /XObject << {' '.join(xobjects)} >> >>"
+
+        paginas = []
+        for contenido in self.paginas:
+            contenido_id = agregar(flujo("/Filter /FlateDecode", zlib.compress(bytes(contenido))))
+            paginas.append(agregar(
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {self.ANCHO} {self.ALTO}] "
+                f"/Resources {recursos} /Contents {contenido_id} 0 R >>".encode()
+            ))
+        objetos[1] = f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in paginas)}] /Count {len(paginas)} >>".encode()
+
+        salida = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        posiciones = []
+        for numero, cuerpo in enumerate(objetos, 1):
+            posiciones.append(len(salida))
+            salida += f"{numero} 0 obj\n".encode() + cuerpo + b"\nendobj\n"
+        inicio_xref = len(salida)
+        salida += f"xref\n0 {len(objetos) + 1}\n0000000000 65535 f \n".encode()
+        salida += "".join(f"{posicion:010d} 00000 n \n" for posicion in posiciones).encode()
+        salida += f"trailer\n<< /Size {len(objetos) + 1} /Root 1 0 R >>\nstartxref\n{inicio_xref}\n%%EOF\n".encode()
+        return bytes(salida)
+
+def _importe(valor: float) -> str:
+    # 1234.5 -> "1.234,50 €"
+    return f"{valor:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".") + " €"
+
+def _cantidad(valor: float) -> str:
+    return f"{valor:.2f}".rstrip("0").rstrip(".").replace(".", ",")
+
+def _fecha(valor: Optional[str]) -> str:
+    # "2026-03-02" o "2026-03-02T10:00:00" -> "02/03/2026"
+    if not valor:
+        return ""
+    try:
+        return datetime.fromisoformat(str(valor)).strftime("%d/%m/%Y")
+    except ValueError:
+        return str(valor)
+
+def _cabecera_pdf(doc: DocumentoPDF, emisor: dict, titulo: str, referencias: List[str]):
+    # Emisor a la izquierda; tipo de documento y referencias a la derecha
+    derecha = doc.ANCHO - doc.MARGEN
+    persona = " ".join(filter(None, [emisor.get("nombre"), emisor.get("apellidos")]))
+    nombre = emisor.get("empresa") or persona
+    doc.texto(doc.MARGEN, doc.y + 16, nombre, 16, negrita=True, color=PDF_AZUL)
+    doc.texto(derecha, doc.y + 16, titulo, 16, negrita=True, alinear="derecha")
+    contacto = [c for c in [persona if emisor.get("empresa") else None, emisor.get("telefono"), emisor.get("email")] if c]
+    for i in range(max(len(contacto), len(referencias))):
+        y = doc.y + 34 + i * 13
+        if i < len(contacto):
+            doc.texto(doc.MARGEN, y, contacto[i], 9, color=PDF_GRIS)
+        if i < len(referencias):
+            doc.texto(derecha, y, referencias[i], 10, negrita=i == 0, alinear="derecha")
+    doc.y += 40 + max(len(contacto), len(referencias)) * 13
+    doc.linea(doc.MARGEN, doc.y, derecha, doc.y)
+    doc.y += 14
+
+def _bloque_cliente(doc: DocumentoPDF, cliente: dict):
+    doc.texto(doc.MARGEN, doc.reservar(14) + 9, "CLIENTE", 8, negrita=True, color=PDF_GRIS)
+    nombre = " ".join(filter(None, [cliente.get("nombre"), cliente.get("apellidos")]))
+    doc.texto(doc.MARGEN, doc.reservar(16) + 11, nombre, 11, negrita=True)
+    poblacion = " ".join(filter(None, [cliente.get("codigo_postal"), cliente.get("ciudad")]))
+    if cliente.get("provincia"):
+        poblacion = f"{poblacion} ({cliente['provincia']})" if poblacion else cliente["provincia"]
+    for dato in [f"NIF/CIF: {cliente['nif_cif']}" if cliente.get("nif_cif") else "", cliente.get("direccion"), poblacion,
+                 " · ".join(filter(None, [cliente.get("telefono"), cliente.get("email")]))]:
+        if dato:
+            doc.texto(doc.MARGEN, doc.reservar(13) + 9, dato, 9)
+    doc.y += 12
+
+def renderizar_presupuesto_pdf(datos: dict) -> bytes:
+    presupuesto, lineas = datos["presupuesto"], datos["lineas"]
+    doc = DocumentoPDF()
+    derecha = doc.ANCHO - doc.MARGEN
+    referencias = [presupuesto["numero"], f"Fecha: {_fecha(presupuesto['fecha_emision'])}"]
+    if presupuesto.get("fecha_validez"):
+        referencias.append(f"Válido hasta: {_fecha(presupuesto['fecha_validez'])}")
+    _cabecera_pdf(doc, datos["emisor"], "PRESUPUESTO", referencias)
+    _bloque_cliente(doc, datos["cliente"])
+
+    doc.parrafo(presupuesto["titulo"], doc.MARGEN, derecha - doc.MARGEN, 13, negrita=True)
+    if presupuesto.get("descripcion"):
+        doc.parrafo(presupuesto["descripcion"], doc.MARGEN, derecha - doc.MARGEN, 10)
+    doc.y += 10
+
+    # Tabla de líneas; la cabecera se repite en cada página
+    columnas = [("Concepto", doc.MARGEN + 6, "izquierda"), ("Cantidad", 375, "derecha"),
+                ("Precio", 460, "derecha"), ("Importe", derecha - 6, "derecha")]
+
+    def cabecera_tabla():
+        y = doc.reservar(22)
+        doc.rectangulo(doc.MARGEN, y, derecha - doc.MARGEN, 20)
+        for titulo, x, alinear in columnas:
+            doc.texto(x, y + 14, titulo, 9, negrita=True, alinear=alinear)
+
+    cabecera_tabla()
+    for linea in lineas:
+        concepto = partir_texto(linea["concepto"], 260, 10)
+        descripcion = partir_texto(linea.get("descripcion"), 260, 8.5)
+        alto = len(concepto) * 13 + len(descripcion) * 11 + 8
+        paginas = len(doc.paginas)
+        y = doc.reservar(alto)
+        if len(doc.paginas) != paginas:
+            doc.y = y
+            cabecera_tabla()
+            y = doc.reservar(alto)
+        doc.texto(columnas[1][1], y + 13, _cantidad(linea["cantidad"]), 10, alinear="derecha")
+        doc.texto(columnas[2][1], y + 13, _importe(linea["precio_unitario"]), 10, alinear="derecha")
+        doc.texto(columnas[3][1], y + 13, _importe(linea["total"]), 10, alinear="derecha")
+        for texto in concepto:
+            y += 13
+            doc.texto(columnas[0][1], y, texto, 10)
+        for texto in descripcion:
+            y += 11
+            doc.texto(columnas[0][1], y, texto, 8.5, color=PDF_GRIS)
+        doc.linea(doc.MARGEN, doc.y - 2, derecha, doc.y - 2)
+
+    # Totales
+    doc.y += 8
+    filas = [("Base imponible", _importe(presupuesto["subtotal"]), False)]
+    if presupuesto["aplicar_iva"]:
+        filas.append((f"IVA ({_cantidad(presupuesto['iva_porcentaje'])} %)", _importe(presupuesto["iva_amount"]), False))
+    else:
+        filas.append(("IVA", "No aplicable", False))
+    filas.append(("TOTAL", _importe(presupuesto["total"]), True))
+    for etiqueta, valor, destacado in filas:
+        tamano = 12 if destacado else 10
+        y = doc.reservar(tamano + 8) + tamano
+        doc.texto(400, y, etiqueta, tamano, negrita=destacado, alinear="derecha")
+        doc.texto(derecha - 6, y, valor, tamano, negrita=destacado, color=PDF_AZUL if destacado else (0, 0, 0), alinear="derecha")
+
+    if presupuesto.get("notas"):
+        doc.y += 16
+        doc.texto(doc.MARGEN, doc.reservar(14) + 9, "NOTAS", 8, negrita=True, color=PDF_GRIS)
+        doc.parrafo(presupuesto["notas"], doc.MARGEN, derecha - doc.MARGEN, 9)
+
+    doc.pie(presupuesto["numero"])
+    return doc.generar()
+
+ETIQUETAS_VISITA = {
+    "valoracion": "Valoración",
+    "reparacion": "Reparación",
+    "instalacion": "Instalación",
+    "mantenimiento": "Mantenimiento",
+    "urgencia": "Urgencia",
+}
+
+def renderizar_visita_pdf(datos: dict) -> bytes:
+    visita = datos["visita"]
+    doc = DocumentoPDF()
+    derecha = doc.ANCHO - doc.MARGEN
+    fecha = " ".join(filter(None, [_fecha(visita["fecha"]), visita.get("hora")]))
+    _cabecera_pdf(doc, datos["emisor"], "PARTE DE TRABAJO", [f"Visita nº {visita['id']}", f"Fecha: {fecha}"])
+    _bloque_cliente(doc, datos["cliente"])
+
+    doc.parrafo(visita["titulo"], doc.MARGEN, derecha - doc.MARGEN, 13, negrita=True)
+    detalles = [f"Tipo: {ETIQUETAS_VISITA.get(visita.get('tipo'), visita.get('tipo') or '')}",
+                f"Prioridad: {(visita.get('prioridad') or '').capitalize()}"]
+    if visita.get("completed_at"):
+        detalles.append(f"Completada el {_fecha(visita['completed_at'])}")
+    doc.texto(doc.MARGEN, doc.reservar(16) + 10, " · ".join(detalles), 9, color=PDF_GRIS)
+    if visita.get("descripcion"):
+        doc.y += 8
+        doc.texto(doc.MARGEN, doc.reservar(14) + 9, "TRABAJO", 8, negrita=True, color=PDF_GRIS)
+        doc.parrafo(visita["descripcion"], doc.MARGEN, derecha - doc.MARGEN, 10)
+
+    # Firma del cliente, en su recuadro
+    doc.y += 24
+    y = doc.reservar(140)
+    doc.texto(doc.MARGEN, y + 9, "CONFORME DEL CLIENTE", 8, negrita=True, color=PDF_GRIS)
+    doc.linea(doc.MARGEN, y + 116, doc.MARGEN + 240, y + 116)
+    imagen = imagen_pdf(datos["firma"]) if datos.get("firma") else None
+    if imagen:
+        doc.imagen(imagen, doc.MARGEN, y + 16, 240, 96)
+    elif visita.get("firma_hash"):
+        doc.texto(doc.MARGEN, y + 64, "(firma en un formato que no se puede incluir)", 9, color=PDF_GRIS)
+    if visita.get("nombre_firmante"):
+        doc.texto(doc.MARGEN, y + 130, f"Firmado por: {visita['nombre_firmante']}", 9)
+
+    doc.pie(f"Parte de la visita nº {visita['id']}")
+    return doc.generar()
+
+RENDERIZADORES_PDF = {
+    "presupuestos": renderizar_presupuesto_pdf,
+    "visitas": renderizar_visita_pdf,
+}
+
+pdf_pool = WorkerPool("pdf", PDF_EXECUTOR, PDF_WORKERS, PDF_MAX_PENDING)
+pdf_stats = {"aciertos": 0, "generados": 0}
+
+def ruta_pdf(tabla: str, registro_id: int, version: int, datos: dict) -> str:
+    huella = hashlib.sha256(
+        json.dumps([PDF_PLANTILLA, {k: v for k, v in datos.items() if k != "firma"}], sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+    return os.path.join(PDF_CACHE_DIR, tabla, str(registro_id), f"v{version}-{huella}.pdf")
+
+def generar_pdf(tabla: str, datos: dict, ruta: str) -> bytes:
+    # Corre en pdf_pool. Se escribe en un temporal y se renombra: quien lea
+    # la caché a la vez nunca ve un PDF a medias
+    contenido = RENDERIZADORES_PDF[tabla](datos)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(contenido)
+    os.replace(temporal, ruta)
+    return contenido
+
+def leer_pdf_cacheado(ruta: str) -> Optional[bytes]:
     try:
-        fecha = datetime.fromisoformat(fecha_rechazo.replace('Z', '+00:00'))
-        fecha_eliminacion = fecha + timedelta(days=30)
-        dias = (fecha_eliminacion - datetime.now(fecha.tzinfo)).days
-        return max(0, dias)
-    except:
+        with open(ruta, "rb") as f:
+            contenido = f.read()
+    except FileNotFoundError:
         return None
+    os.utime(ruta)  # la limpieza programada borra lo que lleva tiempo sin usarse
+    return contenido
+
+def invalidar_pdf(tabla: str, registro_id: int):
+    shutil.rmtree(os.path.join(PDF_CACHE_DIR, tabla, str(registro_id)), ignore_errors=True)
+
+async def servir_pdf(tabla: str, registro_id: int, version: int, datos: dict, nombre_archivo: str) -> Response:
+    ruta = ruta_pdf(tabla, registro_id, version, datos)
+    contenido = await run_in_threadpool(leer_pdf_cacheado, ruta)
+    if contenido is None:
+        contenido = await pdf_pool.ejecutar(generar_pdf, tabla, datos, ruta)
+        pdf_stats["generados"] += 1
+    else:
+        pdf_stats["aciertos"] += 1
+    return Response(
+        content=contenido,
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{nombre_archivo}"',
+            "Cache-Control": "private, no-cache",
+        },
+    )
+
+# ============ TOKENS ============
+
+# Access token: JWT de vida corta (ACCESS_TOKEN_EXPIRE_MINUTES) con el usuario,
+# la sesión (sid) y un id propio (jti). Refresh token: valor opaco de un solo
+# uso guardado como hash en `refresh_tokens`. Cerrar sesión o detectar la
+# reutilización de un refresh token revoca la sesión entera.
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def create_token(user_id: int, sid: str) -> str:
+    ahora = int(time.time())
+    payload = {
+        "user_id": user_id,
+        "sid": sid,
+        "jti": secrets.token_hex(8),
+        "type": "access",
+        "iat": ahora,
+        "exp": ahora + ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+def crear_refresh_token(user_id: int, familia: str) -> str:
+    token = secrets.token_urlsafe(32)
+    almacen.guardar_refresh_token(user_id, hash_token(token), familia, time.time() + REFRESH_TOKEN_EXPIRE_DAYS * 86400)
+    return token
+
+def emitir_sesion(user_id: int) -> dict:
+    familia = secrets.token_hex(8)
+    return {
+        "access_token": create_token(user_id, familia),
+        "refresh_token": crear_refresh_token(user_id, familia),
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
+class ListaRevocacion:
+    """Copia en memoria de `tokens_revocados`. Se consulta en cada petición sin
+    tocar la BD y se sincroniza cada REVOCATION_SYNC_SECONDS leyendo solo las
+    filas nuevas, así las revocaciones de otros workers llegan enseguida."""
+
+    def __init__(self):
+        self._claves = {}
+        self._ultimo_id = 0
+        self._sincronizada = 0.0
+        self._en_curso = False
+        self._lock = threading.Lock()
+
+    def toca_sincronizar(self) -> bool:
+        # Solo la primera petición que la encuentra caducada lanza la lectura
+        with self._lock:
+            if self._en_curso or time.monotonic() - self._sincronizada < REVOCATION_SYNC_SECONDS:
+                return False
+            self._en_curso = True
+            return True
+
+    def sincronizar(self):
+        ahora = time.time()
+        try:
+            filas = almacen.revocaciones_desde(self._ultimo_id, ahora)
+            with self._lock:
+                for fila in filas:
+                    self._claves[fila["clave"]] = fila["expira"]
+                if filas:
+                    self._ultimo_id = filas[-1]["id"]
+                self._claves = {clave: expira for clave, expira in self._claves.items() if expira > ahora}
+                self._sincronizada = time.monotonic()
+        finally:
+            with self._lock:
+                self._en_curso = False
+
+    def revocado(self, *claves: str) -> bool:
+        return any(clave in self._claves for clave in claves)
+
+    def stats(self) -> dict:
+        return {"revocadas": len(self._claves), "ultimo_id": self._ultimo_id}
+
+revocaciones = ListaRevocacion()
+revocaciones.sincronizar()  # carga inicial, antes de atender peticiones
+
+# Claims de los tokens ya verificados, por hash del token y hasta su expiración
+token_cache = MemoryCacheBackend(TOKEN_CACHE_MAX_ENTRIES) if TOKEN_CACHE_MAX_ENTRIES > 0 else NullCacheBackend()
+
+async def verificar_token(token: str) -> dict:
+    clave = "token:" + hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+    claims = token_cache.get(clave)
+    if claims is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except jwt.ExpiredSignatureError:
+            raise HTTPException(status_code=401, detail="Token expirado")
+        except jwt.InvalidTokenError:
+            raise HTTPException(status_code=401, detail="Token inválido")
+        # Los tokens de 30 días anteriores no llevan tipo ni sesión: se rechazan
+        if payload.get("type") != "access" or "user_id" not in payload or "sid" not in payload:
+            raise HTTPException(status_code=401, detail="Token inválido")
+        claims = {k: payload[k] for k in ("user_id", "sid", "jti", "exp")}
+        token_cache.set(clave, claims, claims["exp"] - time.time())
+
+    if revocaciones.toca_sincronizar():
+        await ejecutar_db(revocaciones.sincronizar)
+    if revocaciones.revocado(f"jti:{claims['jti']}", f"sid:{claims['sid']}"):
+        raise HTTPException(status_code=401, detail="Sesión cerrada")
+    return claims
+
+# Solo CPU salvo la sincronización periódica de revocaciones: como async def se
+# resuelve en el event loop sin ocupar un hilo por petición
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> int:
+    user_id = (await verificar_token(credentials.credentials))["user_id"]
+    usuario_peticion.set(user_id)  # get_db() usará el shard de este usuario
+    return user_id
 
 # ============ ENDPOINTS AUTH ============
 
+def _insertar_usuario(user: UserRegister, password_hash: str) -> int:
+    user_id = almacen.insertar_usuario(user, password_hash)
+    if user_id is None:
+        raise HTTPException(status_code=400, detail="El email ya está registrado")
+    return user_id
+
+# registro y login son async: el acceso a BD va al threadpool y el hashing al
+# pool de auth, así una ráfaga de logins no ocupa los hilos del resto de la API
+
 @app.post("/api/auth/registro", response_model=TokenResponse)
-def registro(user: UserRegister):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        # Verificar si existe
-        cursor.execute("SELECT id FROM usuarios WHERE email = ?", (user.email,))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="El email ya está registrado")
-        
-        # Crear usuario
-        password_hash = hash_password(user.password)
-        cursor.execute(
-            """INSERT INTO usuarios (nombre, apellidos, email, telefono, empresa, password_hash)
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (user.nombre, user.apellidos, user.email, user.telefono, user.empresa, password_hash)
-        )
-        conn.commit()
-        user_id = cursor.lastrowid
-        
-        token = create_token(user_id)
-        return TokenResponse(
-            access_token=token,
-            token_type="bearer",
-            user=UserResponse(
-                id=user_id,
-                nombre=user.nombre,
-                apellidos=user.apellidos,
-                email=user.email,
-                telefono=user.telefono,
-                empresa=user.empresa
-            )
+async def registro(user: UserRegister):
+    # Verificar si existe
+    if await ejecutar_db(almacen.email_registrado, user.email):
+        raise HTTPException(status_code=400, detail="El email ya está registrado")
+    
+    # Crear usuario
+    password_hash = await hash_password_async(user.password)
+    user_id = await ejecutar_db(_insertar_usuario, user, password_hash)
+    
+    sesion = await ejecutar_db(emitir_sesion, user_id)
+    return TokenResponse(
+        **sesion,
+        token_type="bearer",
+        user=UserResponse(
+            id=user_id,
+            nombre=user.nombre,
+            apellidos=user.apellidos,
+            email=user.email,
+            telefono=user.telefono,
+            empresa=user.empresa
         )
+    )
 
 @app.post("/api/auth/login", response_model=TokenResponse)
-def login(credentials: UserLogin):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios WHERE email = ?", (credentials.email,))
-        user = cursor.fetchone()
-        
-        if not user or not verify_password(credentials.password, user["password_hash"]):
-            raise HTTPException(status_code=401, detail="Credenciales incorrectas")
-        
-        token = create_token(user["id"])
-        return TokenResponse(
-            access_token=token,
-            token_type="bearer",
-            user=UserResponse(
-                id=user["id"],
-                nombre=user["nombre"],
-                apellidos=user["apellidos"],
-                email=user["email"],
-                telefono=user["telefono"],
-                empresa=user["empresa"]
-            )
+async def login(credentials: UserLogin):
+    user = await ejecutar_db(almacen.buscar_usuario, credentials.email)
+    if not user:
+        raise HTTPException(status_code=401, detail="Credenciales incorrectas")
+    
+    valida, nuevo_hash = await verify_password_async(credentials.password, user["password_hash"])
+    if not valida:
+        raise HTTPException(status_code=401, detail="Credenciales incorrectas")
+    
+    # Rehash si el hash guardado usa un coste inferior al configurado
+    if nuevo_hash:
+        await ejecutar_db(almacen.actualizar_hash, user["id"], nuevo_hash)
+    
+    sesion = await ejecutar_db(emitir_sesion, user["id"])
+    return TokenResponse(
+        **sesion,
+        token_type="bearer",
+        user=UserResponse(
+            id=user["id"],
+            nombre=user["nombre"],
+            apellidos=user["apellidos"],
+            email=user["email"],
+            telefono=user["telefono"],
+            empresa=user["empresa"]
         )
+    )
+
+@app.post("/api/auth/refresh", response_model=TokenResponse)
+def refrescar_token(datos: RefreshRequest):
+    refresh_token = secrets.token_urlsafe(32)
+    estado, fila, user = almacen.renovar_refresh_token(
+        hash_token(datos.refresh_token), hash_token(refresh_token),
+        time.time() + REFRESH_TOKEN_EXPIRE_DAYS * 86400, time.time()
+    )
+    if estado == "reutilizada":
+        # Un refresh token usado dos veces indica que se ha copiado: el
+        # almacén ya ha revocado la sesión entera
+        revocaciones.sincronizar()
+    if estado != "ok":
+        raise HTTPException(status_code=401, detail="Sesión caducada")
+
+    return TokenResponse(
+        access_token=create_token(fila["usuario_id"], fila["familia"]),
+        refresh_token=refresh_token,
+        expires_in=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        token_type="bearer",
+        user=UserResponse(**user),
+    )
+
+def _cerrar_sesion(familia: str):
+    almacen.revocar_sesion(familia)
+    revocaciones.sincronizar()
+
+@app.post("/api/auth/logout")
+async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    claims = await verificar_token(credentials.credentials)
+    await ejecutar_db(_cerrar_sesion, claims["sid"])
+    return {"message": "Sesión cerrada"}
 
 @app.get("/api/auth/perfil", response_model=UserResponse)
+@cacheado
 def get_perfil(user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        if not user:
-            raise HTTPException(status_code=404, detail="Usuario no encontrado")
-        return UserResponse(**dict(user))
+    user = almacen.obtener_usuario(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    return UserResponse(**user)
 
 # ============ ENDPOINTS CLIENTES ============
 
 @app.get("/api/clientes", response_model=List[ClienteResponse])
-def listar_clientes(user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM clientes WHERE usuario_id = ? ORDER BY nombre",
-            (user_id,)
-        )
-        return [ClienteResponse(**dict(row)) for row in cursor.fetchall()]
+@condicional("clientes")
+@cacheado
+def listar_clientes(
+    response: Response,
+    q: Optional[str] = None,
+    tipo: Optional[str] = None,
+    limite: Annotated[Optional[int], Query(ge=1, le=PAGE_SIZE_MAX)] = None,
+    cursor_pagina: Annotated[Optional[str], Query(alias="cursor")] = None,
+    user_id: int = Depends(get_current_user)
+):
+    return respuesta_pagina(response, *almacen.listar_clientes(user_id, q, tipo, limite, cursor_pagina))
 
 @app.get("/api/clientes/{cliente_id}", response_model=ClienteResponse)
+@condicional("clientes")
+@cacheado
 def obtener_cliente(cliente_id: int, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM clientes WHERE id = ? AND usuario_id = ?",
-            (cliente_id, user_id)
-        )
-        cliente = cursor.fetchone()
-        if not cliente:
-            raise HTTPException(status_code=404, detail="Cliente no encontrado")
-        return ClienteResponse(**dict(cliente))
+    cliente = almacen.obtener_cliente(user_id, cliente_id)
+    if not cliente:
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    return ClienteResponse(**cliente)
 
 @app.post("/api/clientes", response_model=ClienteResponse)
 def crear_cliente(cliente: ClienteCreate, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO clientes (usuario_id, nombre, apellidos, email, telefono, 
-               telefono_secundario, direccion, ciudad, codigo_postal, provincia, tipo, nif_cif, notas)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, cliente.nombre, cliente.apellidos, cliente.email, cliente.telefono,
-             cliente.telefono_secundario, cliente.direccion, cliente.ciudad, cliente.codigo_postal,
-             cliente.provincia, cliente.tipo, cliente.nif_cif, cliente.notas)
-        )
-        conn.commit()
-        cliente_id = cursor.lastrowid
-        
-        cursor.execute("SELECT * FROM clientes WHERE id = ?", (cliente_id,))
-        return ClienteResponse(**dict(cursor.fetchone()))
+    creado = almacen.crear_cliente(user_id, cliente)
+    invalidar_cache(user_id)
+    return ClienteResponse(**creado)
 
 @app.put("/api/clientes/{cliente_id}", response_model=ClienteResponse)
 def actualizar_cliente(cliente_id: int, cliente: ClienteCreate, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """UPDATE clientes SET nombre=?, apellidos=?, email=?, telefono=?, 
-               telefono_secundario=?, direccion=?, ciudad=?, codigo_postal=?, 
-               provincia=?, tipo=?, nif_cif=?, notas=?
-               WHERE id=? AND usuario_id=?""",
-            (cliente.nombre, cliente.apellidos, cliente.email, cliente.telefono,
-             cliente.telefono_secundario, cliente.direccion, cliente.ciudad, cliente.codigo_postal,
-             cliente.provincia, cliente.tipo, cliente.nif_cif, cliente.notas,
-             cliente_id, user_id)
-        )
-        conn.commit()
-        
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Cliente no encontrado")
-        
-        cursor.execute("SELECT * FROM clientes WHERE id = ?", (cliente_id,))
-        return ClienteResponse(**dict(cursor.fetchone()))
+    actualizado = almacen.actualizar_cliente(user_id, cliente_id, cliente)
+    invalidar_cache(user_id)
+    if not actualizado:
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    return ClienteResponse(**actualizado)
 
 @app.delete("/api/clientes/{cliente_id}")
 def eliminar_cliente(cliente_id: int, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "DELETE FROM clientes WHERE id = ? AND usuario_id = ?",
-            (cliente_id, user_id)
-        )
-        conn.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Cliente no encontrado")
-        return {"message": "Cliente eliminado"}
+    eliminado = almacen.eliminar_cliente(user_id, cliente_id)
+    invalidar_cache(user_id)
+    if not eliminado:
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    return {"message": "Cliente eliminado"}
 
 # ============ ENDPOINTS VISITAS ============
 
 @app.get("/api/visitas", response_model=List[VisitaResponse])
+@condicional("visitas", "clientes")
+@cacheado
 def listar_visitas(
+    response: Response,
     fecha: Optional[str] = None,
     estado: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    limite: Annotated[Optional[int], Query(ge=1, le=PAGE_SIZE_MAX)] = None,
+    cursor_pagina: Annotated[Optional[str], Query(alias="cursor")] = None,
     user_id: int = Depends(get_current_user)
 ):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        query = """
-            SELECT v.*, c.nombre || ' ' || COALESCE(c.apellidos, '') as cliente_nombre,
-                   c.telefono as cliente_telefono, c.direccion || ', ' || c.ciudad as cliente_direccion
-            FROM visitas v
-            JOIN clientes c ON v.cliente_id = c.id
-            WHERE v.usuario_id = ?
-        """
-        params = [user_id]
-        
-        if fecha:
-            query += " AND v.fecha = ?"
-            params.append(fecha)
-        if estado:
-            query += " AND v.estado = ?"
-            params.append(estado)
-        
-        query += " ORDER BY v.fecha DESC, v.hora"
-        cursor.execute(query, params)
-        
-        return [VisitaResponse(**dict(row)) for row in cursor.fetchall()]
+    return respuesta_pagina(
+        response, *almacen.listar_visitas(user_id, fecha, estado, desde, hasta, limite, cursor_pagina)
+    )
 
 @app.get("/api/visitas/hoy", response_model=List[VisitaResponse])
-def visitas_hoy(user_id: int = Depends(get_current_user)):
+@condicional("visitas", "clientes")
+def visitas_hoy(response: Response, user_id: int = Depends(get_current_user)):
+    # Es el listado filtrado por la fecha de hoy: comparte su entrada de caché
     hoy = datetime.now().strftime("%Y-%m-%d")
-    return listar_visitas(fecha=hoy, user_id=user_id)
+    return listar_visitas(response, fecha=hoy, user_id=user_id)
 
 @app.get("/api/visitas/{visita_id}", response_model=VisitaResponse)
+@condicional("visitas", "clientes")
+@cacheado
 def obtener_visita(visita_id: int, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """SELECT v.*, c.nombre || ' ' || COALESCE(c.apellidos, '') as cliente_nombre,
-                      c.telefono as cliente_telefono, c.direccion || ', ' || c.ciudad as cliente_direccion
-               FROM visitas v
-               JOIN clientes c ON v.cliente_id = c.id
-               WHERE v.id = ? AND v.usuario_id = ?""",
-            (visita_id, user_id)
-        )
-        visita = cursor.fetchone()
-        if not visita:
-            raise HTTPException(status_code=404, detail="Visita no encontrada")
-        return VisitaResponse(**dict(visita))
+    return leer_visita(visita_id, user_id)
+
+def leer_visita(visita_id: int, user_id: int) -> VisitaResponse:
+    # Sin caché: para las escrituras que devuelven el registro guardado
+    visita = almacen.obtener_visita(user_id, visita_id)
+    if not visita:
+        raise HTTPException(status_code=404, detail="Visita no encontrada")
+    return VisitaResponse(**visita)
 
 @app.post("/api/visitas", response_model=VisitaResponse)
 def crear_visita(visita: VisitaCreate, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO visitas (usuario_id, cliente_id, titulo, descripcion, fecha, hora, tipo, estado, prioridad, notas_internas)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, visita.cliente_id, visita.titulo, visita.descripcion, visita.fecha,
-             visita.hora, visita.tipo, visita.estado, visita.prioridad, visita.notas_internas)
-        )
-        conn.commit()
-        visita_id = cursor.lastrowid
-        return obtener_visita(visita_id, user_id)
+    visita_id = almacen.crear_visita(user_id, visita)
+    invalidar_cache(user_id)
+    return leer_visita(visita_id, user_id)
 
 @app.put("/api/visitas/{visita_id}", response_model=VisitaResponse)
 def actualizar_visita(visita_id: int, visita: VisitaCreate, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """UPDATE visitas SET cliente_id=?, titulo=?, descripcion=?, fecha=?, hora=?, 
-               tipo=?, estado=?, prioridad=?, notas_internas=?
-               WHERE id=? AND usuario_id=?""",
-            (visita.cliente_id, visita.titulo, visita.descripcion, visita.fecha, visita.hora,
-             visita.tipo, visita.estado, visita.prioridad, visita.notas_internas,
-             visita_id, user_id)
-        )
-        conn.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Visita no encontrada")
-        return obtener_visita(visita_id, user_id)
+    actualizada = almacen.actualizar_visita(user_id, visita_id, visita)
+    invalidar_cache(user_id)
+    invalidar_pdf("visitas", visita_id)
+    if not actualizada:
+        raise HTTPException(status_code=404, detail="Visita no encontrada")
+    return leer_visita(visita_id, user_id)
 
 @app.patch("/api/visitas/{visita_id}/estado")
 def cambiar_estado_visita(visita_id: int, estado: str, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        completed_at = datetime.now().isoformat() if estado == "completada" else None
-        cursor.execute(
-            "UPDATE visitas SET estado = ?, completed_at = ? WHERE id = ? AND usuario_id = ?",
-            (estado, completed_at, visita_id, user_id)
-        )
-        conn.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Visita no encontrada")
-        return {"message": "Estado actualizado"}
+    completed_at = datetime.now().isoformat() if estado == "completada" else None
+    actualizada = almacen.cambiar_estado_visita(user_id, visita_id, estado, completed_at)
+    invalidar_cache(user_id)
+    invalidar_pdf("visitas", visita_id)
+    if not actualizada:
+        raise HTTPException(status_code=404, detail="Visita no encontrada")
+    return {"message": "Estado actualizado"}
 
 @app.patch("/api/visitas/{visita_id}/completar")
 def completar_visita(visita_id: int, data: CompletarVisita, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """UPDATE visitas SET estado = 'completada', completed_at = ?, 
-               firma_cliente = ?, nombre_firmante = ?, notas_internas = ?
-               WHERE id = ? AND usuario_id = ?""",
-            (datetime.now().isoformat(), data.firma_cliente, data.nombre_firmante,
-             data.notas_internas, visita_id, user_id)
-        )
-        conn.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Visita no encontrada")
-        return {"message": "Visita completada"}
+    firma = None
+    if data.firma_cliente:
+        try:
+            firma = decodificar_firma(data.firma_cliente)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if len(firma[1]) > FIRMA_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="La firma es demasiado grande")
+
+    if not almacen.completar_visita(user_id, visita_id, firma, data.nombre_firmante, data.notas_internas,
+                                    datetime.now().isoformat()):
+        raise HTTPException(status_code=404, detail="Visita no encontrada")
+    invalidar_cache(user_id)
+    invalidar_pdf("visitas", visita_id)
+    return {"message": "Visita completada"}
 
 @app.delete("/api/visitas/{visita_id}")
 def eliminar_visita(visita_id: int, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM visitas WHERE id = ? AND usuario_id = ?", (visita_id, user_id))
-        conn.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Visita no encontrada")
-        return {"message": "Visita eliminada"}
+    eliminada = almacen.eliminar_visita(user_id, visita_id)
+    invalidar_cache(user_id)
+    invalidar_pdf("visitas", visita_id)
+    if not eliminada:
+        raise HTTPException(status_code=404, detail="Visita no encontrada")
+    return {"message": "Visita eliminada"}
+
+@app.get("/api/visitas/{visita_id}/pdf")
+async def pdf_visita(visita_id: int, user_id: int = Depends(get_current_user)):
+    datos = await ejecutar_db(almacen.datos_pdf_visita, user_id, visita_id)
+    return await servir_pdf("visitas", visita_id, datos["visita"]["version"], datos, f"parte-visita-{visita_id}.pdf")
+
+# ============ ENDPOINT AGENDA ============
+
+def fecha_parametro(valor: str, nombre: str) -> date:
+    try:
+        return date.fromisoformat(valor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{nombre}: fecha no válida (AAAA-MM-DD)")
+
+@app.get("/api/agenda", response_model=AgendaResponse)
+@condicional("visitas", "clientes")
+@cacheado
+def agenda(
+    desde: str,
+    hasta: str,
+    incluir_visitas: bool = True,
+    user_id: int = Depends(get_current_user)
+):
+    # Visitas entre dos fechas (incluidas) agrupadas por día, con todos los días
+    # del rango aunque estén vacíos. Sin `incluir_visitas` solo van los
+    # contadores, suficiente para la vista de mes
+    inicio, fin = fecha_parametro(desde, "desde"), fecha_parametro(hasta, "hasta")
+    if fin < inicio:
+        raise HTTPException(status_code=400, detail="hasta debe ser igual o posterior a desde")
+    if (fin - inicio).days >= AGENDA_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"El rango no puede superar {AGENDA_MAX_DAYS} días")
+
+    dias = {}
+    for n in range((fin - inicio).days + 1):
+        dia = (inicio + timedelta(days=n)).isoformat()
+        dias[dia] = DiaAgenda(fecha=dia, por_estado={}, por_prioridad={}, visitas=[])
+    resultado = AgendaResponse(desde=inicio.isoformat(), hasta=fin.isoformat(), por_estado={}, por_prioridad={})
+
+    for row in almacen.agenda(user_id, resultado.desde, resultado.hasta, incluir_visitas):
+        dia = dias.get(row["fecha"])
+        if dia is None:
+            # Fecha guardada con otro formato: no cae en ningún día
+            continue
+        for contadores in (dia, resultado):
+            contadores.total += 1
+            # Sin estado o prioridad, bajo "" (como en resumen_contadores)
+            estado, prioridad = row["estado"] or "", row["prioridad"] or ""
+            contadores.por_estado[estado] = contadores.por_estado.get(estado, 0) + 1
+            contadores.por_prioridad[prioridad] = contadores.por_prioridad.get(prioridad, 0) + 1
+            contadores.conflictos += int(row["conflicto"] or 0)
+        if incluir_visitas:
+            dia.visitas.append(VisitaAgenda(**dict(row)))
+
+    resultado.dias = list(dias.values())
+    return resultado
+
+# ============ ENDPOINT FIRMAS ============
+
+def rango_solicitado(cabecera: Optional[str], tamano: int) -> Optional[tuple]:
+    # Un único rango "bytes=a-b", "bytes=a-" o "bytes=-n"; cualquier otra
+    # forma se ignora y se sirve la imagen completa
+    if not cabecera or not cabecera.startswith("bytes=") or "," in cabecera:
+        return None
+    inicio, _, fin = cabecera[6:].strip().partition("-")
+    try:
+        if inicio:
+            inicio, fin = int(inicio), int(fin) if fin else tamano - 1
+        else:
+            inicio, fin = tamano - int(fin), tamano - 1
+    except ValueError:
+        return None
+    inicio = max(0, inicio)
+    if inicio >= tamano or fin < inicio:
+        raise HTTPException(status_code=416, detail="Rango no válido", headers={"Content-Range": f"bytes */{tamano}"})
+    return inicio, min(fin, tamano - 1)
+
+@app.get("/api/firmas/{firma_hash}")
+def obtener_firma(firma_hash: str, request: Request, user_id: int = Depends(get_current_user)):
+    firma = almacen.info_firma(user_id, firma_hash)
+    if not firma:
+        raise HTTPException(status_code=404, detail="Firma no encontrada")
+
+    # Contenido direccionado por hash: nunca cambia
+    cabeceras = {
+        "ETag": f'"{firma_hash}"',
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Vary": "Authorization",
+        "Accept-Ranges": "bytes",
+    }
+    if etag_coincide(request.headers.get("if-none-match"), cabeceras["ETag"]):
+        return Response(status_code=304, headers=cabeceras)
+
+    rango = rango_solicitado(request.headers.get("range"), firma["tamano"])
+    inicio, fin = rango or (0, firma["tamano"] - 1)
+    if rango:
+        cabeceras["Content-Range"] = f"bytes {inicio}-{fin}/{firma['tamano']}"
+    status_code = 206 if rango else 200
+
+    # Se transmite por trozos, sin cargarla entera en memoria. Una firma zlib
+    # se descomprime al vuelo desde el principio hasta el final del rango
+    if firma["codificacion"] == "zlib":
+        trozos = descomprimir_trozos(
+            almacen.trozos_firma(user_id, firma["id"], 0, firma["almacenado"] - 1), inicio, fin
+        )
+    else:
+        trozos = almacen.trozos_firma(user_id, firma["id"], inicio, fin)
+    cabeceras["Content-Length"] = str(fin - inicio + 1)
+    return StreamingResponse(trozos, status_code=status_code, media_type=firma["mime"], headers=cabeceras)
 
 # ============ ENDPOINTS PRESUPUESTOS ============
 
 @app.get("/api/presupuestos", response_model=List[PresupuestoResponse])
-def listar_presupuestos(estado: Optional[str] = None, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        query = """
-            SELECT p.*, c.nombre || ' ' || COALESCE(c.apellidos, '') as cliente_nombre
-            FROM presupuestos p
-            JOIN clientes c ON p.cliente_id = c.id
-            WHERE p.usuario_id = ?
-        """
-        params = [user_id]
-        
-        if estado:
-            query += " AND p.estado = ?"
-            params.append(estado)
-        
-        query += " ORDER BY p.created_at DESC"
-        cursor.execute(query, params)
-        
-        presupuestos = []
-        for row in cursor.fetchall():
-            pres_dict = dict(row)
-            pres_dict['dias_para_eliminar'] = calcular_dias_para_eliminar(pres_dict.get('fecha_rechazo'))
-            
-            # Obtener líneas
-            cursor.execute("SELECT * FROM lineas_presupuesto WHERE presupuesto_id = ? ORDER BY orden", (pres_dict['id'],))
-            pres_dict['lineas'] = [dict(l) for l in cursor.fetchall()]
-            
-            presupuestos.append(PresupuestoResponse(**pres_dict))
-        
-        return presupuestos
+@condicional("presupuestos", "clientes")
+@cacheado
+def listar_presupuestos(
+    response: Response,
+    estado: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    incluir_lineas: bool = True,
+    limite: Annotated[Optional[int], Query(ge=1, le=PAGE_SIZE_MAX)] = None,
+    cursor_pagina: Annotated[Optional[str], Query(alias="cursor")] = None,
+    user_id: int = Depends(get_current_user)
+):
+    return respuesta_pagina(response, *almacen.listar_presupuestos(
+        user_id, estado, desde, hasta, incluir_lineas, limite, cursor_pagina
+    ))
 
 @app.get("/api/presupuestos/cliente/{cliente_id}", response_model=List[PresupuestoResponse])
-def presupuestos_cliente(cliente_id: int, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """SELECT p.*, c.nombre || ' ' || COALESCE(c.apellidos, '') as cliente_nombre
-               FROM presupuestos p
-               JOIN clientes c ON p.cliente_id = c.id
-               WHERE p.usuario_id = ? AND p.cliente_id = ?
-               ORDER BY p.created_at DESC""",
-            (user_id, cliente_id)
-        )
-        
-        presupuestos = []
-        for row in cursor.fetchall():
-            pres_dict = dict(row)
-            pres_dict['dias_para_eliminar'] = calcular_dias_para_eliminar(pres_dict.get('fecha_rechazo'))
-            cursor.execute("SELECT * FROM lineas_presupuesto WHERE presupuesto_id = ? ORDER BY orden", (pres_dict['id'],))
-            pres_dict['lineas'] = [dict(l) for l in cursor.fetchall()]
-            presupuestos.append(PresupuestoResponse(**pres_dict))
-        
-        return presupuestos
+@condicional("presupuestos", "clientes")
+@cacheado
+def presupuestos_cliente(
+    cliente_id: int,
+    incluir_lineas: bool = True,
+    user_id: int = Depends(get_current_user)
+):
+    return RespuestaJSON(almacen.presupuestos_cliente(user_id, cliente_id, incluir_lineas))
 
 @app.get("/api/presupuestos/{presupuesto_id}", response_model=PresupuestoResponse)
+@condicional("presupuestos", "clientes")
+@cacheado
 def obtener_presupuesto(presupuesto_id: int, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """SELECT p.*, c.nombre || ' ' || COALESCE(c.apellidos, '') as cliente_nombre
-               FROM presupuestos p
-               JOIN clientes c ON p.cliente_id = c.id
-               WHERE p.id = ? AND p.usuario_id = ?""",
-            (presupuesto_id, user_id)
-        )
-        pres = cursor.fetchone()
-        if not pres:
-            raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
-        
-        pres_dict = dict(pres)
-        pres_dict['dias_para_eliminar'] = calcular_dias_para_eliminar(pres_dict.get('fecha_rechazo'))
-        cursor.execute("SELECT * FROM lineas_presupuesto WHERE presupuesto_id = ? ORDER BY orden", (presupuesto_id,))
-        pres_dict['lineas'] = [dict(l) for l in cursor.fetchall()]
-        
-        return PresupuestoResponse(**pres_dict)
+    return leer_presupuesto(presupuesto_id, user_id)
+
+def leer_presupuesto(presupuesto_id: int, user_id: int) -> PresupuestoResponse:
+    # Sin caché: para las escrituras que devuelven el registro guardado
+    presupuesto = almacen.obtener_presupuesto(user_id, presupuesto_id)
+    if not presupuesto:
+        raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
+    return PresupuestoResponse(**presupuesto)
+
+@app.get("/api/presupuestos/{presupuesto_id}/pdf")
+async def pdf_presupuesto(presupuesto_id: int, user_id: int = Depends(get_current_user)):
+    datos = await ejecutar_db(almacen.datos_pdf_presupuesto, user_id, presupuesto_id)
+    presupuesto = datos["presupuesto"]
+    return await servir_pdf("presupuestos", presupuesto_id, presupuesto["version"], datos, f"{presupuesto['numero']}.pdf")
 
 @app.post("/api/presupuestos", response_model=PresupuestoResponse)
 def crear_presupuesto(presupuesto: PresupuestoCreate, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        # Calcular totales
-        subtotal = sum(l.cantidad * l.precio_unitario for l in presupuesto.lineas)
-        iva_amount = subtotal * (presupuesto.iva_porcentaje / 100) if presupuesto.aplicar_iva else 0
-        total = subtotal + iva_amount
-        
-        numero = generar_numero_presupuesto(user_id)
-        fecha_emision = datetime.now().strftime("%Y-%m-%d")
-        
-        cursor.execute(
-            """INSERT INTO presupuestos (usuario_id, cliente_id, numero, titulo, descripcion,
-               subtotal, iva_porcentaje, aplicar_iva, iva_amount, total, estado, fecha_emision, fecha_validez, notas)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'borrador', ?, ?, ?)""",
-            (user_id, presupuesto.cliente_id, numero, presupuesto.titulo, presupuesto.descripcion,
-             subtotal, presupuesto.iva_porcentaje, presupuesto.aplicar_iva, iva_amount, total,
-             fecha_emision, presupuesto.fecha_validez, presupuesto.notas)
-        )
-        presupuesto_id = cursor.lastrowid
-        
-        # Insertar líneas
-        for i, linea in enumerate(presupuesto.lineas):
-            total_linea = linea.cantidad * linea.precio_unitario
-            cursor.execute(
-                """INSERT INTO lineas_presupuesto (presupuesto_id, concepto, descripcion, cantidad, precio_unitario, total, orden)
-                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (presupuesto_id, linea.concepto, linea.descripcion, linea.cantidad, linea.precio_unitario, total_linea, i)
-            )
-        
-        conn.commit()
-        return obtener_presupuesto(presupuesto_id, user_id)
+    presupuesto_id = almacen.crear_presupuesto(user_id, presupuesto)
+    invalidar_cache(user_id)
+    return leer_presupuesto(presupuesto_id, user_id)
+
+def editar_presupuesto(presupuesto_id: int, user_id: int, version: int, cambios: dict,
+                       lineas: Optional[List[LineaPresupuesto]]) -> PresupuestoResponse:
+    almacen.editar_presupuesto(user_id, presupuesto_id, version, cambios, lineas)
+    invalidar_cache(user_id)
+    invalidar_pdf("presupuestos", presupuesto_id)
+    return leer_presupuesto(presupuesto_id, user_id)
+
+@app.put("/api/presupuestos/{presupuesto_id}", response_model=PresupuestoResponse)
+def actualizar_presupuesto(presupuesto_id: int, presupuesto: PresupuestoUpdate,
+                           user_id: int = Depends(get_current_user)):
+    # Conserva número, estado y fecha de emisión; las líneas se sustituyen por
+    # las enviadas aplicando solo las diferencias
+    cambios = presupuesto.model_dump(exclude={"version", "lineas"})
+    return editar_presupuesto(presupuesto_id, user_id, presupuesto.version, cambios, presupuesto.lineas)
+
+@app.patch("/api/presupuestos/{presupuesto_id}", response_model=PresupuestoResponse)
+def modificar_presupuesto(presupuesto_id: int, presupuesto: PresupuestoPatch,
+                          user_id: int = Depends(get_current_user)):
+    # Solo los campos enviados (y no nulos); sin "lineas", las líneas no se tocan
+    cambios = presupuesto.model_dump(exclude={"version", "lineas"}, exclude_unset=True, exclude_none=True)
+    return editar_presupuesto(presupuesto_id, user_id, presupuesto.version, cambios, presupuesto.lineas)
 
 @app.patch("/api/presupuestos/{presupuesto_id}/estado")
 def cambiar_estado_presupuesto(presupuesto_id: int, estado: str, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        # Si se rechaza, guardar fecha
-        fecha_rechazo = datetime.now().isoformat() if estado == "rechazado" else None
-        
-        if fecha_rechazo:
-            cursor.execute(
-                "UPDATE presupuestos SET estado = ?, fecha_rechazo = ? WHERE id = ? AND usuario_id = ?",
-                (estado, fecha_rechazo, presupuesto_id, user_id)
-            )
-        else:
-            cursor.execute(
-                "UPDATE presupuestos SET estado = ?, fecha_rechazo = NULL WHERE id = ? AND usuario_id = ?",
-                (estado, presupuesto_id, user_id)
-            )
-        
-        conn.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
-        return {"message": "Estado actualizado"}
+    # Si se rechaza, guardar fecha
+    fecha_rechazo = datetime.now().isoformat() if estado == "rechazado" else None
+    actualizado = almacen.cambiar_estado_presupuesto(user_id, presupuesto_id, estado, fecha_rechazo)
+    invalidar_cache(user_id)
+    invalidar_pdf("presupuestos", presupuesto_id)
+    if not actualizado:
+        raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
+    return {"message": "Estado actualizado"}
 
 @app.delete("/api/presupuestos/{presupuesto_id}")
 def eliminar_presupuesto(presupuesto_id: int, user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM presupuestos WHERE id = ? AND usuario_id = ?", (presupuesto_id, user_id))
-        conn.commit()
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
-        return {"message": "Presupuesto eliminado"}
+    eliminado = almacen.eliminar_presupuesto(user_id, presupuesto_id)
+    invalidar_cache(user_id)
+    invalidar_pdf("presupuestos", presupuesto_id)
+    if not eliminado:
+        raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
+    return {"message": "Presupuesto eliminado"}
+
+# ============ IMPORTACIÓN / EXPORTACIÓN ============
+
+FORMATOS_DATOS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+MODELOS_IMPORTACION = {
+    "clientes": ClienteCreate,
+    "visitas": VisitaCreate,
+    "presupuestos": PresupuestoCreate,
+}
+
+def formato_datos(formato: Optional[str], nombre_archivo: Optional[str] = None) -> str:
+    if formato is None and nombre_archivo:
+        formato = "ndjson" if nombre_archivo.lower().endswith((".ndjson", ".jsonl")) else "csv"
+    formato = formato or "csv"
+    if formato not in FORMATOS_DATOS:
+        raise HTTPException(status_code=400, detail="Formato no soportado (csv o ndjson)")
+    return formato
+
+def leer_filas(archivo, formato: str):
+    # Lectura incremental del archivo subido: genera (número de línea, fila)
+    texto = io.TextIOWrapper(archivo, encoding="utf-8-sig", newline="")
+    if formato == "ndjson":
+        for n, linea in enumerate(texto, start=1):
+            if linea.strip():
+                yield n, linea
+        return
+
+    lector = csv.DictReader(texto)
+    for fila in lector:
+        # En CSV las celdas vacías toman el valor por defecto del modelo
+        fila = {k: v for k, v in fila.items() if k and v not in (None, "")}
+        yield lector.line_num, fila
+
+def validar_fila(modelo, fila):
+    if isinstance(fila, str):
+        return modelo.model_validate_json(fila)
+    if "lineas" in fila and isinstance(fila["lineas"], str):
+        # En CSV las líneas del presupuesto van como JSON en una sola celda
+        try:
+            fila = dict(fila, lineas=json.loads(fila["lineas"]))
+        except ValueError:
+            raise ValueError("lineas: JSON inválido")
+    return modelo.model_validate(fila)
+
+def describir_error(exc: Exception) -> str:
+    if isinstance(exc, ValidationError):
+        return "; ".join(
+            f"{'.'.join(str(p) for p in e['loc']) or 'fila'}: {e['msg']}" for e in exc.errors()
+        )
+    return str(exc)
+
+def insertar_lote(entidad: str, user_id: int, lote: list, errores: list) -> int:
+    insertadas = almacen.importar_lote(user_id, entidad, lote, errores)
+    if insertadas:
+        invalidar_cache(user_id)
+    return insertadas
+
+@app.post("/api/importar/{entidad}")
+def importar_datos(
+    entidad: str,
+    archivo: UploadFile = File(...),
+    formato: Optional[str] = None,
+    user_id: int = Depends(get_current_user)
+):
+    if entidad not in MODELOS_IMPORTACION:
+        raise HTTPException(status_code=404, detail="Entidad no soportada")
+    formato = formato_datos(formato, archivo.filename)
+    modelo = MODELOS_IMPORTACION[entidad]
+
+    filas, insertadas = 0, 0
+    errores, lote = [], []
+    try:
+        for n, fila in leer_filas(archivo.file, formato):
+            filas += 1
+            try:
+                lote.append((n, validar_fila(modelo, fila)))
+            except (ValidationError, ValueError) as e:
+                errores.append({"fila": n, "error": describir_error(e)})
+            if len(lote) >= IMPORT_CHUNK_SIZE:
+                insertadas += insertar_lote(entidad, user_id, lote, errores)
+                lote = []
+    except (UnicodeDecodeError, csv.Error) as e:
+        errores.append({"fila": filas + 1, "error": f"Archivo ilegible: {e}"})
+    if lote:
+        insertadas += insertar_lote(entidad, user_id, lote, errores)
+
+    errores.sort(key=lambda e: e["fila"])
+    return {
+        "entidad": entidad,
+        "formato": formato,
+        "filas": filas,
+        "insertadas": insertadas,
+        "total_errores": len(errores),
+        "errores": errores[:IMPORT_MAX_ERRORS],
+    }
+
+def serializar_filas(filas: List[dict], columnas: List[str], formato: str) -> str:
+    if formato == "ndjson":
+        return "".join(json.dumps(f, ensure_ascii=False) + "\n" for f in filas)
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    for f in filas:
+        escritor.writerow([
+            json.dumps(f[c], ensure_ascii=False) if isinstance(f[c], list) else f[c]
+            for c in columnas
+        ])
+    return buffer.getvalue()
+
+def generar_exportacion(bloques, entidad: str, formato: str):
+    # `bloques` (almacen.exportar) solo tiene conexión una vez arrancado:
+    # cerrarlo la devuelve, también si el cliente corta la descarga
+    try:
+        columnas = COLUMNAS_EXPORTACION[entidad]
+        if entidad == "presupuestos":
+            columnas = columnas + ["lineas"]
+        if formato == "csv":
+            yield "\ufeff" + serializar_filas([dict(zip(columnas, columnas))], columnas, formato)
+        for filas in bloques:
+            yield serializar_filas(filas, columnas, formato)
+    finally:
+        bloques.close()
+
+@app.get("/api/exportar/{entidad}")
+def exportar_datos(entidad: str, formato: str = "csv", user_id: int = Depends(get_current_user)):
+    if entidad not in COLUMNAS_EXPORTACION:
+        raise HTTPException(status_code=404, detail="Entidad no soportada")
+    formato = formato_datos(formato)
+
+    nombre = f"{entidad}-{datetime.now().strftime('%Y%m%d')}.{formato}"
+    return StreamingResponse(
+        generar_exportacion(almacen.exportar(user_id, entidad), entidad, formato),
+        media_type=FORMATOS_DATOS[formato],
+        headers={"Content-Disposition": f'attachment; filename="{nombre}"'},
+    )
+
+# ============ ENDPOINTS SINCRONIZACIÓN ============
+
+@app.get("/api/sync", response_model=SyncResponse)
+def sincronizar(
+    cursor_sync: Annotated[Optional[str], Query(alias="cursor")] = None,
+    limite: Annotated[int, Query(ge=1, le=SYNC_PAGE_SIZE_MAX)] = SYNC_PAGE_SIZE,
+    user_id: int = Depends(get_current_user)
+):
+    # Cambios posteriores al cursor, en orden: los registros como los devuelven
+    # los listados y las bajas como ids. Sin cursor, todo lo que hay (sin
+    # marcas de borrado). El cursor de la respuesta es el siguiente a pedir
+    desde = decodificar_cursor(cursor_sync, 1)[0] if cursor_sync else 0
+    if not isinstance(desde, int):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    reiniciar, mas, cambios, filas = almacen.leer_cambios_sync(user_id, desde, limite)
+
+    respuesta = SyncResponse(
+        cursor=codificar_cursor([cambios[-1]["seq"] if cambios else (0 if reiniciar else desde)]),
+        mas=mas, reiniciar=reiniciar
+    )
+    for tabla in TABLAS_SYNC:
+        ids = [c["registro_id"] for c in cambios if c["tabla"] == tabla and not c["borrado"]]
+        borrados = [c["registro_id"] for c in cambios if c["tabla"] == tabla and c["borrado"]]
+        if ids:
+            registros = [MODELOS_RESPUESTA[tabla](**fila) for fila in filas.get(tabla, ())]
+            setattr(respuesta, tabla, registros)
+            # Lo que ya no sale en los listados (visita de un cliente
+            # borrado...) se quita también de la copia local
+            encontrados = {r.id for r in registros}
+            borrados += [i for i in ids if i not in encontrados]
+        setattr(respuesta.borrados, tabla, borrados)
+    return respuesta
+
+# (entidad, acción) -> (modelo de `datos` o None, función(id, datos, user_id)).
+# Cada operación se aplica con el mismo código que su endpoint REST
+ACCIONES_SYNC = {
+    ("clientes", "crear"): (ClienteCreate, lambda _, datos, user_id: crear_cliente(datos, user_id)),
+    ("clientes", "actualizar"): (ClienteCreate, actualizar_cliente),
+    ("clientes", "eliminar"): (None, lambda registro_id, _, user_id: eliminar_cliente(registro_id, user_id)),
+    ("visitas", "crear"): (VisitaCreate, lambda _, datos, user_id: crear_visita(datos, user_id)),
+    ("visitas", "actualizar"): (VisitaCreate, actualizar_visita),
+    ("visitas", "estado"): (
+        EstadoSync, lambda registro_id, datos, user_id: cambiar_estado_visita(registro_id, datos.estado, user_id)
+    ),
+    ("visitas", "completar"): (CompletarVisita, completar_visita),
+    ("visitas", "eliminar"): (None, lambda registro_id, _, user_id: eliminar_visita(registro_id, user_id)),
+    ("presupuestos", "crear"): (PresupuestoCreate, lambda _, datos, user_id: crear_presupuesto(datos, user_id)),
+    ("presupuestos", "actualizar"): (PresupuestoUpdate, actualizar_presupuesto),
+    ("presupuestos", "modificar"): (PresupuestoPatch, modificar_presupuesto),
+    ("presupuestos", "estado"): (
+        EstadoSync, lambda registro_id, datos, user_id: cambiar_estado_presupuesto(registro_id, datos.estado, user_id)
+    ),
+    ("presupuestos", "eliminar"): (None, lambda registro_id, _, user_id: eliminar_presupuesto(registro_id, user_id)),
+}
+
+def resolver_id_local(registro_id: Optional[int], ids: dict) -> Optional[int]:
+    # Los registros creados offline llevan un id local negativo hasta subirse
+    if registro_id is None or registro_id > 0:
+        return registro_id
+    if registro_id not in ids:
+        raise HTTPException(status_code=400, detail=f"Id local {registro_id} desconocido")
+    return ids[registro_id]
+
+def aplicar_operacion_sync(operacion: OperacionSync, user_id: int, ids: dict) -> dict:
+    if (operacion.entidad, operacion.accion) not in ACCIONES_SYNC:
+        raise HTTPException(status_code=400, detail=f"Operación no soportada: {operacion.entidad}.{operacion.accion}")
+    modelo, funcion = ACCIONES_SYNC[(operacion.entidad, operacion.accion)]
+    datos = None
+    if modelo is not None:
+        valores = dict(operacion.datos)
+        if "cliente_id" in valores and isinstance(valores["cliente_id"], int):
+            valores["cliente_id"] = resolver_id_local(valores["cliente_id"], ids)
+        datos = modelo.model_validate(valores)
+    if operacion.accion == "crear":
+        resultado = funcion(None, datos, user_id)
+    elif operacion.id is None:
+        raise HTTPException(status_code=400, detail="Falta el id del registro")
+    else:
+        resultado = funcion(resolver_id_local(operacion.id, ids), datos, user_id)
+    return jsonable_encoder(resultado)
+
+@app.post("/api/sync", response_model=SubidaSyncResponse)
+def subir_cambios(subida: SubidaSync, user_id: int = Depends(get_current_user)):
+    # Aplica en orden las operaciones encoladas offline. Cada una va en su
+    # propia transacción junto con su `id_peticion`, así que reenviar el lote
+    # (porque se cortó la respuesta) no repite nada: devuelve lo guardado.
+    # Los errores del cliente (4xx) también se guardan; ante uno temporal se
+    # para y el resto queda pendiente para el siguiente intento
+    if len(subida.operaciones) > SYNC_MAX_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"Máximo {SYNC_MAX_OPERATIONS} operaciones por envío")
+    if any(not 0 < len(op.id_peticion) <= 64 for op in subida.operaciones):
+        raise HTTPException(status_code=400, detail="id_peticion debe tener entre 1 y 64 caracteres")
+
+    respuesta = SubidaSyncResponse()
+    ids = {}
+    with almacen.transaccion():
+        for n, operacion in enumerate(subida.operaciones):
+            previa = almacen.peticion_sync(user_id, operacion.id_peticion)
+            if previa:
+                resultado = ResultadoOperacionSync(
+                    id_peticion=operacion.id_peticion, estado=previa["estado"] or 200, repetida=True,
+                    **json.loads(previa["resultado"] or "{}")
+                )
+            else:
+                try:
+                    almacen.registrar_peticion_sync(user_id, operacion.id_peticion)
+                    resultado = ResultadoOperacionSync(
+                        id_peticion=operacion.id_peticion, estado=200,
+                        resultado=aplicar_operacion_sync(operacion, user_id, ids)
+                    )
+                except HTTPException as e:
+                    almacen.deshacer()
+                    if e.status_code >= 500:
+                        respuesta.pendientes = len(subida.operaciones) - n
+                        break
+                    resultado = ResultadoOperacionSync(
+                        id_peticion=operacion.id_peticion, estado=e.status_code, error=str(e.detail)
+                    )
+                except ValidationError as e:
+                    almacen.deshacer()
+                    resultado = ResultadoOperacionSync(
+                        id_peticion=operacion.id_peticion, estado=422, error=describir_error(e)
+                    )
+                except Exception:
+                    almacen.deshacer()
+                    logger.exception("Sincronización: error al aplicar %s", operacion.id_peticion)
+                    respuesta.pendientes = len(subida.operaciones) - n
+                    break
+                guardado = resultado.model_dump(include={"resultado", "error"}, exclude_none=True)
+                almacen.guardar_peticion_sync(user_id, operacion.id_peticion, resultado.estado, json.dumps(guardado))
+
+            if (operacion.accion == "crear" and operacion.id is not None and operacion.id < 0
+                    and resultado.resultado and "id" in resultado.resultado):
+                ids[operacion.id] = resultado.resultado["id"]
+            respuesta.resultados.append(resultado)
+    # Con PostgreSQL cada operación se confirma con su `id_peticion`, después
+    # de que su endpoint haya invalidado la caché
+    invalidar_cache(user_id)
+    respuesta.ids = ids
+    return respuesta
+
+# ============ ENDPOINT BÚSQUEDA ============
+
+@app.get("/api/buscar", response_model=BusquedaResponse)
+@condicional("clientes", "visitas", "presupuestos")
+@cacheado
+def buscar(
+    q: Annotated[str, Query(min_length=1, max_length=200)],
+    tipos: Optional[str] = None,
+    limite: Annotated[int, Query(ge=1, le=50)] = 10,
+    user_id: int = Depends(get_current_user)
+):
+    # Resultados por entidad, ordenados por relevancia (bm25 en SQLite,
+    # ts_rank en PostgreSQL). `tipos` limita la búsqueda a algunas entidades,
+    # separadas por comas
+    entidades = {"clientes", "visitas", "presupuestos"}
+    pedidas = set(tipos.split(",")) if tipos else entidades
+    if not pedidas <= entidades:
+        raise HTTPException(status_code=400, detail=f"Tipos válidos: {', '.join(sorted(entidades))}")
+
+    resultado = BusquedaResponse()
+    if not re.search(r"\w", q):
+        return resultado
+
+    filas = almacen.buscar(user_id, q, pedidas, limite)
+    resultado.clientes = [
+        ResultadoBusqueda(
+            id=row["id"], titulo=f"{row['nombre']} {row['apellidos'] or ''}".strip(),
+            subtitulo=row["telefono"], cliente_id=row["id"]
+        )
+        for row in filas.get("clientes", ())
+    ]
+    resultado.visitas = [
+        ResultadoBusqueda(id=row["id"], titulo=row["titulo"], subtitulo=row["fecha"], cliente_id=row["cliente_id"])
+        for row in filas.get("visitas", ())
+    ]
+    resultado.presupuestos = [
+        ResultadoBusqueda(id=row["id"], titulo=row["titulo"], subtitulo=row["numero"], cliente_id=row["cliente_id"])
+        for row in filas.get("presupuestos", ())
+    ]
+    return resultado
 
 # ============ ENDPOINT DASHBOARD ============
 
 @app.get("/api/dashboard")
+@condicional("clientes", "visitas", "presupuestos")
+@cacheado
 def get_dashboard(user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        hoy = datetime.now().strftime("%Y-%m-%d")
-        
-        # Visitas hoy
-        cursor.execute("SELECT COUNT(*) FROM visitas WHERE usuario_id = ? AND fecha = ?", (user_id, hoy))
-        visitas_hoy = cursor.fetchone()[0]
-        
-        # Visitas pendientes
-        cursor.execute("SELECT COUNT(*) FROM visitas WHERE usuario_id = ? AND estado IN ('pendiente', 'confirmada')", (user_id,))
-        visitas_pendientes = cursor.fetchone()[0]
-        
-        # Total clientes
-        cursor.execute("SELECT COUNT(*) FROM clientes WHERE usuario_id = ?", (user_id,))
-        total_clientes = cursor.fetchone()[0]
-        
-        # Presupuestos pendientes
-        cursor.execute("SELECT COUNT(*) FROM presupuestos WHERE usuario_id = ? AND estado IN ('borrador', 'enviado')", (user_id,))
-        presupuestos_pendientes = cursor.fetchone()[0]
-        
-        # Facturación mes (presupuestos aceptados)
-        mes_actual = datetime.now().strftime("%Y-%m")
-        cursor.execute(
-            "SELECT COALESCE(SUM(total), 0) FROM presupuestos WHERE usuario_id = ? AND estado = 'aceptado' AND fecha_emision LIKE ?",
-            (user_id, f"{mes_actual}%")
-        )
-        facturacion_mes = cursor.fetchone()[0]
-        
-        return {
-            "visitas_hoy": visitas_hoy,
-            "visitas_pendientes": visitas_pendientes,
-            "total_clientes": total_clientes,
-            "presupuestos_pendientes": presupuestos_pendientes,
-            "facturacion_mes": facturacion_mes
-        }
+    hoy = datetime.now().strftime("%Y-%m-%d")
+    mes_actual = datetime.now().strftime("%Y-%m")
+    
+    c = almacen.contadores(user_id, [
+        f"visitas:fecha:{hoy}",
+        "visitas:estado:pendiente",
+        "visitas:estado:confirmada",
+        "clientes",
+        "presupuestos:estado:borrador",
+        "presupuestos:estado:enviado",
+        f"facturacion:{mes_actual}",
+    ])
+    
+    return {
+        "visitas_hoy": int(c[f"visitas:fecha:{hoy}"]),
+        "visitas_pendientes": int(c["visitas:estado:pendiente"] + c["visitas:estado:confirmada"]),
+        "total_clientes": int(c["clientes"]),
+        "presupuestos_pendientes": int(c["presupuestos:estado:borrador"] + c["presupuestos:estado:enviado"]),
+        "facturacion_mes": round(c[f"facturacion:{mes_actual}"], 2)
+    }
 
 # ============ ENDPOINT ESTADÍSTICAS ============
 
 @app.get("/api/estadisticas/presupuestos")
+@condicional("presupuestos")
+@cacheado
 def estadisticas_presupuestos(user_id: int = Depends(get_current_user)):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM presupuestos WHERE usuario_id = ?", (user_id,))
-        total = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM presupuestos WHERE usuario_id = ? AND estado = 'aceptado'", (user_id,))
-        aceptados = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM presupuestos WHERE usuario_id = ? AND estado IN ('borrador', 'enviado')", (user_id,))
-        pendientes = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM presupuestos WHERE usuario_id = ? AND estado = 'rechazado'", (user_id,))
-        rechazados = cursor.fetchone()[0]
-        
-        tasa_conversion = (aceptados / total * 100) if total > 0 else 0
-        
-        return {
-            "total": total,
-            "aceptados": aceptados,
-            "pendientes": pendientes,
-            "rechazados": rechazados,
-            "tasa_conversion": round(tasa_conversion, 1)
+    # Contadores por estado (incluidos estados no estándar para el total)
+    por_estado = almacen.presupuestos_por_estado(user_id)
+    
+    total = sum(por_estado.values())
+    aceptados = por_estado.get("aceptado", 0)
+    pendientes = por_estado.get("borrador", 0) + por_estado.get("enviado", 0)
+    rechazados = por_estado.get("rechazado", 0)
+    
+    tasa_conversion = (aceptados / total * 100) if total > 0 else 0
+    
+    return {
+        "total": total,
+        "aceptados": aceptados,
+        "pendientes": pendientes,
+        "rechazados": rechazados,
+        "tasa_conversion": round(tasa_conversion, 1)
+    }
+
+# Tareas sobre ficheros locales: con la BD compartida entre varias máquinas
+# cada una tiene que hacer la suya, así que se bloquean por nodo
+TAREAS_POR_NODO = {"limpiar_pdf"}
+
+class Planificador:
+    """Ejecuta las tareas programadas del almacén en un hilo de fondo. La tabla
+    `tareas_programadas` guarda cuándo toca cada una y hace de bloqueo: con
+    varios workers, cada ejecución la hace solo el que consigue marcarla."""
+
+    def __init__(self, tareas: dict, dry_run: bool = SCHEDULER_DRY_RUN):
+        self.tareas = tareas
+        self.dry_run = dry_run
+        self.propietario = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self._parar = threading.Event()
+        self._hilo = None
+        self._lock = threading.Lock()
+        self._metricas = {
+            nombre: {"ejecuciones": 0, "errores": 0, "ultima_ejecucion": None,
+                     "ultima_duracion_ms": None, "ultimo_resultado": None, "ultimo_error": None}
+            for nombre in tareas
         }
 
+    def iniciar(self):
+        if self._hilo is None:
+            self._parar.clear()
+            self._hilo = threading.Thread(target=self._bucle, name="planificador", daemon=True)
+            self._hilo.start()
+
+    def detener(self, timeout: float = 10):
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout)
+            self._hilo = None
+
+    def _bucle(self):
+        while not self._parar.wait(SCHEDULER_TICK_SECONDS):
+            for nombre in self.tareas:
+                if self._parar.is_set():
+                    break
+                try:
+                    self.ejecutar(nombre)
+                except Exception:
+                    logger.exception("Tarea programada %s: no se pudo ejecutar", nombre)
+
+    def ejecutar(self, nombre: str, forzar: bool = False) -> Optional[dict]:
+        # Ejecuta la tarea si le toca (o ya, con forzar) y nadie la tiene.
+        # Devuelve su resumen, o None si no se ha ejecutado
+        intervalo, funcion = self.tareas[nombre]
+        clave = f"{nombre}@{socket.gethostname()}" if DB_BACKEND != "sqlite" and nombre in TAREAS_POR_NODO else nombre
+        if not almacen.tomar_tarea(clave, self.propietario, forzar):
+            return None
+        inicio = time.monotonic()
+        resultado, error = None, None
+        try:
+            resultado = almacen.ejecutar_tarea(nombre, funcion, self.dry_run)
+            if self.dry_run:
+                resultado = {"dry_run": True, **resultado}
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            logger.exception("Tarea programada %s: error", nombre)
+        duracion_ms = round((time.monotonic() - inicio) * 1000, 2)
+        ahora = time.time()
+        almacen.cerrar_tarea(clave, self.propietario, ahora + intervalo, ahora, duracion_ms,
+                             json.dumps(resultado), error)
+
+        with self._lock:
+            metricas = self._metricas[nombre]
+            metricas["ejecuciones"] += 1
+            metricas["errores"] += error is not None
+            metricas["ultima_ejecucion"] = datetime.fromtimestamp(ahora).isoformat(timespec="seconds")
+            metricas["ultima_duracion_ms"] = duracion_ms
+            metricas["ultimo_resultado"] = resultado
+            metricas["ultimo_error"] = error
+        return resultado if error is None else {"error": error}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "activo": self._hilo is not None and self._hilo.is_alive(),
+                "dry_run": self.dry_run,
+                "tareas": {
+                    nombre: {"intervalo_s": self.tareas[nombre][0], **dict(metricas)}
+                    for nombre, metricas in self._metricas.items()
+                },
+            }
+
+planificador = Planificador(almacen.tareas_programadas())
+
+# ============ ENDPOINTS ANALÍTICA ============
+
+ANALITICA_MAX_DIAS_DIARIOS = 366
+
+def rango_analitica(desde: Optional[str], hasta: Optional[str]) -> tuple:
+    # Por defecto, los últimos doce meses naturales hasta hoy
+    fin = fecha_parametro(hasta, "hasta") if hasta else date.today()
+    if desde:
+        inicio = fecha_parametro(desde, "desde")
+    else:
+        meses = fin.year * 12 + fin.month - 1 - 11
+        inicio = date(meses // 12, meses % 12 + 1, 1)
+    if fin < inicio:
+        raise HTTPException(status_code=400, detail="hasta debe ser igual o posterior a desde")
+    return inicio, fin
+
+def sumar_metricas(filas: List[dict], metricas) -> dict:
+    return {m: sum(fila[m] for fila in filas) for m in metricas}
+
+def metricas_presupuestos(fila: dict) -> MetricasPresupuestos:
+    return MetricasPresupuestos(**{
+        **fila,
+        "importe": round(fila["importe"], 2),
+        "facturado": round(fila["facturado"], 2),
+        "ticket_medio": round(fila["facturado"] / fila["aceptados"], 2) if fila["aceptados"] else 0,
+        "tasa_conversion": round(fila["aceptados"] / fila["emitidos"] * 100, 1) if fila["emitidos"] else 0,
+    })
+
+def metricas_visitas(fila: dict) -> MetricasVisitas:
+    return MetricasVisitas(**{
+        **fila,
+        "tasa_completadas": round(fila["completadas"] / fila["total"] * 100, 1) if fila["total"] else 0,
+    })
+
+@app.get("/api/analitica/presupuestos", response_model=AnaliticaPresupuestosResponse)
+@condicional("presupuestos", "clientes")
+@cacheado
+def analitica_presupuestos(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    agrupar: Annotated[str, Query(pattern="^(dia|mes)$")] = "mes",
+    por: Annotated[Optional[str], Query(pattern="^cliente$")] = None,
+    user_id: int = Depends(get_current_user)
+):
+    # Presupuestos emitidos en el rango (por fecha de emisión): cuántos se
+    # aceptaron o rechazaron, importe, facturación y ticket medio
+    inicio, fin = rango_analitica(desde, hasta)
+    if agrupar == "dia" and (fin - inicio).days >= ANALITICA_MAX_DIAS_DIARIOS:
+        raise HTTPException(status_code=400, detail=f"Por días el rango no puede superar {ANALITICA_MAX_DIAS_DIARIOS} días")
+    filas = almacen.analitica("analitica_presupuestos", user_id, inicio, fin, agrupar, por)
+    return AnaliticaPresupuestosResponse(
+        desde=inicio.isoformat(), hasta=fin.isoformat(), agrupar=agrupar, por=por,
+        totales=metricas_presupuestos(sumar_metricas(filas, ROLLUPS["analitica_presupuestos"][3])),
+        series=[metricas_presupuestos(fila) for fila in filas]
+    )
+
+@app.get("/api/analitica/visitas", response_model=AnaliticaVisitasResponse)
+@condicional("visitas")
+@cacheado
+def analitica_visitas(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    agrupar: Annotated[str, Query(pattern="^(dia|mes)$")] = "mes",
+    por: Annotated[Optional[str], Query(pattern="^tipo$")] = None,
+    user_id: int = Depends(get_current_user)
+):
+    # Visitas del rango (por fecha de la visita): total, completadas y canceladas
+    inicio, fin = rango_analitica(desde, hasta)
+    if agrupar == "dia" and (fin - inicio).days >= ANALITICA_MAX_DIAS_DIARIOS:
+        raise HTTPException(status_code=400, detail=f"Por días el rango no puede superar {ANALITICA_MAX_DIAS_DIARIOS} días")
+    filas = almacen.analitica("analitica_visitas", user_id, inicio, fin, agrupar, por)
+    return AnaliticaVisitasResponse(
+        desde=inicio.isoformat(), hasta=fin.isoformat(), agrupar=agrupar, por=por,
+        totales=metricas_visitas(sumar_metricas(filas, ROLLUPS["analitica_visitas"][3])),
+        series=[metricas_visitas(fila) for fila in filas]
+    )
+
 # ============ HEALTH CHECK ============
 
 @app.get("/")
@@ -837,8 +1993,185 @@ def root():
 
 @app.get("/health")
 def health():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "db_backend": DB_BACKEND,
+        "db_pool": almacen.stats(),
+        "cache": response_cache.stats(),
+        "auth": auth_pool.stats(),
+        "pdf": {**pdf_pool.stats(), **pdf_stats},
+        "tokens": {**token_cache.stats(), **revocaciones.stats()},
+        "db_mode": DB_MODE,
+        "db_executor": db_executor.stats(),
+        "scheduler": planificador.stats(),
+        **({"db_shards": shards.stats()} if DB_SHARDING != "no" else {}),
+    }
+
+@app.get("/metrics", include_in_schema=False)
+def metrics(request: Request):
+    # Formato de texto de Prometheus; cada worker expone sus propias métricas
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if METRICS_TOKEN and not secrets.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=401, detail="No autorizado")
+    lineas = [
+        "# HELP tecnigestion_http_requests_in_progress Peticiones HTTP en curso",
+        "# TYPE tecnigestion_http_requests_in_progress gauge",
+        f"tecnigestion_http_requests_in_progress {metricas.http_en_curso}",
+    ]
+    for metrica in (http_peticiones, http_latencia, http_entrada, http_salida, http_consultas,
+                    sql_latencia, sql_lentas):
+        lineas += metrica.exportar()
+    lineas += estadisticas_sql.exportar()
+    lineas += exportar_stats("db_pool", almacen.stats())
+    lineas += exportar_stats("db_executor", db_executor.stats())
+    if DB_SHARDING != "no":
+        lineas += exportar_stats("db_shards", shards.stats())
+    lineas += exportar_stats("cache", response_cache.stats())
+    lineas += exportar_stats("auth_pool", auth_pool.stats())
+    lineas += exportar_stats("pdf", {**pdf_pool.stats(), **pdf_stats})
+    lineas += exportar_stats("tokens", {**token_cache.stats(), **revocaciones.stats()})
+    tareas = planificador.stats()["tareas"]
+    for clave in ("ejecuciones", "errores", "ultima_duracion_ms"):
+        nombre = f"tecnigestion_scheduler_{clave}"
+        lineas.append(f"# TYPE {nombre} gauge")
+        lineas += [
+            f"{nombre}{etiquetas_prometheus(('tarea',), (tarea,))} {numero_prometheus(datos[clave])}"
+            for tarea, datos in tareas.items() if datos[clave] is not None
+        ]
+    return Response("\n".join(lineas) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    # Arranque y parada de la app: tareas programadas y pools
+    if SCHEDULER_ENABLED:
+        planificador.iniciar()
+    yield
+    planificador.detener()
+    auth_pool.close()
+    pdf_pool.close()
+    db_executor.close()
+    almacen.close()
+
+app.router.lifespan_context = ciclo_de_vida
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="TecniGestión API")
+    comandos = parser.add_subparsers(dest="comando")
+    comandos.add_parser("serve", help="Arrancar el servidor (por defecto)")
+    cmd_resumen = comandos.add_parser("resumen", help="Verificar o reconstruir los contadores y agregados")
+    cmd_resumen.add_argument("--usuario", type=int, help="Limitar a un usuario")
+    cmd_resumen.add_argument("--reconstruir", action="store_true", help="Recalcular desde cero tras verificar")
+    cmd_mantenimiento = comandos.add_parser("mantenimiento", help="Ejecutar ya las tareas programadas")
+    cmd_mantenimiento.add_argument("tareas", nargs="*", metavar="tarea",
+                                   help=f"Tareas a ejecutar (por defecto, todas): {', '.join(planificador.tareas)}")
+    cmd_mantenimiento.add_argument("--dry-run", action="store_true", help="Informar sin modificar nada")
+    cmd_mantenimiento.add_argument("--vacuum-completo", action="store_true",
+                                   help="VACUUM completo para activar auto_vacuum incremental")
+    cmd_shards = comandos.add_parser("shards", help="Reparto de los usuarios en shards (DB_SHARDING)")
+    acciones_shards = cmd_shards.add_subparsers(dest="accion", required=True)
+    acciones_shards.add_parser("estado", help="Usuarios y tamaño de cada shard")
+    cmd_migrar = acciones_shards.add_parser("migrar", help="Trasladar usuarios de la BD principal a su shard")
+    cmd_migrar.add_argument("--usuario", type=int, action="append", dest="usuarios", default=[], metavar="ID")
+    cmd_migrar.add_argument("--todos", action="store_true", help="Todos los que siguen en la BD principal")
+    cmd_migrar.add_argument("--propio", action="store_true", help="Un fichero por usuario aunque DB_SHARDING=fijo")
+    cmd_migrar.add_argument("--espera", type=float, default=DB_SHARD_CACHE_SECONDS + 1,
+                            help="Segundos a esperar a que los workers dejen de atender al usuario")
+    cmd_postgres = comandos.add_parser("postgres", help="Utilidades de DB_BACKEND=postgres")
+    acciones_postgres = cmd_postgres.add_subparsers(dest="accion", required=True)
+    cmd_copiar = acciones_postgres.add_parser("copiar-sqlite", help="Copiar una BD SQLite (y sus shards) a DATABASE_URL")
+    cmd_copiar.add_argument("--origen", default=DATABASE_PATH, help="BD SQLite principal")
+    cmd_copiar.add_argument("--shards", default=DB_SHARD_DIR, help="Carpeta de sus shards")
+    args = parser.parse_args()
+    
+    if args.comando == "shards" and DB_BACKEND != "sqlite":
+        parser.error(f"{args.comando}: solo con DB_BACKEND=sqlite")
+    if args.comando == "resumen" and DB_BACKEND == "postgres":
+        desviaciones, diferencias = almacen.verificar_resumen(args.usuario)
+        for d in desviaciones:
+            print(f"usuario {d['usuario_id']} {d['clave']}: esperado {d['esperado']}, guardado {d['actual']}")
+        print(f"{len(desviaciones)} desviaciones encontradas")
+        for tabla, filas in diferencias.items():
+            print(f"{tabla}: {filas} filas distintas")
+        if args.reconstruir:
+            almacen.reconstruir_resumen(args.usuario)
+            print("Contadores y agregados reconstruidos")
+    elif args.comando == "resumen":
+        # La BD principal y cada shard por separado (o solo la del usuario)
+        if args.usuario is not None:
+            bases = [("", lambda: get_db(args.usuario))]
+        else:
+            bases = [("", lambda: get_db(principal=True))]
+            bases += [(f"[{shard}] ", functools.partial(shards.conexion_directa, shard)) for shard in shards.nombres()]
+        for prefijo, conexion in bases:
+            with conexion() as conn:
+                desviaciones = verificar_resumen(conn, args.usuario)
+                for d in desviaciones:
+                    print(f"{prefijo}usuario {d['usuario_id']} {d['clave']}: esperado {d['esperado']}, guardado {d['actual']}")
+                print(f"{prefijo}{len(desviaciones)} desviaciones encontradas")
+                for tabla, diferencias in verificar_analitica(conn, args.usuario).items():
+                    print(f"{prefijo}{tabla}: {diferencias} filas distintas")
+                if args.reconstruir:
+                    reconstruir_resumen(conn, args.usuario)
+                    reconstruir_analitica(conn, args.usuario)
+                    conn.commit()
+                    print(f"{prefijo}Contadores y agregados reconstruidos")
+    elif args.comando == "mantenimiento":
+        desconocidas = set(args.tareas) - set(planificador.tareas)
+        if desconocidas:
+            parser.error(f"tareas desconocidas: {', '.join(sorted(desconocidas))}")
+        if args.vacuum_completo and DB_BACKEND != "sqlite":
+            parser.error("--vacuum-completo: solo con DB_BACKEND=sqlite")
+        if args.vacuum_completo and not args.dry_run:
+            with get_db() as conn:
+                vacuum_completo(conn)
+            print("VACUUM completo hecho")
+        planificador.dry_run = planificador.dry_run or args.dry_run
+        for nombre in args.tareas or planificador.tareas:
+            resultado = planificador.ejecutar(nombre, forzar=True)
+            print(f"{nombre}: {'en curso en otro proceso' if resultado is None else json.dumps(resultado)}")
+    elif args.comando == "shards":
+        if DB_SHARDING == "no":
+            parser.error("DB_SHARDING=no: no hay shards")
+        with get_db(principal=True) as conn:
+            en_principal = [fila[0] for fila in conn.execute(
+                "SELECT id FROM usuarios WHERE id NOT IN (SELECT usuario_id FROM directorio_shards) ORDER BY id"
+            )]
+            repartidos = conn.execute(
+                "SELECT shard, COUNT(*) AS usuarios, SUM(estado != 'activo') AS migrando "
+                "FROM directorio_shards GROUP BY shard ORDER BY shard"
+            ).fetchall()
+        if args.accion == "estado":
+            print(f"BD principal: {len(en_principal)} usuarios")
+            for fila in repartidos:
+                ruta = shards.ruta(fila["shard"])
+                tamano = sum(os.path.getsize(r) for r in (ruta, f"{ruta}-wal") if os.path.exists(r))
+                print(f"{fila['shard']}: {fila['usuarios']} usuarios ({fila['migrando']} migrando), "
+                      f"{tamano / 1024 / 1024:.1f} MB")
+        else:
+            usuarios = args.usuarios + (en_principal if args.todos else [])
+            if not usuarios:
+                parser.error("indica --usuario o --todos")
+            for usuario_id in dict.fromkeys(usuarios):
+                try:
+                    resultado = shards.migrar(usuario_id, propio=args.propio, espera=args.espera)
+                except ValueError as e:
+                    print(f"usuario {usuario_id}: {e}")
+                    continue
+                print(json.dumps(resultado))
+    elif args.comando == "postgres":
+        if DB_BACKEND != "postgres":
+            parser.error("postgres: solo con DB_BACKEND=postgres")
+        try:
+            copiadas = almacen.copiar_sqlite(args.origen, args.shards)
+        except ValueError as e:
+            parser.error(str(e))
+        for tabla, filas in copiadas.items():
+            print(f"{tabla}: {filas} filas")
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,405 @@
+"""
+Métricas Prometheus e instrumentación de las consultas SQL.
+"""
+
+from typing import List
+import contextvars
+import bisect
+import hashlib
+import sqlite3
+import re
+import threading
+import time
+
+from config import logger, METRICS_MAX_STATEMENTS, SLOW_QUERY_MS, SLOW_QUERY_EXPLAIN, QUERIES_PER_REQUEST_WARN
+
+# ============ MÉTRICAS ============
+
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_BYTES = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152, 8388608)
+BUCKETS_CONSULTAS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+BUCKETS_SQL = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+def etiquetas_prometheus(nombres: tuple, valores: tuple) -> str:
+    if not nombres:
+        return ""
+    escapados = (
+        str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in valores
+    )
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(nombres, escapados)) + "}"
+
+def numero_prometheus(valor) -> str:
+    if isinstance(valor, float):
+        return "+Inf" if valor == float("inf") else repr(round(valor, 6))
+    return str(int(valor))
+
+class Contador:
+    """Contador por etiquetas en formato de texto de Prometheus."""
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def sumar(self, valores: tuple = (), cantidad: float = 1):
+        with self._lock:
+            self._valores[valores] = self._valores.get(valores, 0) + cantidad
+
+    def exportar(self) -> List[str]:
+        with self._lock:
+            valores = sorted(self._valores.items())
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        lineas += [
+            f"{self.nombre}{etiquetas_prometheus(self.etiquetas, etiquetas)} {numero_prometheus(valor)}"
+            for etiquetas, valor in valores
+        ]
+        return lineas
+
+class Histograma:
+    """Histograma por etiquetas con límites fijos; exporta los buckets
+    acumulados, la suma y el recuento como espera Prometheus."""
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple, limites: tuple):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.limites = limites
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observar(self, valores: tuple, valor: float):
+        posicion = bisect.bisect_left(self.limites, valor)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [[0] * (len(self.limites) + 1), 0.0]
+            serie[0][posicion] += 1
+            serie[1] += valor
+
+    def exportar(self) -> List[str]:
+        with self._lock:
+            series = sorted((etiquetas, list(cuentas), suma) for etiquetas, (cuentas, suma) in self._series.items())
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        nombres_le = (*self.etiquetas, "le")
+        for etiquetas, cuentas, suma in series:
+            acumulado = 0
+            for limite, cuenta in zip((*self.limites, float("inf")), cuentas):
+                acumulado += cuenta
+                le = etiquetas_prometheus(nombres_le, (*etiquetas, numero_prometheus(float(limite))))
+                lineas.append(f"{self.nombre}_bucket{le} {acumulado}")
+            etiquetas_serie = etiquetas_prometheus(self.etiquetas, etiquetas)
+            lineas.append(f"{self.nombre}_sum{etiquetas_serie} {numero_prometheus(suma)}")
+            lineas.append(f"{self.nombre}_count{etiquetas_serie} {acumulado}")
+        return lineas
+
+http_peticiones = Contador(
+    "tecnigestion_http_requests_total", "Peticiones HTTP por ruta, método y código de estado",
+    ("route", "method", "status"))
+http_latencia = Histograma(
+    "tecnigestion_http_request_duration_seconds", "Tiempo hasta enviar el último byte de la respuesta",
+    ("route", "method"), BUCKETS_LATENCIA)
+http_entrada = Histograma(
+    "tecnigestion_http_request_size_bytes", "Tamaño del cuerpo de la petición",
+    ("route", "method"), BUCKETS_BYTES)
+http_salida = Histograma(
+    "tecnigestion_http_response_size_bytes", "Tamaño del cuerpo de la respuesta",
+    ("route", "method"), BUCKETS_BYTES)
+http_consultas = Histograma(
+    "tecnigestion_http_request_db_queries", "Consultas SQL ejecutadas por petición",
+    ("route", "method"), BUCKETS_CONSULTAS)
+sql_latencia = Histograma(
+    "tecnigestion_db_query_duration_seconds", "Duración de execute() por tipo de sentencia",
+    ("statement",), BUCKETS_SQL)
+sql_lentas = Contador(
+    "tecnigestion_db_slow_queries_total", f"Consultas por encima de SLOW_QUERY_MS ({SLOW_QUERY_MS:g} ms)")
+http_en_curso = 0
+
+class ConsultasPeticion:
+    """Consultas SQL de la petición en curso (contextvar del middleware)."""
+    __slots__ = ("scope", "total", "segundos", "por_sentencia")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.total = 0
+        self.segundos = 0.0
+        self.por_sentencia = {}
+
+_consultas_peticion = contextvars.ContextVar("consultas_peticion", default=None)
+
+class EstadisticasSQL:
+    """Llamadas, tiempo y filas acumulados por sentencia normalizada (espacios
+    colapsados y listas de `?` reducidas a una). Pasado METRICS_MAX_STATEMENTS
+    sentencias distintas, el resto se agrupa en "(otras)"."""
+
+    _LISTA_PARAMETROS = re.compile(r"\?(\s*,\s*\?)+")
+
+    def __init__(self, max_sentencias: int = METRICS_MAX_STATEMENTS):
+        self.max_sentencias = max_sentencias
+        self._claves = {}
+        self._sentencias = {}
+        self._lock = threading.Lock()
+
+    def clave(self, sql: str) -> str:
+        clave = self._claves.get(sql)
+        if clave is None:
+            clave = self._LISTA_PARAMETROS.sub("?, ...", " ".join(sql.split()))
+            with self._lock:
+                if len(self._sentencias) >= self.max_sentencias and clave not in self._sentencias:
+                    clave = "(otras)"
+                if len(self._claves) < self.max_sentencias * 4:
+                    self._claves[sql] = clave
+        return clave
+
+    def registrar(self, clave: str, segundos: float, filas: int = 0, llamadas: int = 1):
+        with self._lock:
+            datos = self._sentencias.get(clave)
+            if datos is None:
+                datos = self._sentencias[clave] = [0, 0.0, 0, 0]
+            datos[0] += llamadas
+            datos[1] += segundos
+            datos[2] += filas
+
+    def marcar_lenta(self, clave: str):
+        with self._lock:
+            self._sentencias[clave][3] += 1
+
+    def exportar(self) -> List[str]:
+        with self._lock:
+            sentencias = sorted((clave, list(datos)) for clave, datos in self._sentencias.items())
+        lineas = []
+        metricas = (
+            ("calls_total", "Ejecuciones por sentencia"),
+            ("seconds_total", "Tiempo en execute() y fetch por sentencia"),
+            ("rows_total", "Filas devueltas (SELECT) o modificadas por sentencia"),
+            ("slow_total", "Ejecuciones lentas por sentencia"),
+        )
+        for posicion, (sufijo, ayuda) in enumerate(metricas):
+            nombre = f"tecnigestion_db_statement_{sufijo}"
+            lineas += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} counter"]
+            for clave, datos in sentencias:
+                # El id distingue sentencias cuyo texto recortado coincide
+                etiquetas = etiquetas_prometheus(
+                    ("id", "sql"), (hashlib.sha1(clave.encode()).hexdigest()[:8], clave[:300]))
+                lineas.append(f"{nombre}{etiquetas} {numero_prometheus(datos[posicion])}")
+        return lineas
+
+estadisticas_sql = EstadisticasSQL()
+
+def _tipo_sentencia(clave: str) -> str:
+    tipo = clave.split(" ", 1)[0].lower()
+    return tipo if tipo in ("select", "with", "insert", "update", "delete", "replace") else "otra"
+
+def plan_consulta(conn: sqlite3.Connection, sql: str, parametros) -> str:
+    # EXPLAIN QUERY PLAN en árbol, con un cursor sin instrumentar
+    try:
+        filas = sqlite3.Cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", parametros).fetchall()
+    except sqlite3.Error as e:
+        return f"(sin plan: {e})"
+    niveles = {0: 0}
+    lineas = []
+    for fila in filas:
+        nivel = niveles.get(fila[1], 0) + 1
+        niveles[fila[0]] = nivel
+        lineas.append(f"{'  ' * nivel}{fila[3]}")
+    return "\n".join(lineas)
+
+def ruta_metricas(scope: dict) -> str:
+    # Plantilla de la ruta (/api/visitas/{visita_id}) para no crear una serie
+    # por cada id; las peticiones sin ruta (404, preflight CORS) van juntas.
+    # Las rutas son las de la app que atiende la petición (scope["app"])
+    endpoint = scope.get("endpoint")
+    rutas = getattr(ruta_metricas, "rutas", None)
+    if rutas is None or (endpoint is not None and endpoint not in rutas):
+        rutas = ruta_metricas.rutas = {getattr(r, "endpoint", None): r.path for r in scope["app"].routes}
+    return rutas.get(endpoint, "(sin ruta)") if endpoint is not None else "(sin ruta)"
+
+def registrar_consulta(conn: sqlite3.Connection, sql: str, parametros, segundos: float, filas: int = 0,
+                       llamadas: int = 1, explicar: bool = True) -> str:
+    clave = estadisticas_sql.clave(sql)
+    estadisticas_sql.registrar(clave, segundos, filas, llamadas)
+    sql_latencia.observar((_tipo_sentencia(clave),), segundos)
+    peticion = _consultas_peticion.get()
+    if peticion is not None:
+        peticion.total += llamadas
+        peticion.segundos += segundos
+        peticion.por_sentencia[clave] = peticion.por_sentencia.get(clave, 0) + llamadas
+    if SLOW_QUERY_MS and segundos * 1000 >= SLOW_QUERY_MS:
+        _avisar_consulta_lenta(conn, clave, sql, parametros, segundos, filas, explicar)
+    return clave
+
+def _avisar_consulta_lenta(conn: sqlite3.Connection, clave: str, sql: str, parametros, segundos: float,
+                           filas: int, explicar: bool):
+    estadisticas_sql.marcar_lenta(clave)
+    sql_lentas.sumar()
+    peticion = _consultas_peticion.get()
+    plan = ""
+    if explicar and SLOW_QUERY_EXPLAIN and _tipo_sentencia(clave) != "otra":
+        plan = plan_consulta(conn, sql, parametros)
+        plan = f"\n{plan}" if plan else ""
+    logger.warning(
+        "Consulta lenta (%.1f ms, %d filas) en %s: %s%s",
+        segundos * 1000, filas, ruta_metricas(peticion.scope) if peticion else "-", clave, plan
+    )
+
+class CursorInstrumentado(sqlite3.Cursor):
+    """Cursor que mide cada sentencia: tiempo de execute() más el de leer sus
+    filas, filas devueltas y consultas de la petición en curso. El aviso de
+    consulta lenta se comprueba al ejecutar y, otra vez, tras un fetchall()."""
+
+    _clave = None
+    _sql = None
+    _parametros = ()
+    _segundos = 0.0
+    _lenta = False
+    _filas_iteradas = 0
+
+    def execute(self, sql, parametros=()):
+        self._volcar_iteradas()
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            segundos = time.perf_counter() - inicio
+            filas = self.rowcount if self.rowcount > 0 else 0
+            self._clave = registrar_consulta(self.connection, sql, parametros, segundos, filas)
+            self._sql, self._parametros, self._segundos = sql, parametros, segundos
+            self._lenta = bool(SLOW_QUERY_MS) and segundos * 1000 >= SLOW_QUERY_MS
+
+    def executemany(self, sql, secuencia):
+        self._volcar_iteradas()
+        self._clave = None
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, secuencia)
+        finally:
+            # Una llamada para los avisos, sin plan (no hay un único juego de parámetros)
+            registrar_consulta(self.connection, sql, (), time.perf_counter() - inicio,
+                               max(self.rowcount, 0), explicar=False)
+
+    def _leidas(self, filas: int, segundos: float):
+        if self._clave is not None:
+            estadisticas_sql.registrar(self._clave, segundos, filas, llamadas=0)
+            peticion = _consultas_peticion.get()
+            if peticion is not None:
+                peticion.segundos += segundos
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        fila = super().fetchone()
+        self._leidas(fila is not None, time.perf_counter() - inicio)
+        return fila
+
+    def fetchmany(self, size=None):
+        inicio = time.perf_counter()
+        filas = super().fetchmany(self.arraysize if size is None else size)
+        self._leidas(len(filas), time.perf_counter() - inicio)
+        return filas
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        filas = super().fetchall()
+        segundos = time.perf_counter() - inicio
+        self._leidas(len(filas), segundos)
+        total = self._segundos + segundos
+        if self._clave is not None and not self._lenta and SLOW_QUERY_MS and total * 1000 >= SLOW_QUERY_MS:
+            self._lenta = True
+            _avisar_consulta_lenta(self.connection, self._clave, self._sql, self._parametros,
+                                   total, len(filas), True)
+        return filas
+
+    def __next__(self):
+        # Por fila solo se cuenta; se vuelca al terminar o en la siguiente sentencia
+        try:
+            fila = super().__next__()
+        except StopIteration:
+            self._volcar_iteradas()
+            raise
+        self._filas_iteradas += 1
+        return fila
+
+    def _volcar_iteradas(self):
+        if self._filas_iteradas:
+            self._leidas(self._filas_iteradas, 0.0)
+            self._filas_iteradas = 0
+
+class ConexionInstrumentada(sqlite3.Connection):
+    """Conexión del pool cuyos cursores (también los de conn.execute) son
+    CursorInstrumentado."""
+
+    def cursor(self, factory=CursorInstrumentado):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, secuencia):
+        return self.cursor().executemany(sql, secuencia)
+
+class MiddlewareMetricas:
+    """Middleware ASGI: latencia, tamaños y códigos de estado por ruta y
+    consultas SQL por petición. ASGI puro (no BaseHTTPMiddleware) para que el
+    contextvar llegue al endpoint y no se acumulen las respuestas en streaming."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global http_en_curso
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        inicio = time.perf_counter()
+        medidas = {"estado": 500, "entrada": 0, "salida": 0}
+        consultas = ConsultasPeticion(scope)
+        contexto = _consultas_peticion.set(consultas)
+
+        async def recibir():
+            mensaje = await receive()
+            if mensaje["type"] == "http.request":
+                medidas["entrada"] += len(mensaje.get("body", b""))
+            return mensaje
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                medidas["estado"] = mensaje["status"]
+            elif mensaje["type"] == "http.response.body":
+                medidas["salida"] += len(mensaje.get("body", b""))
+            await send(mensaje)
+
+        http_en_curso += 1
+        try:
+            await self.app(scope, recibir, enviar)
+        finally:
+            http_en_curso -= 1
+            _consultas_peticion.reset(contexto)
+            self.registrar(scope, medidas, consultas, time.perf_counter() - inicio)
+
+    def registrar(self, scope: dict, medidas: dict, consultas: ConsultasPeticion, segundos: float):
+        ruta, metodo = ruta_metricas(scope), scope["method"]
+        # Cuerpo no leído por el endpoint (401, 413...): vale Content-Length
+        for nombre, valor in scope["headers"]:
+            if nombre == b"content-length" and valor.isdigit():
+                medidas["entrada"] = max(medidas["entrada"], int(valor))
+        http_peticiones.sumar((ruta, metodo, str(medidas["estado"])))
+        http_latencia.observar((ruta, metodo), segundos)
+        http_entrada.observar((ruta, metodo), medidas["entrada"])
+        http_salida.observar((ruta, metodo), medidas["salida"])
+        http_consultas.observar((ruta, metodo), consultas.total)
+        if QUERIES_PER_REQUEST_WARN and consultas.total >= QUERIES_PER_REQUEST_WARN:
+            repetidas = sorted(consultas.por_sentencia.items(), key=lambda item: -item[1])[:3]
+            logger.warning(
+                "%s %s: %d consultas SQL (%.1f ms); las más repetidas: %s",
+                metodo, ruta, consultas.total, consultas.segundos * 1000,
+                "; ".join(f"{veces}x {clave[:200]}" for clave, veces in repetidas)
+            )
+
+def exportar_stats(prefijo: str, stats: dict, etiquetas: tuple = (), valores: tuple = ()) -> List[str]:
+    # Los valores numéricos de los stats() de pools y cachés como gauges
+    lineas = []
+    for clave, valor in stats.items():
+        if isinstance(valor, (int, float)):
+            nombre = f"tecnigestion_{prefijo}_{clave}"
+            lineas += [f"# TYPE {nombre} gauge",
+                       f"{nombre}{etiquetas_prometheus(etiquetas, valores)} {numero_prometheus(valor)}"]
+    return lineas
@@ -0,0 +1,363 @@
+"""
+Modelos Pydantic de la API y serialización de las respuestas JSON.
+"""
+
+from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, EmailStr
+from typing import Optional, List
+import json
+import orjson
+import re
+import typing
+
+from config import RESPONSE_VALIDATION
+
+# ============ MODELOS PYDANTIC ============
+
+# Auth
+class UserRegister(BaseModel):
+    nombre: str
+    apellidos: Optional[str] = ""
+    email: EmailStr
+    telefono: Optional[str] = ""
+    empresa: Optional[str] = ""
+    password: str
+
+class UserLogin(BaseModel):
+    email: EmailStr
+    password: str
+
+class UserResponse(BaseModel):
+    id: int
+    nombre: str
+    apellidos: Optional[str]
+    email: str
+    telefono: Optional[str]
+    empresa: Optional[str]
+
+class TokenResponse(BaseModel):
+    access_token: str
+    refresh_token: str
+    expires_in: int
+    token_type: str
+    user: UserResponse
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+# Clientes
+class ClienteCreate(BaseModel):
+    nombre: str
+    apellidos: Optional[str] = ""
+    email: Optional[str] = ""
+    telefono: str
+    telefono_secundario: Optional[str] = ""
+    direccion: Optional[str] = ""
+    ciudad: Optional[str] = ""
+    codigo_postal: Optional[str] = ""
+    provincia: Optional[str] = ""
+    tipo: Optional[str] = "particular"
+    nif_cif: Optional[str] = ""
+    notas: Optional[str] = ""
+
+class ClienteResponse(BaseModel):
+    id: int
+    nombre: str
+    apellidos: Optional[str]
+    email: Optional[str]
+    telefono: str
+    telefono_secundario: Optional[str]
+    direccion: Optional[str]
+    ciudad: Optional[str]
+    codigo_postal: Optional[str]
+    provincia: Optional[str]
+    tipo: str
+    nif_cif: Optional[str]
+    notas: Optional[str]
+    created_at: Optional[str]
+
+# Visitas
+class VisitaCreate(BaseModel):
+    cliente_id: int
+    titulo: str
+    descripcion: Optional[str] = ""
+    fecha: str
+    hora: Optional[str] = ""
+    tipo: Optional[str] = "reparacion"
+    estado: Optional[str] = "pendiente"
+    prioridad: Optional[str] = "normal"
+    notas_internas: Optional[str] = ""
+
+class VisitaResponse(BaseModel):
+    id: int
+    cliente_id: int
+    cliente_nombre: Optional[str]
+    cliente_telefono: Optional[str]
+    cliente_direccion: Optional[str]
+    titulo: str
+    descripcion: Optional[str]
+    fecha: str
+    hora: Optional[str]
+    tipo: str
+    estado: Optional[str]
+    prioridad: Optional[str]
+    notas_internas: Optional[str]
+    tiene_firma: bool = False
+    firma_hash: Optional[str] = None
+    nombre_firmante: Optional[str]
+    created_at: Optional[str]
+    completed_at: Optional[str]
+    version: int = 1
+
+# Agenda
+class VisitaAgenda(VisitaResponse):
+    conflicto: bool = False
+
+class DiaAgenda(BaseModel):
+    fecha: str
+    total: int = 0
+    por_estado: dict = {}
+    por_prioridad: dict = {}
+    conflictos: int = 0
+    visitas: List[VisitaAgenda] = []
+
+class AgendaResponse(BaseModel):
+    desde: str
+    hasta: str
+    total: int = 0
+    por_estado: dict = {}
+    por_prioridad: dict = {}
+    conflictos: int = 0
+    dias: List[DiaAgenda] = []
+
+# Analítica
+class MetricasPresupuestos(BaseModel):
+    periodo: Optional[str] = None
+    cliente_id: Optional[int] = None
+    cliente_nombre: Optional[str] = None
+    emitidos: int = 0
+    aceptados: int = 0
+    rechazados: int = 0
+    importe: float = 0
+    facturado: float = 0
+    ticket_medio: float = 0
+    tasa_conversion: float = 0
+
+class AnaliticaPresupuestosResponse(BaseModel):
+    desde: str
+    hasta: str
+    agrupar: str
+    por: Optional[str] = None
+    totales: MetricasPresupuestos
+    series: List[MetricasPresupuestos] = []
+
+class MetricasVisitas(BaseModel):
+    periodo: Optional[str] = None
+    tipo: Optional[str] = None
+    total: int = 0
+    completadas: int = 0
+    canceladas: int = 0
+    tasa_completadas: float = 0
+
+class AnaliticaVisitasResponse(BaseModel):
+    desde: str
+    hasta: str
+    agrupar: str
+    por: Optional[str] = None
+    totales: MetricasVisitas
+    series: List[MetricasVisitas] = []
+
+class CompletarVisita(BaseModel):
+    firma_cliente: Optional[str] = ""
+    nombre_firmante: Optional[str] = ""
+    notas_internas: Optional[str] = ""
+
+# Presupuestos
+class LineaPresupuesto(BaseModel):
+    id: Optional[int] = None  # al editar, la línea guardada que se conserva
+    concepto: str
+    descripcion: Optional[str] = ""
+    cantidad: float = 1
+    precio_unitario: float = 0
+
+class PresupuestoCreate(BaseModel):
+    cliente_id: int
+    titulo: str
+    descripcion: Optional[str] = ""
+    aplicar_iva: bool = True
+    iva_porcentaje: float = 21
+    fecha_validez: Optional[str] = ""
+    notas: Optional[str] = ""
+    lineas: List[LineaPresupuesto] = []
+
+class PresupuestoUpdate(PresupuestoCreate):
+    version: int
+
+class PresupuestoPatch(BaseModel):
+    version: int
+    cliente_id: Optional[int] = None
+    titulo: Optional[str] = None
+    descripcion: Optional[str] = None
+    aplicar_iva: Optional[bool] = None
+    iva_porcentaje: Optional[float] = None
+    fecha_validez: Optional[str] = None
+    notas: Optional[str] = None
+    lineas: Optional[List[LineaPresupuesto]] = None
+
+class PresupuestoResponse(BaseModel):
+    id: int
+    cliente_id: int
+    cliente_nombre: Optional[str]
+    numero: str
+    titulo: str
+    descripcion: Optional[str]
+    subtotal: float
+    iva_porcentaje: float
+    aplicar_iva: bool
+    iva_amount: float
+    total: float
+    estado: str
+    fecha_emision: Optional[str]
+    fecha_validez: Optional[str]
+    fecha_rechazo: Optional[str]
+    dias_para_eliminar: Optional[int]
+    notas: Optional[str]
+    lineas: List[dict] = []
+    created_at: Optional[str]
+    version: int = 1
+
+# Búsqueda
+class ResultadoBusqueda(BaseModel):
+    id: int
+    titulo: str
+    subtitulo: Optional[str] = None
+    cliente_id: Optional[int] = None
+
+class BusquedaResponse(BaseModel):
+    clientes: List[ResultadoBusqueda] = []
+    visitas: List[ResultadoBusqueda] = []
+    presupuestos: List[ResultadoBusqueda] = []
+
+# Sincronización
+class BorradosSync(BaseModel):
+    clientes: List[int] = []
+    visitas: List[int] = []
+    presupuestos: List[int] = []
+
+class SyncResponse(BaseModel):
+    cursor: str
+    mas: bool = False
+    reiniciar: bool = False  # el cursor era demasiado viejo: vaciar la copia local
+    clientes: List[ClienteResponse] = []
+    visitas: List[VisitaResponse] = []
+    presupuestos: List[PresupuestoResponse] = []
+    borrados: BorradosSync = BorradosSync()
+
+class OperacionSync(BaseModel):
+    id_peticion: str  # generado por el cliente; repetido no se vuelve a aplicar
+    entidad: str
+    accion: str
+    id: Optional[int] = None  # negativo: id local de un alta aún sin subir
+    datos: dict = {}
+
+class SubidaSync(BaseModel):
+    operaciones: List[OperacionSync]
+
+class ResultadoOperacionSync(BaseModel):
+    id_peticion: str
+    estado: int
+    resultado: Optional[dict] = None
+    error: Optional[str] = None
+    repetida: bool = False
+
+class SubidaSyncResponse(BaseModel):
+    resultados: List[ResultadoOperacionSync] = []
+    ids: dict = {}  # id local -> id asignado, de las altas
+    pendientes: int = 0  # no procesadas por un error temporal: reintentarlas
+
+class EstadoSync(BaseModel):
+    estado: str
+
+# ============ SERIALIZACIÓN JSON ============
+
+# orjson escribe distinto que json los números con exponente (1e-7 frente a
+# 1e-07) y los de 1e-5 a 1e-4 (0.00001 frente a 1e-05). Si la salida puede
+# contener alguno (un número así tras `:`, `,` o `[`) se repite con json para
+# no cambiar un byte; un falso positivo dentro de un texto solo cuesta eso
+_NUMERO_DISTINTO_JSON = re.compile(rb"[:,\[]-?(?:0\.0000|[0-9]+(?:\.[0-9]+)?e)")
+
+def _json_default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    raise TypeError
+
+def serializar_json(contenido) -> bytes:
+    # Los mismos bytes que JSONResponse(jsonable_encoder(contenido)), con orjson
+    try:
+        datos = orjson.dumps(contenido, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        datos = None
+    if datos is None or _NUMERO_DISTINTO_JSON.search(datos):
+        return json.dumps(
+            jsonable_encoder(contenido), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+        ).encode("utf-8")
+    return datos
+
+class RespuestaJSON(JSONResponse):
+    """JSONResponse serializada con orjson. Es la respuesta por defecto de la
+    app y la que devuelven los listados ya convertidos con filas_respuesta."""
+
+    def render(self, content) -> bytes:
+        return serializar_json(content)
+
+def _conversor_campo(anotacion):
+    # Coerción que haría Pydantic con los tipos que devuelve SQLite (0/1 en los
+    # bool, enteros en columnas REAL); el resto de valores pasa tal cual
+    argumentos = [a for a in typing.get_args(anotacion) if a is not type(None)]
+    if typing.get_origin(anotacion) is typing.Union and len(argumentos) == 1:
+        anotacion = argumentos[0]
+    return anotacion if anotacion in (bool, int, float) else None
+
+_planes_filas = {}
+
+def _plan_filas(modelo, columnas: tuple) -> list:
+    # Por campo del modelo y en su orden: (posición en la fila o None, conversor, valor por defecto)
+    plan = _planes_filas.get((modelo, columnas))
+    if plan is None:
+        posiciones = {columna: i for i, columna in enumerate(columnas)}
+        plan = []
+        for nombre, campo in modelo.model_fields.items():
+            plan.append((
+                nombre, posiciones.get(nombre), _conversor_campo(campo.annotation),
+                None if campo.is_required() else campo.get_default(call_default_factory=True)
+            ))
+        _planes_filas[(modelo, columnas)] = plan
+    return plan
+
+def filas_respuesta(modelo, filas) -> List[dict]:
+    """Convierte filas de sqlite3 en los dicts que serializaría `modelo`: sus
+    campos en orden, sin columnas de más y con los defaults de las que no
+    vienen. Evita construir y volver a validar un modelo Pydantic por fila."""
+    if not filas:
+        return []
+    plan = _plan_filas(modelo, tuple(filas[0].keys()))
+    resultado = []
+    for fila in filas:
+        registro = {}
+        for nombre, posicion, conversor, defecto in plan:
+            valor = defecto if posicion is None else fila[posicion]
+            registro[nombre] = conversor(valor) if conversor is not None and valor is not None else valor
+        if RESPONSE_VALIDATION:
+            validar_fila_respuesta(modelo, fila, registro)
+        resultado.append(registro)
+    return resultado
+
+def validar_fila_respuesta(modelo, fila, registro: dict):
+    # RESPONSE_VALIDATION: lo convertido a mano tiene que ser lo que dejaría
+    # Pydantic. Los campos que la fila no trae (los rellena quien llama, como
+    # dias_para_eliminar) se validan con el valor que se les ha puesto
+    esperado = modelo.model_validate({**registro, **dict(fila)}).model_dump()
+    if registro != esperado or list(registro) != list(esperado):
+        diferentes = sorted(k for k in esperado.keys() | registro.keys() if registro.get(k) != esperado.get(k))
+        raise AssertionError(f"filas_respuesta({modelo.__name__}) difiere de Pydantic en {diferentes or 'el orden'}")
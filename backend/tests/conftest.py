@@ -0,0 +1,119 @@
+"""
+Fixtures de las pruebas de la API: cada prueba corre contra los dos almacenes
+(DB_BACKEND=sqlite y postgres). PostgreSQL solo si TEST_DATABASE_URL apunta
+a una base de pruebas; su esquema public se vacía al empezar.
+
+Requiere pytest y httpx (pip install pytest httpx). Uso (desde la carpeta backend):
+    python -m pytest -q tests
+    TEST_DATABASE_URL=postgresql://postgres@localhost/pruebas python -m pytest -q tests
+"""
+
+import asyncio
+import importlib
+import itertools
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+_emails = itertools.count(1)
+
+# Módulos del backend que lee la configuración al importarse; main los importa
+MODULOS = ("config", "metricas", "modelos", "cache", "almacen", "almacen_sqlite", "almacen_postgres")
+_cargados = {}
+
+
+def vaciar_postgres(dsn: str):
+    import asyncpg
+
+    async def vaciar():
+        conn = await asyncpg.connect(dsn)
+        try:
+            await conn.execute("DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public")
+        finally:
+            await conn.close()
+
+    asyncio.run(vaciar())
+
+
+def cargar_main(backend: str, carpeta: str):
+    # La configuración se lee al importar: cada almacén con sus propios módulos
+    os.environ.update(
+        DB_BACKEND=backend,
+        DATABASE_PATH=os.path.join(carpeta, "pruebas.db"),
+        SCHEDULER_ENABLED="0",
+        AUTH_EXECUTOR="inline",
+        PDF_EXECUTOR="inline",
+        BCRYPT_ROUNDS="4",
+        METRICS_ENABLED="0",
+        RESPONSE_VALIDATION="1",
+    )
+    if backend == "postgres":
+        os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+        vaciar_postgres(TEST_DATABASE_URL)
+    for nombre in ("main", *MODULOS):
+        sys.modules.pop(nombre, None)
+    main = importlib.import_module("main")
+    _cargados[main] = {nombre: sys.modules[nombre] for nombre in MODULOS if nombre in sys.modules}
+    return main
+
+
+def modulo(main, nombre: str):
+    # El módulo `nombre` que importó este main: cada carga tiene los suyos
+    return _cargados[main][nombre]
+
+
+@pytest.fixture(scope="session", params=[
+    "sqlite",
+    pytest.param("postgres", marks=pytest.mark.skipif(not TEST_DATABASE_URL, reason="sin TEST_DATABASE_URL")),
+])
+def app(request, tmp_path_factory):
+    from fastapi.testclient import TestClient
+
+    main = cargar_main(request.param, str(tmp_path_factory.mktemp(request.param)))
+    with TestClient(main.app) as cliente:
+        yield main, cliente
+
+
+@pytest.fixture
+def main(app):
+    return app[0]
+
+
+@pytest.fixture
+def api(app):
+    # Un técnico nuevo por prueba: las pruebas no ven los datos de las demás
+    return registrar(app[1])
+
+
+@pytest.fixture
+def otro_api(app):
+    return registrar(app[1])
+
+
+def registrar(cliente):
+    email = f"tecnico{next(_emails)}@pruebas.example.com"
+    respuesta = cliente.post("/api/auth/registro", json={"nombre": "Técnico", "email": email, "password": "secreto123"})
+    assert respuesta.status_code == 200, respuesta.text
+    datos = respuesta.json()
+    return Sesion(cliente, datos["user"]["id"], email, datos["access_token"])
+
+
+class Sesion:
+    """TestClient con el token de un técnico"""
+
+    def __init__(self, cliente, user_id: int, email: str, token: str):
+        self.cliente = cliente
+        self.user_id = user_id
+        self.email = email
+        self.cabeceras = {"Authorization": f"Bearer {token}"}
+
+    def __getattr__(self, metodo):
+        # get, post, put, patch, delete con la cabecera del técnico
+        llamada = getattr(self.cliente, metodo)
+        return lambda url, headers=None, **kwargs: llamada(url, headers={**self.cabeceras, **(headers or {})}, **kwargs)
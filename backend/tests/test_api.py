@@ -0,0 +1,587 @@
+"""
+Comportamiento de la API, el mismo con DB_BACKEND=sqlite y postgres (ver
+conftest.py): lo que `bench_endpoints.py paridad` compara a mano.
+"""
+
+import base64
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pytest
+
+from conftest import BACKEND_DIR, modulo
+
+CLIENTE = {"nombre": "Ana", "apellidos": "García", "telefono": "600111222", "ciudad": "Bilbao"}
+
+
+def crear_cliente(api, **campos) -> dict:
+    respuesta = api.post("/api/clientes", json={**CLIENTE, **campos})
+    assert respuesta.status_code == 200, respuesta.text
+    return respuesta.json()
+
+
+def crear_visita(api, cliente_id: int, **campos) -> dict:
+    datos = {"cliente_id": cliente_id, "titulo": "Revisión caldera", "fecha": "2026-03-10", "hora": "10:00", **campos}
+    respuesta = api.post("/api/visitas", json=datos)
+    assert respuesta.status_code == 200, respuesta.text
+    return respuesta.json()
+
+
+def crear_presupuesto(api, cliente_id: int, **campos) -> dict:
+    datos = {
+        "cliente_id": cliente_id, "titulo": "Cambio de caldera",
+        "lineas": [
+            {"concepto": "Caldera", "cantidad": 2, "precio_unitario": 10},
+            {"concepto": "Mano de obra", "cantidad": 1, "precio_unitario": 5.5},
+        ],
+        **campos,
+    }
+    respuesta = api.post("/api/presupuestos", json=datos)
+    assert respuesta.status_code == 200, respuesta.text
+    return respuesta.json()
+
+
+def verificar_resumen(main, user_id: int) -> tuple:
+    # (desviaciones de resumen_contadores, {rollup: filas distintas}) del usuario
+    if main.DB_BACKEND == "postgres":
+        return main.almacen.verificar_resumen(user_id)
+    with main.get_db(user_id) as conn:
+        return main.verificar_resumen(conn, user_id), main.verificar_analitica(conn, user_id)
+
+
+def ejecutar_sql(main, sql: str):
+    # SQL directo contra la base de pruebas del almacén en uso
+    if main.DB_BACKEND == "postgres":
+        async def ejecutar():
+            async with main.almacen._conexion() as conn:
+                await conn.execute(sql)
+        main.almacen._ejecutar(ejecutar())
+    else:
+        with main.get_db() as conn:
+            conn.executescript(sql)
+
+
+# Autenticación
+
+def test_login_y_perfil(app, api):
+    cliente = app[1]
+    respuesta = cliente.post("/api/auth/login", json={"email": api.email, "password": "secreto123"})
+    assert respuesta.status_code == 200
+    assert respuesta.json()["user"]["id"] == api.user_id
+
+    perfil = api.get("/api/auth/perfil")
+    assert perfil.status_code == 200
+    assert perfil.json()["email"] == api.email
+
+
+def test_login_con_contrasena_incorrecta(app, api):
+    respuesta = app[1].post("/api/auth/login", json={"email": api.email, "password": "otra-cosa"})
+    assert respuesta.status_code == 401
+
+
+def test_sin_token(app):
+    assert app[1].get("/api/clientes").status_code == 403
+
+
+# Clientes
+
+def test_crud_clientes(api):
+    creado = crear_cliente(api)
+    assert creado["nombre"] == "Ana" and creado["tipo"] == "particular"
+
+    assert api.get(f"/api/clientes/{creado['id']}").json() == creado
+
+    editado = api.put(f"/api/clientes/{creado['id']}", json={**CLIENTE, "nombre": "Ana María"})
+    assert editado.status_code == 200
+    assert editado.json()["nombre"] == "Ana María"
+
+    assert api.delete(f"/api/clientes/{creado['id']}").status_code == 200
+    assert api.get(f"/api/clientes/{creado['id']}").status_code == 404
+    assert api.delete(f"/api/clientes/{creado['id']}").status_code == 404
+
+
+def test_clientes_de_otro_tecnico(api, otro_api):
+    ajeno = crear_cliente(otro_api)
+    assert api.get(f"/api/clientes/{ajeno['id']}").status_code == 404
+    assert api.get("/api/clientes").json() == []
+
+
+def test_paginacion_clientes(api):
+    ids = [crear_cliente(api, nombre=f"Cliente {n}")["id"] for n in range(5)]
+
+    vistos, cursor = [], None
+    while True:
+        respuesta = api.get("/api/clientes", params={"limite": 2, **({"cursor": cursor} if cursor else {})})
+        assert respuesta.headers["X-Total-Count"] == "5"
+        vistos += [c["id"] for c in respuesta.json()]
+        cursor = respuesta.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert sorted(vistos) == sorted(ids)
+    assert len(vistos) == len(set(vistos))
+
+
+def test_etag_cambia_tras_escribir(api):
+    crear_cliente(api)
+    primera = api.get("/api/clientes")
+    etag = primera.headers["ETag"]
+
+    assert api.get("/api/clientes", headers={"If-None-Match": etag}).status_code == 304
+
+    crear_cliente(api, nombre="Benito")
+    segunda = api.get("/api/clientes", headers={"If-None-Match": etag})
+    assert segunda.status_code == 200
+    assert segunda.headers["ETag"] != etag
+    assert len(segunda.json()) == 2
+    assert api.get("/api/clientes", headers={"If-None-Match": segunda.headers["ETag"]}).status_code == 304
+
+
+def test_lectura_solapada_con_escritura(main, api, monkeypatch):
+    # Una lectura que termina después de que otra petición escriba e invalide
+    # la caché no puede quedar servida como si fuera de después
+    crear_cliente(api)
+    listar = main.almacen.listar_clientes
+
+    def listar_y_escribir(*args, **kwargs):
+        filas = listar(*args, **kwargs)
+        monkeypatch.setattr(main.almacen, "listar_clientes", listar)
+        crear_cliente(api, nombre="Benito")
+        return filas
+
+    monkeypatch.setattr(main.almacen, "listar_clientes", listar_y_escribir)
+    solapada = api.get("/api/clientes")
+    assert len(solapada.json()) == 1
+
+    despues = api.get("/api/clientes")
+    assert len(despues.json()) == 2
+    assert despues.headers["ETag"] != solapada.headers["ETag"]
+
+
+def test_pool_agotado(main, tmp_path):
+    pool = modulo(main, "almacen_sqlite").ConnectionPool(str(tmp_path / "pool.db"), size=1, timeout=0.01)
+    conn = pool.acquire()
+    with pytest.raises(main.PoolAgotado):
+        pool.acquire()
+    pool.release(conn)
+    pool.release(pool.acquire())
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_pool_agotado_devuelve_503(main, api, monkeypatch):
+    def agotado(*args, **kwargs):
+        raise main.PoolAgotado()
+
+    monkeypatch.setattr(main.almacen, "listar_clientes", agotado)
+    respuesta = api.get("/api/clientes")
+    assert respuesta.status_code == 503
+    assert respuesta.headers["Retry-After"] == "1"
+
+
+def test_almacen_incompleto(main):
+    # Almacen y CacheBackend son ABC: un motor a medias no llega a crearse
+    class SoloClientes(main.Almacen):
+        def listar_clientes(self, *args):
+            return [], 0, None
+
+    with pytest.raises(TypeError, match="obtener_cliente"):
+        SoloClientes()
+    with pytest.raises(TypeError, match="invalidate_user"):
+        type("SinInvalidar", (modulo(main, "cache").CacheBackend,), {"get": None, "set": None, "generacion": None})()
+
+
+def test_sqlite_sin_asyncpg(tmp_path):
+    # asyncpg solo lo importa almacen_postgres, y main solo con DB_BACKEND=postgres
+    entorno = {**os.environ, "DB_BACKEND": "sqlite", "DATABASE_PATH": str(tmp_path / "t.db"), "SCHEDULER_ENABLED": "0"}
+    codigo = "import sys, main; assert 'almacen_postgres' not in sys.modules and 'asyncpg' not in sys.modules"
+    subprocess.run([sys.executable, "-c", codigo], env=entorno, cwd=BACKEND_DIR, check=True)
+
+
+def test_escrituras_no_pasan_por_la_cache(main, api, monkeypatch):
+    # Las altas devuelven el registro leído sin caché: ni la llenan ni
+    # reciben una respuesta ya serializada
+    guardadas = []
+    monkeypatch.setattr(main.response_cache, "set", lambda key, *args: guardadas.append(key))
+    cliente = crear_cliente(api)
+    visita = crear_visita(api, cliente["id"])
+    presupuesto = crear_presupuesto(api, cliente["id"])
+    assert visita["cliente_nombre"] and presupuesto["numero"]
+    assert guardadas == []
+
+    api.get(f"/api/visitas/{visita['id']}")
+    assert [key.split(":")[1] for key in guardadas] == ["obtener_visita"]
+
+
+# Presupuestos
+
+def test_presupuesto_totales(api):
+    cliente = crear_cliente(api)
+    presupuesto = crear_presupuesto(api, cliente["id"])
+
+    assert presupuesto["subtotal"] == pytest.approx(25.5)
+    assert presupuesto["iva_amount"] == pytest.approx(5.355, abs=0.01)
+    assert presupuesto["total"] == pytest.approx(30.855, abs=0.01)
+    assert presupuesto["estado"] == "borrador"
+    assert presupuesto["cliente_nombre"] == "Ana García"
+    assert [l["concepto"] for l in presupuesto["lineas"]] == ["Caldera", "Mano de obra"]
+
+
+def test_presupuesto_numeros_consecutivos(api):
+    cliente = crear_cliente(api)
+    numeros = [crear_presupuesto(api, cliente["id"])["numero"] for _ in range(3)]
+    assert len(set(numeros)) == 3
+    assert numeros == sorted(numeros)
+
+
+def test_presupuesto_numeros_concurrentes(api, otro_api):
+    # Altas simultáneas de dos técnicos: cada uno con su serie del año, sin
+    # repetidos ni huecos
+    clientes = {sesion: crear_cliente(sesion)["id"] for sesion in (api, otro_api)}
+    with ThreadPoolExecutor(max_workers=8) as hilos:
+        creados = list(hilos.map(
+            lambda sesion: (sesion, crear_presupuesto(sesion, clientes[sesion])["numero"]),
+            [api, otro_api] * 15
+        ))
+
+    anio = date.today().year
+    for sesion in (api, otro_api):
+        numeros = sorted(numero for s, numero in creados if s is sesion)
+        assert numeros == [f"PRES-{anio}-{n:04d}" for n in range(1, 16)]
+
+
+def test_presupuesto_edicion_con_version(api):
+    cliente = crear_cliente(api)
+    presupuesto = crear_presupuesto(api, cliente["id"])
+    version = presupuesto["version"]
+
+    editado = api.patch(f"/api/presupuestos/{presupuesto['id']}", json={"version": version, "titulo": "Nuevo"})
+    assert editado.status_code == 200
+    assert editado.json()["titulo"] == "Nuevo"
+    assert editado.json()["version"] == version + 1
+    assert len(editado.json()["lineas"]) == 2
+
+    obsoleto = api.patch(f"/api/presupuestos/{presupuesto['id']}", json={"version": version, "titulo": "Otro"})
+    assert obsoleto.status_code == 409
+
+    # Se conserva una línea, se cambia su cantidad y se añade otra
+    primera = editado.json()["lineas"][0]
+    lineas = [{**{c: primera[c] for c in ("id", "concepto", "precio_unitario")}, "cantidad": 3},
+              {"concepto": "Desplazamiento", "cantidad": 1, "precio_unitario": 15}]
+    con_lineas = api.patch(f"/api/presupuestos/{presupuesto['id']}",
+                           json={"version": version + 1, "lineas": lineas})
+    assert con_lineas.status_code == 200
+    assert [l["concepto"] for l in con_lineas.json()["lineas"]] == ["Caldera", "Desplazamiento"]
+    assert con_lineas.json()["subtotal"] == pytest.approx(45)
+
+
+def test_presupuesto_rechazado(api):
+    cliente = crear_cliente(api)
+    presupuesto = crear_presupuesto(api, cliente["id"])
+
+    assert api.patch(f"/api/presupuestos/{presupuesto['id']}/estado", params={"estado": "rechazado"}).status_code == 200
+    rechazado = api.get(f"/api/presupuestos/{presupuesto['id']}").json()
+    assert rechazado["estado"] == "rechazado"
+    assert rechazado["fecha_rechazo"]
+
+    assert [p["id"] for p in api.get("/api/presupuestos", params={"estado": "rechazado"}).json()] == [presupuesto["id"]]
+    assert api.get("/api/presupuestos", params={"estado": "aceptado"}).json() == []
+
+
+# Visitas y firmas
+
+def test_visita_completada_con_firma(api):
+    cliente = crear_cliente(api)
+    visita = crear_visita(api, cliente["id"])
+    assert visita["cliente_nombre"] == "Ana García" and visita["estado"] == "pendiente"
+
+    firma = os.urandom(100_000)  # aleatoria: no se comprime y se transmite por trozos
+    respuesta = api.patch(f"/api/visitas/{visita['id']}/completar", json={
+        "firma_cliente": "data:image/png;base64," + base64.b64encode(firma).decode(),
+        "nombre_firmante": "Ana García",
+    })
+    assert respuesta.status_code == 200
+
+    completada = api.get(f"/api/visitas/{visita['id']}").json()
+    assert completada["estado"] == "completada"
+    assert completada["tiene_firma"]
+    url = f"/api/firmas/{completada['firma_hash']}"
+
+    entera = api.get(url)
+    assert entera.status_code == 200
+    assert entera.content == firma
+
+    trozo = api.get(url, headers={"Range": "bytes=70000-70099"})
+    assert trozo.status_code == 206
+    assert trozo.content == firma[70000:70100]
+
+    assert api.get(url, headers={"If-None-Match": entera.headers["ETag"]}).status_code == 304
+
+
+@pytest.mark.parametrize("rango", [None, "bytes=0-99", "bytes=150000-150099", "bytes=-10"])
+def test_firma_comprimida_por_trozos(api, rango):
+    # Un SVG se guarda con zlib y se descomprime al vuelo, también por rangos
+    firma = ("<svg>" + "".join(f'<path d="M{n} {n * 7 % 13}"/>' for n in range(8000)) + "</svg>").encode()
+    visita = crear_visita(api, crear_cliente(api)["id"])
+    api.patch(f"/api/visitas/{visita['id']}/completar", json={
+        "firma_cliente": "data:image/svg+xml;base64," + base64.b64encode(firma).decode(),
+    })
+    firma_hash = api.get(f"/api/visitas/{visita['id']}").json()["firma_hash"]
+    url = f"/api/firmas/{firma_hash}"
+
+    respuesta = api.get(url, headers={"Range": rango} if rango else {})
+    if rango is None:
+        assert respuesta.status_code == 200 and respuesta.content == firma
+    else:
+        inicio, fin = map(int, respuesta.headers["Content-Range"].split()[1].split("/")[0].split("-"))
+        assert respuesta.status_code == 206
+        assert respuesta.content == firma[inicio:fin + 1]
+    assert respuesta.headers["Content-Type"] == "image/svg+xml"
+
+
+def test_firma_png_sin_recomprimir(main):
+    codificar_firma = modulo(main, "almacen_sqlite").codificar_firma
+    assert codificar_firma("image/png", bytes(10_000)) == ("identity", bytes(10_000))
+    assert codificar_firma("image/svg+xml", bytes(10_000))[0] == "zlib"
+
+
+def test_firma_no_valida(api):
+    visita = crear_visita(api, crear_cliente(api)["id"])
+    respuesta = api.patch(f"/api/visitas/{visita['id']}/completar", json={"firma_cliente": "data:image/png;base64,%%%"})
+    assert respuesta.status_code == 400
+
+
+def test_agenda_con_estado_nulo(main, api):
+    # Sin estado cuenta como no cancelada: choca con la otra de la misma hora
+    cliente = crear_cliente(api)
+    sin_estado = crear_visita(api, cliente["id"])
+    crear_visita(api, cliente["id"])
+    crear_visita(api, cliente["id"], estado="cancelada")
+    ejecutar_sql(main, f"UPDATE visitas SET estado = NULL WHERE id = {sin_estado['id']}")
+    main.invalidar_cache(api.user_id)
+
+    for incluir_visitas in (True, False):
+        respuesta = api.get("/api/agenda", params={
+            "desde": "2026-03-09", "hasta": "2026-03-11", "incluir_visitas": incluir_visitas
+        })
+        assert respuesta.status_code == 200, respuesta.text
+        agenda = respuesta.json()
+        assert (agenda["total"], agenda["conflictos"]) == (3, 2)
+
+    dia = api.get("/api/agenda", params={"desde": "2026-03-10", "hasta": "2026-03-10"}).json()["dias"][0]
+    visita = next(v for v in dia["visitas"] if v["id"] == sin_estado["id"])
+    assert visita["conflicto"] and visita["estado"] is None
+    assert dia["por_estado"] == {"": 1, "pendiente": 1, "cancelada": 1}
+
+
+# Sincronización
+
+def test_sync_altas_y_bajas(api):
+    cliente = crear_cliente(api)
+    visita = crear_visita(api, cliente["id"])
+
+    inicial = api.get("/api/sync").json()
+    assert [c["id"] for c in inicial["clientes"]] == [cliente["id"]]
+    assert [v["id"] for v in inicial["visitas"]] == [visita["id"]]
+    assert not inicial["mas"] and not inicial["reiniciar"]
+
+    assert api.delete(f"/api/visitas/{visita['id']}").status_code == 200
+    otro = crear_cliente(api, nombre="Benito")
+
+    cambios = api.get("/api/sync", params={"cursor": inicial["cursor"]}).json()
+    assert [c["id"] for c in cambios["clientes"]] == [otro["id"]]
+    assert cambios["borrados"]["visitas"] == [visita["id"]]
+
+    assert api.get("/api/sync", params={"cursor": cambios["cursor"]}).json()["clientes"] == []
+
+
+def test_sync_subida_sin_repetir(api):
+    subida = {"operaciones": [
+        {"id_peticion": "op-1", "entidad": "clientes", "accion": "crear", "id": -1, "datos": CLIENTE},
+        {"id_peticion": "op-2", "entidad": "visitas", "accion": "crear", "id": -2,
+         "datos": {"cliente_id": -1, "titulo": "Offline", "fecha": "2026-03-11"}},
+    ]}
+    primera = api.post("/api/sync", json=subida).json()
+    assert [r["estado"] for r in primera["resultados"]] == [200, 200]
+    assert primera["pendientes"] == 0
+
+    segunda = api.post("/api/sync", json=subida).json()
+    assert all(r["repetida"] for r in segunda["resultados"])
+    assert segunda["ids"] == primera["ids"]
+
+    assert len(api.get("/api/clientes").json()) == 1
+    visitas = api.get("/api/visitas").json()
+    assert [v["cliente_id"] for v in visitas] == [int(primera["ids"]["-1"])]
+
+
+# Importación y exportación
+
+def test_importar_y_exportar_clientes(api):
+    csv_entrada = "nombre,telefono,ciudad\nAna,600111222,Bilbao\nSin teléfono,,Getxo\nBenito,600333444,Leioa\n"
+    respuesta = api.post("/api/importar/clientes", files={"archivo": ("clientes.csv", csv_entrada.encode(), "text/csv")})
+    assert respuesta.status_code == 200
+    resultado = respuesta.json()
+    assert (resultado["filas"], resultado["insertadas"], resultado["total_errores"]) == (3, 2, 1)
+    assert resultado["errores"][0]["fila"] == 3  # la cabecera es la 1
+
+    exportado = api.get("/api/exportar/clientes", params={"formato": "csv"})
+    assert exportado.status_code == 200
+    filas = list(csv.DictReader(io.StringIO(exportado.text.lstrip("﻿"))))
+    assert [(f["nombre"], f["ciudad"]) for f in filas] == [("Ana", "Bilbao"), ("Benito", "Leioa")]
+
+    ndjson = api.get("/api/exportar/clientes", params={"formato": "ndjson"}).text.splitlines()
+    assert [json.loads(l)["telefono"] for l in ndjson] == ["600111222", "600333444"]
+
+
+@pytest.fixture
+def titulo_prohibido(main):
+    # Restricción temporal que rechaza los presupuestos titulados "Rota"
+    if main.DB_BACKEND == "postgres":
+        ejecutar_sql(main, "ALTER TABLE presupuestos ADD CONSTRAINT titulo_prohibido CHECK (titulo <> 'Rota') NOT VALID")
+        yield
+        ejecutar_sql(main, "ALTER TABLE presupuestos DROP CONSTRAINT titulo_prohibido")
+    else:
+        ejecutar_sql(main, """CREATE TRIGGER titulo_prohibido BEFORE INSERT ON presupuestos
+            WHEN NEW.titulo = 'Rota' BEGIN SELECT RAISE(ABORT, 'titulo prohibido'); END""")
+        yield
+        ejecutar_sql(main, "DROP TRIGGER titulo_prohibido")
+
+
+def test_importar_con_fila_rechazada_por_la_base(api, titulo_prohibido):
+    # La fila que viola una restricción no se lleva por delante las demás del
+    # lote, ni deja hueco en la numeración
+    cliente = crear_cliente(api)
+    lineas = [{"concepto": "Revisión", "cantidad": 1, "precio_unitario": 50}]
+    ndjson = "".join(
+        json.dumps({"cliente_id": cliente["id"], "titulo": titulo, "lineas": lineas}) + "\n"
+        for titulo in ("Caldera", "Rota", "Radiadores")
+    )
+    respuesta = api.post("/api/importar/presupuestos", files={"archivo": ("p.ndjson", ndjson.encode())})
+    assert respuesta.status_code == 200, respuesta.text
+    resultado = respuesta.json()
+    assert (resultado["filas"], resultado["insertadas"], resultado["total_errores"]) == (3, 2, 1)
+    assert resultado["errores"][0]["fila"] == 2
+
+    presupuestos = sorted(api.get("/api/presupuestos").json(), key=lambda p: p["numero"])
+    assert [p["titulo"] for p in presupuestos] == ["Caldera", "Radiadores"]
+    assert [p["numero"][-4:] for p in presupuestos] == ["0001", "0002"]
+
+
+def test_exportar_presupuestos_con_lineas(api):
+    presupuesto = crear_presupuesto(api, crear_cliente(api)["id"])
+    filas = [json.loads(l) for l in api.get("/api/exportar/presupuestos", params={"formato": "ndjson"}).text.splitlines()]
+    assert [f["numero"] for f in filas] == [presupuesto["numero"]]
+    assert [l["concepto"] for l in filas[0]["lineas"]] == ["Caldera", "Mano de obra"]
+
+
+def test_exportacion_cortada_devuelve_la_conexion(main, api):
+    for n in range(3):
+        crear_cliente(api, nombre=f"Cliente {n}")
+    en_uso = main.almacen.stats()["in_use"]
+
+    # Sin arrancar, tras la cabecera y a mitad: ninguna retiene la conexión
+    main.generar_exportacion(main.almacen.exportar(api.user_id, "clientes"), "clientes", "csv")
+    cortada = main.generar_exportacion(main.almacen.exportar(api.user_id, "clientes"), "clientes", "csv")
+    next(cortada)
+    cortada.close()
+    cortada = main.generar_exportacion(main.almacen.exportar(api.user_id, "clientes"), "clientes", "csv")
+    next(cortada)
+    next(cortada)
+    cortada.close()
+
+    assert main.almacen.stats()["in_use"] == en_uso
+
+
+# Búsqueda
+
+def test_busqueda(api):
+    cliente = crear_cliente(api, nombre="Zubizarreta")
+    visita = crear_visita(api, cliente["id"], titulo="Avería Zubizarreta")
+    crear_cliente(api, nombre="Otro")
+
+    resultado = api.get("/api/buscar", params={"q": "zubizarreta"}).json()
+    assert [c["id"] for c in resultado["clientes"]] == [cliente["id"]]
+    assert [v["id"] for v in resultado["visitas"]] == [visita["id"]]
+
+    solo_clientes = api.get("/api/buscar", params={"q": "zubizarreta", "tipos": "clientes"}).json()
+    assert solo_clientes["visitas"] == []
+    assert api.get("/api/buscar", params={"q": "x", "tipos": "facturas"}).status_code == 400
+
+
+# Analítica
+
+def test_analitica_con_estado_nulo(main, api):
+    # Una visita sin estado (datos antiguos) cuenta en el total y no como
+    # completada ni cancelada
+    cliente = crear_cliente(api)
+    completada = crear_visita(api, cliente["id"], estado="completada")
+    sin_estado = crear_visita(api, cliente["id"])
+    ejecutar_sql(main, f"UPDATE visitas SET estado = NULL WHERE id = {sin_estado['id']}")
+
+    totales = api.get("/api/analitica/visitas", params={"desde": "2026-03-01", "hasta": "2026-03-31"}).json()["totales"]
+    assert (totales["total"], totales["completadas"], totales["canceladas"]) == (2, 1, 0)
+
+    ejecutar_sql(main, f"DELETE FROM visitas WHERE id = {completada['id']}")
+    main.invalidar_cache(api.user_id)
+    totales = api.get("/api/analitica/visitas", params={"desde": "2026-03-01", "hasta": "2026-03-31"}).json()["totales"]
+    assert (totales["total"], totales["completadas"]) == (1, 0)
+    assert not any(verificar_resumen(main, api.user_id)[1].values())
+
+
+def test_contadores_y_agregados_cuadran(main, api):
+    # Lo que mantienen los triggers coincide con lo recalculado desde las
+    # tablas tras altas, cambios de clave, borrados e importaciones
+    cliente = crear_cliente(api)
+    otro = crear_cliente(api, nombre="Luis")
+    completada = crear_visita(api, cliente["id"], estado="completada")
+    movida = crear_visita(api, cliente["id"], tipo="mantenimiento")
+    respuesta = api.put(f"/api/visitas/{movida['id']}", json={
+        "cliente_id": otro["id"], "titulo": "Revisión", "fecha": "2026-04-02", "tipo": "instalacion"
+    })
+    assert respuesta.status_code == 200, respuesta.text
+    api.patch(f"/api/visitas/{completada['id']}/estado", params={"estado": "cancelada"})
+    api.delete(f"/api/visitas/{crear_visita(api, otro['id'], fecha='2026-03-31')['id']}")
+    ejecutar_sql(main, f"UPDATE visitas SET estado = NULL WHERE id = {movida['id']}")
+
+    aceptado = crear_presupuesto(api, cliente["id"])
+    api.patch(f"/api/presupuestos/{aceptado['id']}/estado", params={"estado": "aceptado"})
+    version = api.get(f"/api/presupuestos/{aceptado['id']}").json()["version"]
+    respuesta = api.patch(f"/api/presupuestos/{aceptado['id']}", json={
+        "version": version, "lineas": [{"concepto": "Caldera", "cantidad": 3, "precio_unitario": 10}]
+    })
+    assert respuesta.status_code == 200, respuesta.text
+    rechazado = crear_presupuesto(api, otro["id"])
+    api.patch(f"/api/presupuestos/{rechazado['id']}/estado", params={"estado": "rechazado"})
+    ejecutar_sql(main, f"UPDATE presupuestos SET fecha_emision = '2026-02-27' WHERE id = {rechazado['id']}")
+    api.delete(f"/api/presupuestos/{crear_presupuesto(api, cliente['id'])['id']}")
+    ndjson = "".join(json.dumps({"cliente_id": otro["id"], "titulo": "Importada", "fecha": f"2026-05-0{n}"}) + "\n"
+                     for n in range(1, 4))
+    assert api.post("/api/importar/visitas", files={"archivo": ("v.ndjson", ndjson.encode())}).status_code == 200
+
+    assert verificar_resumen(main, api.user_id) == ([], {"analitica_presupuestos": 0, "analitica_visitas": 0})
+    main.invalidar_cache(api.user_id)
+    dashboard = api.get("/api/dashboard").json()
+    assert (dashboard["total_clientes"], dashboard["presupuestos_pendientes"]) == (2, 0)
+    assert dashboard["facturacion_mes"] == 36.3
+    estadisticas = api.get("/api/estadisticas/presupuestos").json()
+    assert (estadisticas["total"], estadisticas["aceptados"], estadisticas["rechazados"]) == (2, 1, 1)
+    totales = api.get("/api/analitica/visitas", params={"desde": "2026-03-01", "hasta": "2026-05-31"}).json()["totales"]
+    assert (totales["total"], totales["completadas"], totales["canceladas"]) == (5, 0, 1)
+
+    # `python main.py resumen --reconstruir` rehace lo que falte
+    ejecutar_sql(main, f"DELETE FROM resumen_contadores WHERE usuario_id = {api.user_id}; "
+                       f"DELETE FROM analitica_visitas WHERE usuario_id = {api.user_id}")
+    desviaciones, diferencias = verificar_resumen(main, api.user_id)
+    assert len(desviaciones) > 5 and diferencias["analitica_visitas"] > 0
+    if main.DB_BACKEND == "postgres":
+        main.almacen.reconstruir_resumen(api.user_id)
+    else:
+        with main.get_db(api.user_id) as conn:
+            main.reconstruir_resumen(conn, api.user_id)
+            main.reconstruir_analitica(conn, api.user_id)
+            conn.commit()
+    assert verificar_resumen(main, api.user_id) == ([], {"analitica_presupuestos": 0, "analitica_visitas": 0})
@@ -0,0 +1,51 @@
+"""
+Migraciones del esquema SQLite sobre una base creada con una versión anterior.
+"""
+
+import base64
+import sqlite3
+
+from conftest import modulo
+
+FIRMA_PNG = "data:image/png;base64," + base64.b64encode(b"\x89PNG\r\n\x1a\n" + bytes(range(200))).decode()
+
+
+def base_en_version(main, ruta: str, version: int) -> sqlite3.Connection:
+    conn = sqlite3.connect(ruta)
+    conn.row_factory = sqlite3.Row
+    almacen_sqlite = modulo(main, "almacen_sqlite")
+    almacen_sqlite.crear_tablas(conn)
+    almacen_sqlite.aplicar_migraciones(conn, hasta=version)
+    return conn
+
+
+def columnas(conn: sqlite3.Connection, tabla: str) -> set:
+    return {fila[1] for fila in conn.execute(f"PRAGMA table_info({tabla})")}
+
+
+def test_firmas_en_linea_pasan_al_almacen(main, tmp_path):
+    conn = base_en_version(main, str(tmp_path / "v4.db"), 4)
+    conn.execute("INSERT INTO usuarios (id, nombre, email, password_hash) VALUES (1, 'T', 't@x.es', '')")
+    conn.execute("INSERT INTO clientes (id, usuario_id, nombre, telefono) VALUES (1, 1, 'Ana', '600')")
+    conn.execute(
+        """INSERT INTO visitas (usuario_id, cliente_id, titulo, fecha, firma_cliente)
+           VALUES (1, 1, 'Revisión', '2026-03-10', ?)""",
+        (FIRMA_PNG,)
+    )
+    conn.commit()
+
+    # La 5 copia las firmas y deja la columna; la 14 la quita
+    aplicar_migraciones = modulo(main, "almacen_sqlite").aplicar_migraciones
+    aplicar_migraciones(conn, hasta=5)
+    assert conn.execute("SELECT firma_cliente FROM visitas").fetchone()[0] == FIRMA_PNG
+    firma_hash = conn.execute("SELECT firma_hash FROM visitas").fetchone()[0]
+    mime, = conn.execute("SELECT mime FROM firmas WHERE hash = ?", (firma_hash,)).fetchone()
+    assert mime == "image/png"
+
+    aplicar_migraciones(conn)
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        assert "firma_cliente" not in columnas(conn, "visitas")
+    else:
+        assert conn.execute("SELECT firma_cliente FROM visitas").fetchone()[0] is None
+    assert conn.execute("SELECT firma_hash FROM visitas").fetchone()[0] == firma_hash
+    conn.close()
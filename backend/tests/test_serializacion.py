@@ -0,0 +1,73 @@
+"""
+Atajos de serialización de los listados: filas_respuesta frente a Pydantic y
+serializar_json (orjson) frente a JSONResponse.
+"""
+
+import sqlite3
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from conftest import modulo
+
+
+def filas_sqlite(sql: str) -> list:
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def test_filas_respuesta_como_pydantic(main):
+    # 0/1 en un bool, enteros en columnas float, NULL, columnas de más y
+    # campos con default que la consulta no trae
+    filas = filas_sqlite("""
+        SELECT 7 AS id, 3 AS cliente_id, 'Ana' AS cliente_nombre, 'PRES-2026-0001' AS numero,
+               'Caldera' AS titulo, NULL AS descripcion, 100 AS subtotal, 21 AS iva_porcentaje,
+               1 AS aplicar_iva, 21.0 AS iva_amount, 121 AS total, 'borrador' AS estado,
+               '2026-03-10' AS fecha_emision, NULL AS fecha_validez, NULL AS fecha_rechazo,
+               NULL AS dias_para_eliminar, NULL AS notas, '2026-03-10 10:00:00' AS created_at, 5 AS usuario_id
+        UNION ALL
+        SELECT 8, 3, NULL, 'PRES-2026-0002', 'Radiadores', 'x', 0.5, 10, 0, 0, 0.5, 'rechazado',
+               NULL, NULL, '2026-03-11', 12, 'nota', NULL, 5
+    """)
+    convertidas = modulo(main, "modelos").filas_respuesta(main.PresupuestoResponse, filas)
+    esperadas = [main.PresupuestoResponse.model_validate(dict(fila)).model_dump() for fila in filas]
+    assert convertidas == esperadas
+    assert [list(c) for c in convertidas] == [list(e) for e in esperadas]
+    assert convertidas[0]["aplicar_iva"] is True and isinstance(convertidas[0]["total"], float)
+
+
+def test_validacion_de_filas_detecta_diferencias(main):
+    fila, = filas_sqlite("SELECT 1 AS id, 'Ana' AS nombre, '600' AS telefono, 'particular' AS tipo")
+    modelos = modulo(main, "modelos")
+    registro = modelos.filas_respuesta(main.ClienteResponse, [fila])[0]
+    modelos.validar_fila_respuesta(main.ClienteResponse, fila, registro)
+    with pytest.raises(AssertionError, match="telefono"):
+        modelos.validar_fila_respuesta(main.ClienteResponse, fila, {**registro, "telefono": 600})
+
+
+@pytest.mark.parametrize("contenido", [
+    {"importe": 0.1, "total": 1234.5, "cero": 0.0, "entero": 10, "grande": 2 ** 60},
+    # Los que orjson escribe distinto: pasan por json
+    {"pequeno": 1e-7, "limite": 0.00001, "casi": 0.0001, "exponente": 1e22, "negativo": -2.5e-6},
+    [0.00005, "texto con :0.0000 dentro", 1e16],
+    {"texto": "Ñandú — «comillas» \"dobles\" \\ barra  ", "nulo": None, "bool": [True, False]},
+    {"anidado": [{"a": [1.5, {"b": 3e-5}]}], "vacio": {}, "lista": []},
+    {"fecha": "2026-03-10", "emoji": "🔧"},
+])
+def test_serializar_json_mismos_bytes_que_json(main, contenido):
+    assert main.serializar_json(contenido) == JSONResponse(jsonable_encoder(contenido)).body
+
+
+def test_serializar_json_modelos(main):
+    cliente = main.ClienteResponse(
+        id=1, nombre="Ana", apellidos=None, email=None, telefono="600", telefono_secundario=None,
+        direccion=None, ciudad="Bilbao", codigo_postal=None, provincia=None, tipo="particular",
+        nif_cif=None, notas=None, created_at=None
+    )
+    contenido = {"clientes": [cliente], "tasa": 1e-5}
+    assert main.serializar_json(contenido) == JSONResponse(jsonable_encoder(contenido)).body
@@ -0,0 +1,56 @@
+"""
+Traslado de un usuario de la BD principal a su shard (DB_SHARDING, solo SQLite).
+"""
+
+import sys
+
+import pytest
+
+from conftest import MODULOS, cargar_main, modulo, registrar
+
+
+@pytest.fixture
+def repartido(tmp_path, monkeypatch):
+    # Un módulo aparte con DB_SHARDING=usuario; el de las demás pruebas no cambia
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setenv("DB_SHARDING", "usuario")
+    monkeypatch.setenv("DB_SHARD_DIR", str(tmp_path / "shards"))
+    for nombre in ("main", *MODULOS):
+        monkeypatch.setitem(sys.modules, nombre, sys.modules.get(nombre))
+    main = cargar_main("sqlite", str(tmp_path))
+    with TestClient(main.app) as cliente:
+        yield main, modulo(main, "almacen_sqlite"), cliente
+    main.shards.close()
+
+
+def test_migrar_usuario_a_su_shard(repartido, monkeypatch):
+    main, almacen_sqlite, cliente = repartido
+    # Un usuario de antes del reparto: todo en la principal
+    monkeypatch.setattr(almacen_sqlite, "DB_SHARDING", "no")
+    api = registrar(cliente)
+    ids = [api.post("/api/clientes", json={"nombre": f"C{n}", "telefono": "600"}).json()["id"] for n in range(30)]
+    monkeypatch.setattr(almacen_sqlite, "DB_SHARDING", "usuario")
+
+    copiar = almacen_sqlite.DirectorioShards._copiar
+    durante_la_copia = []
+
+    def copiar_y_escribir(self, destino, usuario_id):
+        resultado = copiar(self, destino, usuario_id)
+        if not durante_la_copia:
+            # En 'copiando' el usuario sigue trabajando contra la principal; lo
+            # que escribe obliga a copiar otra vez ya en 'migrando'
+            durante_la_copia.append(api.get("/api/clientes").status_code)
+            api.put(f"/api/clientes/{ids[0]}", json={"nombre": "Tarde", "telefono": "600"})
+        return resultado
+
+    monkeypatch.setattr(almacen_sqlite.DirectorioShards, "_copiar", copiar_y_escribir)
+    resultado = main.shards.migrar(api.user_id, espera=0)
+    assert durante_la_copia == [200]
+    assert resultado["intentos"] == 2 and resultado["borradas_principal"] == 30
+
+    with main.get_db(principal=True) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM clientes WHERE usuario_id = ?", (api.user_id,)).fetchone()[0] == 0
+        assert conn.execute("SELECT estado FROM directorio_shards").fetchall()[0][0] == "activo"
+    nombres = [c["nombre"] for c in api.get("/api/clientes").json()]
+    assert len(nombres) == 30 and "Tarde" in nombres
@@ -155,6 +155,14 @@ function AppRoutes() {
           </ProtectedRoute>
         }
       />
+      <Route
+        path="/presupuestos/:id/editar"
+        element={
+          <ProtectedRoute>
+            <PresupuestoFormPage />
+          </ProtectedRoute>
+        }
+      />
 
       {/* Configuración */}
       <Route
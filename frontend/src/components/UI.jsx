@@ -123,6 +123,16 @@ export function Button({
   );
 }
 
+// ============ LOAD MORE ============
+export function LoadMore({ hasMore, loading, onClick }) {
+  if (!hasMore) return null;
+  return (
+    <Button variant="ghost" className="w-full" loading={loading} onClick={onClick}>
+      Cargar más
+    </Button>
+  );
+}
+
 // ============ LOADER ============
 export function Loader({ text = 'Cargando...' }) {
   return (
@@ -0,0 +1,58 @@
+import { useState, useEffect, useRef, useCallback } from 'react';
+
+// Carga un listado paginado por cursor: la primera página al montar (o al
+// cambiar los filtros) y las siguientes bajo demanda con loadMore().
+export default function usePaginatedList(fetchPages, filtros = {}, { delay = 0 } = {}) {
+  const [items, setItems] = useState([]);
+  const [total, setTotal] = useState(0);
+  const [hasMore, setHasMore] = useState(false);
+  const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const pagesRef = useRef(null);
+  const key = JSON.stringify(filtros);
+
+  const nextPage = useCallback(async (pages, reset) => {
+    const { value, done } = await pages.next();
+    // Si los filtros cambiaron mientras tanto, descartar la página
+    if (pagesRef.current !== pages) return;
+    if (done) {
+      setHasMore(false);
+      return;
+    }
+    setItems(prev => reset ? value.items : [...prev, ...value.items]);
+    setTotal(value.total);
+    setHasMore(value.hasMore);
+  }, []);
+
+  const reload = useCallback(async () => {
+    const pages = fetchPages(JSON.parse(key));
+    pagesRef.current = pages;
+    setLoading(true);
+    try {
+      await nextPage(pages, true);
+    } catch (error) {
+      console.error('Error loading list:', error);
+    } finally {
+      if (pagesRef.current === pages) setLoading(false);
+    }
+  }, [fetchPages, key, nextPage]);
+
+  useEffect(() => {
+    const timer = setTimeout(reload, delay);
+    return () => clearTimeout(timer);
+  }, [reload, delay]);
+
+  const loadMore = async () => {
+    if (!pagesRef.current || !hasMore || loadingMore) return;
+    setLoadingMore(true);
+    try {
+      await nextPage(pagesRef.current, false);
+    } catch (error) {
+      console.error('Error loading list:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  return { items, setItems, total, hasMore, loading, loadingMore, loadMore, reload };
+}
@@ -22,7 +22,7 @@ export default function ClienteDetailPage() {
     try {
       const [clienteData, presupuestosData] = await Promise.all([
         clientesService.obtener(id),
-        presupuestosService.porCliente(id)
+        presupuestosService.porCliente(id, { incluir_lineas: false })
       ]);
       setCliente(clienteData);
       setPresupuestos(presupuestosData);
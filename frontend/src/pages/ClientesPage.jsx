@@ -1,35 +1,19 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { ArrowLeft, Search, X, Plus, Phone, MapPin, ChevronRight, Users } from 'lucide-react';
 import { clientesService } from '../services/api';
 import Layout from '../components/Layout';
-import { Card, Loader, EmptyState, FAB, Avatar, COLORS } from '../components/UI';
+import { Card, Loader, EmptyState, FAB, Avatar, LoadMore, COLORS } from '../components/UI';
+import usePaginatedList from '../hooks/usePaginatedList';
 
 export default function ClientesPage() {
   const navigate = useNavigate();
-  const [loading, setLoading] = useState(true);
-  const [clientes, setClientes] = useState([]);
   const [search, setSearch] = useState('');
 
-  useEffect(() => {
-    loadClientes();
-  }, []);
-
-  const loadClientes = async () => {
-    try {
-      const data = await clientesService.listar();
-      setClientes(data);
-    } catch (error) {
-      console.error('Error loading clientes:', error);
-    } finally {
-      setLoading(false);
-    }
-  };
-
-  const filtered = clientes.filter(c => 
-    `${c.nombre} ${c.apellidos}`.toLowerCase().includes(search.toLowerCase()) ||
-    c.telefono?.includes(search)
-  );
+  // La búsqueda se resuelve en el servidor (con un pequeño retardo al teclear)
+  const {
+    items: clientes, total, hasMore, loading, loadingMore, loadMore
+  } = usePaginatedList(clientesService.paginas, { q: search }, { delay: search ? 300 : 0 });
 
   return (
     <Layout>
@@ -39,7 +23,7 @@ export default function ClientesPage() {
           <ArrowLeft size={24} className="text-gray-800" />
         </button>
         <h1 className="text-xl font-bold text-gray-800 flex-1">
-          Clientes ({clientes.length})
+          Clientes ({total})
         </h1>
       </div>
 
@@ -64,7 +48,7 @@ export default function ClientesPage() {
         {/* List */}
         {loading ? (
           <Loader />
-        ) : filtered.length === 0 ? (
+        ) : clientes.length === 0 ? (
           <EmptyState
             icon={Users}
             title={search ? 'Sin resultados' : 'No hay clientes'}
@@ -74,7 +58,7 @@ export default function ClientesPage() {
           />
         ) : (
           <div className="space-y-3">
-            {filtered.map(cliente => (
+            {clientes.map(cliente => (
               <Card 
                 key={cliente.id} 
                 onClick={() => navigate(`/clientes/${cliente.id}`)}
@@ -114,6 +98,7 @@ export default function ClientesPage() {
                 </div>
               </Card>
             ))}
+            <LoadMore hasMore={hasMore} loading={loadingMore} onClick={loadMore} />
           </div>
         )}
       </div>
@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from 'react';
-import { useNavigate, useSearchParams } from 'react-router-dom';
+import { useNavigate, useParams, useSearchParams } from 'react-router-dom';
 import { X, Save, User, Plus, ChevronDown, Trash2 } from 'lucide-react';
 import { presupuestosService, clientesService } from '../services/api';
 import { Card, Input, Button, Toggle, COLORS } from '../components/UI';
@@ -8,8 +8,12 @@ export default function PresupuestoFormPage() {
   const navigate = useNavigate();
   const [searchParams] = useSearchParams();
   const preselectedClientId = searchParams.get('cliente');
+  const { id } = useParams();
+  const isEditing = !!id;
 
+  const [loading, setLoading] = useState(false);
   const [saving, setSaving] = useState(false);
+  const [version, setVersion] = useState(null);
   const [clientes, setClientes] = useState([]);
   const [loadingClientes, setLoadingClientes] = useState(true);
   
@@ -30,6 +34,41 @@ export default function PresupuestoFormPage() {
     loadClientes();
   }, []);
 
+  useEffect(() => {
+    if (isEditing) {
+      loadPresupuesto();
+    }
+  }, [id]);
+
+  const loadPresupuesto = async () => {
+    setLoading(true);
+    try {
+      const presupuesto = await presupuestosService.obtener(id);
+      setForm({
+        cliente_id: presupuesto.cliente_id,
+        titulo: presupuesto.titulo,
+        descripcion: presupuesto.descripcion || '',
+        aplicar_iva: presupuesto.aplicar_iva,
+        iva_porcentaje: presupuesto.iva_porcentaje,
+        fecha_validez: presupuesto.fecha_validez || '',
+        notas: presupuesto.notas || '',
+        lineas: presupuesto.lineas.map(l => ({
+          id: l.id,
+          concepto: l.concepto,
+          descripcion: l.descripcion || '',
+          cantidad: l.cantidad,
+          precio_unitario: l.precio_unitario
+        }))
+      });
+      setVersion(presupuesto.version);
+    } catch (error) {
+      console.error('Error loading presupuesto:', error);
+      navigate('/presupuestos');
+    } finally {
+      setLoading(false);
+    }
+  };
+
   const loadClientes = async () => {
     try {
       const data = await clientesService.listar();
@@ -87,7 +126,7 @@ export default function PresupuestoFormPage() {
 
     setSaving(true);
     try {
-      await presupuestosService.crear({
+      const datos = {
         cliente_id: parseInt(form.cliente_id),
         titulo: form.titulo,
         descripcion: form.descripcion,
@@ -96,21 +135,31 @@ export default function PresupuestoFormPage() {
         fecha_validez: form.fecha_validez || null,
         notas: form.notas,
         lineas: form.lineas.map(l => ({
+          id: l.id,
           concepto: l.concepto,
           descripcion: l.descripcion,
           cantidad: parseFloat(l.cantidad) || 0,
           precio_unitario: parseFloat(l.precio_unitario) || 0
         }))
-      });
+      };
+      if (isEditing) {
+        await presupuestosService.actualizar(id, { ...datos, version });
+      } else {
+        await presupuestosService.crear(datos);
+      }
       navigate('/presupuestos');
     } catch (error) {
       console.error('Error saving presupuesto:', error);
-      alert('Error al guardar el presupuesto');
+      alert(isEditing ? error.message : 'Error al guardar el presupuesto');
     } finally {
       setSaving(false);
     }
   };
 
+  if (loading) {
+    return <div className="flex items-center justify-center h-screen">Cargando...</div>;
+  }
+
   return (
     <div className="min-h-screen bg-gray-50">
       {/* Header */}
@@ -119,7 +168,9 @@ export default function PresupuestoFormPage() {
           <button onClick={() => navigate(-1)}>
             <X size={24} className="text-gray-800" />
           </button>
-          <h1 className="text-xl font-bold text-gray-800">Nuevo Presupuesto</h1>
+          <h1 className="text-xl font-bold text-gray-800">
+            {isEditing ? 'Editar Presupuesto' : 'Nuevo Presupuesto'}
+          </h1>
         </div>
         <Button
           variant="primary"
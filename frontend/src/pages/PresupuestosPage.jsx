@@ -1,32 +1,40 @@
 import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
-import { ArrowLeft, Plus, FileText, User, Download, Timer, Send, Check, XCircle } from 'lucide-react';
-import { presupuestosService } from '../services/api';
+import { ArrowLeft, Plus, FileText, User, Download, Timer, Send, Check, XCircle, Pencil } from 'lucide-react';
+import { presupuestosService, guardarArchivo } from '../services/api';
 import Layout from '../components/Layout';
-import { Card, Loader, EmptyState, FAB, Badge, Modal, Button, STATUS_CONFIG, COLORS } from '../components/UI';
+import { Card, Loader, EmptyState, FAB, Badge, Modal, Button, LoadMore, STATUS_CONFIG, COLORS } from '../components/UI';
+import usePaginatedList from '../hooks/usePaginatedList';
 
 export default function PresupuestosPage() {
   const navigate = useNavigate();
-  const [loading, setLoading] = useState(true);
-  const [presupuestos, setPresupuestos] = useState([]);
   const [expandedId, setExpandedId] = useState(null);
   const [pdfModal, setPdfModal] = useState(null);
+  const [downloading, setDownloading] = useState(false);
+  const [stats, setStats] = useState({ total: 0, aceptados: 0, pendientes: 0 });
 
+  const {
+    items: presupuestos, hasMore, loading, loadingMore, loadMore, reload
+  } = usePaginatedList(presupuestosService.paginas, { incluir_lineas: false });
+
+  // Los contadores salen del servidor: la lista solo tiene las páginas cargadas
   useEffect(() => {
-    loadPresupuestos();
+    loadStats();
   }, []);
 
-  const loadPresupuestos = async () => {
+  const loadStats = async () => {
     try {
-      const data = await presupuestosService.listar();
-      setPresupuestos(data);
+      setStats(await presupuestosService.estadisticas());
     } catch (error) {
-      console.error('Error loading presupuestos:', error);
-    } finally {
-      setLoading(false);
+      console.error('Error loading stats:', error);
     }
   };
 
+  const loadPresupuestos = () => {
+    reload();
+    loadStats();
+  };
+
   const handleChangeStatus = async (id, estado) => {
     try {
       await presupuestosService.cambiarEstado(id, estado);
@@ -38,16 +46,17 @@ export default function PresupuestosPage() {
     }
   };
 
-  const handleDownloadPdf = (pres) => {
-    // Simular descarga de PDF
-    alert(`📄 PDF descargado: ${pres.numero}.pdf`);
-    setPdfModal(null);
-  };
-
-  const stats = {
-    total: presupuestos.length,
-    aceptados: presupuestos.filter(p => p.estado === 'aceptado').length,
-    pendientes: presupuestos.filter(p => ['borrador', 'enviado'].includes(p.estado)).length
+  const handleDownloadPdf = async (pres) => {
+    setDownloading(true);
+    try {
+      guardarArchivo(await presupuestosService.pdf(pres.id), `${pres.numero}.pdf`);
+      setPdfModal(null);
+    } catch (error) {
+      console.error('Error downloading PDF:', error);
+      alert(error.message);
+    } finally {
+      setDownloading(false);
+    }
   };
 
   return (
@@ -140,15 +149,25 @@ export default function PresupuestosPage() {
                   </p>
                 </div>
 
-                {/* Botón PDF */}
-                <button
-                  onClick={() => setPdfModal(pres)}
-                  className="w-full mt-3 py-2 rounded-xl flex items-center justify-center gap-2 border"
-                  style={{ borderColor: COLORS.primary, color: COLORS.primary }}
-                >
-                  <Download size={18} />
-                  <span className="font-medium text-sm">Descargar PDF</span>
-                </button>
+                {/* Botones editar y PDF */}
+                <div className="flex gap-2 mt-3">
+                  <button
+                    onClick={() => navigate(`/presupuestos/${pres.id}/editar`)}
+                    className="flex-1 py-2 rounded-xl flex items-center justify-center gap-2 border"
+                    style={{ borderColor: COLORS.primary, color: COLORS.primary }}
+                  >
+                    <Pencil size={18} />
+                    <span className="font-medium text-sm">Editar</span>
+                  </button>
+                  <button
+                    onClick={() => setPdfModal(pres)}
+                    className="flex-1 py-2 rounded-xl flex items-center justify-center gap-2 border"
+                    style={{ borderColor: COLORS.primary, color: COLORS.primary }}
+                  >
+                    <Download size={18} />
+                    <span className="font-medium text-sm">Descargar PDF</span>
+                  </button>
+                </div>
 
                 {/* Status change panel */}
                 {expandedId === pres.id && (
@@ -185,6 +204,7 @@ export default function PresupuestosPage() {
                 )}
               </Card>
             ))}
+            <LoadMore hasMore={hasMore} loading={loadingMore} onClick={loadMore} />
           </div>
         )}
       </div>
@@ -225,6 +245,7 @@ export default function PresupuestosPage() {
               variant="primary"
               icon={Download}
               className="w-full mb-3"
+              loading={downloading}
               onClick={() => handleDownloadPdf(pdfModal)}
             >
               Descargar PDF
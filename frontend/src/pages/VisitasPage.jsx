@@ -1,33 +1,32 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState } from 'react';
 import { useNavigate } from 'react-router-dom';
-import { ArrowLeft, Plus, Calendar, Clock, User, ChevronDown, ChevronUp, AlertTriangle, Wrench, ClipboardList, Phone, MapPin, Play, Check, CheckCircle } from 'lucide-react';
-import { visitasService } from '../services/api';
+import { ArrowLeft, Plus, Calendar, Clock, User, ChevronDown, ChevronUp, AlertTriangle, Wrench, ClipboardList, Phone, MapPin, Play, Check, CheckCircle, Download } from 'lucide-react';
+import { visitasService, guardarArchivo } from '../services/api';
 import Layout from '../components/Layout';
-import { Card, Loader, EmptyState, FAB, Badge, TabBar, STATUS_CONFIG, COLORS } from '../components/UI';
+import { Card, Loader, EmptyState, FAB, Badge, TabBar, LoadMore, STATUS_CONFIG, COLORS } from '../components/UI';
+import usePaginatedList from '../hooks/usePaginatedList';
 
 export default function VisitasPage() {
   const navigate = useNavigate();
-  const [loading, setLoading] = useState(true);
-  const [visitas, setVisitas] = useState([]);
   const [filter, setFilter] = useState('todas');
   const [expandedId, setExpandedId] = useState(null);
   const [statusModalId, setStatusModalId] = useState(null);
+  const [downloadingId, setDownloadingId] = useState(null);
 
-  useEffect(() => {
-    loadVisitas();
-  }, []);
+  const today = new Date().toISOString().split('T')[0];
 
-  const loadVisitas = async () => {
-    try {
-      const data = await visitasService.listar();
-      setVisitas(data);
-    } catch (error) {
-      console.error('Error loading visitas:', error);
-    } finally {
-      setLoading(false);
-    }
+  // Cada pestaña se traduce a filtros del servidor
+  const filterParams = {
+    todas: {},
+    hoy: { fecha: today },
+    pendientes: { estado: 'pendiente,confirmada' },
+    completada: { estado: 'completada' },
   };
 
+  const {
+    items: visitas, setItems: setVisitas, total, hasMore, loading, loadingMore, loadMore
+  } = usePaginatedList(visitasService.paginas, filterParams[filter]);
+
   const handleChangeStatus = async (id, estado) => {
     try {
       await visitasService.cambiarEstado(id, estado);
@@ -38,6 +37,18 @@ export default function VisitasPage() {
     }
   };
 
+  const handleDownloadPdf = async (id) => {
+    setDownloadingId(id);
+    try {
+      guardarArchivo(await visitasService.pdf(id), `parte-visita-${id}.pdf`);
+    } catch (error) {
+      console.error('Error downloading PDF:', error);
+      alert(error.message);
+    } finally {
+      setDownloadingId(null);
+    }
+  };
+
   const filters = [
     { value: 'todas', label: 'Todas' },
     { value: 'hoy', label: 'Hoy' },
@@ -45,17 +56,7 @@ export default function VisitasPage() {
     { value: 'completada', label: 'Completadas' },
   ];
 
-  const isToday = (fecha) => {
-    const today = new Date().toISOString().split('T')[0];
-    return fecha === today;
-  };
-
-  const filtered = visitas.filter(v => {
-    if (filter === 'todas') return true;
-    if (filter === 'hoy') return isToday(v.fecha);
-    if (filter === 'pendientes') return ['pendiente', 'confirmada'].includes(v.estado);
-    return v.estado === filter;
-  });
+  const isToday = (fecha) => fecha === today;
 
   const formatDate = (fecha) => {
     if (isToday(fecha)) return 'Hoy';
@@ -75,7 +76,7 @@ export default function VisitasPage() {
           <ArrowLeft size={24} className="text-gray-800" />
         </button>
         <h1 className="text-xl font-bold text-gray-800 flex-1">
-          Visitas ({visitas.length})
+          Visitas ({total})
         </h1>
       </div>
 
@@ -86,7 +87,7 @@ export default function VisitasPage() {
         {/* List */}
         {loading ? (
           <Loader />
-        ) : filtered.length === 0 ? (
+        ) : visitas.length === 0 ? (
           <EmptyState
             icon={Calendar}
             title="No hay visitas"
@@ -96,7 +97,7 @@ export default function VisitasPage() {
           />
         ) : (
           <div className="space-y-3">
-            {filtered.map(visita => (
+            {visitas.map(visita => (
               <Card key={visita.id}>
                 {/* Header */}
                 <div className="flex justify-between items-start mb-3">
@@ -196,6 +197,20 @@ export default function VisitasPage() {
                         )}
                       </div>
                     )}
+
+                    {visita.estado === 'completada' && (
+                      <button
+                        onClick={() => handleDownloadPdf(visita.id)}
+                        disabled={downloadingId === visita.id}
+                        className="w-full mt-3 py-2 rounded-xl flex items-center justify-center gap-2 border"
+                        style={{ borderColor: COLORS.primary, color: COLORS.primary }}
+                      >
+                        <Download size={18} />
+                        <span className="font-medium text-sm">
+                          {downloadingId === visita.id ? 'Generando...' : 'Parte de trabajo (PDF)'}
+                        </span>
+                      </button>
+                    )}
                   </div>
                 )}
 
@@ -237,6 +252,7 @@ export default function VisitasPage() {
                 )}
               </Card>
             ))}
+            <LoadMore hasMore={hasMore} loading={loadingMore} onClick={loadMore} />
           </div>
         )}
       </div>
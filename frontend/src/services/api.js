@@ -1,45 +1,181 @@
+import { crearEspejo, disponible as espejoDisponible } from './offline';
+
 // Configuración de la API
 const API_URL = import.meta.env.VITE_API_URL || '/api';
 
+// Tamaño de página por defecto de los listados
+export const PAGE_SIZE = 50;
+
 // Helper para obtener el token
 const getToken = () => localStorage.getItem('token');
+const getRefreshToken = () => localStorage.getItem('refresh_token');
+
+const guardarSesion = (data) => {
+  localStorage.setItem('token', data.access_token);
+  localStorage.setItem('refresh_token', data.refresh_token);
+  localStorage.setItem('user', JSON.stringify(data.user));
+};
+
+const borrarSesion = () => {
+  localStorage.removeItem('token');
+  localStorage.removeItem('refresh_token');
+  localStorage.removeItem('user');
+  etagCache.clear();
+};
+
+// El access token dura minutos: al recibir un 401 se pide uno nuevo con el
+// refresh token. Las peticiones que fallan a la vez comparten el mismo refresco
+let refreshPromise = null;
+
+const refrescarSesion = () => {
+  if (!refreshPromise) {
+    const refreshToken = getRefreshToken();
+    refreshPromise = (async () => {
+      if (!refreshToken) return false;
+      const response = await fetch(`${API_URL}/auth/refresh`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ refresh_token: refreshToken })
+      });
+      if (response.ok) {
+        guardarSesion(await response.json());
+        return true;
+      }
+      // Otra pestaña puede haber usado ya este refresh token y guardado el nuevo
+      return getRefreshToken() !== refreshToken && !!getToken();
+    })()
+      .catch(() => false)
+      .finally(() => { refreshPromise = null; });
+  }
+  return refreshPromise;
+};
+
+// Respuestas GET guardadas por ETag: si el servidor contesta 304 se reutilizan
+const ETAG_CACHE_MAX = 100;
+const etagCache = new Map();
+
+const rememberResponse = (key, entry) => {
+  etagCache.delete(key);
+  etagCache.set(key, entry);
+  if (etagCache.size > ETAG_CACHE_MAX) {
+    etagCache.delete(etagCache.keys().next().value);
+  }
+};
+
+// Helper para construir query strings ignorando filtros vacíos
+const buildQuery = (params = {}) => {
+  const query = new URLSearchParams(
+    Object.entries(params).filter(([, value]) => value !== undefined && value !== null && value !== '')
+  ).toString();
+  return query ? `?${query}` : '';
+};
 
 // Helper para hacer peticiones
 async function request(endpoint, options = {}) {
+  const { data } = await requestWithHeaders(endpoint, options);
+  return data;
+}
+
+// Igual que request() pero devuelve también las cabeceras de la respuesta
+async function requestWithHeaders(endpoint, options = {}, reintento = true) {
   const token = getToken();
+  const isGet = !options.method || options.method === 'GET';
+  // Los tokens rotan: la caché se indexa por usuario, no por token
+  const cacheKey = `${authService.getUser()?.id}:${endpoint}`;
+  const cached = isGet ? etagCache.get(cacheKey) : null;
   
   const config = {
+    ...options,
     headers: {
       'Content-Type': 'application/json',
       ...(token && { 'Authorization': `Bearer ${token}` }),
+      ...(cached && { 'If-None-Match': cached.etag }),
       ...options.headers
     },
-    ...options
+    // La revalidación la gestionamos nosotros con If-None-Match
+    ...(isGet && { cache: 'no-store' })
   };
 
   try {
     const response = await fetch(`${API_URL}${endpoint}`, config);
     
-    if (response.status === 401) {
-      localStorage.removeItem('token');
-      localStorage.removeItem('user');
+    if (response.status === 401 && token) {
+      if (reintento && await refrescarSesion()) {
+        return requestWithHeaders(endpoint, options, false);
+      }
+      borrarSesion();
       window.location.href = '/login';
       throw new Error('Sesión expirada');
     }
 
+    if (response.status === 304 && cached) {
+      rememberResponse(cacheKey, cached);
+      return { data: cached.data, headers: cached.headers };
+    }
+
     const data = await response.json();
     
     if (!response.ok) {
       throw new Error(data.detail || 'Error en la petición');
     }
 
-    return data;
+    const etag = response.headers.get('ETag');
+    if (isGet && etag) {
+      rememberResponse(cacheKey, { etag, data, headers: response.headers });
+    }
+
+    return { data, headers: response.headers };
   } catch (error) {
     console.error('API Error:', error);
     throw error;
   }
 }
 
+// Descarga un archivo (PDF...) como Blob, con la misma renovación de sesión
+async function requestBlob(endpoint, reintento = true) {
+  const token = getToken();
+  const response = await fetch(`${API_URL}${endpoint}`, {
+    headers: token ? { 'Authorization': `Bearer ${token}` } : {}
+  });
+  if (response.status === 401 && token && reintento && await refrescarSesion()) {
+    return requestBlob(endpoint, false);
+  }
+  if (!response.ok) {
+    const data = await response.json().catch(() => ({}));
+    throw new Error(data.detail || 'No se pudo descargar el archivo');
+  }
+  return response.blob();
+}
+
+// Guarda un Blob con el nombre indicado (descarga del navegador)
+export function guardarArchivo(blob, nombre) {
+  const url = URL.createObjectURL(blob);
+  const enlace = document.createElement('a');
+  enlace.href = url;
+  enlace.download = nombre;
+  document.body.appendChild(enlace);
+  enlace.click();
+  enlace.remove();
+  setTimeout(() => URL.revokeObjectURL(url), 1000);
+}
+
+// Recorre un listado paginado por cursor, una página por iteración:
+//   for await (const { items, total, hasMore } of requestPages('/clientes')) { ... }
+export async function* requestPages(endpoint, filtros = {}, limite = PAGE_SIZE) {
+  let cursor = null;
+  do {
+    const { data, headers } = await requestWithHeaders(
+      `${endpoint}${buildQuery({ ...filtros, limite, cursor })}`
+    );
+    cursor = headers.get('X-Next-Cursor');
+    yield {
+      items: data,
+      total: Number(headers.get('X-Total-Count') ?? data.length),
+      hasMore: !!cursor
+    };
+  } while (cursor);
+}
+
 // ============ AUTH ============
 export const authService = {
   async login(email, password) {
@@ -47,8 +183,7 @@ export const authService = {
       method: 'POST',
       body: JSON.stringify({ email, password })
     });
-    localStorage.setItem('token', data.access_token);
-    localStorage.setItem('user', JSON.stringify(data.user));
+    guardarSesion(data);
     return data;
   },
 
@@ -57,8 +192,7 @@ export const authService = {
       method: 'POST',
       body: JSON.stringify(userData)
     });
-    localStorage.setItem('token', data.access_token);
-    localStorage.setItem('user', JSON.stringify(data.user));
+    guardarSesion(data);
     return data;
   },
 
@@ -67,8 +201,15 @@ export const authService = {
   },
 
   logout() {
-    localStorage.removeItem('token');
-    localStorage.removeItem('user');
+    // Revoca la sesión en el servidor sin esperar la respuesta
+    const token = getToken();
+    if (token) {
+      fetch(`${API_URL}/auth/logout`, {
+        method: 'POST',
+        headers: { 'Authorization': `Bearer ${token}` }
+      }).catch(() => {});
+    }
+    borrarSesion();
   },
 
   isAuthenticated() {
@@ -81,118 +222,437 @@ export const authService = {
   }
 };
 
+// ============ SINCRONIZACIÓN ============
+// Clientes, visitas y presupuestos se leen de la copia local (offline.js), que
+// se pone al día con los cambios de /api/sync en vez de volver a pedir los
+// listados. Las escrituras se encolan, se aplican a la copia y se suben en
+// lote a POST /api/sync en cuanto hay conexión. Sin IndexedDB todo va directo
+// al servidor.
+const SYNC_ESPERA_MS = 3000;
+const SYNC_MAX_OPERACIONES = 200;
+const resultadosSync = new Map();
+let syncPromise = null;
+let syncRepetir = false;
+
+const espejoActual = () => {
+  const user = authService.getUser();
+  return user && espejoDisponible() ? crearEspejo(user.id) : null;
+};
+
+// El servidor rechazó la operación: el registro vuelve a su estado real
+async function descartarCambioLocal(espejo, { entidad, id }) {
+  if (id < 0) {
+    await espejo.borrar(entidad, id);
+    return;
+  }
+  try {
+    await espejo.guardar(entidad, await request(`/${entidad}/${id}`));
+  } catch (error) {
+    if (!(error instanceof TypeError)) await espejo.borrar(entidad, id);
+  }
+}
+
+// Sube la cola por lotes. Devuelve false si el servidor deja operaciones
+// pendientes (error temporal): se reintentarán en la siguiente sincronización
+async function subirCola(espejo) {
+  for (;;) {
+    const cola = (await espejo.cola()).slice(0, SYNC_MAX_OPERACIONES);
+    if (!cola.length) return true;
+    const { resultados, ids, pendientes } = await request('/sync', {
+      method: 'POST',
+      body: JSON.stringify({ operaciones: cola.map(({ orden, ...operacion }) => operacion) })
+    });
+    const procesadas = cola.slice(0, resultados.length);
+    await espejo.confirmar(procesadas.map(operacion => operacion.orden), ids);
+    for (const [i, resultado] of resultados.entries()) {
+      resultadosSync.set(resultado.id_peticion, resultado);
+      if (resultado.estado >= 400) await descartarCambioLocal(espejo, procesadas[i]);
+    }
+    if (pendientes) return false;
+  }
+}
+
+async function bajarCambios(espejo) {
+  let cambios;
+  do {
+    cambios = await request(`/sync${buildQuery({ cursor: await espejo.cursor() })}`);
+    await espejo.aplicarCambios(cambios);
+  } while (cambios.mas);
+}
+
+export const syncService = {
+  // Sube lo pendiente y baja los cambios. Las llamadas durante una
+  // sincronización la repiten al terminar en vez de lanzar otra a la vez.
+  // Resuelve a false si no se ha podido completar (sin conexión...)
+  sincronizar() {
+    const espejo = espejoActual();
+    if (!espejo) return Promise.resolve(false);
+    if (syncPromise) {
+      syncRepetir = true;
+      return syncPromise;
+    }
+    syncPromise = (async () => {
+      let completa;
+      do {
+        syncRepetir = false;
+        try {
+          completa = await subirCola(espejo);
+          if (completa) await bajarCambios(espejo);
+        } catch (error) {
+          completa = false;
+        }
+      } while (syncRepetir && completa);
+      return completa;
+    })().finally(() => { syncPromise = null; });
+    return syncPromise;
+  },
+
+  async pendientes() {
+    const espejo = espejoActual();
+    return espejo ? (await espejo.cola()).length : 0;
+  }
+};
+
+if (typeof window !== 'undefined') {
+  window.addEventListener('online', () => syncService.sincronizar());
+}
+
+// La copia local tras intentar ponerla al día, o null si aún no tiene datos
+// (primera sincronización sin terminar) o no hay IndexedDB. Con mala
+// cobertura no se espera más de SYNC_ESPERA_MS: se sirve lo que ya hay
+async function espejoSincronizado() {
+  const espejo = espejoActual();
+  if (!espejo) return null;
+  try {
+    await Promise.race([
+      syncService.sincronizar(),
+      new Promise(resolve => setTimeout(resolve, SYNC_ESPERA_MS))
+    ]);
+    return (await espejo.listo()) ? espejo : null;
+  } catch (error) {
+    return null;
+  }
+}
+
+const comparar = (a, b) => (a ?? '') < (b ?? '') ? -1 : (a ?? '') > (b ?? '') ? 1 : 0;
+const contiene = (texto, q) => (texto || '').toLowerCase().includes(q.toLowerCase());
+const enLista = (valor, lista) => !lista || lista.split(',').includes(valor);
+
+// Los mismos filtros y orden que aplican los listados del servidor
+const CONSULTAS_LOCALES = {
+  clientes: {
+    filtrar: (c, { q, tipo }) =>
+      (!q || contiene(`${c.nombre} ${c.apellidos || ''}`, q) || contiene(c.telefono, q)) &&
+      (!tipo || c.tipo === tipo),
+    ordenar: (a, b) => comparar(a.nombre, b.nombre) || a.id - b.id
+  },
+  visitas: {
+    filtrar: (v, { fecha, estado, desde, hasta }) =>
+      (!fecha || v.fecha === fecha) && enLista(v.estado, estado) &&
+      (!desde || v.fecha >= desde) && (!hasta || v.fecha <= hasta),
+    ordenar: (a, b) => comparar(b.fecha, a.fecha) || comparar(a.hora, b.hora) || a.id - b.id
+  },
+  presupuestos: {
+    filtrar: (p, { cliente_id, estado, desde, hasta }) =>
+      (!cliente_id || p.cliente_id === Number(cliente_id)) && enLista(p.estado, estado) &&
+      (!desde || p.fecha_emision >= desde) && (!hasta || p.fecha_emision <= hasta),
+    ordenar: (a, b) => comparar(b.created_at, a.created_at) || b.id - a.id
+  }
+};
+
+async function listarLocal(espejo, tabla, filtros) {
+  const { filtrar, ordenar } = CONSULTAS_LOCALES[tabla];
+  return (await espejo.todos(tabla)).filter(registro => filtrar(registro, filtros)).sort(ordenar);
+}
+
+async function listar(tabla, endpoint, filtros) {
+  const espejo = await espejoSincronizado();
+  return espejo ? listarLocal(espejo, tabla, filtros) : request(`${endpoint}${buildQuery(filtros)}`);
+}
+
+// Mismo formato que requestPages(), pero paginando la copia local
+async function* paginasLocales(tabla, endpoint, filtros) {
+  const espejo = await espejoSincronizado();
+  if (!espejo) {
+    yield* requestPages(endpoint, filtros);
+    return;
+  }
+  const items = await listarLocal(espejo, tabla, filtros);
+  let inicio = 0;
+  do {
+    yield {
+      items: items.slice(inicio, inicio + PAGE_SIZE),
+      total: items.length,
+      hasMore: inicio + PAGE_SIZE < items.length
+    };
+    inicio += PAGE_SIZE;
+  } while (inicio < items.length);
+}
+
+async function obtenerLocal(tabla, id) {
+  const espejo = await espejoSincronizado();
+  const registro = espejo && await espejo.obtener(tabla, Number(id));
+  return registro || request(`/${tabla}/${id}`);
+}
+
+// Escritura offline-first. `local(anterior, id, espejo)` calcula cómo queda el
+// registro en la copia (null = se borra). Con conexión devuelve la respuesta
+// del servidor o lanza su error; sin ella, el registro local. `directo` es la
+// petición REST, para cuando no hay IndexedDB
+async function escribir(entidad, accion, { id = null, datos = {} }, local, directo) {
+  const espejo = espejoActual();
+  if (!espejo) return directo();
+
+  const idPeticion = crypto.randomUUID();
+  const registroId = accion === 'crear' ? await espejo.nuevoIdLocal() : Number(id);
+  await espejo.encolar({ id_peticion: idPeticion, entidad, accion, id: registroId, datos });
+
+  const anterior = accion === 'crear' ? {} : await espejo.obtener(entidad, registroId);
+  let registro = null;
+  if (anterior) {
+    registro = await local(anterior, registroId, espejo);
+    await (registro ? espejo.guardar(entidad, registro) : espejo.borrar(entidad, registroId));
+  }
+
+  await syncService.sincronizar();
+  const resultado = resultadosSync.get(idPeticion);
+  resultadosSync.delete(idPeticion);
+  if (!resultado) return registro ?? { message: 'Pendiente de sincronizar' };
+  if (resultado.estado >= 400) throw new Error(resultado.error || 'Error en la petición');
+  return resultado.resultado;
+}
+
+// Datos del cliente que las visitas y presupuestos llevan copiados
+async function conCliente(espejo, registro) {
+  const cliente = await espejo.obtener('clientes', registro.cliente_id);
+  if (!cliente) return registro;
+  return {
+    ...registro,
+    cliente_nombre: `${cliente.nombre} ${cliente.apellidos || ''}`,
+    cliente_telefono: cliente.telefono,
+    cliente_direccion: `${cliente.direccion || ''}, ${cliente.ciudad || ''}`
+  };
+}
+
+const conTotales = (presupuesto) => {
+  const lineas = (presupuesto.lineas || []).map(l => ({ ...l, total: (l.cantidad ?? 1) * (l.precio_unitario ?? 0) }));
+  const subtotal = lineas.reduce((suma, l) => suma + l.total, 0);
+  const iva = presupuesto.aplicar_iva === false ? 0 : subtotal * (presupuesto.iva_porcentaje ?? 21) / 100;
+  return { ...presupuesto, lineas, subtotal, iva_amount: iva, total: subtotal + iva };
+};
+
+const ahora = () => new Date().toISOString();
+
 // ============ CLIENTES ============
 export const clientesService = {
-  async listar() {
-    return request('/clientes');
+  async listar(filtros = {}) {
+    return listar('clientes', '/clientes', filtros);
+  },
+
+  paginas(filtros = {}) {
+    return paginasLocales('clientes', '/clientes', filtros);
   },
 
   async obtener(id) {
-    return request(`/clientes/${id}`);
+    return obtenerLocal('clientes', id);
   },
 
   async crear(cliente) {
-    return request('/clientes', {
-      method: 'POST',
-      body: JSON.stringify(cliente)
-    });
+    return escribir('clientes', 'crear', { datos: cliente },
+      (_, id) => ({ ...cliente, id, created_at: ahora() }),
+      () => request('/clientes', {
+        method: 'POST',
+        body: JSON.stringify(cliente)
+      })
+    );
   },
 
   async actualizar(id, cliente) {
-    return request(`/clientes/${id}`, {
-      method: 'PUT',
-      body: JSON.stringify(cliente)
-    });
+    return escribir('clientes', 'actualizar', { id, datos: cliente },
+      (anterior) => ({ ...anterior, ...cliente }),
+      () => request(`/clientes/${id}`, {
+        method: 'PUT',
+        body: JSON.stringify(cliente)
+      })
+    );
   },
 
   async eliminar(id) {
-    return request(`/clientes/${id}`, {
-      method: 'DELETE'
-    });
+    return escribir('clientes', 'eliminar', { id }, () => null,
+      () => request(`/clientes/${id}`, {
+        method: 'DELETE'
+      })
+    );
   }
 };
 
 // ============ VISITAS ============
 export const visitasService = {
   async listar(filtros = {}) {
-    const params = new URLSearchParams(filtros).toString();
-    return request(`/visitas${params ? `?${params}` : ''}`);
+    return listar('visitas', '/visitas', filtros);
+  },
+
+  paginas(filtros = {}) {
+    return paginasLocales('visitas', '/visitas', filtros);
   },
 
   async hoy() {
     return request('/visitas/hoy');
   },
 
+  // Visitas de un rango de días agrupadas por día, con contadores por estado y
+  // prioridad y las que coinciden en hora. Para la vista de mes basta con
+  // { incluirVisitas: false }
+  async agenda(desde, hasta, { incluirVisitas = true } = {}) {
+    return request(`/agenda${buildQuery({ desde, hasta, incluir_visitas: incluirVisitas })}`);
+  },
+
   async obtener(id) {
-    return request(`/visitas/${id}`);
+    return obtenerLocal('visitas', id);
   },
 
   async crear(visita) {
-    return request('/visitas', {
-      method: 'POST',
-      body: JSON.stringify(visita)
-    });
+    return escribir('visitas', 'crear', { datos: visita },
+      (_, id, espejo) => conCliente(espejo, { estado: 'pendiente', ...visita, id, created_at: ahora() }),
+      () => request('/visitas', {
+        method: 'POST',
+        body: JSON.stringify(visita)
+      })
+    );
   },
 
   async actualizar(id, visita) {
-    return request(`/visitas/${id}`, {
-      method: 'PUT',
-      body: JSON.stringify(visita)
-    });
+    return escribir('visitas', 'actualizar', { id, datos: visita },
+      (anterior, _, espejo) => conCliente(espejo, { ...anterior, ...visita }),
+      () => request(`/visitas/${id}`, {
+        method: 'PUT',
+        body: JSON.stringify(visita)
+      })
+    );
   },
 
   async cambiarEstado(id, estado) {
-    return request(`/visitas/${id}/estado?estado=${estado}`, {
-      method: 'PATCH'
-    });
+    return escribir('visitas', 'estado', { id, datos: { estado } },
+      (anterior) => ({ ...anterior, estado }),
+      () => request(`/visitas/${id}/estado?estado=${estado}`, {
+        method: 'PATCH'
+      })
+    );
   },
 
   async completar(id, data) {
-    return request(`/visitas/${id}/completar`, {
-      method: 'PATCH',
-      body: JSON.stringify(data)
+    return escribir('visitas', 'completar', { id, datos: data },
+      (anterior) => ({
+        ...anterior,
+        estado: 'completada',
+        completed_at: ahora(),
+        nombre_firmante: data.nombre_firmante,
+        notas_internas: data.notas_internas,
+        tiene_firma: !!data.firma_cliente
+      }),
+      () => request(`/visitas/${id}/completar`, {
+        method: 'PATCH',
+        body: JSON.stringify(data)
+      })
+    );
+  },
+
+  // Imagen de la firma (visita.firma_hash) como Blob. Es inmutable, así que
+  // aquí sí se deja actuar a la caché HTTP del navegador
+  async firma(firmaHash) {
+    const token = getToken();
+    const response = await fetch(`${API_URL}/firmas/${firmaHash}`, {
+      headers: token ? { 'Authorization': `Bearer ${token}` } : {}
     });
+    if (!response.ok) {
+      throw new Error('No se pudo cargar la firma');
+    }
+    return response.blob();
+  },
+
+  // Parte de trabajo en PDF (solo visitas completadas), con la firma
+  async pdf(id) {
+    return requestBlob(`/visitas/${id}/pdf`);
   },
 
   async eliminar(id) {
-    return request(`/visitas/${id}`, {
-      method: 'DELETE'
-    });
+    return escribir('visitas', 'eliminar', { id }, () => null,
+      () => request(`/visitas/${id}`, {
+        method: 'DELETE'
+      })
+    );
   }
 };
 
 // ============ PRESUPUESTOS ============
 export const presupuestosService = {
   async listar(filtros = {}) {
-    const params = new URLSearchParams(filtros).toString();
-    return request(`/presupuestos${params ? `?${params}` : ''}`);
+    return listar('presupuestos', '/presupuestos', filtros);
+  },
+
+  paginas(filtros = {}) {
+    return paginasLocales('presupuestos', '/presupuestos', filtros);
   },
 
-  async porCliente(clienteId) {
-    return request(`/presupuestos/cliente/${clienteId}`);
+  async porCliente(clienteId, filtros = {}) {
+    const espejo = await espejoSincronizado();
+    return espejo
+      ? listarLocal(espejo, 'presupuestos', { ...filtros, cliente_id: clienteId })
+      : request(`/presupuestos/cliente/${clienteId}${buildQuery(filtros)}`);
   },
 
   async obtener(id) {
-    return request(`/presupuestos/${id}`);
+    return obtenerLocal('presupuestos', id);
   },
 
+  // Offline, el número lo asigna el servidor al subirlo
   async crear(presupuesto) {
-    return request('/presupuestos', {
-      method: 'POST',
-      body: JSON.stringify(presupuesto)
-    });
+    return escribir('presupuestos', 'crear', { datos: presupuesto },
+      (_, id, espejo) => conCliente(espejo, conTotales({
+        ...presupuesto, id, numero: 'Pendiente', estado: 'borrador', version: 1,
+        fecha_emision: ahora().slice(0, 10), created_at: ahora()
+      })),
+      () => request('/presupuestos', {
+        method: 'POST',
+        body: JSON.stringify(presupuesto)
+      })
+    );
+  },
+
+  // Lleva la `version` leída: si otro lo ha guardado antes, el servidor
+  // responde 409. Las líneas con `id` se conservan; las que faltan se borran.
+  // La copia local sube la versión para que otra edición offline encadene
+  async actualizar(id, presupuesto) {
+    return escribir('presupuestos', 'actualizar', { id, datos: presupuesto },
+      (anterior, _, espejo) => conCliente(espejo, conTotales({
+        ...anterior, ...presupuesto, version: presupuesto.version + 1
+      })),
+      () => request(`/presupuestos/${id}`, {
+        method: 'PUT',
+        body: JSON.stringify(presupuesto)
+      })
+    );
   },
 
   async cambiarEstado(id, estado) {
-    return request(`/presupuestos/${id}/estado?estado=${estado}`, {
-      method: 'PATCH'
-    });
+    return escribir('presupuestos', 'estado', { id, datos: { estado } },
+      (anterior) => ({ ...anterior, estado }),
+      () => request(`/presupuestos/${id}/estado?estado=${estado}`, {
+        method: 'PATCH'
+      })
+    );
+  },
+
+  async pdf(id) {
+    return requestBlob(`/presupuestos/${id}/pdf`);
   },
 
   async eliminar(id) {
-    return request(`/presupuestos/${id}`, {
-      method: 'DELETE'
-    });
+    return escribir('presupuestos', 'eliminar', { id }, () => null,
+      () => request(`/presupuestos/${id}`, {
+        method: 'DELETE'
+      })
+    );
   },
 
   async estadisticas() {
@@ -200,6 +660,28 @@ export const presupuestosService = {
   }
 };
 
+// ============ BÚSQUEDA ============
+export const busquedaService = {
+  // Resultados agrupados en { clientes, visitas, presupuestos }. Cada palabra
+  // cuenta como prefijo, así que sirve para buscar mientras se escribe
+  async buscar(q, { tipos, limite } = {}) {
+    return request(`/buscar${buildQuery({ q, tipos: tipos?.join(','), limite })}`);
+  }
+};
+
+// ============ ANALÍTICA ============
+export const analiticaService = {
+  // Filtros: { desde, hasta, agrupar: 'dia' | 'mes', por }. Sin fechas, los
+  // últimos 12 meses agrupados por mes
+  async presupuestos(filtros = {}) {
+    return request(`/analitica/presupuestos${buildQuery(filtros)}`);
+  },
+
+  async visitas(filtros = {}) {
+    return request(`/analitica/visitas${buildQuery(filtros)}`);
+  }
+};
+
 // ============ DASHBOARD ============
 export const dashboardService = {
   async obtener() {
@@ -212,5 +694,8 @@ export default {
   clientes: clientesService,
   visitas: visitasService,
   presupuestos: presupuestosService,
-  dashboard: dashboardService
+  busqueda: busquedaService,
+  analitica: analiticaService,
+  dashboard: dashboardService,
+  sync: syncService
 };
@@ -0,0 +1,139 @@
+// Copia local (IndexedDB) de clientes, visitas y presupuestos para trabajar sin
+// cobertura. Se mantiene al día con los cambios de /api/sync y guarda en una
+// cola las escrituras hechas offline hasta poder subirlas.
+//
+// Una base de datos por usuario con un almacén por tabla (clave `id`), `meta`
+// (cursor de sincronización y contador de ids locales) y `cola` (operaciones
+// pendientes en orden). Los registros creados offline llevan un id local
+// negativo hasta que el servidor les asigna el suyo.
+
+export const TABLAS = ['clientes', 'visitas', 'presupuestos'];
+
+const DB_VERSION = 1;
+const conexiones = new Map();
+
+const promesa = (peticion) => new Promise((resolve, reject) => {
+  peticion.onsuccess = () => resolve(peticion.result);
+  peticion.onerror = () => reject(peticion.error);
+});
+
+export const disponible = () => typeof indexedDB !== 'undefined';
+
+function abrir(usuarioId) {
+  if (!conexiones.has(usuarioId)) {
+    const peticion = indexedDB.open(`tecnigestion-${usuarioId}`, DB_VERSION);
+    peticion.onupgradeneeded = () => {
+      const db = peticion.result;
+      TABLAS.forEach(tabla => db.createObjectStore(tabla, { keyPath: 'id' }));
+      db.createObjectStore('meta');
+      db.createObjectStore('cola', { keyPath: 'orden', autoIncrement: true });
+    };
+    const conexion = promesa(peticion);
+    // Si falla (modo privado...), el siguiente intento vuelve a abrirla
+    conexion.catch(() => conexiones.delete(usuarioId));
+    conexiones.set(usuarioId, conexion);
+  }
+  return conexiones.get(usuarioId);
+}
+
+// Ejecuta fn(almacenes) en una transacción y resuelve al confirmarse con lo
+// que devuelva fn (puede ser una promesa de una petición de la transacción)
+async function transaccion(usuarioId, nombres, modo, fn) {
+  const db = await abrir(usuarioId);
+  const tx = db.transaction(nombres, modo);
+  const almacenes = Object.fromEntries(nombres.map(nombre => [nombre, tx.objectStore(nombre)]));
+  const resultado = fn(almacenes);
+  await new Promise((resolve, reject) => {
+    tx.oncomplete = resolve;
+    tx.onerror = () => reject(tx.error);
+    tx.onabort = () => reject(tx.error);
+  });
+  return resultado;
+}
+
+export function crearEspejo(usuarioId) {
+  return {
+    async cursor() {
+      return transaccion(usuarioId, ['meta'], 'readonly', ({ meta }) => promesa(meta.get('cursor')));
+    },
+
+    // La copia está lista cuando ha completado al menos una sincronización
+    async listo() {
+      return (await this.cursor()) !== undefined;
+    },
+
+    async todos(tabla) {
+      return transaccion(usuarioId, [tabla], 'readonly', almacenes => promesa(almacenes[tabla].getAll()));
+    },
+
+    async obtener(tabla, id) {
+      return transaccion(usuarioId, [tabla], 'readonly', almacenes => promesa(almacenes[tabla].get(id)));
+    },
+
+    async guardar(tabla, registro) {
+      return transaccion(usuarioId, [tabla], 'readwrite', almacenes => { almacenes[tabla].put(registro); });
+    },
+
+    async borrar(tabla, id) {
+      return transaccion(usuarioId, [tabla], 'readwrite', almacenes => { almacenes[tabla].delete(id); });
+    },
+
+    // Una página de /api/sync, entera o nada: registros, bajas y cursor
+    async aplicarCambios(cambios) {
+      return transaccion(usuarioId, [...TABLAS, 'meta'], 'readwrite', almacenes => {
+        TABLAS.forEach(tabla => {
+          if (cambios.reiniciar) almacenes[tabla].clear();
+          cambios[tabla].forEach(registro => almacenes[tabla].put(registro));
+          cambios.borrados[tabla].forEach(id => almacenes[tabla].delete(id));
+        });
+        almacenes.meta.put(cambios.cursor, 'cursor');
+      });
+    },
+
+    async nuevoIdLocal() {
+      return transaccion(usuarioId, ['meta'], 'readwrite', ({ meta }) => {
+        const peticion = meta.get('ultimoIdLocal');
+        return new Promise(resolve => {
+          peticion.onsuccess = () => {
+            const id = (peticion.result ?? 0) - 1;
+            meta.put(id, 'ultimoIdLocal');
+            resolve(id);
+          };
+        });
+      });
+    },
+
+    async encolar(operacion) {
+      return transaccion(usuarioId, ['cola'], 'readwrite', ({ cola }) => { cola.add(operacion); });
+    },
+
+    async cola() {
+      return transaccion(usuarioId, ['cola'], 'readonly', ({ cola }) => promesa(cola.getAll()));
+    },
+
+    // Quita de la cola las operaciones ya procesadas y sustituye en las que
+    // quedan (y en la copia) los ids locales por los asignados: { local: real }
+    async confirmar(ordenes, ids) {
+      const reales = new Map(Object.entries(ids).map(([local, real]) => [Number(local), real]));
+      const traducir = (id) => reales.get(id) ?? id;
+      return transaccion(usuarioId, [...TABLAS, 'cola'], 'readwrite', almacenes => {
+        ordenes.forEach(orden => almacenes.cola.delete(orden));
+        almacenes.cola.openCursor().onsuccess = (evento) => {
+          const fila = evento.target.result;
+          if (!fila) return;
+          const operacion = fila.value;
+          if (reales.has(operacion.id) || reales.has(operacion.datos?.cliente_id)) {
+            fila.update({
+              ...operacion,
+              id: traducir(operacion.id),
+              datos: operacion.datos?.cliente_id ? { ...operacion.datos, cliente_id: traducir(operacion.datos.cliente_id) } : operacion.datos
+            });
+          }
+          fila.continue();
+        };
+        // El registro con el id real llega en la siguiente bajada de cambios
+        TABLAS.forEach(tabla => reales.forEach((_, local) => almacenes[tabla].delete(local)));
+      });
+    }
+  };
+}